@@ -15,11 +15,12 @@ from flask import (
     redirect,
 )
 from flask_babel import lazy_gettext as _
-from sqlalchemy.sql import func
-from sqlalchemy.sql.expression import desc, nullslast, and_, distinct, select, join
+from sqlalchemy.sql.expression import desc, nullslast
 
+from api.admin.dashboard_stats import DashboardStatistics
 from api.admin.exceptions import *
 from api.admin.google_oauth_admin_authentication_provider import GoogleOAuthAdminAuthenticationProvider
+from api.admin.lane_size_updater import LaneSizeUpdater
 from api.admin.opds import AdminAnnotator, AdminFeed
 from api.admin.password_admin_authentication_provider import PasswordAdminAuthenticationProvider
 from api.admin.template_styles import *
@@ -28,6 +29,7 @@ from api.admin.validator import Validator
 from api.adobe_vendor_id import AuthdataUtility
 from api.authenticator import (
     CannotCreateLocalPatron,
+    PatronAuthenticationCache,
     PatronData,
 )
 from api.authenticator import LibraryAuthenticator
@@ -70,12 +72,9 @@ from core.model import (
     CustomListEntry,
     DataSource,
     ExternalIntegration,
-    Hold,
     Identifier,
     Library,
     LicensePool,
-    Loan,
-    Patron,
     Timestamp,
     Work,
 )
@@ -612,6 +611,10 @@ class PatronController(AdminCirculationManagerController):
         # Wipe the Patron's 'identifier for Adobe ID purposes'.
         for credential in AuthdataUtility.adobe_relevant_credentials(patron):
             self._db.delete(credential)
+
+        # The next time the patron makes a request, their credentials
+        # will be checked with the ILS.
+        PatronAuthenticationCache.invalidate_patron(patron.id)
         if patron.username:
             identifier = patron.username
         else:
@@ -712,6 +715,144 @@ class CustomListsController(AdminCirculationManagerController):
         work = query.one()
         return work
 
+    def _get_works_from_urns(self, library, urns):
+        """Find the Works for a number of URNs at once.
+
+        :return: A dictionary mapping URNs to Works. A URN that doesn't
+            identify a Work in one of the library's collections is left
+            out.
+        """
+        identifiers_by_urn, failures = Identifier.parse_urns(
+            self._db, urns, autocreate=False
+        )
+        if not identifiers_by_urn:
+            return {}
+        urns_by_identifier_id = dict(
+            (identifier.id, urn)
+            for urn, identifier in identifiers_by_urn.items()
+        )
+        query = self._db.query(
+            LicensePool.identifier_id, Work
+        ).join(
+            Work, LicensePool.work_id==Work.id
+        ).filter(
+            LicensePool.identifier_id.in_(urns_by_identifier_id.keys())
+        ).filter(
+            LicensePool.collection_id.in_(
+                [c.id for c in library.all_collections]
+            )
+        )
+        works_by_urn = dict()
+        for identifier_id, work in query:
+            works_by_urn[urns_by_identifier_id[identifier_id]] = work
+        return works_by_urn
+
+    def _update_entries(self, list, works, deleted_works):
+        """Bring a custom list's entries up to date.
+
+        The list's current entries are loaded once and compared with
+        the submitted works, rather than looking up each work's entry
+        separately. New entries are inserted in a single flush, and
+        removed entries are deleted with a single query.
+
+        :param works: Works that should be on the list, as featured
+            titles.
+        :param deleted_works: Works that should be taken off the list.
+        :return: True if any works were added or removed.
+        """
+        now = datetime.utcnow()
+        existing = self._db.query(CustomListEntry).filter(
+            CustomListEntry.list_id==list.id
+        ).all()
+        entries_by_work_id = dict()
+        entries_by_edition_id = dict()
+        for entry in existing:
+            if entry.work_id:
+                entries_by_work_id.setdefault(entry.work_id, []).append(entry)
+            if entry.edition_id:
+                entries_by_edition_id.setdefault(
+                    entry.edition_id, []
+                ).append(entry)
+
+        def entries_for(work):
+            entries = entries_by_work_id.get(work.id, []) + [
+                x for x in entries_by_edition_id.get(
+                    work.presentation_edition_id, []
+                ) if x.work_id != work.id
+            ]
+            return entries
+
+        changed_works = set()
+        kept_entry_ids = set()
+        for work in works:
+            if work in changed_works:
+                # This work was submitted twice.
+                continue
+            entries = entries_for(work)
+            if entries:
+                kept_entry_ids.update(x.id for x in entries)
+                continue
+            entry = CustomListEntry(
+                customlist=list, work=work, edition=work.presentation_edition,
+                featured=True, first_appearance=now,
+                most_recent_appearance=now
+            )
+            self._db.add(entry)
+            entries_by_work_id[work.id] = [entry]
+            changed_works.add(work)
+
+        # Insert the new entries all at once, so that a work that's
+        # both added and deleted can be deleted below.
+        self._db.flush()
+
+        if kept_entry_ids:
+            # Works that were already on the list are now featured
+            # and have just been seen on the list again.
+            self._db.query(CustomListEntry).filter(
+                CustomListEntry.id.in_(kept_entry_ids)
+            ).update(
+                dict(featured=True, most_recent_appearance=now),
+                synchronize_session='fetch'
+            )
+        added = len(changed_works)
+
+        doomed = dict()
+        for work in deleted_works:
+            for entry in entries_for(work):
+                if entry.id not in doomed:
+                    doomed[entry.id] = entry
+                    changed_works.add(work)
+        if doomed:
+            self._db.query(CustomListEntry).filter(
+                CustomListEntry.id.in_(doomed.keys())
+            ).delete(synchronize_session=False)
+            for entry in doomed.values():
+                self._db.expunge(entry)
+            self._db.expire(list, ['entries'])
+            for work in changed_works:
+                self._db.expire(work, ['custom_list_entries'])
+
+        if not changed_works:
+            return False
+
+        list.size = (list.size or 0) + added - len(doomed)
+
+        # The works' search documents need to reflect their new list
+        # membership.
+        for work in changed_works:
+            work.external_index_needs_updating()
+        return True
+
+    def _update_lane_sizes(self, lanes):
+        """Update the sizes of lanes affected by a change to a custom
+        list, in the background.
+        """
+        updater = LaneSizeUpdater(
+            self._db, self.search_engine,
+            asynchronous=not self.manager.testing
+        )
+        updater.update(lanes)
+
     def _create_or_update_list(self, library, name, entries, collections, deletedEntries=None, id=None):
         data_source = DataSource.lookup(self._db, DataSource.LIBRARY_STAFF)
 
@@ -735,31 +876,20 @@ class CustomListsController(AdminCirculationManagerController):
 
         list.updated = datetime.now()
         list.name = name
-        membership_change = False
 
-        for entry in entries:
-            urn = entry.get("id")
-            work = self._get_work_from_urn(library, urn)
-
-            if work:
-                entry, entry_is_new = list.add_entry(work, featured=True)
-                if entry_is_new:
-                    membership_change = True
-
-        if deletedEntries:
-            for entry in deletedEntries:
-                urn = entry.get("id")
-                work = self._get_work_from_urn(library, urn)
-
-                if work:
-                    list.remove_entry(work)
-                    membership_change = True
+        urns = [entry.get("id") for entry in entries]
+        deleted_urns = [entry.get("id") for entry in (deletedEntries or [])]
+        works_by_urn = self._get_works_from_urns(library, urns + deleted_urns)
+        works = [works_by_urn[urn] for urn in urns if urn in works_by_urn]
+        deleted_works = [
+            works_by_urn[urn] for urn in deleted_urns if urn in works_by_urn
+        ]
+        membership_change = self._update_entries(list, works, deleted_works)
 
         if membership_change:
             # If this list was used to populate any lanes, those
             # lanes need to have their counts updated.
-            for lane in Lane.affected_by_customlist(list):
-                lane.update_size(self._db, self.search_engine)
+            self._update_lane_sizes(Lane.affected_by_customlist(list))
 
         new_collections = []
         for collection_id in collections:
@@ -855,8 +985,7 @@ class CustomListsController(AdminCirculationManagerController):
             self._db.flush()
             # Update the size for any lanes affected by this
             # CustomList which _weren't_ deleted.
-            for lane in surviving_lanes:
-                lane.update_size(self._db, self.search_engine)
+            self._update_lane_sizes(surviving_lanes)
             return Response(unicode(_("Deleted")), 200)
 
 
@@ -1018,65 +1147,70 @@ class LanesController(AdminCirculationManagerController):
 class DashboardController(AdminCirculationManagerController):
 
     def stats(self):
+        """Summarize circulation and inventory for the libraries and
+        collections the admin can see.
+
+        Counts come from the stored DashboardStatistics where
+        available. Pass `live=true` to recalculate (and store) every
+        count instead.
+        """
+        live = flask.request.args.get("live", "").lower() == "true"
+        now = datetime.utcnow()
+
+        stored = dict()
+        if not live:
+            for stats in self._db.query(DashboardStatistics):
+                if stats.library_id:
+                    stored[(Library, stats.library_id)] = stats
+                else:
+                    stored[(Collection, stats.collection_id)] = stats
+
+        def counts_for(model, item):
+            """Find the counts for a library or collection, and the
+            time they were calculated.
+            """
+            stats = stored.get((model, item.id))
+            if stats:
+                return stats.counts, stats.updated_at
+            if model is Library:
+                if live:
+                    stats = DashboardStatistics.refresh_library(
+                        self._db, item, now
+                    )
+                    return stats.counts, now
+                return DashboardStatistics.library_counts(self._db, item), now
+            if live:
+                stats = DashboardStatistics.refresh_collection(
+                    self._db, item, now
+                )
+                return stats.counts, now
+            return DashboardStatistics.collection_counts(self._db, item), now
+
+        def isoformat(updated_at):
+            return updated_at.isoformat() + "Z"
+
         library_stats = {}
 
         total_title_count = 0
         total_license_count = 0
         total_available_license_count = 0
+        oldest_update = now
 
         collection_counts = dict()
+        collection_updates = dict()
         for collection in self._db.query(Collection):
             if not flask.request.admin or not flask.request.admin.can_see_collection(collection):
                 continue
 
-            licensed_title_count = self._db.query(
-                LicensePool
-            ).filter(
-                LicensePool.collection_id == collection.id
-            ).filter(
-                and_(
-                    LicensePool.licenses_owned > 0,
-                    LicensePool.open_access == False,
-                )
-            ).count()
-
-            open_title_count = self._db.query(
-                LicensePool
-            ).filter(
-                LicensePool.collection_id == collection.id
-            ).filter(
-                LicensePool.open_access == True
-            ).count()
+            counts, updated_at = counts_for(Collection, collection)
+            oldest_update = min(oldest_update, updated_at)
 
-            # The sum queries return None instead of 0 if there are
-            # no license pools in the db.
+            total_title_count += counts["licensed_titles"] + counts["open_access_titles"]
+            total_license_count += counts["licenses"]
+            total_available_license_count += counts["available_licenses"]
 
-            license_count = self._db.query(
-                func.sum(LicensePool.licenses_owned)
-            ).filter(
-                LicensePool.collection_id == collection.id
-            ).filter(
-                LicensePool.open_access == False,
-            ).all()[0][0] or 0
-
-            available_license_count = self._db.query(
-                func.sum(LicensePool.licenses_available)
-            ).filter(
-                LicensePool.collection_id == collection.id
-            ).filter(
-                LicensePool.open_access == False,
-            ).all()[0][0] or 0
-
-            total_title_count += licensed_title_count + open_title_count
-            total_license_count += license_count
-            total_available_license_count += available_license_count
-
-            collection_counts[collection.name] = dict(
-                licensed_titles=licensed_title_count,
-                open_access_titles=open_title_count,
-                licenses=license_count,
-                available_licenses=available_license_count,
-            )
+            collection_counts[collection.name] = counts
+            collection_updates[collection.name] = updated_at
 
 
         for library in self._db.query(Library):
@@ -1084,74 +1218,8 @@ class DashboardController(AdminCirculationManagerController):
             if not flask.request.admin or not flask.request.admin.is_librarian(library):
                 continue
 
-            patron_count = self._db.query(Patron).filter(Patron.library_id==library.id).count()
-
-            active_loans_patron_count = self._db.query(
-                distinct(Patron.id)
-            ).join(
-                Patron.loans
-            ).filter(
-                Loan.end >= datetime.now(),
-            ).filter(
-                Patron.library_id == library.id
-            ).count()
-
-            active_patrons = select(
-                [Patron.id]
-            ).select_from(
-                join(
-                    Loan,
-                    Patron,
-                    and_(
-                        Patron.id == Loan.patron_id,
-                        Patron.library_id == library.id,
-                        Loan.id != None,
-                        Loan.end >= datetime.now()
-                    )
-                )
-            ).union(
-                select(
-                    [Patron.id]
-                ).select_from(
-                    join(
-                        Hold,
-                        Patron,
-                        and_(
-                            Patron.id == Hold.patron_id,
-                            Patron.library_id == library.id,
-                            Hold.id != None,
-                        )
-                    )
-                )
-            ).alias()
-
-
-            active_loans_or_holds_patron_count_query = select(
-                [func.count(distinct(active_patrons.c.id))]
-            ).select_from(
-                active_patrons
-            )
-
-            result = self._db.execute(active_loans_or_holds_patron_count_query)
-            active_loans_or_holds_patron_count = [r[0] for r in result][0]
-
-            loan_count = self._db.query(
-                Loan
-            ).join(
-                Loan.patron
-            ).filter(
-                Patron.library_id == library.id
-            ).filter(
-                Loan.end >= datetime.now()
-            ).count()
-
-            hold_count = self._db.query(
-                Hold
-            ).join(
-                Hold.patron
-            ).filter(
-                Patron.library_id == library.id
-            ).count()
+            patron_counts, updated_at = counts_for(Library, library)
+            oldest_update = min(oldest_update, updated_at)
 
             title_count = 0
             license_count = 0
@@ -1160,25 +1228,21 @@ class DashboardController(AdminCirculationManagerController):
             library_collection_counts = dict()
             for collection in library.all_collections:
                 counts = collection_counts[collection.name]
+                updated_at = min(updated_at, collection_updates[collection.name])
                 library_collection_counts[collection.name] = counts
                 title_count += counts.get("licensed_titles", 0) + counts.get("open_access_titles", 0)
                 license_count += counts.get("licenses", 0)
                 available_license_count += counts.get("available_licenses", 0)
 
             library_stats[library.short_name] = dict(
-                patrons=dict(
-                    total=patron_count,
-                    with_active_loans=active_loans_patron_count,
-                    with_active_loans_or_holds=active_loans_or_holds_patron_count,
-                    loans=loan_count,
-                    holds=hold_count,
-                ),
+                patrons=patron_counts,
                 inventory=dict(
                     titles=title_count,
                     licenses=license_count,
                     available_licenses=available_license_count,
                 ),
                 collections=library_collection_counts,
+                updated_at=isoformat(updated_at),
             )
 
         total_patrons = sum([
@@ -1214,6 +1278,7 @@ class DashboardController(AdminCirculationManagerController):
                 available_licenses=total_available_license_count,
             ),
             collections=collection_counts,
+            updated_at=isoformat(oldest_update),
         )
 
         return library_stats
@@ -1274,12 +1339,17 @@ class DashboardController(AdminCirculationManagerController):
         library = getattr(flask.request, 'library', None)
         library_short_name = library.short_name if library else None
 
+        # If requested, the CSV file will be gzipped as it's generated.
+        compress = flask.request.args.get("gzip", "").lower() == "true"
+
         analytics_exporter = analytics_exporter or LocalAnalyticsExporter()
-        data = analytics_exporter.export(
-            self._db, date_start, date_end, locations, library
+        data = analytics_exporter.stream(
+            self._db, date_start, date_end, locations, library,
+            compress=compress
         )
         return (data, date_start.strftime(date_format),
-                date_end_label.strftime(date_format), library_short_name)
+                date_end_label.strftime(date_format), library_short_name,
+                compress)
 
 class SettingsController(AdminCirculationManagerController):
 
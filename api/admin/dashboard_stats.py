@@ -0,0 +1,294 @@
+"""Precomputed statistics for the admin dashboard.
+
+Counting patrons, loans, holds and licenses means running aggregate
+queries over some of the biggest tables in the database. Rather than
+run them every time an admin opens the dashboard, we store the counts
+for each library and each collection in a DashboardStatistics row.
+
+Circulation events mark the affected rows as stale, and the
+DashboardStatisticsMonitor recalculates stale (and old) rows.
+"""
+import datetime
+
+from nose.tools import set_trace
+from sqlalchemy import (
+    Boolean,
+    Column,
+    DateTime,
+    ForeignKey,
+    Integer,
+)
+from sqlalchemy.sql import func
+from sqlalchemy.sql.expression import (
+    and_,
+    distinct,
+    join,
+    or_,
+    select,
+)
+
+from core.model import (
+    Base,
+    Hold,
+    LicensePool,
+    Loan,
+    Patron,
+    get_one_or_create,
+)
+
+
+class DashboardStatistics(Base):
+    """Stored circulation and inventory counts for a single library or
+    a single collection.
+    """
+
+    __tablename__ = "dashboardstatistics"
+
+    id = Column(Integer, primary_key=True)
+
+    # Exactly one of these is set.
+    library_id = Column(
+        Integer, ForeignKey('libraries.id'), index=True, unique=True,
+        nullable=True
+    )
+    collection_id = Column(
+        Integer, ForeignKey('collections.id'), index=True, unique=True,
+        nullable=True
+    )
+
+    # Library statistics.
+    patrons = Column(Integer, default=0)
+    patrons_with_active_loans = Column(Integer, default=0)
+    patrons_with_active_loans_or_holds = Column(Integer, default=0)
+    loans = Column(Integer, default=0)
+    holds = Column(Integer, default=0)
+
+    # Collection statistics.
+    licensed_titles = Column(Integer, default=0)
+    open_access_titles = Column(Integer, default=0)
+    licenses = Column(Integer, default=0)
+    available_licenses = Column(Integer, default=0)
+
+    # When the counts were calculated.
+    updated_at = Column(DateTime, index=True)
+
+    # Set when something has happened that might have changed the
+    # counts since they were calculated.
+    stale = Column(Boolean, default=False, index=True)
+
+    LIBRARY_FIELDS = [
+        ('total', 'patrons'),
+        ('with_active_loans', 'patrons_with_active_loans'),
+        ('with_active_loans_or_holds', 'patrons_with_active_loans_or_holds'),
+        ('loans', 'loans'),
+        ('holds', 'holds'),
+    ]
+
+    COLLECTION_FIELDS = [
+        ('licensed_titles', 'licensed_titles'),
+        ('open_access_titles', 'open_access_titles'),
+        ('licenses', 'licenses'),
+        ('available_licenses', 'available_licenses'),
+    ]
+
+    def __repr__(self):
+        if self.library_id:
+            scope = "library=%s" % self.library_id
+        else:
+            scope = "collection=%s" % self.collection_id
+        return "<DashboardStatistics %s updated_at=%s stale=%s>" % (
+            scope, self.updated_at, self.stale
+        )
+
+    @property
+    def counts(self):
+        """The stored counts, in the form used by
+        DashboardController.stats.
+        """
+        if self.library_id:
+            fields = self.LIBRARY_FIELDS
+        else:
+            fields = self.COLLECTION_FIELDS
+        return dict(
+            (key, getattr(self, attr) or 0) for key, attr in fields
+        )
+
+    @classmethod
+    def library_counts(cls, _db, library):
+        """Calculate patron, loan and hold counts for a library."""
+        now = datetime.datetime.now()
+        patron_count = _db.query(Patron).filter(
+            Patron.library_id==library.id
+        ).count()
+
+        active_loans_patron_count = _db.query(
+            distinct(Patron.id)
+        ).join(
+            Patron.loans
+        ).filter(
+            Loan.end >= now,
+        ).filter(
+            Patron.library_id == library.id
+        ).count()
+
+        active_patrons = select(
+            [Patron.id]
+        ).select_from(
+            join(
+                Loan,
+                Patron,
+                and_(
+                    Patron.id == Loan.patron_id,
+                    Patron.library_id == library.id,
+                    Loan.id != None,
+                    Loan.end >= now
+                )
+            )
+        ).union(
+            select(
+                [Patron.id]
+            ).select_from(
+                join(
+                    Hold,
+                    Patron,
+                    and_(
+                        Patron.id == Hold.patron_id,
+                        Patron.library_id == library.id,
+                        Hold.id != None,
+                    )
+                )
+            )
+        ).alias()
+
+        active_loans_or_holds_patron_count_query = select(
+            [func.count(distinct(active_patrons.c.id))]
+        ).select_from(
+            active_patrons
+        )
+
+        result = _db.execute(active_loans_or_holds_patron_count_query)
+        active_loans_or_holds_patron_count = [r[0] for r in result][0]
+
+        loan_count = _db.query(
+            Loan
+        ).join(
+            Loan.patron
+        ).filter(
+            Patron.library_id == library.id
+        ).filter(
+            Loan.end >= now
+        ).count()
+
+        hold_count = _db.query(
+            Hold
+        ).join(
+            Hold.patron
+        ).filter(
+            Patron.library_id == library.id
+        ).count()
+
+        return dict(
+            total=patron_count,
+            with_active_loans=active_loans_patron_count,
+            with_active_loans_or_holds=active_loans_or_holds_patron_count,
+            loans=loan_count,
+            holds=hold_count,
+        )
+
+    @classmethod
+    def collection_counts(cls, _db, collection):
+        """Calculate title and license counts for a collection."""
+        licensed_title_count = _db.query(
+            LicensePool
+        ).filter(
+            LicensePool.collection_id == collection.id
+        ).filter(
+            and_(
+                LicensePool.licenses_owned > 0,
+                LicensePool.open_access == False,
+            )
+        ).count()
+
+        open_title_count = _db.query(
+            LicensePool
+        ).filter(
+            LicensePool.collection_id == collection.id
+        ).filter(
+            LicensePool.open_access == True
+        ).count()
+
+        # The sum queries return None instead of 0 if there are
+        # no license pools in the db.
+
+        license_count = _db.query(
+            func.sum(LicensePool.licenses_owned)
+        ).filter(
+            LicensePool.collection_id == collection.id
+        ).filter(
+            LicensePool.open_access == False,
+        ).all()[0][0] or 0
+
+        available_license_count = _db.query(
+            func.sum(LicensePool.licenses_available)
+        ).filter(
+            LicensePool.collection_id == collection.id
+        ).filter(
+            LicensePool.open_access == False,
+        ).all()[0][0] or 0
+
+        return dict(
+            licensed_titles=licensed_title_count,
+            open_access_titles=open_title_count,
+            licenses=license_count,
+            available_licenses=available_license_count,
+        )
+
+    @classmethod
+    def refresh_library(cls, _db, library, now=None):
+        """Recalculate and store the statistics for a library.
+
+        :return: The DashboardStatistics row.
+        """
+        counts = cls.library_counts(_db, library)
+        stats, is_new = get_one_or_create(_db, cls, library_id=library.id)
+        stats._set(cls.LIBRARY_FIELDS, counts, now)
+        return stats
+
+    @classmethod
+    def refresh_collection(cls, _db, collection, now=None):
+        """Recalculate and store the statistics for a collection.
+
+        :return: The DashboardStatistics row.
+        """
+        counts = cls.collection_counts(_db, collection)
+        stats, is_new = get_one_or_create(
+            _db, cls, collection_id=collection.id
+        )
+        stats._set(cls.COLLECTION_FIELDS, counts, now)
+        return stats
+
+    def _set(self, fields, counts, now):
+        for key, attr in fields:
+            setattr(self, attr, counts[key])
+        self.updated_at = now or datetime.datetime.utcnow()
+        self.stale = False
+
+    @classmethod
+    def mark_stale(cls, _db, library=None, collection_id=None):
+        """Note that the statistics for a library and/or a collection
+        may have changed.
+
+        This is a single UPDATE that doesn't touch rows that are
+        already stale, so it's cheap enough to call on every
+        circulation event.
+        """
+        clauses = []
+        if library is not None:
+            clauses.append(cls.library_id==library.id)
+        if collection_id is not None:
+            clauses.append(cls.collection_id==collection_id)
+        if not clauses:
+            return
+        _db.query(cls).filter(or_(*clauses)).filter(
+            cls.stale==False
+        ).update(dict(stale=True), synchronize_session='fetch')
@@ -0,0 +1,170 @@
+"""Update the sizes of lanes without making an admin wait for it.
+
+Finding out how many works are in a lane means asking the search
+engine, once per lane. Editing a custom list can affect a lot of
+lanes, and the new sizes won't change much until the list's works
+have been reindexed anyway, so the lanes are queued and their sizes
+are updated in the background.
+"""
+import logging
+import os
+import threading
+from Queue import (
+    Full,
+    Queue,
+)
+
+from nose.tools import set_trace
+from sqlalchemy import event
+
+from core.lane import Lane
+from core.model import Session
+
+
+class LaneSizeUpdater(object):
+
+    log = logging.getLogger("Lane size updater")
+
+    # Queue up to this many lanes at once. If more lanes than this
+    # are waiting, the rest will be updated by the update_lane_size
+    # script.
+    QUEUE_SIZE = 1000
+
+    # A thread can't be shared with a forked process, so each process
+    # has its own queue and worker thread.
+    _queue = None
+    _queue_pid = None
+    _pending = set()
+    _lock = threading.Lock()
+
+    # Lanes waiting for a database session to commit are kept in
+    # the session's info dictionary under this key.
+    SESSION_INFO_KEY = 'lane_size_updater'
+
+    def __init__(self, _db, search_engine, asynchronous=True):
+        """Constructor.
+
+        :param _db: A database session.
+        :param search_engine: An ExternalSearchIndex to ask about
+            the size of each lane.
+        :param asynchronous: If this is False, lane sizes are updated
+            right away, in the given database session.
+        """
+        self._db = _db
+        self.search_engine = search_engine
+        self.asynchronous = asynchronous
+
+    def update(self, lanes):
+        """Update the sizes of the given lanes, now or later.
+
+        If the sizes are updated later, the lanes aren't queued until
+        the current transaction is committed. Until then, a separate
+        database session would see the lanes as they were before
+        this change.
+        """
+        if not self.asynchronous:
+            for lane in lanes:
+                lane.update_size(self._db, self.search_engine)
+            return
+        if not lanes:
+            return
+
+        _db = Session.object_session(lanes[0])
+        info = _db.info.setdefault(
+            self.SESSION_INFO_KEY, dict(lane_ids=set())
+        )
+        info['bind'] = _db.get_bind()
+        info['search_engine'] = self.search_engine
+        info['lane_ids'].update(lane.id for lane in lanes)
+        if not info.get('listening'):
+            event.listen(_db, 'after_commit', self.session_committed)
+            event.listen(_db, 'after_rollback', self.session_rolled_back)
+            info['listening'] = True
+
+    @classmethod
+    def session_committed(cls, _db):
+        info = _db.info.get(cls.SESSION_INFO_KEY)
+        if not info or not info['lane_ids']:
+            return
+        lane_ids = info['lane_ids']
+        info['lane_ids'] = set()
+        cls.queue(info['bind'], info['search_engine'], lane_ids)
+
+    @classmethod
+    def session_rolled_back(cls, _db):
+        # The changes that affected these lanes never happened.
+        info = _db.info.get(cls.SESSION_INFO_KEY)
+        if info:
+            info['lane_ids'] = set()
+
+    @classmethod
+    def queue(cls, bind, search_engine, lane_ids):
+        """Queue lanes to have their sizes updated by the worker thread."""
+        queue = cls.worker_queue()
+        for lane_id in lane_ids:
+            with cls._lock:
+                if lane_id in cls._pending:
+                    # This lane is already waiting to be updated.
+                    continue
+                cls._pending.add(lane_id)
+            try:
+                queue.put_nowait((bind, search_engine, lane_id))
+            except Full:
+                with cls._lock:
+                    cls._pending.discard(lane_id)
+                cls.log.warn(
+                    "Too many lanes waiting to be updated, not queueing lane %s.",
+                    lane_id
+                )
+
+    @classmethod
+    def worker_queue(cls):
+        """Find or create the queue for this process, starting the
+        thread that works through it.
+        """
+        pid = os.getpid()
+        with cls._lock:
+            if not cls._queue or cls._queue_pid != pid:
+                cls._queue = Queue(cls.QUEUE_SIZE)
+                cls._queue_pid = pid
+                cls._pending = set()
+                thread = threading.Thread(
+                    target=cls.process_queue, args=(cls._queue,),
+                    name="Lane size updater"
+                )
+                thread.daemon = True
+                thread.start()
+            return cls._queue
+
+    @classmethod
+    def process_queue(cls, queue):
+        while True:
+            bind, search_engine, lane_id = queue.get()
+            with cls._lock:
+                # If the lane changes again while its size is being
+                # updated, it'll need to be updated again.
+                cls._pending.discard(lane_id)
+            try:
+                cls.update_lane(bind, search_engine, lane_id)
+            except Exception, e:
+                cls.log.error(
+                    "Could not update the size of lane %s", lane_id,
+                    exc_info=e
+                )
+            finally:
+                queue.task_done()
+
+    @classmethod
+    def update_lane(cls, bind, search_engine, lane_id):
+        """Update the size of one lane in its own database session."""
+        _db = Session(bind=bind)
+        try:
+            lane = _db.query(Lane).get(lane_id)
+            if lane:
+                lane.update_size(_db, search_engine)
+            _db.commit()
+        except Exception:
+            _db.rollback()
+            raise
+        finally:
+            _db.close()
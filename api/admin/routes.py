@@ -4,7 +4,8 @@ import flask
 from flask import (
     Response,
     redirect,
-    make_response
+    make_response,
+    stream_with_context,
 )
 import os
 
@@ -273,18 +274,26 @@ def genres():
 def bulk_circulation_events():
     """Returns a CSV representation of all circulation events with optional
     start and end times."""
-    data, date, date_end, library = app.manager.admin_dashboard_controller.bulk_circulation_events()
+    data, date, date_end, library, compressed = app.manager.admin_dashboard_controller.bulk_circulation_events()
     if isinstance(data, ProblemDetail):
         return data
 
-    response = make_response(data)
+    # The CSV file is streamed to the client as it's generated. The
+    # request context has to stay around until it's done, since the
+    # data is coming out of a database cursor.
+    response = Response(stream_with_context(data))
 
     # If gathering events per library, include the library name in the file
     # for convenience. The start and end dates will always be included.
     filename = library + "-" if library else ""
     filename += date + "-to-" + date_end if date_end and date != date_end else date
-    response.headers['Content-Disposition'] = "attachment; filename=circulation_events_" + filename + ".csv"
-    response.headers["Content-type"] = "text/csv"
+    filename = "circulation_events_" + filename + ".csv"
+    if compressed:
+        filename += ".gz"
+        response.headers["Content-type"] = "application/gzip"
+    else:
+        response.headers["Content-type"] = "text/csv"
+    response.headers['Content-Disposition'] = "attachment; filename=" + filename
     return response
 
 @library_route('/admin/circulation_events')
@@ -9,6 +9,7 @@ import datetime
 import jwt
 from jwt.algorithms import HMACAlgorithm
 import sys
+from expiringdict import ExpiringDict
 
 import flask
 from flask import Response
@@ -19,6 +20,7 @@ from config import (
 )
 from api.base_controller import BaseCirculationManagerController
 from problem_details import *
+from sqlalchemy import event
 from sqlalchemy.orm.session import Session
 from core.util.xmlparser import XMLParser
 from core.util.problem_detail import ProblemDetail
@@ -400,7 +402,7 @@ class AdobeVendorIDModel(object):
 
         # Look up or create a DelegatedPatronIdentifier using the
         # anonymized patron identifier we just looked up or created.
-        utility = AuthdataUtility.from_config(patron.library, self._db)
+        utility = AuthdataUtility.for_library(patron.library, self._db)
         return self.to_delegated_patron_identifier_uuid(
             utility.library_uri, adobe_account_id_patron_identifier_credential.credential,
             value_generator=new_value
@@ -460,7 +462,7 @@ class AdobeVendorIDModel(object):
             return None, None
 
         library_uri = foreign_patron_identifier = None
-        utility = AuthdataUtility.from_config(self.library, self._db)
+        utility = AuthdataUtility.for_library(self.library, self._db)
         if utility:
             # Hopefully this is an authdata JWT generated by another
             # library's circulation manager.
@@ -496,7 +498,7 @@ class AdobeVendorIDModel(object):
 
     def short_client_token_lookup(self, token, signature):
         """Validate a short client token that came in as username/password."""
-        utility = AuthdataUtility.from_config(self.library, self._db)
+        utility = AuthdataUtility.for_library(self.library, self._db)
         library_uri = foreign_patron_identifier = None
         if utility:
             # Hopefully this is a short client token generated by
@@ -672,9 +674,70 @@ class AuthdataUtility(object):
             self.secret
         )
 
+        # Prepare the keys used to check short client tokens from
+        # every library ahead of time, rather than once per token.
+        self.short_token_signing_keys_by_library_uri = dict(
+            (uri, self.short_token_signer.prepare_key(secret))
+            for uri, secret in self.secrets_by_library_uri.items()
+        )
+
     VENDOR_ID_KEY = u'vendor_id'
     OTHER_LIBRARIES_KEY = u'other_libraries'
 
+    # AuthdataUtility objects created by for_library() are kept around
+    # for this many seconds, unless the configuration changes first.
+    CACHE_MAX_AGE = 10 * 60
+    _cache = ExpiringDict(max_len=1000, max_age_seconds=CACHE_MAX_AGE)
+
+    # A change to any of these objects might change how an
+    # AuthdataUtility is configured.
+    CONFIGURATION_CLASSES = (ConfigurationSetting, ExternalIntegration, Library)
+
+    @classmethod
+    def for_library(cls, library, _db=None):
+        """Find a ready-to-use AuthdataUtility for the given library.
+
+        This works like from_config(), but the AuthdataUtility is
+        reused by every request this process handles for the library,
+        instead of being rebuilt from the database each time.
+
+        The cache is cleared whenever this process changes the
+        configuration, and whenever the CirculationManager reloads its
+        settings because another process changed the configuration.
+
+        :return: An AuthdataUtility if one is configured; otherwise None.
+
+        :raise CannotLoadConfiguration: If an AuthdataUtility is
+            incompletely configured.
+        """
+        _db = _db or Session.object_session(library)
+        if _db and cls._configuration_changes_pending(_db):
+            # The configuration has been changed but the changes
+            # haven't been written to the database yet. Go to the
+            # database directly and don't cache the result.
+            return cls.from_config(library, _db)
+
+        key = library.id
+        cached = cls._cache.get(key)
+        if cached is not None:
+            return cached[0]
+        utility = cls.from_config(library, _db)
+        cls._cache[key] = (utility,)
+        return utility
+
+    @classmethod
+    def _configuration_changes_pending(cls, _db):
+        for objects in (_db.new, _db.dirty, _db.deleted):
+            for obj in objects:
+                if isinstance(obj, cls.CONFIGURATION_CLASSES):
+                    return True
+        return False
+
+    @classmethod
+    def reset_cache(cls):
+        """Forget about every AuthdataUtility created by for_library()."""
+        AuthdataUtility._cache.clear()
+
     @classmethod
     def from_config(cls, library, _db=None):
         """Initialize an AuthdataUtility from site configuration.
@@ -1005,7 +1068,9 @@ class AuthdataUtility(object):
             )
 
         # Sign the token and check against the provided signature.
-        key = self.short_token_signer.prepare_key(secret)
+        key = self.short_token_signing_keys_by_library_uri.get(library_uri)
+        if key is None:
+            key = self.short_token_signer.prepare_key(secret)
         actual_signature = self.short_token_signer.sign(token, key)
 
         if actual_signature != supposed_signature:
@@ -1062,6 +1127,17 @@ class AuthdataUtility(object):
         return patron_identifier_credential, delegated_identifier
 
 
+def _configuration_changed(mapper, connection, target):
+    """A change to the configuration was written to the database, so
+    cached AuthdataUtility objects may be out of date.
+    """
+    AuthdataUtility.reset_cache()
+
+for _configuration_class in AuthdataUtility.CONFIGURATION_CLASSES:
+    for _event_name in ('after_insert', 'after_update', 'after_delete'):
+        event.listen(_configuration_class, _event_name, _configuration_changed)
+
+
 class VendorIDLibraryConfigurationScript(Script):
 
     @classmethod
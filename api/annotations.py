@@ -4,9 +4,14 @@ import json
 from datetime import datetime
 import os
 
+from expiringdict import ExpiringDict
+from sqlalchemy import func
+
+from core.lane import Pagination
 from core.model import (
     Annotation,
     Identifier,
+    Session,
     get_one_or_create,
 )
 
@@ -16,6 +21,11 @@ from core.app_server import (
 
 from problem_details import *
 
+# The local copies of JSON-LD contexts, keyed by URL. Each one is read
+# the first time it's needed and kept in memory from then on, since
+# pyld asks for a context every time it expands or compacts a document.
+_local_documents = {}
+
 def load_document(url):
     """Retrieves JSON-LD for the given URL from a local
     file if available, and falls back to the network.
@@ -25,13 +35,15 @@ def load_document(url):
         AnnotationWriter.LDP_CONTEXT: "ldp.jsonld"
     }
     if url in files:
-        base_path = os.path.join(os.path.split(__file__)[0], 'jsonld')
-        jsonld_file = os.path.join(base_path, files[url])
-        data = open(jsonld_file).read()
+        if url not in _local_documents:
+            base_path = os.path.join(os.path.split(__file__)[0], 'jsonld')
+            jsonld_file = os.path.join(base_path, files[url])
+            data = open(jsonld_file).read()
+            _local_documents[url] = data.decode('utf-8')
         doc = {
             "contextUrl": None,
             "documentUrl": url,
-            "document": data.decode('utf-8')
+            "document": _local_documents[url]
         }
         return doc
     else:
@@ -46,6 +58,18 @@ class AnnotationWriter(object):
     JSONLD_CONTEXT = "http://www.w3.org/ns/anno.jsonld"
     LDP_CONTEXT = "http://www.w3.org/ns/ldp.jsonld"
 
+    # The number of annotations on each page of an annotation container.
+    PAGE_SIZE = 100
+
+    # Compacting a JSON-LD document is slow, and clients ask for the
+    # same annotations over and over as they sync, so the compacted
+    # form of recently seen targets and bodies is kept around.
+    COMPACTION_CACHE_SIZE = 10000
+    COMPACTION_CACHE_MAX_AGE = 3600
+    _compacted = ExpiringDict(
+        max_len=COMPACTION_CACHE_SIZE, max_age_seconds=COMPACTION_CACHE_MAX_AGE
+    )
+
     @classmethod
     def annotations_for(cls, patron, identifier=None):
         annotations = [annotation for annotation in patron.annotations if annotation.active]
@@ -54,51 +78,88 @@ class AnnotationWriter(object):
         return annotations
 
     @classmethod
-    def annotation_container_for(cls, patron, identifier=None):
+    def annotations_query(cls, patron, identifier=None):
+        """A database query for a patron's active annotations, most
+        recent first.
+        """
+        _db = Session.object_session(patron)
+        qu = _db.query(Annotation).filter(
+            Annotation.patron==patron
+        ).filter(
+            Annotation.active==True
+        )
         if identifier:
-            url = url_for('annotations_for_work',
-                          identifier_type=identifier.type,
-                          identifier=identifier.identifier,
-                          library_short_name=patron.library.short_name,
-                          _external=True)
-        else:
-            url = url_for("annotations", library_short_name=patron.library.short_name, _external=True)
-        annotations = cls.annotations_for(patron, identifier=identifier)
+            qu = qu.filter(Annotation.identifier==identifier)
+        return qu.order_by(Annotation.timestamp.desc(), Annotation.id.desc())
 
-        latest_timestamp = None
-        if len(annotations) > 0:
-            # patron.annotations is already sorted by timestamp, so the first
-            # annotation is the most recent.
-            latest_timestamp = annotations[0].timestamp
+    @classmethod
+    def url_for(cls, patron, identifier=None, pagination=None):
+        kwargs = dict(
+            library_short_name=patron.library.short_name,
+            _external=True
+        )
+        if pagination:
+            kwargs.update(dict(pagination.items()))
+        if identifier:
+            return url_for('annotations_for_work',
+                           identifier_type=identifier.type,
+                           identifier=identifier.identifier,
+                           **kwargs)
+        return url_for("annotations", **kwargs)
+
+    @classmethod
+    def annotation_container_for(cls, patron, identifier=None, pagination=None):
+        url = cls.url_for(patron, identifier)
+        qu = cls.annotations_query(patron, identifier=identifier)
+        total, latest_timestamp = qu.with_entities(
+            func.count(Annotation.id), func.max(Annotation.timestamp)
+        ).order_by(None).one()
 
         container = dict()
         container["@context"] = [cls.JSONLD_CONTEXT, cls.LDP_CONTEXT]
         container["id"] = url
         container["type"] = ["BasicContainer", "AnnotationCollection"]
-        container["total"] = len(annotations)
-        container["first"] = cls.annotation_page_for(patron, identifier=identifier, with_context=False)
+        container["total"] = total
+        container["first"] = cls.annotation_page_for(
+            patron, identifier=identifier, with_context=False,
+            pagination=pagination
+        )
         return container, latest_timestamp
 
-
     @classmethod
-    def annotation_page_for(cls, patron, identifier=None, with_context=True):
-        if identifier:
-            url = url_for('annotations_for_work',
-                          identifier_type=identifier.type,
-                          identifier=identifier.identifier,
-                          library_short_name=patron.library.short_name,
-                          _external=True)
-        else:
-            url = url_for("annotations", library_short_name=patron.library.short_name, _external=True)
-        annotations = cls.annotations_for(patron, identifier=identifier)
+    def annotation_page_for(cls, patron, identifier=None, with_context=True,
+                            pagination=None):
+        """Describe one page of a patron's annotations.
+
+        :param pagination: A Pagination saying which page to describe.
+            By default, the first PAGE_SIZE annotations are described.
+        """
+        pagination = pagination or Pagination(size=cls.PAGE_SIZE)
+        qu = cls.annotations_query(patron, identifier=identifier)
+
+        # Ask for one extra annotation to find out whether there's
+        # another page after this one.
+        annotations = qu.offset(pagination.offset).limit(
+            pagination.size + 1
+        ).all()
+        has_next_page = len(annotations) > pagination.size
+        annotations = annotations[:pagination.size]
         details = [cls.detail(annotation, with_context=with_context) for annotation in annotations]
 
         page = dict()
         if with_context:
             page["@context"] = cls.JSONLD_CONTEXT
-        page["id"] = url
+        if pagination.offset:
+            page["id"] = cls.url_for(patron, identifier, pagination)
+        else:
+            page["id"] = cls.url_for(patron, identifier)
         page["type"] = "AnnotationPage"
+        page["startIndex"] = pagination.offset
         page["items"] = details
+        if has_next_page:
+            page["next"] = cls.url_for(
+                patron, identifier, pagination.next_page
+            )
         return page
 
     @classmethod
@@ -113,18 +174,31 @@ class AnnotationWriter(object):
         item["motivation"] = annotation.motivation
         item["body"] = annotation.content
         if annotation.target:
-            target = json.loads(annotation.target)
-            compacted = jsonld.compact(target, cls.JSONLD_CONTEXT)
-            del compacted["@context"]
-            item["target"] = compacted
+            item["target"] = cls.compact(annotation.target)
         if annotation.content:
-            body = json.loads(annotation.content)
-            compacted = jsonld.compact(body, cls.JSONLD_CONTEXT)
-            del compacted["@context"]
-            item["body"] = compacted
+            item["body"] = cls.compact(annotation.content)
 
         return item
 
+    @classmethod
+    def compact(cls, data):
+        """Compact a stored JSON-LD document against the annotation
+        context.
+
+        :param data: A JSON string, as stored in Annotation.target or
+            Annotation.content.
+        :return: A dictionary, with no @context.
+        """
+        compacted = cls._compacted.get(data)
+        if compacted is None:
+            document = jsonld.compact(json.loads(data), cls.JSONLD_CONTEXT)
+            del document["@context"]
+            compacted = json.dumps(document)
+            cls._compacted[data] = compacted
+
+        # Each caller gets its own copy of the document.
+        return json.loads(compacted)
+
 class AnnotationParser(object):
 
     @classmethod
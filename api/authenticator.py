@@ -1,10 +1,16 @@
+import copy
 import datetime
+import hashlib
 import importlib
 import json
 import logging
+import os
 import re
+import threading
+import time
 import urllib
 from abc import ABCMeta
+from collections import OrderedDict
 
 import flask
 import jwt
@@ -22,6 +28,7 @@ from api.adobe_vendor_id import AuthdataUtility
 from api.annotations import AnnotationWriter
 from api.announcements import Announcements
 from api.custom_patron_catalog import CustomPatronCatalog
+from api.library_settings import LibrarySettings
 from api.opds import LibraryAnnotator
 from api.saml.configuration.model import SAMLSettings
 from config import (
@@ -492,7 +499,7 @@ class CirculationPatronProfileStorage(PatronProfileStorage):
         links = []
         device_link = {}
 
-        authdata = AuthdataUtility.from_config(self.patron.library)
+        authdata = AuthdataUtility.for_library(self.patron.library)
         if authdata:
             vendor_id, token = authdata.short_client_token_for_patron(self.patron)
             adobe_drm = {}
@@ -1009,7 +1016,7 @@ class LibraryAuthenticator(object):
         # For OPDS.
         for rel in (LibraryAnnotator.CONFIGURATION_LINKS +
                     Configuration.AUTHENTICATION_FOR_OPDS_LINKS):
-            value = ConfigurationSetting.for_library(rel, library).value
+            value = LibrarySettings.value_for(rel, library)
             if not value:
                 continue
             link = dict(rel=rel, href=value)
@@ -1058,22 +1065,22 @@ class LibraryAuthenticator(object):
             links.append(dict(rel="help", href=uri, type=type))
 
         # Add a link to the web page of the library itself.
-        library_uri = ConfigurationSetting.for_library(
-            Configuration.WEBSITE_URL, library).value
+        library_uri = LibrarySettings.value_for(
+            Configuration.WEBSITE_URL, library)
         if library_uri:
             links.append(
                 dict(rel="alternate", type="text/html", href=library_uri)
             )
 
         # Add the library's logo, if it has one.
-        logo = ConfigurationSetting.for_library(
-            Configuration.LOGO, library).value
+        logo = LibrarySettings.value_for(
+            Configuration.LOGO, library)
         if logo:
             links.append(dict(rel="logo", type="image/png", href=logo))
 
         # Add the library's custom CSS file, if it has one.
-        css_file = ConfigurationSetting.for_library(
-            Configuration.WEB_CSS_FILE, library).value
+        css_file = LibrarySettings.value_for(
+            Configuration.WEB_CSS_FILE, library)
         if css_file:
             links.append(dict(rel="stylesheet", type="text/css", href=css_file))
 
@@ -1086,23 +1093,23 @@ class LibraryAuthenticator(object):
         ).to_dict(self._db)
 
         # Add the library's mobile color scheme, if it has one.
-        description = ConfigurationSetting.for_library(
-            Configuration.COLOR_SCHEME, library).value
+        description = LibrarySettings.value_for(
+            Configuration.COLOR_SCHEME, library)
         if description:
             doc['color_scheme'] = description
 
         # Add the library's web colors, if it has any.
-        primary = ConfigurationSetting.for_library(
-            Configuration.WEB_PRIMARY_COLOR, library).value
-        secondary = ConfigurationSetting.for_library(
-            Configuration.WEB_SECONDARY_COLOR, library).value
+        primary = LibrarySettings.value_for(
+            Configuration.WEB_PRIMARY_COLOR, library)
+        secondary = LibrarySettings.value_for(
+            Configuration.WEB_SECONDARY_COLOR, library)
         if primary or secondary:
             doc["web_color_scheme"] = dict(primary=primary, secondary=secondary, background=primary, foreground=secondary)
 
         # Add the description of the library as the OPDS feed's
         # service_description.
-        description = ConfigurationSetting.for_library(
-            Configuration.LIBRARY_DESCRIPTION, library).value
+        description = LibrarySettings.value_for(
+            Configuration.LIBRARY_DESCRIPTION, library)
         if description:
             doc['service_description'] = description
 
@@ -1182,7 +1189,7 @@ class LibraryAuthenticator(object):
 
         See https://github.com/NYPL-Simplified/Simplified/wiki/Authentication-For-OPDS-Extensions#service_area and #focus_area
         """
-        setting = ConfigurationSetting.for_library(key, library).value
+        setting = LibrarySettings.value_for(key, library)
         if not setting:
             return setting
         if setting == 'everywhere':
@@ -1618,6 +1625,169 @@ class AuthenticationProvider(OPDSAuthenticationFlow):
         raise NotImplementedError()
 
 
+class PatronAuthenticationCache(object):
+    """A short-lived, size-bounded, in-memory record of credentials that
+    were recently approved by an ILS.
+
+    A patron using an app sends their credentials with every request,
+    and checking them with the ILS every time puts the ILS's latency
+    into every request. Once a set of credentials has been approved,
+    this cache lets us skip the remote check for a few seconds.
+
+    Credentials are never stored. Each entry is keyed by a salted hash
+    of (library, username, password), and holds the ID of the
+    authenticated Patron and a copy of the PatronData obtained from
+    the ILS.
+    """
+
+    # By default, keep up to this many entries per integration.
+    DEFAULT_SIZE = 10000
+
+    # Caches are shared across threads, one per integration.
+    _caches = {}
+    _caches_lock = threading.Lock()
+
+    class Entry(object):
+        def __init__(self, patron_id, username_key, patrondata, expires):
+            self.patron_id = patron_id
+            self.username_key = username_key
+            self.patrondata = patrondata
+            self.expires = expires
+
+    @classmethod
+    def for_integration(cls, integration_id, ttl, size=None):
+        """Find or create the cache for the given integration.
+
+        If the cache's configuration has changed, the old cache is
+        thrown out.
+        """
+        size = size or cls.DEFAULT_SIZE
+        with cls._caches_lock:
+            cache = cls._caches.get(integration_id)
+            if not cache or (cache.ttl, cache.size) != (ttl, size):
+                cache = cls(ttl, size)
+                cls._caches[integration_id] = cache
+            return cache
+
+    @classmethod
+    def invalidate_patron(cls, patron_id):
+        """Remove any cached authentications for the given patron, in
+        every cache.
+
+        :return: The number of entries removed.
+        """
+        with cls._caches_lock:
+            caches = cls._caches.values()
+        return sum(cache.remove_patron(patron_id) for cache in caches)
+
+    @classmethod
+    def reset(cls):
+        """Forget about every cache. Mainly for use in tests."""
+        with cls._caches_lock:
+            cls._caches = {}
+
+    def __init__(self, ttl, size=None, clock=time.time):
+        """Constructor.
+
+        :param ttl: Cached authentications expire after this many seconds.
+        :param size: The maximum number of entries to keep.
+        :param clock: A callable returning the current time, in seconds.
+            Only intended for use in tests.
+        """
+        self.ttl = ttl
+        self.size = size or self.DEFAULT_SIZE
+        self.clock = clock
+        self.salt = os.urandom(16)
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _hash(self, *parts):
+        h = hashlib.sha256(self.salt)
+        for part in parts:
+            if isinstance(part, unicode):
+                part = part.encode("utf8")
+            h.update(str(part))
+            h.update("\0")
+        return h.hexdigest()
+
+    def keys(self, library_id, username, password):
+        """Calculate the keys for a set of credentials.
+
+        :return: A 2-tuple (credentials_key, username_key). The second
+            key identifies the username alone, so that every cached
+            authentication for a username can be invalidated at once.
+        """
+        return (
+            self._hash(library_id, username, password or ""),
+            self._hash(library_id, username)
+        )
+
+    def lookup(self, library_id, username, password):
+        """Find the cached authentication for a set of credentials.
+
+        :return: An Entry, or None if the credentials aren't cached or
+            the cached authentication has expired.
+        """
+        key, username_key = self.keys(library_id, username, password)
+        now = self.clock()
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry and entry.expires > now:
+                # Move this entry to the end so it's the last to be evicted.
+                self.entries[key] = entry
+                self.hits += 1
+                return entry
+            self.misses += 1
+        return None
+
+    def store(self, library_id, username, password, patron_id, patrondata):
+        """Record that a set of credentials was approved by the ILS."""
+        key, username_key = self.keys(library_id, username, password)
+        if isinstance(patrondata, PatronData):
+            patrondata = copy.copy(patrondata)
+        else:
+            patrondata = None
+        entry = self.Entry(
+            patron_id, username_key, patrondata, self.clock() + self.ttl
+        )
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = entry
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def remove_username(self, library_id, username):
+        """Remove every cached authentication for a username, no matter
+        which password was used.
+
+        :return: The number of entries removed.
+        """
+        key, username_key = self.keys(library_id, username, None)
+        return self._remove(lambda entry: entry.username_key == username_key)
+
+    def remove_patron(self, patron_id):
+        """Remove every cached authentication for a patron.
+
+        :return: The number of entries removed.
+        """
+        return self._remove(lambda entry: entry.patron_id == patron_id)
+
+    def _remove(self, matches):
+        with self.lock:
+            remove = [k for k, entry in self.entries.items() if matches(entry)]
+            for k in remove:
+                del self.entries[k]
+        return len(remove)
+
+    @property
+    def stats(self):
+        """Summarize the cache's activity."""
+        with self.lock:
+            return dict(size=len(self.entries), hits=self.hits, misses=self.misses)
+
+
 class BasicAuthenticationProvider(AuthenticationProvider, HasSelfTests):
     """Verify a username/password, obtained through HTTP Basic Auth, with
     a remote source of truth.
@@ -1730,6 +1900,12 @@ class BasicAuthenticationProvider(AuthenticationProvider, HasSelfTests):
         TEST_IDENTIFIER_DESCRIPTION_FOR_REQUIRED_PASSWORD,
         "An optional Test Password for this identifier can be set in the next section.",
     ))
+    # Recently approved credentials can be cached for this many
+    # seconds, so they don't need to be checked with the ILS for every
+    # request.
+    AUTHENTICATION_CACHE_TTL = u"authentication_cache_ttl"
+    AUTHENTICATION_CACHE_SIZE = u"authentication_cache_size"
+
     TEST_PASSWORD_DESCRIPTION_REQUIRED = _("The password for the Test Identifier.")
     TEST_PASSWORD_DESCRIPTION_OPTIONAL = _("The password for the Test Identifier (above, in previous section).")
 
@@ -1798,6 +1974,17 @@ class BasicAuthenticationProvider(AuthenticationProvider, HasSelfTests):
         { "key": PASSWORD_LABEL,
           "label": _("Label for password entry"),
         },
+        { "key": AUTHENTICATION_CACHE_TTL,
+          "label": _("Authentication cache duration (seconds)"),
+          "description": _("Once the ILS approves a patron's credentials, don't check them again for this many seconds. This makes requests faster, but a patron whose PIN has changed may be able to use the old PIN for this long. Leave blank to check credentials with the ILS for every request."),
+          "type": "number",
+        },
+        { "key": AUTHENTICATION_CACHE_SIZE,
+          "label": _("Authentication cache size"),
+          "description": _("The maximum number of recently approved credentials to remember."),
+          "type": "number",
+          "default": PatronAuthenticationCache.DEFAULT_SIZE,
+        },
     ] + AuthenticationProvider.SETTINGS
 
     # Used in the constructor to signify that the default argument
@@ -1863,6 +2050,23 @@ class BasicAuthenticationProvider(AuthenticationProvider, HasSelfTests):
             or self.DEFAULT_PASSWORD_LABEL
         )
 
+        self.authentication_cache_ttl = integration.setting(
+            self.AUTHENTICATION_CACHE_TTL).int_value
+        self.authentication_cache_size = integration.setting(
+            self.AUTHENTICATION_CACHE_SIZE).int_value
+
+    @property
+    def authentication_cache(self):
+        """The PatronAuthenticationCache shared by every provider for this
+        integration, or None if authentications should not be cached.
+        """
+        if not self.authentication_cache_ttl or self.authentication_cache_ttl <= 0:
+            return None
+        return PatronAuthenticationCache.for_integration(
+            self.external_integration_id, self.authentication_cache_ttl,
+            self.authentication_cache_size
+        )
+
     def remote_patron_lookup(self, patron_or_patrondata):
         """Ask the remote for information about this patron, and then make sure
         the patron belongs to the library associated with thie BasicAuthenticationProvider."""
@@ -1961,17 +2165,75 @@ class BasicAuthenticationProvider(AuthenticationProvider, HasSelfTests):
             # need to be checked with the source of truth.
             return server_side_validation_result
 
+        cache = self.authentication_cache
+        if cache:
+            # If the source of truth approved these credentials very
+            # recently, there's no need to ask again.
+            patron = self._cached_patron(_db, cache, username, password)
+            if patron:
+                return patron
+
+        patron, patrondata = self._authenticate_with_source_of_truth(
+            _db, username, password
+        )
+        if cache:
+            if isinstance(patron, Patron):
+                cache.store(
+                    self.library_id, username, password, patron.id, patrondata
+                )
+            elif not patron:
+                # The source of truth rejected these credentials. Maybe
+                # the PIN changed; in any case, no previously cached
+                # authentication for this username should be trusted.
+                cache.remove_username(self.library_id, username)
+        return patron
+
+    def _cached_patron(self, _db, cache, username, password):
+        """Look up the Patron for a set of recently approved credentials.
+
+        :return: A Patron, or None if the credentials were not
+            recently approved.
+        """
+        entry = cache.lookup(self.library_id, username, password)
+        if not entry:
+            return None
+        patron = get_one(
+            _db, Patron, id=entry.patron_id, library_id=self.library_id
+        )
+        if not patron:
+            # The patron has been deleted since they were cached.
+            cache.remove_patron(entry.patron_id)
+            return None
+        if entry.patrondata:
+            # The patron's neighborhood isn't stored in the database,
+            # so it wasn't loaded along with the Patron.
+            patron.neighborhood = (
+                entry.patrondata.neighborhood
+                or entry.patrondata.cached_neighborhood
+            )
+        return patron
+
+    def _authenticate_with_source_of_truth(self, _db, username, password):
+        """Check a set of credentials with the source of truth and find or
+        create the corresponding Patron.
+
+        :return: A 2-tuple (result, patrondata). `result` is a Patron
+            if one can be authenticated; a ProblemDetail if an error
+            occurs; None if the credentials are wrong. `patrondata` is
+            the most recent PatronData obtained from the source of
+            truth.
+        """
         # Check these credentials with the source of truth.
         patrondata = self.remote_authenticate(username, password)
         if not patrondata or isinstance(patrondata, ProblemDetail):
             # Either an error occured or the credentials did not correspond
             # to any patron.
-            return patrondata
+            return patrondata, None
 
         # Check that the patron belongs to this library.
         patrondata = self.enforce_library_identifier_restriction(username, patrondata)
         if not patrondata:
-            return PATRON_OF_ANOTHER_LIBRARY
+            return PATRON_OF_ANOTHER_LIBRARY, None
 
         # At this point we know there is _some_ authenticated patron,
         # but it might not correspond to a Patron in our database, and
@@ -1993,7 +2255,7 @@ class BasicAuthenticationProvider(AuthenticationProvider, HasSelfTests):
             # Just make sure our local data is up to date with
             # whatever we just got from remote.
             self.apply_patrondata(patrondata, patron)
-            return patron
+            return patron, patrondata
 
         # At this point there are two possibilities:
         #
@@ -2015,13 +2277,13 @@ class BasicAuthenticationProvider(AuthenticationProvider, HasSelfTests):
             # the patron does not exist on the remote. How we passed
             # remote validation is a mystery, but ours not to reason
             # why. There is no authenticated patron.
-            return patrondata
+            return patrondata, None
 
         if isinstance(patrondata, Patron):
             # For whatever reason, the remote lookup implementation
             # returned a Patron object instead of a PatronData. Just
             # use that Patron object.
-            return patrondata
+            return patrondata, None
 
         # At this point we have a _complete_ PatronData object which we
         # know represents an existing patron on the remote side. Try
@@ -2042,7 +2304,7 @@ class BasicAuthenticationProvider(AuthenticationProvider, HasSelfTests):
         # we now need to update the Patron record with the account
         # information we just got from the source of truth.
         self.apply_patrondata(patrondata, patron)
-        return patron
+        return patron, patrondata
 
     def apply_patrondata(self, patrondata, patron):
         """Apply a PatronData object to the given patron and make sure
@@ -94,6 +94,8 @@ from selftest import (
     SelfTestResult,
 )
 
+from util.response import ResponseUtility
+
 from web_publication_manifest import (
     FindawayManifest,
     SpineItem,
@@ -285,6 +287,9 @@ class Axis360API(Authenticator, BaseCirculationAPI, HasCollectionSelfTests):
             # make _make_request raise a RemoteIntegrationException.
             #
             # The token has expired. Get a new token and try again.
+            # If this response was streamed, nobody's going to read
+            # it, so its connection needs to be released first.
+            ResponseUtility.close(response)
             self.token = None
             return self.request(
                 url=url, method=method, extra_headers=extra_headers,
@@ -294,7 +299,14 @@ class Axis360API(Authenticator, BaseCirculationAPI, HasCollectionSelfTests):
         else:
             return response
 
-    def availability(self, patron_id=None, since=None, title_ids=[]):
+    def availability(self, patron_id=None, since=None, title_ids=[],
+                     stream=False):
+        """Ask Axis 360 for availability information.
+
+        :param stream: If True, the response body is not read ahead of
+            time, so that it can be parsed with
+            BibliographicParser.process_stream as it arrives.
+        """
         url = self.base_url + self.availability_endpoint
         args = dict()
         if since:
@@ -304,9 +316,23 @@ class Axis360API(Authenticator, BaseCirculationAPI, HasCollectionSelfTests):
             args['patronId'] = patron_id
         if title_ids:
             args['titleIds'] = ','.join(title_ids)
-        response = self.request(url, params=args, timeout=None)
+        kwargs = dict(timeout=None)
+        if stream:
+            kwargs['stream'] = True
+        response = self.request(url, params=args, **kwargs)
         return response
 
+    def _stream_availability(self, **kwargs):
+        """Parse an availability document while it's being downloaded.
+
+        :yield: A sequence of (Metadata, CirculationData) 2-tuples.
+        """
+        response = self.availability(stream=True, **kwargs)
+        with ResponseUtility.body(response) as body:
+            parser = BibliographicParser(self.collection)
+            for data in parser.process_stream(body):
+                yield data
+
     def get_fulfillment_info(self, transaction_id):
         """Make a call to the getFulfillmentInfoAPI."""
         url = self.base_url + self.fulfillment_endpoint
@@ -491,9 +517,7 @@ class Axis360API(Authenticator, BaseCirculationAPI, HasCollectionSelfTests):
         :yield: A stream of (Metadata, CirculationData) 2-tuples.
         """
         identifier_strings = self.create_identifier_strings(identifiers)
-        response = self.availability(title_ids=identifier_strings)
-        parser = BibliographicParser(self.collection)
-        return parser.process_all(response.content)
+        return self._stream_availability(title_ids=identifier_strings)
 
     def _reap(self, identifier):
         """Update our local circulation information to reflect the fact that
@@ -529,12 +553,14 @@ class Axis360API(Authenticator, BaseCirculationAPI, HasCollectionSelfTests):
     def recent_activity(self, since):
         """Find books that have had recent activity.
 
+        The availability document for a long period of time can be
+        very large, so each title is yielded as soon as it has been
+        downloaded and parsed.
+
         :yield: A sequence of (Metadata, CirculationData) 2-tuples
         """
-        availability = self.availability(since=since)
-        content = availability.content
-        for bibliographic, circulation in BibliographicParser(self.collection).process_all(
-                content):
+        for bibliographic, circulation in self._stream_availability(
+                since=since):
             yield bibliographic, circulation
 
     @classmethod
@@ -825,6 +851,32 @@ class BibliographicParser(Axis360Parser):
                 string, "//axis:title", self.NS):
             yield i
 
+    def process_stream(self, stream):
+        """Parse an availability document without loading all of it
+        into memory.
+
+        Each title is processed as soon as its closing tag has been
+        read, and its element is thrown away once it's been processed.
+
+        :param stream: A file-like object, such as the raw body of a
+            streamed HTTP response.
+        :yield: The same items as process_all.
+        """
+        tag = "{%s}title" % self.NS['axis']
+        for event, element in etree.iterparse(
+                stream, events=("end",), tag=tag,
+                resolve_entities=False, no_network=True
+        ):
+            data = self.process_one(element, self.NS)
+            if data is not None:
+                yield data
+
+            # Free the memory used by this title and any elements
+            # that came before it.
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+
     def extract_availability(self, circulation_data, element, ns):
         identifier = self.text_of_subtag(element, 'axis:titleId', ns)
         primary_identifier = IdentifierData(Identifier.AXIS_360_ID, identifier)
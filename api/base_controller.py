@@ -12,6 +12,7 @@ from core.model import (
     get_one,
 )
 from core.util.problem_detail import ProblemDetail
+from library_settings import LibrarySettings
 from problem_details import *
 
 
@@ -141,6 +142,7 @@ class BaseCirculationManagerController(object):
 
         library = loan.patron.library
         flask.request.library = library
+        self.attach_library_settings(library)
 
         return library
 
@@ -161,4 +163,15 @@ class BaseCirculationManagerController(object):
         if not library:
             return LIBRARY_NOT_FOUND
         flask.request.library = library
+        self.attach_library_settings(library)
         return library
+
+    def attach_library_settings(self, library):
+        """Make the snapshot of the library's settings available to
+        code that runs during this request.
+        """
+        settings = getattr(self.manager, 'library_settings', None)
+        if settings is None:
+            return
+        snapshot = settings.get(library.id) or LibrarySettings(library.id)
+        flask.request.library_settings = snapshot.for_request()
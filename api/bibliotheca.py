@@ -1,4 +1,5 @@
 import json
+from collections import OrderedDict
 from lxml import etree
 
 from cStringIO import StringIO
@@ -12,12 +13,14 @@ import urlparse
 import time
 import hmac
 import hashlib
+from multiprocessing.pool import ThreadPool
 
 from flask_babel import lazy_gettext as _
 
 from nose.tools import set_trace
 
 from sqlalchemy import or_
+from sqlalchemy.orm import contains_eager
 from sqlalchemy.orm.session import Session
 
 from web_publication_manifest import (
@@ -43,6 +46,7 @@ from core.model import (
     DataSource,
     DeliveryMechanism,
     Edition,
+    Equivalency,
     ExternalIntegration,
     get_one,
     get_one_or_create,
@@ -1188,10 +1192,27 @@ class BibliothecaCirculationSweep(IdentifierSweepMonitor):
     will act like they never heard of it.
     """
     SERVICE_NAME = "Bibliotheca Circulation Sweep"
-    DEFAULT_BATCH_SIZE = 25
     PROTOCOL = ExternalIntegration.BIBLIOTHECA
 
-    def __init__(self, _db, collection, api_class=BibliothecaAPI, **kwargs):
+    # Bibliotheca will tell us about at most this many items in a
+    # single request.
+    LOOKUP_SIZE = 25
+
+    # By default, have this many lookups in progress at once.
+    DEFAULT_CONCURRENCY = 4
+
+    # Each batch of identifiers is split up into lookups, which run
+    # concurrently. The results are applied in a single transaction.
+    DEFAULT_BATCH_SIZE = LOOKUP_SIZE * DEFAULT_CONCURRENCY
+
+    def __init__(self, _db, collection, api_class=BibliothecaAPI,
+                 concurrency=None, **kwargs):
+        """Constructor.
+
+        :param concurrency: Make up to this many requests to
+            Bibliotheca at once.
+        :param batch_size: Handle this many identifiers per batch.
+        """
         _db = Session.object_session(collection)
         super(BibliothecaCirculationSweep, self).__init__(
             _db, collection, **kwargs
@@ -1202,20 +1223,26 @@ class BibliothecaCirculationSweep(IdentifierSweepMonitor):
             self.api = api_class(_db, collection)
         self.replacement_policy = BibliothecaAPI.replacement_policy(_db)
         self.analytics = self.replacement_policy.analytics
+        self.concurrency = concurrency or self.DEFAULT_CONCURRENCY
+        self._lookup_pool = None
 
     def process_items(self, identifiers):
         identifiers_by_bibliotheca_id = dict()
-        bibliotheca_ids = set()
         for identifier in identifiers:
-            bibliotheca_ids.add(identifier.identifier)
             identifiers_by_bibliotheca_id[identifier.identifier] = identifier
 
+        # Find the LicensePools and Editions for this whole batch up
+        # front, rather than looking them up one title at a time.
+        license_pools = self.license_pools_for(identifiers)
+        editions = self.editions_for(identifiers)
+
         identifiers_not_mentioned_by_bibliotheca = set(identifiers)
         now = datetime.utcnow()
-        for metadata in self.api.bibliographic_lookup(bibliotheca_ids):
+        for metadata in self.lookup(identifiers_by_bibliotheca_id.keys()):
             self._process_metadata(
                 metadata, identifiers_by_bibliotheca_id,
                 identifiers_not_mentioned_by_bibliotheca,
+                license_pools, editions
             )
 
         # At this point there may be some license pools left over
@@ -1223,12 +1250,8 @@ class BibliothecaCirculationSweep(IdentifierSweepMonitor):
         # indication that we no longer own any licenses to the
         # book.
         for identifier in identifiers_not_mentioned_by_bibliotheca:
-            pools = [lp for lp in identifier.licensed_through
-                     if lp.data_source.name==DataSource.BIBLIOTHECA
-                     and lp.collection == self.collection]
-            if pools:
-                [pool] = pools
-            else:
+            pool = license_pools.get(identifier.id)
+            if not pool:
                 continue
             if pool.licenses_owned > 0:
                 self.log.warn(
@@ -1237,12 +1260,74 @@ class BibliothecaCirculationSweep(IdentifierSweepMonitor):
                 )
             pool.update_availability(0, 0, 0, 0, self.analytics, as_of=now)
 
+    def lookup(self, bibliotheca_ids):
+        """Ask Bibliotheca about a number of items, making several
+        requests at once if there are too many items for one request.
+
+        The requests don't touch the database, so they can be made
+        from worker threads.
+
+        :yield: A sequence of Metadata objects.
+        """
+        bibliotheca_ids = sorted(bibliotheca_ids)
+        chunks = [
+            bibliotheca_ids[i:i+self.LOOKUP_SIZE]
+            for i in range(0, len(bibliotheca_ids), self.LOOKUP_SIZE)
+        ]
+        if self.concurrency > 1 and len(chunks) > 1:
+            if not self._lookup_pool:
+                self._lookup_pool = ThreadPool(self.concurrency)
+            results = self._lookup_pool.map(
+                self.api.bibliographic_lookup, chunks
+            )
+        else:
+            results = [self.api.bibliographic_lookup(x) for x in chunks]
+        for metadatas in results:
+            for metadata in metadatas:
+                yield metadata
+
+    def license_pools_for(self, identifiers):
+        """Find this collection's Bibliotheca LicensePools for the given
+        identifiers, in a single query.
+
+        :return: A dictionary mapping Identifier IDs to LicensePools.
+        """
+        data_source = DataSource.lookup(self._db, DataSource.BIBLIOTHECA)
+        qu = self._db.query(LicensePool).filter(
+            LicensePool.identifier_id.in_([x.id for x in identifiers])
+        ).filter(
+            LicensePool.data_source==data_source
+        ).filter(
+            LicensePool.collection==self.collection
+        )
+        return dict((pool.identifier_id, pool) for pool in qu)
+
+    def editions_for(self, identifiers):
+        """Find the Bibliotheca Editions for the given identifiers, in a
+        single query.
+
+        :return: A dictionary mapping Identifier IDs to Editions.
+        """
+        data_source = DataSource.lookup(self._db, DataSource.BIBLIOTHECA)
+        qu = self._db.query(Edition).filter(
+            Edition.primary_identifier_id.in_([x.id for x in identifiers])
+        ).filter(
+            Edition.data_source==data_source
+        )
+        return dict((edition.primary_identifier_id, edition) for edition in qu)
+
     def _process_metadata(
         self, metadata, identifiers_by_bibliotheca_id,
-        identifiers_not_mentioned_by_bibliotheca
+        identifiers_not_mentioned_by_bibliotheca, license_pools=None,
+        editions=None
     ):
         """Process a single Metadata object (containing CirculationData)
         retrieved from Bibliotheca.
+
+        :param license_pools: A dictionary mapping Identifier IDs to
+            LicensePools that were looked up ahead of time.
+        :param editions: A dictionary mapping Identifier IDs to Editions
+            that were looked up ahead of time.
         """
         bibliotheca_id = metadata.primary_identifier.identifier
         identifier = identifiers_by_bibliotheca_id[bibliotheca_id]
@@ -1251,8 +1336,16 @@ class BibliothecaCirculationSweep(IdentifierSweepMonitor):
             # this list so we know the title is still in the collection.
             identifiers_not_mentioned_by_bibliotheca.remove(identifier)
 
-        edition, is_new = metadata.edition(self._db)
-        pool, is_new = metadata.circulation.license_pool(self._db, self.collection)
+        edition = (editions or {}).get(identifier.id)
+        if not edition:
+            edition, is_new = metadata.edition(self._db)
+        pool = (license_pools or {}).get(identifier.id)
+        if pool:
+            is_new = False
+        else:
+            pool, is_new = metadata.circulation.license_pool(
+                self._db, self.collection
+            )
         if is_new:
             # We didn't have a license pool for this work. That
             # shouldn't happen--how did we know about the
@@ -1286,6 +1379,10 @@ class BibliothecaEventMonitor(CollectionMonitor, TimelineMonitor):
     DEFAULT_START_TIME = timedelta(365*3)
     PROTOCOL = ExternalIntegration.BIBLIOTHECA
 
+    # Look up the books mentioned by this many events at once, and
+    # commit after handling them.
+    EVENT_BATCH_SIZE = 1000
+
     def __init__(self, _db, collection, api_class=BibliothecaAPI,
                  cli_date=None, analytics=None):
         self.analytics = analytics or Analytics(_db)
@@ -1344,7 +1441,6 @@ class BibliothecaEventMonitor(CollectionMonitor, TimelineMonitor):
         return None
 
     def catch_up_from(self, start, cutoff, progress):
-        added_books = 0
         i = 0
         one_day = timedelta(days=1)
         for slice_start, slice_cutoff, full_slice in self.slice_timespan(
@@ -1354,18 +1450,185 @@ class BibliothecaEventMonitor(CollectionMonitor, TimelineMonitor):
                 "Asking for events between %r and %r", slice_start,
                 slice_cutoff
             )
-            event = None
             events = self.api.get_events_between(
                 slice_start, slice_cutoff, full_slice
             )
-            for event in events:
-                event_timestamp = self.handle_event(*event)
-                i += 1
-                if not i % 1000:
-                    self._db.commit()
-            self._db.commit()
+            for batch in self.event_batches(events):
+                i += self.handle_events(batch)
+                self._db.commit()
         progress.achievements = "Events handled: %d." % i
 
+    def event_batches(self, events):
+        """Split a stream of events into lists of EVENT_BATCH_SIZE events."""
+        batch = []
+        for event in events:
+            batch.append(event)
+            if len(batch) >= self.EVENT_BATCH_SIZE:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def handle_events(self, events):
+        """Handle a batch of events.
+
+        This has the same effect as calling handle_event() on each
+        event, but the LicensePools, Identifiers, Editions and
+        equivalencies mentioned by the events are looked up with a
+        few queries for the whole batch, rather than several queries
+        per event.
+
+        :param events: A list of 6-tuples, as yielded by EventParser.
+        :return: The number of events handled.
+        """
+        source = self.api.source
+        bibliotheca_ids = set(event[0] for event in events)
+
+        license_pools = self._license_pools_for(bibliotheca_ids)
+        new_pools = set()
+        for bibliotheca_id in bibliotheca_ids - set(license_pools):
+            license_pool, is_new = LicensePool.for_foreign_id(
+                self._db, source, Identifier.BIBLIOTHECA_ID,
+                bibliotheca_id, collection=self.collection
+            )
+            license_pools[bibliotheca_id] = license_pool
+            if is_new:
+                # This is a new book. Immediately acquire bibliographic
+                # coverage for it, just as handle_event() would.
+                new_pools.add(bibliotheca_id)
+                self.bibliographic_coverage_provider.ensure_coverage(
+                    license_pool.identifier, force=True
+                )
+
+        editions = self._editions_for(bibliotheca_ids)
+        for bibliotheca_id in bibliotheca_ids - set(editions):
+            editions[bibliotheca_id], ignore = Edition.for_foreign_id(
+                self._db, source, Identifier.BIBLIOTHECA_ID, bibliotheca_id
+            )
+
+        # The ISBN and the Bibliotheca identifier are exactly
+        # equivalent. Create any equivalencies we don't already have.
+        isbns = self._isbns_for(set(event[1] for event in events if event[1]))
+        pairs = set(
+            (license_pools[event[0]].identifier, isbns[event[1]])
+            for event in events if event[1]
+        )
+        existing = self._existing_equivalencies(pairs)
+        for bibliotheca_identifier, isbn in pairs:
+            if (bibliotheca_identifier.id, isbn.id) not in existing:
+                bibliotheca_identifier.equivalent_to(source, isbn, strength=1)
+
+        # Apply the events to each LicensePool in the order they
+        # happened.
+        events_by_pool = OrderedDict()
+        for event in events:
+            events_by_pool.setdefault(event[0], []).append(event)
+
+        for bibliotheca_id, pool_events in events_by_pool.items():
+            license_pool = license_pools[bibliotheca_id]
+            title = editions[bibliotheca_id].title or "[no title]"
+            for (ignore, ignore, ignore, start_time, end_time,
+                 internal_event_type) in pool_events:
+                license_pool.update_availability_from_delta(
+                    internal_event_type, start_time, 1, self.analytics
+                )
+                if bibliotheca_id in new_pools:
+                    # This is our first time seeing this LicensePool. Log
+                    # its occurance as a separate event.
+                    license_pool.collect_analytics_event(
+                        self.analytics, CirculationEvent.DISTRIBUTOR_TITLE_ADD,
+                        license_pool.last_checked or start_time,
+                        0, 1
+                    )
+                    new_pools.remove(bibliotheca_id)
+                self.log.info(
+                    "%r %s: %s", start_time, title, internal_event_type
+                )
+        return len(events)
+
+    def _license_pools_for(self, bibliotheca_ids):
+        """Find this collection's LicensePools for the given Bibliotheca IDs.
+
+        :return: A dictionary mapping Bibliotheca IDs to LicensePools.
+        """
+        qu = self._db.query(LicensePool).join(
+            LicensePool.identifier
+        ).filter(
+            Identifier.type==Identifier.BIBLIOTHECA_ID
+        ).filter(
+            Identifier.identifier.in_(bibliotheca_ids)
+        ).filter(
+            LicensePool.data_source_id==self.api.source.id
+        ).filter(
+            LicensePool.collection_id==self.collection.id
+        ).options(
+            contains_eager(LicensePool.identifier)
+        )
+        return dict((pool.identifier.identifier, pool) for pool in qu)
+
+    def _editions_for(self, bibliotheca_ids):
+        """Find the Bibliotheca Editions for the given Bibliotheca IDs.
+
+        :return: A dictionary mapping Bibliotheca IDs to Editions.
+        """
+        qu = self._db.query(Edition).join(
+            Edition.primary_identifier
+        ).filter(
+            Identifier.type==Identifier.BIBLIOTHECA_ID
+        ).filter(
+            Identifier.identifier.in_(bibliotheca_ids)
+        ).filter(
+            Edition.data_source_id==self.api.source.id
+        ).options(
+            contains_eager(Edition.primary_identifier)
+        )
+        return dict(
+            (edition.primary_identifier.identifier, edition) for edition in qu
+        )
+
+    def _isbns_for(self, isbns):
+        """Find or create ISBN Identifiers for the given strings.
+
+        :return: A dictionary mapping strings to Identifiers.
+        """
+        if not isbns:
+            return {}
+        qu = self._db.query(Identifier).filter(
+            Identifier.type==Identifier.ISBN
+        ).filter(
+            Identifier.identifier.in_(isbns)
+        )
+        identifiers = dict((x.identifier, x) for x in qu)
+        for isbn in isbns - set(identifiers):
+            identifiers[isbn], ignore = Identifier.for_foreign_id(
+                self._db, Identifier.ISBN, isbn
+            )
+        return identifiers
+
+    def _existing_equivalencies(self, pairs):
+        """Find out which of the given (Bibliotheca identifier, ISBN) pairs
+        are already registered as exact equivalents.
+
+        :return: A set of (input ID, output ID) 2-tuples.
+        """
+        if not pairs:
+            return set()
+        self._db.flush()
+        input_ids = set(input.id for input, output in pairs)
+        output_ids = set(output.id for input, output in pairs)
+        qu = self._db.query(
+            Equivalency.input_id, Equivalency.output_id
+        ).filter(
+            Equivalency.input_id.in_(input_ids)
+        ).filter(
+            Equivalency.output_id.in_(output_ids)
+        ).filter(
+            Equivalency.data_source_id==self.api.source.id
+        ).filter(
+            Equivalency.strength==1
+        )
+        return set((x.input_id, x.output_id) for x in qu)
+
     def handle_event(self, bibliotheca_id, isbn, foreign_patron_id,
                      start_time, end_time, internal_event_type):
         # Find or lookup the LicensePool for this event.
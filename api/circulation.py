@@ -1,14 +1,26 @@
+import copy
 import datetime
 import logging
+import os
 import sys
 import time
-from threading import Thread
+from Queue import Queue
+from threading import (
+    Event,
+    Lock,
+    Thread,
+)
 
 import flask
 from flask_babel import lazy_gettext as _
+from sqlalchemy import tuple_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
 
+from api.admin.dashboard_stats import DashboardStatistics
 from circulation_exceptions import *
 from config import Configuration
+from library_settings import LibrarySettings
 from core.cdn import cdnify
 from core.config import CannotLoadConfiguration
 from core.mirror import MirrorUploader
@@ -16,9 +28,10 @@ from core.model import (
     get_one,
     CirculationEvent,
     Collection,
-    ConfigurationSetting,
+    DataSource,
     DeliveryMechanism,
     ExternalIntegration,
+    Identifier,
     Library,
     LicensePoolDeliveryMechanism,
     LicensePool,
@@ -360,12 +373,210 @@ class HoldInfo(CirculationInfo):
         )
 
 
+class LatencyHistogram(object):
+    """Counts observed latencies in a fixed set of buckets."""
+
+    # The upper bound of each bucket, in seconds. Anything slower than
+    # the last bound goes into an extra, open-ended bucket.
+    BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+    def __init__(self):
+        self.lock = Lock()
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def record(self, seconds):
+        """Record a single observation."""
+        index = len(self.BUCKETS)
+        for i, bound in enumerate(self.BUCKETS):
+            if seconds <= bound:
+                index = i
+                break
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += seconds
+
+    @property
+    def mean(self):
+        if not self.count:
+            return None
+        return self.total / self.count
+
+    def as_dict(self):
+        """Summarize the histogram as a dictionary.
+
+        Each bucket is keyed by its upper bound; the open-ended bucket
+        is keyed by "+Inf".
+        """
+        with self.lock:
+            buckets = dict(
+                ("%s" % bound, count)
+                for bound, count in zip(self.BUCKETS + ["+Inf"], self.counts)
+            )
+            return dict(count=self.count, mean=self.mean, buckets=buckets)
+
+
+class PatronActivityTask(object):
+    """A request for one API's view of a patron's activity, to be run
+    by a PatronActivityExecutor.
+
+    The task runs in a database session of its own, so that whoever
+    submitted it can stop waiting for it and go back to using their
+    own session.
+    """
+    def __init__(self, api, patron, pin, on_complete=None):
+        self.api = api
+        self.patron_id = patron.id
+        self.bind = Session.object_session(patron).get_bind()
+        self.pin = pin
+        self.on_complete = on_complete
+        self.activity = None
+        self.exception = None
+        self.trace = None
+        self.elapsed = None
+        self.cancelled = False
+        self.patron_not_found = False
+        self.done = Event()
+
+    @property
+    def name(self):
+        return self.api.__class__.__name__
+
+    def cancel(self):
+        """Tell the task not to run if it hasn't started yet."""
+        self.cancelled = True
+
+    def run(self):
+        if self.cancelled:
+            # Whoever submitted this task has stopped waiting for it.
+            self.done.set()
+            return
+        _db = Session(bind=self.bind)
+        try:
+            patron = _db.query(Patron).get(self.patron_id)
+            if patron:
+                self.run_in(_db, patron, commit=True)
+            else:
+                # The patron was created in a transaction that hasn't
+                # been committed yet, so only the session that
+                # created it can see it.
+                self.patron_not_found = True
+                self.done.set()
+        finally:
+            _db.close()
+
+    def run_in(self, _db, patron, commit=False):
+        """Ask the API about the patron's activity, using the given
+        database session.
+
+        :param commit: If this is True, the session belongs to this
+            task, and any changes the API made are committed (or, if
+            the API raised an exception, rolled back).
+        """
+        before = time.time()
+        try:
+            self.activity = self.api.in_session(_db).patron_activity(
+                patron, self.pin
+            )
+            if commit:
+                _db.commit()
+        except Exception, e:
+            if commit:
+                _db.rollback()
+            self.exception = e
+            self.trace = sys.exc_info()
+        self.elapsed = time.time() - before
+        self.done.set()
+        if self.on_complete:
+            self.on_complete(self)
+
+    def wait(self, timeout):
+        """Wait up to `timeout` seconds for the task to finish.
+
+        :return: True if the task finished; False otherwise.
+        """
+        return self.done.wait(max(timeout, 0))
+
+
+class PatronActivityExecutor(object):
+    """A bounded pool of worker threads that ask vendor APIs about patron
+    activity.
+
+    A single executor is shared by every CirculationAPI in a process,
+    so a burst of bookshelf syncs can't start an unlimited number of
+    threads.
+    """
+
+    DEFAULT_WORKERS = 20
+
+    _instance = None
+    _instance_lock = Lock()
+
+    @classmethod
+    def instance(cls):
+        """The executor shared by this process."""
+        with cls._instance_lock:
+            if not cls._instance:
+                cls._instance = cls()
+            return cls._instance
+
+    def __init__(self, workers=DEFAULT_WORKERS):
+        self.workers = workers
+        self.queue = Queue()
+        self.lock = Lock()
+        self.threads = []
+        self.pid = None
+
+    def submit(self, task):
+        """Queue a PatronActivityTask to be run by a worker thread."""
+        self._ensure_workers()
+        self.queue.put(task)
+        return task
+
+    def _ensure_workers(self):
+        with self.lock:
+            if self.pid != os.getpid():
+                # Either the workers haven't been started, or this
+                # process was forked from the one that started them
+                # and they don't exist here.
+                self.pid = os.getpid()
+                self.queue = Queue()
+                self.threads = []
+            while len(self.threads) < self.workers:
+                thread = Thread(target=self._work, args=(self.queue,))
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def _work(self, queue):
+        while True:
+            task = queue.get()
+            try:
+                task.run()
+            except Exception, e:
+                logging.getLogger("Patron activity executor").error(
+                    "Unexpected error running %s", task.name, exc_info=e
+                )
+
+
 class CirculationAPI(object):
     """Implement basic circulation logic and abstract away the details
     between different circulation APIs behind generic operations like
     'borrow'.
     """
 
+    # Stop waiting for vendor APIs to report a patron's activity after
+    # this many seconds. Any API that hasn't reported by then is
+    # treated as if it had failed.
+    PATRON_ACTIVITY_DEADLINE = 30
+
+    # How long each API took to report patron activity, keyed by the
+    # name of the API class. Shared across the process.
+    patron_activity_latency = {}
+    _patron_activity_latency_lock = Lock()
+
     def __init__(self, _db, library, analytics=None, api_map=None):
         """Constructor.
 
@@ -515,9 +726,6 @@ class CirculationAPI(object):
             then that neighborhood information (but not the patron's
             identity) will be associated with the circulation event.
         """
-        if not self.analytics:
-            return
-
         # It would be really useful to know which patron caused this
         # this event -- this will help us get a library and
         # potentially a neighborhood.
@@ -529,16 +737,26 @@ class CirculationAPI(object):
 
         # We need to figure out which library is associated with
         # this circulation event.
+        library = None
         if patron:
             # The library of the patron who caused the event.
             library = patron.library
         elif flask.request:
-            # The library associated with the current request.
-            library = flask.request.library
-        else:
+            # The library associated with the current request, if any.
+            library = getattr(flask.request, 'library', None)
+        if not library:
             # The library associated with the CirculationAPI itself.
             library = self.library
 
+        # Whether or not we're collecting analytics, the dashboard
+        # statistics for this library and collection are now out of date.
+        DashboardStatistics.mark_stale(
+            self._db, library, licensepool and licensepool.collection_id
+        )
+
+        if not self.analytics:
+            return
+
         neighborhood = None
         if (include_neighborhood and flask.request
             and request_patron and request_patron == patron):
@@ -1067,64 +1285,68 @@ class CirculationAPI(object):
 
         return True
 
-    def patron_activity(self, patron, pin):
+    def patron_activity(self, patron, pin, executor=None):
         """Return a record of the patron's current activity
         vis-a-vis all relevant external loan sources.
 
-        We check each source in a separate thread for speed.
+        We check all the sources at once, in a shared pool of worker
+        threads. A source that takes too long to respond is treated
+        as if it had failed.
 
-        :return: A 2-tuple (loans, holds) containing `HoldInfo` and
-            `LoanInfo` objects.
-        """
-        log = self.log
-        class PatronActivityThread(Thread):
-            def __init__(self, api, patron, pin):
-                self.api = api
-                self.patron = patron
-                self.pin = pin
-                self.activity = None
-                self.exception = None
-                self.trace = None
-                super(PatronActivityThread, self).__init__()
-
-            def run(self):
-                before = time.time()
-                try:
-                    self.activity = self.api.patron_activity(
-                        self.patron, self.pin)
-                except Exception, e:
-                    self.exception = e
-                    self.trace = sys.exc_info()
-                after = time.time()
-                log.debug(
-                    "Synced %s in %.2f sec", self.api.__class__.__name__,
-                    after-before
-                )
+        :param executor: A PatronActivityExecutor. Only intended for
+            use in tests; by default the executor shared by this process
+            is used.
 
-        threads = []
+        :return: A 3-tuple (loans, holds, complete). `loans` and
+            `holds` contain `LoanInfo` and `HoldInfo` objects. `complete`
+            is False if any source failed or timed out.
+        """
+        executor = executor or PatronActivityExecutor.instance()
         before = time.time()
+        deadline = before + self.PATRON_ACTIVITY_DEADLINE
+        tasks = []
         for api in self.api_for_collection.values():
-            thread = PatronActivityThread(api, patron, pin)
-            threads.append(thread)
-        for thread in threads:
-            thread.start()
-        for thread in threads:
-            thread.join()
+            task = PatronActivityTask(
+                api, patron, pin, on_complete=self._record_patron_activity_latency
+            )
+            tasks.append(task)
+            executor.submit(task)
+
         loans = []
         holds = []
         complete = True
-        for thread in threads:
-            if thread.exception:
+        for task in tasks:
+            # Don't wait past the overall deadline, or past the time
+            # this particular API is allowed to take.
+            wait_until = deadline
+            timeout = getattr(task.api, 'PATRON_ACTIVITY_TIMEOUT', None)
+            if timeout is not None:
+                wait_until = min(wait_until, before + timeout)
+            if not task.wait(wait_until - time.time()):
+                # We can't wait any longer for this API, so we don't
+                # have a complete picture of the patron's loans. If
+                # the task hasn't started yet, it never will.
+                task.cancel()
+                complete = False
+                self.log.warn(
+                    "%s did not report patron activity within %.2f sec",
+                    task.name, wait_until-before
+                )
+                continue
+            if task.patron_not_found:
+                # The worker thread couldn't see the patron, so the
+                # task has to run here, in our session.
+                task.run_in(self._db, patron)
+            if task.exception:
                 # Something went wrong, so we don't have a complete
                 # picture of the patron's loans.
                 complete = False
                 self.log.error(
-                    "%s errored out: %s", thread.api.__class__.__name__,
-                    thread.exception,
-                    exc_info=thread.trace
+                    "%s errored out: %s", task.name, task.exception,
+                    exc_info=task.trace
                 )
-            if thread.activity:
-                for i in thread.activity:
+            if task.activity:
+                for i in task.activity:
                     l = None
                     if isinstance(i, LoanInfo):
                         l = loans
@@ -1141,11 +1363,31 @@ class CirculationAPI(object):
         self.log.debug("Full sync took %.2f sec", after-before)
         return loans, holds, complete
 
+    @classmethod
+    def _record_patron_activity_latency(cls, task):
+        """Note how long an API took to report patron activity."""
+        cls.patron_activity_histogram(task.name).record(task.elapsed)
+        logging.getLogger("Circulation API").debug(
+            "Synced %s in %.2f sec", task.name, task.elapsed
+        )
+
+    @classmethod
+    def patron_activity_histogram(cls, name):
+        """Find or create the LatencyHistogram for the named API."""
+        with cls._patron_activity_latency_lock:
+            histogram = cls.patron_activity_latency.get(name)
+            if not histogram:
+                histogram = LatencyHistogram()
+                cls.patron_activity_latency[name] = histogram
+            return histogram
+
     def local_loans(self, patron):
         return self._db.query(Loan).join(Loan.license_pool).filter(
             LicensePool.collection_id.in_(self.collection_ids_for_sync)
         ).filter(
             Loan.patron==patron
+        ).options(
+            joinedload(Loan.license_pool).joinedload(LicensePool.identifier)
         )
 
     def local_holds(self, patron):
@@ -1153,8 +1395,61 @@ class CirculationAPI(object):
             LicensePool.collection_id.in_(self.collection_ids_for_sync)
         ).filter(
             Hold.patron==patron
+        ).options(
+            joinedload(Hold.license_pool).joinedload(LicensePool.identifier)
         )
 
+    def license_pools_for(self, infos):
+        """Find the LicensePools for a number of CirculationInfo objects
+        with as few database queries as possible.
+
+        :param infos: A list of CirculationInfo objects.
+        :return: A dictionary mapping each CirculationInfo to its
+            LicensePool. LicensePools that didn't already exist are
+            created.
+        """
+        def key(info):
+            data_source_name = info.data_source_name
+            if isinstance(data_source_name, DataSource):
+                data_source_name = data_source_name.name
+            return (info.collection_id, data_source_name,
+                    info.identifier_type, info.identifier)
+
+        found = {}
+        wanted = set(key(info) for info in infos)
+        if wanted:
+            pairs = set((k[2], k[3]) for k in wanted)
+            collection_ids = set(k[0] for k in wanted)
+            qu = self._db.query(LicensePool).join(
+                LicensePool.identifier
+            ).join(
+                LicensePool.data_source
+            ).filter(
+                LicensePool.collection_id.in_(list(collection_ids))
+            ).filter(
+                tuple_(Identifier.type, Identifier.identifier).in_(list(pairs))
+            ).options(
+                joinedload(LicensePool.identifier),
+                joinedload(LicensePool.data_source)
+            )
+            for pool in qu:
+                pool_key = (
+                    pool.collection_id, pool.data_source.name,
+                    pool.identifier.type, pool.identifier.identifier
+                )
+                if pool_key in wanted:
+                    found[pool_key] = pool
+
+        pools = {}
+        for info in infos:
+            pool = found.get(key(info))
+            if not pool:
+                # This LicensePool needs to be created.
+                pool = info.license_pool(self._db)
+                found[key(info)] = pool
+            pools[info] = pool
+        return pools
+
     def sync_bookshelf(self, patron, pin, force=False):
         """Sync our internal model of a patron's bookshelf with any external
         vendors that provide books to the patron's library.
@@ -1221,12 +1516,24 @@ class CirculationAPI(object):
             key = (i.type, i.identifier)
             local_holds_by_identifier[key] = h
 
-        active_loans = []
-        active_holds = []
+        # Look up the LicensePools for any remote loans and holds we
+        # don't already know about, all at once.
+        unknown = [
+            x for x in remote_loans
+            if (x.identifier_type, x.identifier) not in local_loans_by_identifier
+        ] + [
+            x for x in remote_holds
+            if (x.identifier_type, x.identifier) not in local_holds_by_identifier
+        ]
+        pools = self.license_pools_for(unknown)
+
+        found_loans = []
+        found_holds = []
+        new_loans = {}
+        new_holds = {}
         for loan in remote_loans:
             # This is a remote loan. Find or create the corresponding
             # local loan.
-            pool = loan.license_pool(self._db)
             start = loan.start_date
             end = loan.end_date
             key = (loan.identifier_type, loan.identifier)
@@ -1241,48 +1548,64 @@ class CirculationAPI(object):
                     local_loan.start = start
                 if end:
                     local_loan.end = end
-            else:
-                local_loan, new = pool.loan_to(patron, start, end)
-
-            if loan.locked_to:
-                # The loan source is letting us know that the loan is
-                # locked to a specific delivery mechanism. Even if
-                # this is the first we've heard of this loan,
-                # it may have been created in another app or through
-                # a library-website integration.
-                loan.locked_to.apply(local_loan, autocommit=False)
-            active_loans.append(local_loan)
 
-            # Check the local loan off the list we're keeping so we
-            # don't delete it later.
-            key = (loan.identifier_type, loan.identifier)
-            if key in local_loans_by_identifier:
+                # Check the local loan off the list we're keeping so we
+                # don't delete it later.
                 del local_loans_by_identifier[key]
+            else:
+                # As far as we know, the patron has no local loan for
+                # this LicensePool, so we can create one without
+                # looking for it first. All the new loans will be
+                # created together. (If the remote mentioned this loan
+                # twice, only one will be created.)
+                local_loan = None
+                new_loans[key] = (pools[loan], start or now, end)
+            found_loans.append((key, loan, local_loan))
 
         for hold in remote_holds:
             # This is a remote hold. Find or create the corresponding
             # local hold.
-            pool = hold.license_pool(self._db)
-            start = hold.start_date
-            end = hold.end_date
-            position = hold.hold_position
             key = (hold.identifier_type, hold.identifier)
             if key in local_holds_by_identifier:
                 # We already have the Hold object, we don't need to look
                 # it up again.
                 local_hold = local_holds_by_identifier[key]
 
-                # But maybe the remote's opinions as to the hold's
-                # start or end date have changed.
-                local_hold.update(start, end, position)
+                # Check the local hold off the list we're keeping so that
+                # we don't delete it later.
+                del local_holds_by_identifier[key]
             else:
-                local_hold, new = pool.on_hold_to(patron, start, end, position)
-            active_holds.append(local_hold)
+                local_hold = None
+                new_holds[key] = pools[hold]
+            found_holds.append((key, hold, local_hold))
 
-            # Check the local hold off the list we're keeping so that
-            # we don't delete it later.
-            if key in local_holds_by_identifier:
-                del local_holds_by_identifier[key]
+        created_loans, created_holds = self._create_loans_and_holds(
+            patron, new_loans, new_holds
+        )
+
+        active_loans = []
+        for key, loan, local_loan in found_loans:
+            if local_loan is None:
+                local_loan = created_loans[key]
+            if loan.locked_to:
+                # The loan source is letting us know that the loan is
+                # locked to a specific delivery mechanism. Even if
+                # this is the first we've heard of this loan,
+                # it may have been created in another app or through
+                # a library-website integration.
+                loan.locked_to.apply(local_loan, autocommit=False)
+            active_loans.append(local_loan)
+
+        active_holds = []
+        for key, hold, local_hold in found_holds:
+            if local_hold is None:
+                local_hold = created_holds[key]
+            # Maybe the remote's opinions as to the hold's start or
+            # end date have changed.
+            local_hold.update(
+                hold.start_date, hold.end_date, hold.hold_position
+            )
+            active_holds.append(local_hold)
 
         # We only want to delete local loans and holds if we were able to
         # successfully sync with all the providers. If there was an error,
@@ -1295,21 +1618,27 @@ class CirculationAPI(object):
             # borrowing a book and syncing their bookshelf at the same time,
             # and the local loan was created after we got the remote loans.
             # If the loan's start date is less than a minute ago, we'll keep it.
+            one_minute_ago = datetime.datetime.utcnow() - datetime.timedelta(minutes=1)
+            doomed_loans = []
             for loan in local_loans_by_identifier.values():
                 if loan.license_pool.collection_id in self.collection_ids_for_sync:
-                    one_minute_ago = datetime.datetime.utcnow() - datetime.timedelta(minutes=1)
                     if loan.start < one_minute_ago:
                         logging.info("In sync_bookshelf for patron %s, deleting loan %d (patron %s)" % (patron.authorization_identifier, loan.id, loan.patron.authorization_identifier))
-                        self._db.delete(loan)
+                        doomed_loans.append(loan)
                     else:
                         logging.info("In sync_bookshelf for patron %s, found local loan %d created in the past minute that wasn't in remote loans" % (patron.authorization_identifier, loan.id))
 
             # Every hold remaining in holds_by_identifier is a hold that
             # the provider doesn't know about, which means it's expired
             # and we should get rid of it.
-            for hold in local_holds_by_identifier.values():
-                if hold.license_pool.collection_id in self.collection_ids_for_sync:
-                    self._db.delete(hold)
+            doomed_holds = [
+                hold for hold in local_holds_by_identifier.values()
+                if hold.license_pool.collection_id in self.collection_ids_for_sync
+            ]
+            self._bulk_delete(Loan, doomed_loans)
+            self._bulk_delete(Hold, doomed_holds)
+            if patron and (doomed_loans or doomed_holds):
+                self._db.expire(patron, ['loans', 'holds'])
 
         # Now that we're in sync (or not), set last_loan_activity_sync
         # to the conservative value obtained earlier.
@@ -1319,6 +1648,63 @@ class CirculationAPI(object):
         __transaction.commit()
         return active_loans, active_holds
 
+    def _create_loans_and_holds(self, patron, new_loans, new_holds):
+        """Create Loans and Holds that the patron didn't have when we
+        looked.
+
+        They're all inserted at once. If that fails because one of
+        them was created in the meantime -- say, the patron borrowed a
+        book while their bookshelf was being synced -- they're found
+        or created one at a time instead.
+
+        :param new_loans: A dictionary mapping keys to (LicensePool,
+            start, end) 3-tuples.
+        :param new_holds: A dictionary mapping keys to LicensePools.
+        :return: A 2-tuple of dictionaries mapping the same keys to
+            Loans and Holds.
+        """
+        if not new_loans and not new_holds:
+            return {}, {}
+        __transaction = self._db.begin_nested()
+        loans = dict(
+            (key, Loan(patron=patron, license_pool=pool, start=start, end=end))
+            for key, (pool, start, end) in new_loans.items()
+        )
+        holds = dict(
+            (key, Hold(patron=patron, license_pool=pool))
+            for key, pool in new_holds.items()
+        )
+        try:
+            self._db.add_all(loans.values() + holds.values())
+            self._db.flush()
+            __transaction.commit()
+        except IntegrityError, e:
+            __transaction.rollback()
+            self.log.info(
+                "Loans or holds for patron %s were created during sync, finding them one at a time: %s",
+                patron.authorization_identifier, e
+            )
+            loans = dict(
+                (key, pool.loan_to(patron, start=start, end=end)[0])
+                for key, (pool, start, end) in new_loans.items()
+            )
+            holds = dict(
+                (key, pool.on_hold_to(patron)[0])
+                for key, pool in new_holds.items()
+            )
+        return loans, holds
+
+    def _bulk_delete(self, model, objects):
+        """Delete a number of Loans or Holds with a single query."""
+        if not objects:
+            return
+        ids = [x.id for x in objects]
+        self._db.query(model).filter(model.id.in_(ids)).delete(
+            synchronize_session=False
+        )
+        for x in objects:
+            self._db.expunge(x)
+
 
 class BaseCirculationAPI(object):
     """Encapsulates logic common to all circulation APIs."""
@@ -1372,6 +1758,11 @@ class BaseCirculationAPI(object):
     # cannot revoke their hold on the book.
     CAN_REVOKE_HOLD_WHEN_RESERVED = True
 
+    # If this API takes longer than this many seconds to report a
+    # patron's activity, CirculationAPI.patron_activity stops waiting
+    # for it. If this is None, only the overall deadline applies.
+    PATRON_ACTIVITY_TIMEOUT = 20
+
     # If the client must set a delivery mechanism at the point of
     # checkout (Axis 360), set this to BORROW_STEP. If the client may
     # wait til the point of fulfillment to set a delivery mechanism
@@ -1388,6 +1779,16 @@ class BaseCirculationAPI(object):
     # is called "ebook-epub-adobe" in Overdrive.
     delivery_mechanism_to_internal_format = {}
 
+    def in_session(self, _db):
+        """Get a copy of this API that uses the given database session.
+
+        CirculationAPI.patron_activity uses this to talk to the API
+        from a worker thread without sharing the caller's session.
+        """
+        api = copy.copy(self)
+        api._db = _db
+        return api
+
     def internal_format(self, delivery_mechanism):
         """Look up the internal format for this delivery mechanism or
         raise an exception.
@@ -1414,10 +1815,10 @@ class BaseCirculationAPI(object):
         """
         if isinstance(library_or_patron, Patron):
             library_or_patron = library_or_patron.library
-        return ConfigurationSetting.for_library(
+        return LibrarySettings.value_for(
             Configuration.DEFAULT_NOTIFICATION_EMAIL_ADDRESS,
             library_or_patron
-        ).value
+        )
 
     @classmethod
     def _library_authenticator(self, library):
@@ -10,6 +10,7 @@ from Crypto.Cipher import PKCS1_OAEP
 from flask_babel import lazy_gettext as _
 
 from .announcements import Announcements
+from .library_settings import LibrarySettings
 
 from core.config import (
     Configuration as CoreConfiguration,
@@ -586,8 +587,7 @@ class Configuration(CoreConfiguration):
         :yield: A sequence of 2-tuples (media type, URL)
         """
         for name in cls.HELP_LINKS:
-            setting = ConfigurationSetting.for_library(name, library)
-            value = setting.value
+            value = LibrarySettings.value_for(name, library)
             if not value:
                 continue
             type = None
@@ -606,7 +606,7 @@ class Configuration(CoreConfiguration):
         :param key: The specific email address to look for.
         """
         for setting in [key, Configuration.HELP_EMAIL]:
-            value = ConfigurationSetting.for_library(setting, library).value
+            value = LibrarySettings.value_for(setting, library)
             if not value:
                 continue
             return cls._as_mailto(value)
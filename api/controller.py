@@ -97,7 +97,6 @@ from core.model import (
     Loan,
     LicensePoolDeliveryMechanism,
     Patron,
-    Representation,
     Session,
 )
 from core.opds import (
@@ -109,7 +108,6 @@ from core.opensearch import OpenSearchDocument
 from core.user_profile import ProfileController as CoreProfileController
 from core.util.authentication_for_opds import AuthenticationForOPDSDocument
 from core.util.http import (
-    HTTP,
     RemoteIntegrationException,
 )
 from core.util.opds_writer import (
@@ -131,6 +129,7 @@ from lanes import (
     CrawlableCustomListBasedLane,
     CrawlableFacets,
 )
+from library_settings import LibrarySettings
 from odl import ODLAPI
 from opds import (
     CirculationManagerAnnotator,
@@ -141,6 +140,7 @@ from opds import (
 )
 from problem_details import *
 from shared_collection import SharedCollectionAPI
+from streaming_proxy import StreamingProxy
 from testing import MockCirculationAPI, MockSharedCollectionAPI
 
 class CirculationManager(object):
@@ -232,6 +232,14 @@ class CirculationManager(object):
 
         self.setup_external_search()
 
+        # Load every library's settings at once, so that requests can
+        # look them up without going to the database.
+        self.library_settings = LibrarySettings.load(self._db)
+
+        # The configuration may have been changed by another process,
+        # so the Short Client Token configuration has to be reloaded.
+        AuthdataUtility.reset_cache()
+
         # Track the Lane configuration for each library by mapping its
         # short name to the top-level lane.
         new_top_level_lanes = {}
@@ -1462,8 +1470,11 @@ class LoanController(CirculationManagerController):
         :param part: Vendor-specific identifier used when fulfilling a
            specific part of a book rather than the whole thing (e.g. a
            single chapter of an audiobook).
+
+        :param do_get: A function used to retrieve content that has to
+           be proxied, which reads it all into memory. By default, the
+           content is streamed to the client as it arrives instead.
         """
-        do_get = do_get or Representation.simple_http_get
 
         # Unlike most controller methods, this one has different
         # behavior whether or not the patron is authenticated. This is
@@ -1609,6 +1620,15 @@ class LoanController(CirculationManagerController):
                 # of redirecting to it, since it may be downloaded through an
                 # indirect acquisition link.
                 try:
+                    if not do_get:
+                        proxy_headers = StreamingProxy.client_headers(
+                            flask.request.headers
+                        )
+                        proxy_headers.update(encoding_header)
+                        return StreamingProxy().proxy(
+                            fulfillment.content_link, headers=proxy_headers,
+                            content_type=fulfillment.content_type
+                        )
                     status_code, headers, content = do_get(fulfillment.content_link, headers=encoding_header)
                     headers = dict(headers)
                 except RemoteIntegrationException, e:
@@ -1747,7 +1767,24 @@ class AnnotationController(CirculationManagerController):
                                '<http://www.w3.org/TR/annotation-protocol/>; rel="http://www.w3.org/ns/ldp#constrainedBy"']
             headers['Content-Type'] = AnnotationWriter.CONTENT_TYPE
 
-            container, timestamp = AnnotationWriter.annotation_container_for(patron, identifier=identifier)
+            pagination = load_pagination_from_request(
+                Pagination, default_size=AnnotationWriter.PAGE_SIZE
+            )
+            if isinstance(pagination, ProblemDetail):
+                return pagination
+
+            if pagination.offset:
+                # The client is following a 'next' link to a later
+                # page of annotations. The page isn't a container.
+                del headers['Link']
+                page = AnnotationWriter.annotation_page_for(
+                    patron, identifier=identifier, pagination=pagination
+                )
+                return Response(json.dumps(page), status=200, headers=headers)
+
+            container, timestamp = AnnotationWriter.annotation_container_for(
+                patron, identifier=identifier, pagination=pagination
+            )
             etag = 'W/""'
             if timestamp:
                 etag = 'W/"%s"' % timestamp
@@ -2282,7 +2319,7 @@ class SharedCollectionController(CirculationManagerController):
             return COULD_NOT_MIRROR_TO_REMOTE.detailed(unicode(e))
         return Response(_("Success"), 200)
 
-    def fulfill(self, collection_name, loan_id, mechanism_id, do_get=HTTP.get_with_timeout):
+    def fulfill(self, collection_name, loan_id, mechanism_id, do_get=None):
         collection = self.load_collection(collection_name)
         if isinstance(collection, ProblemDetail):
             return collection
@@ -2325,6 +2362,12 @@ class SharedCollectionController(CirculationManagerController):
             # be able to access it if the remote server does not support CORS requests.
             # We need to fetch the content and return it instead of redirecting to it.
             try:
+                if not do_get:
+                    return StreamingProxy().proxy(
+                        fulfillment.content_link,
+                        headers=StreamingProxy.client_headers(flask.request.headers),
+                        content_type=fulfillment.content_type
+                    )
                 response = do_get(fulfillment.content_link)
                 status_code = response.status_code
                 headers = dict(response.headers)
@@ -2397,8 +2440,10 @@ class RBDFulfillmentProxyController(CirculationManagerController):
         fulfillment_url = flask.request.values.get('url', None)
 
         try:
-            response = RBDigitalFulfillmentProxy.proxy(self._db, bearer, fulfillment_url,
-                                                       api_class=api_class)
+            response = RBDigitalFulfillmentProxy.proxy(
+                self._db, bearer, fulfillment_url, api_class=api_class,
+                headers=StreamingProxy.client_headers(flask.request.headers)
+            )
         except RBDProxyException as e:
             status = e.message.get('status', 500)
             message = e.message.get('message', 'unspecified error')
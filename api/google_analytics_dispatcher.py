@@ -0,0 +1,403 @@
+"""Send Google Analytics hits from a background thread.
+
+Sending a hit to the Measurement Protocol means an HTTP request to
+Google, and analytics events are collected in the middle of borrow,
+fulfill and hold requests. Rather than making the patron wait for
+Google, hits are put on a bounded in-process queue and a background
+thread sends them in batches of up to 20, which is the most the
+/batch endpoint will accept.
+
+If the queue fills up, or Google can't be reached even after a few
+retries, hits are appended to a local spill file instead of being
+lost. The spill file is sent once the queue has drained.
+"""
+import atexit
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+from Queue import (
+    Queue,
+    Empty,
+    Full,
+)
+
+from nose.tools import set_trace
+
+from core.util.http import HTTP
+
+
+class GoogleAnalyticsDispatcher(object):
+    """Sends the hits for a single Measurement Protocol URL."""
+
+    log = logging.getLogger("Google Analytics dispatcher")
+
+    # The /batch endpoint accepts at most this many hits per request.
+    MAX_BATCH_SIZE = 20
+
+    # By default, keep up to this many unsent hits in memory.
+    DEFAULT_QUEUE_SIZE = 1000
+
+    # Try to send a batch this many times before giving up on it.
+    MAX_ATTEMPTS = 4
+
+    # Wait this many seconds before the first retry, doubling the
+    # wait before each subsequent retry.
+    BACKOFF = 1
+
+    # Google discards hits that are more than four hours old, so
+    # there's no point in keeping them around any longer than that.
+    MAX_HIT_AGE = 4 * 60 * 60
+
+    # By default, wait up to this many seconds for queued hits to be
+    # sent when the process shuts down.
+    SHUTDOWN_TIMEOUT = 5
+
+    # The directory for spill files can be set through this
+    # environment variable. It defaults to the system's temporary
+    # directory.
+    SPILL_DIRECTORY_ENVIRONMENT_VARIABLE = "SIMPLIFIED_GOOGLE_ANALYTICS_SPILL_DIRECTORY"
+
+    # Dispatchers are shared across threads, one per URL.
+    _dispatchers = {}
+    _dispatchers_lock = threading.Lock()
+
+    @classmethod
+    def for_url(cls, url):
+        """Find or create the dispatcher for the given collect URL."""
+        with cls._dispatchers_lock:
+            dispatcher = cls._dispatchers.get(url)
+            if not dispatcher:
+                dispatcher = cls(url)
+                cls._dispatchers[url] = dispatcher
+            return dispatcher
+
+    @classmethod
+    def shutdown_all(cls, timeout=None):
+        """Send or spill the hits queued by every dispatcher.
+
+        This is called automatically when the process exits.
+        """
+        with cls._dispatchers_lock:
+            dispatchers = cls._dispatchers.values()
+        for dispatcher in dispatchers:
+            dispatcher.shutdown(timeout)
+
+    @classmethod
+    def reset(cls):
+        """Shut down and forget about every dispatcher. Mainly for use in
+        tests.
+        """
+        cls.shutdown_all(timeout=0)
+        with cls._dispatchers_lock:
+            cls._dispatchers = {}
+
+    @classmethod
+    def batch_url_for(cls, url):
+        """Find the /batch endpoint that corresponds to a /collect endpoint.
+
+        :return: A URL, or None if `url` doesn't look like a
+            Measurement Protocol /collect endpoint, in which case hits
+            have to be sent one at a time.
+        """
+        base, ignore, path = url.rstrip("/").rpartition("/")
+        if base and path == "collect":
+            return base + "/batch"
+        return None
+
+    @classmethod
+    def default_spill_path(cls, url):
+        directory = (
+            os.environ.get(cls.SPILL_DIRECTORY_ENVIRONMENT_VARIABLE)
+            or tempfile.gettempdir()
+        )
+        filename = "google-analytics-%s.spill" % hashlib.md5(url).hexdigest()
+        return os.path.join(directory, filename)
+
+    def __init__(self, url, queue_size=None, spill_path=None,
+                 clock=time.time, sleep=time.sleep):
+        """Constructor.
+
+        :param url: The Measurement Protocol /collect URL.
+        :param queue_size: The maximum number of hits to keep in memory.
+        :param spill_path: Path to the file where hits go when they
+            can't be kept in memory.
+        :param clock: A callable returning the current time, in seconds.
+            Only intended for use in tests.
+        :param sleep: A callable used to wait between retries. Only
+            intended for use in tests.
+        """
+        self.url = url
+        self.batch_url = self.batch_url_for(url)
+        if queue_size is None:
+            queue_size = self.DEFAULT_QUEUE_SIZE
+        self.queue = Queue(maxsize=queue_size)
+        self.spill_path = spill_path or self.default_spill_path(url)
+        self.clock = clock
+        self.sleep = sleep
+
+        self.lock = threading.Lock()
+        self.spill_lock = threading.Lock()
+        self.worker = None
+        self.worker_pid = None
+        self.stopping = False
+
+        # Counters, so we can tell how the dispatcher is doing.
+        self.sent = 0
+        self.spilled = 0
+        self.dropped = 0
+        self.failed_requests = 0
+
+    @property
+    def queue_depth(self):
+        """The number of hits waiting in memory to be sent."""
+        return self.queue.qsize()
+
+    def metrics(self):
+        """Summarize the state of the dispatcher.
+
+        :return: A dictionary suitable for logging or for display.
+        """
+        return dict(
+            queue_depth=self.queue_depth,
+            sent=self.sent,
+            spilled=self.spilled,
+            dropped=self.dropped,
+            failed_requests=self.failed_requests,
+        )
+
+    def enqueue(self, params):
+        """Arrange for a hit to be sent in the background.
+
+        :param params: The hit, as a urlencoded string.
+        """
+        hit = (params, self.clock())
+        if self.stopping:
+            self.spill([hit])
+            return
+        self.ensure_worker()
+        try:
+            self.queue.put_nowait(hit)
+        except Full:
+            self.spill([hit])
+
+    def ensure_worker(self):
+        """Make sure a background thread is sending hits.
+
+        A thread doesn't survive a fork, so a new one is started if this
+        dispatcher was created in a parent process.
+        """
+        pid = os.getpid()
+        with self.lock:
+            if (self.worker and self.worker_pid == pid
+                and self.worker.is_alive()):
+                return
+            self.worker = threading.Thread(
+                target=self.run, name="Google Analytics dispatcher"
+            )
+            self.worker.daemon = True
+            self.worker_pid = pid
+            self.worker.start()
+
+    def run(self):
+        """Send hits until the dispatcher is shut down."""
+        while not self.stopping:
+            try:
+                if not self.dispatch(timeout=1):
+                    self.resend_spilled()
+            except Exception, e:
+                self.log.error(
+                    "Unexpected error sending Google Analytics hits",
+                    exc_info=e
+                )
+
+    def dispatch(self, timeout=None):
+        """Take up to one batch of hits off the queue and send them.
+
+        :param timeout: Wait up to this many seconds for a hit to show
+            up. If this is None, don't wait at all.
+        :return: The number of hits taken off the queue.
+        """
+        try:
+            if timeout is None:
+                hits = [self.queue.get_nowait()]
+            else:
+                hits = [self.queue.get(timeout=timeout)]
+        except Empty:
+            return 0
+        while len(hits) < self.MAX_BATCH_SIZE:
+            try:
+                hits.append(self.queue.get_nowait())
+            except Empty:
+                break
+        try:
+            self.send(hits)
+        finally:
+            for hit in hits:
+                self.queue.task_done()
+        return len(hits)
+
+    def send(self, hits):
+        """Send hits to Google, retrying with backoff if necessary.
+
+        Hits that still can't be sent are spilled to disk.
+
+        :param hits: A list of (params, queued_at) 2-tuples.
+        """
+        hits = self.current_hits(hits)
+        if not hits:
+            return
+        if self.batch_url:
+            batches = [
+                (self.batch_url, hits[i:i+self.MAX_BATCH_SIZE])
+                for i in range(0, len(hits), self.MAX_BATCH_SIZE)
+            ]
+        else:
+            batches = [(self.url, [hit]) for hit in hits]
+
+        unsent = []
+        for url, batch in batches:
+            if self.post_with_retries(url, batch):
+                self.sent += len(batch)
+            else:
+                unsent.extend(batch)
+        if unsent:
+            self.spill(unsent)
+
+    def current_hits(self, hits):
+        """Discard hits too old for Google to accept."""
+        now = self.clock()
+        current = [
+            (params, queued_at) for params, queued_at in hits
+            if now - queued_at <= self.MAX_HIT_AGE
+        ]
+        self.dropped += len(hits) - len(current)
+        return current
+
+    def post_with_retries(self, url, batch):
+        """Try a few times to send a batch of hits to Google.
+
+        :return: True if the batch was sent, False if it wasn't.
+        """
+        delay = self.BACKOFF
+        for attempt in range(self.MAX_ATTEMPTS):
+            if attempt:
+                self.sleep(delay)
+                delay *= 2
+            payload = self.payload(batch)
+            try:
+                self.post(url, payload)
+                return True
+            except Exception, e:
+                self.failed_requests += 1
+                self.log.warn(
+                    "Could not send %d hit(s) to %s (attempt %d of %d): %r",
+                    len(batch), url, attempt+1, self.MAX_ATTEMPTS, e
+                )
+        return False
+
+    def payload(self, batch):
+        """Turn a batch of hits into a request body.
+
+        Each hit gets a queue time ('qt') so that Google records it as
+        happening when it was collected rather than when it was sent.
+        """
+        now = self.clock()
+        hits = []
+        for params, queued_at in batch:
+            queue_time = int(max(now - queued_at, 0) * 1000)
+            hits.append("%s&qt=%d" % (params, queue_time))
+        return "\n".join(hits)
+
+    def post(self, url, payload):
+        HTTP.post_with_timeout(url, payload)
+
+    def spill(self, hits):
+        """Append hits to the spill file so they can be sent later."""
+        lines = "".join("%f\t%s\n" % (queued_at, params)
+                        for params, queued_at in hits)
+        try:
+            with self.spill_lock:
+                with open(self.spill_path, "a") as spill_file:
+                    spill_file.write(lines)
+                self.spilled += len(hits)
+        except IOError, e:
+            self.dropped += len(hits)
+            self.log.error(
+                "Could not spill %d Google Analytics hit(s) to %s: %r",
+                len(hits), self.spill_path, e
+            )
+
+    def take_spilled(self):
+        """Remove every hit from the spill file.
+
+        :return: A list of (params, queued_at) 2-tuples.
+        """
+        with self.spill_lock:
+            if not os.path.exists(self.spill_path):
+                return []
+            # Move the file out of the way first, so that another
+            # process sharing the spill file doesn't send the same hits.
+            claimed_path = "%s.%d" % (self.spill_path, os.getpid())
+            try:
+                os.rename(self.spill_path, claimed_path)
+            except OSError, e:
+                return []
+            with open(claimed_path) as spill_file:
+                lines = spill_file.readlines()
+            os.remove(claimed_path)
+
+        hits = []
+        for line in lines:
+            queued_at, ignore, params = line.rstrip("\n").partition("\t")
+            try:
+                hits.append((params, float(queued_at)))
+            except ValueError, e:
+                self.dropped += 1
+        return hits
+
+    def resend_spilled(self):
+        """Send the hits in the spill file, if there are any."""
+        hits = self.take_spilled()
+        if hits:
+            self.log.info("Resending %d spilled hit(s).", len(hits))
+            self.send(hits)
+
+    def flush(self, timeout=None):
+        """Wait for the queue to empty out.
+
+        :return: True if every queued hit was handled, False if the
+            timeout ran out first.
+        """
+        if timeout is None:
+            timeout = self.SHUTDOWN_TIMEOUT
+        deadline = self.clock() + timeout
+        while self.queue.unfinished_tasks:
+            if not (self.worker and self.worker.is_alive()):
+                return False
+            if self.clock() >= deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def shutdown(self, timeout=None):
+        """Give the worker a chance to send queued hits, then spill
+        whatever is left so it isn't lost.
+        """
+        self.flush(timeout)
+        self.stopping = True
+        leftover = []
+        while True:
+            try:
+                leftover.append(self.queue.get_nowait())
+            except Empty:
+                break
+            self.queue.task_done()
+        if leftover:
+            self.spill(leftover)
+        self.log.info("Shutting down: %r", self.metrics())
+
+
+atexit.register(GoogleAnalyticsDispatcher.shutdown_all)
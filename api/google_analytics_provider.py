@@ -4,7 +4,7 @@ import unicodedata
 import urllib
 import re
 from flask_babel import lazy_gettext as _
-from core.util.http import HTTP
+from google_analytics_dispatcher import GoogleAnalyticsDispatcher
 from core.model import (
     ConfigurationSetting,
     ExternalIntegration,
@@ -126,7 +126,9 @@ class GoogleAnalyticsProvider(object):
         self.post(self.url, params)
 
     def post(self, url, params):
-        response = HTTP.post_with_timeout(url, params)
+        # Sending the hit happens in the background, so that a slow
+        # response from Google doesn't slow down the patron's request.
+        GoogleAnalyticsDispatcher.for_url(url).enqueue(params)
 
 
 Provider = GoogleAnalyticsProvider
@@ -0,0 +1,145 @@
+"""A snapshot of each library's ConfigurationSettings.
+
+Building an OPDS feed or an Authentication For OPDS document means
+looking up dozens of per-library settings, and each call to
+ConfigurationSetting.for_library is a database query. The
+CirculationManager loads every library's settings with a single query
+when it loads its configuration, and reloads them whenever the site
+configuration changes. Code that runs during a request can then use
+LibrarySettings.value_for to look up a setting without going to the
+database.
+"""
+import json
+import logging
+
+import flask
+from nose.tools import set_trace
+
+from core.model import (
+    ConfigurationSetting,
+    Session,
+)
+
+
+class LibrarySettings(object):
+    """The values of all the ConfigurationSettings associated with a
+    single library, as of the time they were loaded.
+    """
+
+    log = logging.getLogger("Library settings")
+
+    def __init__(self, library_id, values=None, defaults=None):
+        """Constructor.
+
+        :param library_id: The ID of the Library these settings belong to.
+        :param values: A dictionary mapping (key, external integration ID)
+            to the value of a setting. Settings that don't belong to
+            an integration have None for the integration ID.
+        :param defaults: A dictionary like `values`, containing the
+            settings that don't belong to any library. A library
+            setting that's not set falls back to one of these, the
+            same way ConfigurationSetting.value does: to the
+            integration's own setting, or, for a setting that doesn't
+            belong to an integration, to the sitewide setting.
+        """
+        self.library_id = library_id
+        self._values = values or {}
+        self._defaults = defaults or {}
+
+        # The number of database lookups this snapshot has avoided.
+        self.lookups_saved = 0
+
+    @classmethod
+    def load(cls, _db):
+        """Load the settings for every library.
+
+        :return: A dictionary mapping library ID to LibrarySettings.
+        """
+        values = {}
+        defaults = {}
+        qu = _db.query(
+            ConfigurationSetting.library_id,
+            ConfigurationSetting.external_integration_id,
+            ConfigurationSetting.key,
+            ConfigurationSetting.value,
+        )
+        for library_id, integration_id, key, value in qu:
+            if library_id is None:
+                defaults[(key, integration_id)] = value
+            else:
+                values.setdefault(library_id, {})[(key, integration_id)] = value
+        return dict(
+            (library_id, cls(library_id, library_values, defaults))
+            for library_id, library_values in values.items()
+        )
+
+    def for_request(self):
+        """Create a LibrarySettings that shares this one's values but
+        counts its own lookups, so they can be reported for a single
+        request.
+        """
+        return LibrarySettings(self.library_id, self._values, self._defaults)
+
+    def value(self, key, integration=None):
+        """Look up the value of a setting.
+
+        :param integration: If this is provided, look up the setting
+            for the library and this ExternalIntegration.
+        :return: The value of the setting, or None if neither it nor
+            the setting it falls back to is set.
+        """
+        integration_id = None
+        if integration is not None:
+            integration_id = integration.id
+        self.lookups_saved += 1
+        value = self._values.get((key, integration_id))
+        if not value:
+            value = self._defaults.get((key, integration_id))
+        return value
+
+    @classmethod
+    def current(cls, library):
+        """Find the settings snapshot for `library` that was attached
+        to the current request, if there is one.
+        """
+        if library is None or not flask.has_request_context():
+            return None
+        settings = getattr(flask.request, 'library_settings', None)
+        if settings is None or settings.library_id != library.id:
+            return None
+        return settings
+
+    @classmethod
+    def value_for(cls, key, library, integration=None):
+        """Look up the value of a library's setting, from the current
+        request's snapshot if possible and from the database otherwise.
+        """
+        settings = cls.current(library)
+        if settings is not None:
+            return settings.value(key, integration)
+        if integration is not None:
+            _db = Session.object_session(integration)
+            return ConfigurationSetting.for_library_and_externalintegration(
+                _db, key, library, integration
+            ).value
+        return ConfigurationSetting.for_library(key, library).value
+
+    @classmethod
+    def json_value_for(cls, key, library, integration=None):
+        """Look up a library's setting and interpret it as JSON."""
+        value = cls.value_for(key, library, integration)
+        if not value:
+            return None
+        return json.loads(value)
+
+    @classmethod
+    def report(cls):
+        """Log how many database lookups were avoided during the current
+        request.
+        """
+        settings = getattr(flask.request, 'library_settings', None)
+        if settings is not None and settings.lookups_saved:
+            cls.log.debug(
+                "Library settings snapshot saved %d database lookups for %s",
+                settings.lookups_saved, flask.request.path
+            )
@@ -1,5 +1,6 @@
 from nose.tools import set_trace
 import logging
+import zlib
 import unicodecsv as csv
 from io import BytesIO
 
@@ -28,24 +29,85 @@ from core.model import (
 class LocalAnalyticsExporter(object):
     """Export large numbers of analytics events in CSV format."""
 
+    HEADER = [
+        "time", "event", "identifier", "identifier_type", "title", "author",
+        "fiction", "audience", "publisher", "imprint", "language",
+        "target_age", "genres", "location"
+    ]
+
+    # Fetch this many rows from the database at a time.
+    FETCH_SIZE = 1000
+
     def export(self, _db, start, end, locations=None, library=None):
+        """Export analytics events as a single CSV document.
+
+        :return: A bytestring.
+        """
+        return b"".join(self.stream(_db, start, end, locations, library))
 
-        # Get the results from the database.
+    def stream(self, _db, start, end, locations=None, library=None,
+               compress=False, fetch_size=None):
+        """Export analytics events as a CSV document, a piece at a time.
+
+        Rows are pulled from the database through a server-side
+        cursor, so memory use doesn't depend on the number of events
+        being exported.
+
+        :param compress: If this is True, the CSV document will be
+            gzipped as it's generated.
+        :param fetch_size: Fetch this many rows from the database at
+            a time.
+
+        :return: A generator of bytestrings.
+        """
+        chunks = self._csv_chunks(
+            _db, start, end, locations, library, fetch_size or self.FETCH_SIZE
+        )
+        if compress:
+            chunks = self.gzip_chunks(chunks)
+        return chunks
+
+    def _csv_chunks(self, _db, start, end, locations, library, fetch_size):
         query = self.analytics_query(start, end, locations, library)
-        results = _db.execute(query)
 
-        # Write the CSV file to a BytesIO.
-        header = [
-            "time", "event", "identifier", "identifier_type", "title", "author",
-            "fiction", "audience", "publisher", "imprint", "language",
-            "target_age", "genres", "location"
-        ]
+        # stream_results makes psycopg2 use a named (server-side)
+        # cursor instead of loading the entire result set into memory.
+        connection = _db.connection().execution_options(stream_results=True)
+        results = connection.execute(query)
+
         output = BytesIO()
         writer = csv.writer(output, encoding="utf-8")
-        writer.writerow(header)
-        writer.writerows(results)
+        writer.writerow(self.HEADER)
+        try:
+            while True:
+                rows = results.fetchmany(fetch_size)
+                writer.writerows(rows)
+                chunk = output.getvalue()
+                if chunk:
+                    yield chunk
+                    output.seek(0)
+                    output.truncate()
+                if not rows:
+                    break
+        finally:
+            results.close()
 
-        return output.getvalue()
+    @classmethod
+    def gzip_chunks(cls, chunks):
+        """Gzip a sequence of bytestrings on the fly.
+
+        :return: A generator of bytestrings which together make up a
+            gzip file.
+        """
+        # Adding 16 to wbits makes zlib write a gzip header and trailer.
+        compressor = zlib.compressobj(
+            zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, 16 + zlib.MAX_WBITS
+        )
+        for chunk in chunks:
+            compressed = compressor.compress(chunk)
+            if compressed:
+                yield compressed
+        yield compressor.flush()
 
     def analytics_query(self, start, end,  locations=None, library=None):
         """Build a database query that fetches rows of analytics data.
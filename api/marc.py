@@ -1,28 +1,89 @@
+import contextlib
+import datetime
 from nose.tools import set_trace
 from pymarc import Field
+from StringIO import StringIO
 import urllib
 
 from core.config import Configuration
+from core.external_search import (
+    ExternalSearchIndex,
+    SortKeyPagination,
+)
+from core.lane import Lane
 from core.marc import (
     Annotator,
     MARCExporter,
+    MARCExporterFacets,
 )
+from core.mirror import MirrorUploader
+from api.library_settings import LibrarySettings
 from core.model import (
+    CachedMARCFile,
     ConfigurationSetting,
+    Representation,
     Session,
+    get_one_or_create,
 )
 
 class LibraryAnnotator(Annotator):
+
+    # These settings are looked up for every record.
+    CACHED_SETTINGS = [
+        MARCExporter.MARC_ORGANIZATION_CODE,
+        MARCExporter.INCLUDE_SUMMARY,
+        MARCExporter.INCLUDE_SIMPLIFIED_GENRES,
+        MARCExporter.WEB_CLIENT_URL,
+    ]
+
     def __init__(self, library):
         super(LibraryAnnotator, self).__init__()
         self.library = library
         _db = Session.object_session(library)
         self.base_url = ConfigurationSetting.sitewide(_db, Configuration.BASE_URL_KEY).value
 
+        # If cache_settings() is called, these hold the settings
+        # instead of looking them up for every record.
+        self._values = None
+        self._registry_web_client_urls = None
+
+    def cache_settings(self, integration):
+        """Look up every setting needed to annotate records for this
+        library, so they don't have to be looked up for each record.
+
+        Only call this when building a whole file at once -- any
+        later changes to the settings will be ignored.
+        """
+        self._values = dict(
+            ((key, integration.id), self.value(key, integration))
+            for key in self.CACHED_SETTINGS
+        )
+        self._registry_web_client_urls = self.registry_web_client_urls(
+            self.library
+        )
+
     def value(self, key, integration):
-        _db = Session.object_session(integration)
-        return ConfigurationSetting.for_library_and_externalintegration(
-            _db, key, self.library, integration).value
+        if self._values is not None:
+            cache_key = (key, integration.id)
+            if cache_key in self._values:
+                return self._values[cache_key]
+        return LibrarySettings.value_for(key, self.library, integration)
+
+    def registry_web_client_urls(self, library):
+        """Find the web client URLs given to this library by library
+        registries.
+        """
+        if (self._registry_web_client_urls is not None
+            and library == self.library):
+            return self._registry_web_client_urls
+        _db = Session.object_session(library)
+        from api.registry import Registration
+        return [s.value for s in _db.query(
+            ConfigurationSetting
+        ).filter(
+            ConfigurationSetting.key==Registration.LIBRARY_REGISTRATION_WEB_CLIENT,
+            ConfigurationSetting.library_id==library.id
+        ) if s.value]
 
 
     def annotate_work_record(self, work, active_license_pool, edition,
@@ -47,7 +108,6 @@ class LibraryAnnotator(Annotator):
         self.add_web_client_urls(record, self.library, identifier, integration)
 
     def add_web_client_urls(self, record, library, identifier, integration=None):
-        _db = Session.object_session(library)
         settings = []
 
         if integration:
@@ -55,13 +115,7 @@ class LibraryAnnotator(Annotator):
             if marc_setting:
                 settings.append(marc_setting)
 
-        from api.registry import Registration
-        settings += [s.value for s in _db.query(
-            ConfigurationSetting
-        ).filter(
-            ConfigurationSetting.key==Registration.LIBRARY_REGISTRATION_WEB_CLIENT,
-            ConfigurationSetting.library_id==library.id
-        ) if s.value]
+        settings += self.registry_web_client_urls(library)
 
         qualified_identifier = urllib.quote(identifier.type + "/" + identifier.identifier, safe='')
 
@@ -82,3 +136,178 @@ class LibraryAnnotator(Annotator):
                     indicators=["4", "0"],
                     subfields=["u", url],
                 ))
+
+
+class MARCFileUpload(object):
+    """A MARC file that is uploaded to a mirror a piece at a time, as
+    it's generated.
+    """
+
+    # S3 rejects a multipart upload if any part but the last is
+    # smaller than this many bytes.
+    MINIMUM_PART_SIZE = 5 * 1024 * 1024
+
+    def __init__(self, exporter, mirror, lane, end_time, start_time=None,
+                 upload_batch_size=7500):
+        """Constructor.
+
+        :param start_time: If this is set, the file will only contain
+            records for works that changed after this time.
+        :param upload_batch_size: Upload a part once it contains
+            records for this many works, so long as it's at least
+            MINIMUM_PART_SIZE bytes.
+        """
+        self.exporter = exporter
+        self.lane = lane
+        self.end_time = end_time
+        self.start_time = start_time
+        self.upload_batch_size = upload_batch_size
+
+        _db = exporter._db
+        self.url = mirror.marc_file_url(
+            exporter.library, lane, end_time, start_time
+        )
+        self.representation, ignore = get_one_or_create(
+            _db, Representation, url=self.url,
+            media_type=Representation.MARC_MEDIA_TYPE
+        )
+        self.context = mirror.multipart_upload(self.representation, self.url)
+        self.upload = None
+        self.batch = StringIO()
+        self.batch_records = 0
+
+    def __enter__(self):
+        self.upload = self.context.__enter__()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None and self.batch.tell() > 0:
+            # Upload the final batch.
+            self.upload.upload_part(self.batch.getvalue())
+        return self.context.__exit__(type, value, traceback)
+
+    def includes(self, work):
+        """Does this file include a record for the given work?"""
+        if not self.start_time:
+            return True
+        return bool(
+            work.last_update_time and work.last_update_time >= self.start_time
+        )
+
+    def write(self, data):
+        """Add one work's MARC record to the file."""
+        self.batch.write(data)
+        self.batch_records += 1
+        if (self.batch_records >= self.upload_batch_size
+            and self.batch.tell() >= self.MINIMUM_PART_SIZE):
+            self.upload.upload_part(self.batch.getvalue())
+            self.batch = StringIO()
+            self.batch_records = 0
+
+    def finish(self):
+        """Record that the file is complete.
+
+        :return: The CachedMARCFile for this file, or None if the
+            upload failed.
+        """
+        _db = self.exporter._db
+        self.representation.fetched_at = self.end_time
+        if self.representation.mirror_exception:
+            return None
+        cached, is_new = get_one_or_create(
+            _db, CachedMARCFile, library=self.exporter.library,
+            lane=(self.lane if isinstance(self.lane, Lane) else None),
+            start_time=self.start_time,
+            create_method_kwargs=dict(representation=self.representation)
+        )
+        if not is_new:
+            cached.representation = self.representation
+        cached.end_time = self.end_time
+        return cached
+
+
+class LibraryMARCExporter(MARCExporter):
+    """Generates MARC files for a library's lanes, building the file
+    of all records and the file of recent changes in a single pass.
+    """
+
+    def records_with_changes(self, lane, annotator, mirror_integration,
+                             start_time=None, force_refresh=False,
+                             mirror=None, search_engine=None,
+                             query_batch_size=500, upload_batch_size=7500):
+        """Create and mirror a MARC file for all the books in a lane
+        and, if `start_time` is provided, a file for the books that
+        changed since `start_time`.
+
+        Works are retrieved in batches and each record is only created
+        once, then written to every file that should include it. The
+        files are uploaded a part at a time, so memory use doesn't
+        depend on the size of the lane.
+
+        :return: A list of CachedMARCFile objects, one for each file
+            that was successfully uploaded.
+        """
+        if not mirror:
+            storage_protocol = mirror_integration.protocol
+            mirror = MirrorUploader.implementation(mirror_integration)
+            if mirror.NAME != storage_protocol:
+                raise Exception("Mirror integration does not match configured storage protocol")
+
+        if not mirror:
+            raise Exception("No mirror integration is configured")
+
+        # End time is before we start the query, because if any
+        # records are changed during the processing we may not catch
+        # them, and they should be handled again on the next run.
+        end_time = datetime.datetime.utcnow()
+
+        files = [
+            MARCFileUpload(self, mirror, lane, end_time, None, upload_batch_size)
+        ]
+        if start_time:
+            files.append(
+                MARCFileUpload(
+                    self, mirror, lane, end_time, start_time, upload_batch_size
+                )
+            )
+
+        with contextlib.nested(*files):
+            for works in self.work_batches(lane, search_engine, query_batch_size):
+                for work in works:
+                    destinations = [x for x in files if x.includes(work)]
+                    if not destinations:
+                        continue
+                    record = self.create_record(
+                        work, annotator, force_refresh, self.integration
+                    )
+                    if not record:
+                        continue
+                    data = record.as_marc()
+                    for file in destinations:
+                        file.write(data)
+
+                # Write out any cached records so that this batch of
+                # works can be garbage-collected.
+                self._db.flush()
+
+        return [x for x in [file.finish() for file in files] if x]
+
+    def work_batches(self, lane, search_engine=None, batch_size=500):
+        """Retrieve every work in a lane from the search index, a page at
+        a time.
+
+        This uses SortKeyPagination, so each page picks up where the
+        last one left off instead of making the search index skip over
+        all the earlier works.
+
+        :yield: A sequence of lists of Works.
+        """
+        search_engine = search_engine or ExternalSearchIndex(self._db)
+        facets = MARCExporterFacets(start_time=None)
+        pagination = SortKeyPagination(size=batch_size)
+        while pagination is not None:
+            yield lane.works(
+                self._db, pagination=pagination, facets=facets,
+                search_engine=search_engine
+            )
+            pagination = pagination.next_page
@@ -2,6 +2,7 @@ import datetime
 import logging
 import os
 import sys
+import time
 from nose.tools import set_trace
 
 from sqlalchemy import (
@@ -9,8 +10,10 @@ from sqlalchemy import (
     or_,
 )
 
+from core.metadata_layer import TimestampData
 from core.monitor import (
     EditionSweepMonitor,
+    Monitor,
     ReaperMonitor,
 )
 from core.model import (
@@ -21,17 +24,157 @@ from core.model import (
     ExternalIntegration,
     Hold,
     Identifier,
+    Library,
     LicensePool,
     Loan,
+    Patron,
 )
 
+from api.admin.dashboard_stats import DashboardStatistics
+
 from odl import (
     ODLAPI,
     SharedODLAPI,
 )
 
 
-class LoanlikeReaperMonitor(ReaperMonitor):
+class BulkReaper(object):
+    """Delete every row that matches a query, a chunk at a time.
+
+    Each chunk is deleted with a single statement along the lines of
+    DELETE FROM loans WHERE id IN (SELECT id ... ORDER BY id LIMIT n),
+    rather than by loading each row as an ORM object and deleting it
+    separately. Rows are taken in order of ID, and each chunk picks up
+    where the last one left off, so the tables don't have to be
+    scanned from the start every time.
+
+    Since the rows never become ORM objects, any ORM-level cascades
+    are skipped. Nothing cascades from loans, holds or annotations.
+    """
+
+    BATCH_SIZE = 1000
+
+    # Loans and holds are counted in the dashboard statistics.
+    COUNTED_IN_STATISTICS = (Loan, Hold)
+
+    def __init__(self, _db, batch_size=None, log=None):
+        self._db = _db
+        self.batch_size = batch_size or self.BATCH_SIZE
+        self.log = log or logging.getLogger("Bulk reaper")
+        self.rows_deleted = 0
+        self.elapsed = 0
+
+    @property
+    def rate(self):
+        """The number of rows deleted per second."""
+        if not self.elapsed:
+            return 0
+        return self.rows_deleted / self.elapsed
+
+    @property
+    def achievements(self):
+        return "Items deleted: %d (%.1f/sec)" % (self.rows_deleted, self.rate)
+
+    def reap(self, model_class, qu, what=None):
+        """Delete every row that matches a query.
+
+        :param model_class: The model class being deleted.
+        :param qu: A query that finds the rows of `model_class` to delete.
+        :param what: A human-readable description of what's being deleted.
+        :return: The number of rows deleted.
+        """
+        what = what or model_class.__table__.name
+        ids = qu.with_entities(model_class.id).order_by(model_class.id)
+
+        stale = []
+        if model_class in self.COUNTED_IN_STATISTICS:
+            stale = self.affected_libraries_and_collections(model_class, ids)
+
+        start = time.time()
+        deleted = 0
+        last_id = None
+        while True:
+            chunk = ids
+            if last_id is not None:
+                chunk = chunk.filter(model_class.id > last_id)
+            chunk = self.uncorrelated(chunk.limit(self.batch_size))
+            table = model_class.__table__
+            statement = table.delete().where(
+                model_class.id.in_(chunk)
+            ).returning(table.c.id)
+            deleted_ids = [row[0] for row in self._db.execute(statement)]
+            self._db.commit()
+            if not deleted_ids:
+                break
+            deleted += len(deleted_ids)
+            last_id = max(deleted_ids)
+            self.log.info(
+                "Deleted %d %s so far (%.1f/sec).", deleted, what,
+                deleted / max(time.time() - start, 0.001)
+            )
+
+        elapsed = time.time() - start
+        self.rows_deleted += deleted
+        self.elapsed += elapsed
+
+        # Deleting loans and holds changes the numbers on the
+        # dashboard, just as a checkin or a hold release would.
+        for library, collection_id in stale:
+            DashboardStatistics.mark_stale(self._db, library, collection_id)
+        if stale:
+            self._db.commit()
+
+        self.log.info(
+            "Deleted %d %s in %.2f sec (%.1f/sec).", deleted, what, elapsed,
+            deleted / max(elapsed, 0.001)
+        )
+        return deleted
+
+    @classmethod
+    def uncorrelated(cls, qu):
+        """Turn a query into a subquery that stands on its own.
+
+        The subquery selects from the same table as the statement
+        around it, and mustn't be correlated with that table.
+        """
+        return qu.statement.correlate(None)
+
+    def affected_libraries_and_collections(self, model_class, ids):
+        """Find every library and collection with a loan or hold that's
+        about to be deleted.
+
+        :param ids: A query for the IDs of the loans or holds.
+        :return: A list of (Library, collection ID) 2-tuples.
+        """
+        pairs = self._db.query(
+            Patron.library_id, LicensePool.collection_id
+        ).filter(
+            Patron.id==model_class.patron_id
+        ).filter(
+            LicensePool.id==model_class.license_pool_id
+        ).filter(
+            model_class.id.in_(self.uncorrelated(ids.order_by(None)))
+        ).distinct()
+        libraries = dict()
+        results = []
+        for library_id, collection_id in pairs:
+            if library_id not in libraries:
+                libraries[library_id] = self._db.query(Library).get(library_id)
+            results.append((libraries[library_id], collection_id))
+        return results
+
+
+class BulkReaperMonitor(ReaperMonitor):
+    """A ReaperMonitor that deletes rows with a BulkReaper."""
+
+    def run_once(self, *args, **kwargs):
+        qu = self._db.query(self.MODEL_CLASS).filter(self.where_clause)
+        reaper = BulkReaper(self._db, log=self.log)
+        reaper.reap(self.MODEL_CLASS, qu)
+        return TimestampData(achievements=reaper.achievements)
+
+
+class LoanlikeReaperMonitor(BulkReaperMonitor):
 
     SOURCE_OF_TRUTH_PROTOCOLS = [
         ODLAPI.NAME,
@@ -118,7 +261,7 @@ class HoldReaper(LoanlikeReaperMonitor):
 ReaperMonitor.REGISTRY.append(HoldReaper)
 
 
-class IdlingAnnotationReaper(ReaperMonitor):
+class IdlingAnnotationReaper(BulkReaperMonitor):
     """Remove idling annotations for inactive loans."""
 
     MODEL_CLASS = Annotation
@@ -155,3 +298,53 @@ class IdlingAnnotationReaper(ReaperMonitor):
             *restrictions
         )
 ReaperMonitor.REGISTRY.append(IdlingAnnotationReaper)
+
+
+class DashboardStatisticsMonitor(Monitor):
+    """Keep the stored statistics shown on the admin dashboard up to date.
+
+    Circulation events mark the statistics for a library and a
+    collection as stale, and only those are recalculated. Statistics
+    that haven't been recalculated in MAX_AGE are recalculated anyway,
+    since loans expire and licenses come and go without any
+    circulation event happening.
+    """
+    SERVICE_NAME = "Dashboard Statistics Monitor"
+
+    MAX_AGE = datetime.timedelta(hours=6)
+
+    def run_once(self, progress):
+        now = datetime.datetime.utcnow()
+        cutoff = now - self.MAX_AGE
+        existing = dict()
+        for stats in self._db.query(DashboardStatistics):
+            if stats.library_id:
+                existing[(Library, stats.library_id)] = stats
+            else:
+                existing[(Collection, stats.collection_id)] = stats
+
+        def needs_refresh(model, item):
+            stats = existing.get((model, item.id))
+            return (
+                not stats or stats.stale or not stats.updated_at
+                or stats.updated_at < cutoff
+            )
+
+        libraries = 0
+        for library in self._db.query(Library):
+            if needs_refresh(Library, library):
+                DashboardStatistics.refresh_library(self._db, library, now)
+                libraries += 1
+
+        collections = 0
+        for collection in self._db.query(Collection):
+            if needs_refresh(Collection, collection):
+                DashboardStatistics.refresh_collection(
+                    self._db, collection, now
+                )
+                collections += 1
+
+        achievements = "Libraries refreshed: %d. Collections refreshed: %d." % (
+            libraries, collections
+        )
+        return TimestampData(achievements=achievements)
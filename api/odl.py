@@ -1,6 +1,7 @@
 from nose.tools import set_trace
 
 import base64
+import bisect
 import json
 import uuid
 import datetime
@@ -16,6 +17,7 @@ from StringIO import StringIO
 import re
 from uritemplate import URITemplate
 
+from sqlalchemy.orm import joinedload
 from sqlalchemy.sql.expression import or_
 
 from core.opds_import import (
@@ -161,6 +163,10 @@ class ODLAPI(BaseCirculationAPI, BaseSharedCollectionAPI):
 
     TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
 
+    # When updating the holds queues for many license pools, load the
+    # loans and holds for this many pools at a time.
+    HOLD_QUEUE_BATCH_SIZE = 500
+
     # Possible status values in the License Status Document:
 
     # The license is available but the user hasn't fulfilled it yet.
@@ -616,29 +622,73 @@ class ODLAPI(BaseCirculationAPI, BaseSharedCollectionAPI):
 
     def update_hold_queue(self, licensepool):
         # Update the pool and the next holds in the queue when a license is reserved.
-        _db = Session.object_session(licensepool)
+        self.update_hold_queues([licensepool])
 
-        loans_count = _db.query(Loan).filter(
-            Loan.license_pool_id==licensepool.id
-        ).filter(
-            or_(
-                Loan.end==None,
-                Loan.end>datetime.datetime.utcnow()
-            )
-        ).count()
-        remaining_licenses = licensepool.licenses_owned - loans_count
+    def update_hold_queues(self, licensepools):
+        """Update the availability of a number of license pools, and the
+        position and estimated end date of every hold on them.
 
-        holds = _db.query(Hold).filter(
-            Hold.license_pool_id==licensepool.id
-        ).filter(
-            or_(
-                Hold.end==None,
-                Hold.end>datetime.datetime.utcnow(),
-                Hold.position>0,
-            )
-        ).order_by(
-            Hold.start
-        ).all()
+        The active loans and holds for all of the pools are loaded
+        with two queries, and everything else is calculated in memory.
+        """
+        licensepools = list(licensepools)
+        if not licensepools:
+            return
+        _db = Session.object_session(licensepools[0])
+        now = datetime.datetime.utcnow()
+
+        for i in range(0, len(licensepools), self.HOLD_QUEUE_BATCH_SIZE):
+            batch = licensepools[i:i+self.HOLD_QUEUE_BATCH_SIZE]
+            pool_ids = [pool.id for pool in batch]
+
+            # We only need to know when each active loan ends.
+            loan_ends = defaultdict(list)
+            loans = _db.query(
+                Loan.license_pool_id, Loan.end
+            ).filter(
+                Loan.license_pool_id.in_(pool_ids)
+            ).filter(
+                or_(
+                    Loan.end==None,
+                    Loan.end>now
+                )
+            ).order_by(Loan.start)
+            for pool_id, end in loans:
+                loan_ends[pool_id].append(end)
+
+            holds_by_pool = defaultdict(list)
+            holds = _db.query(Hold).options(
+                joinedload(Hold.patron)
+            ).filter(
+                Hold.license_pool_id.in_(pool_ids)
+            ).filter(
+                or_(
+                    Hold.end==None,
+                    Hold.end>now,
+                    Hold.position>0,
+                )
+            ).order_by(Hold.start)
+            for hold in holds:
+                holds_by_pool[hold.license_pool_id].append(hold)
+
+            for pool in batch:
+                self._recalculate_hold_queue(
+                    pool, loan_ends[pool.id], holds_by_pool[pool.id], now
+                )
+
+    def _recalculate_hold_queue(self, licensepool, loan_ends, holds, now):
+        """Update a license pool's availability and its holds queue in
+        memory.
+
+        This does the same calculations as _update_hold_position and
+        _update_hold_end_date, but for the whole queue at once.
+
+        :param loan_ends: The end dates of the pool's active loans,
+            ordered by loan start date.
+        :param holds: The pool's active holds, ordered by start date.
+        """
+        _db = Session.object_session(licensepool)
+        remaining_licenses = licensepool.licenses_owned - len(loan_ends)
 
         if len(holds) > remaining_licenses:
             new_licenses_available = 0
@@ -654,13 +704,76 @@ class ODLAPI(BaseCirculationAPI, BaseSharedCollectionAPI):
             new_licenses_reserved,
             new_patrons_in_hold_queue,
             analytics=self.analytics,
-            as_of=datetime.datetime.utcnow(),
+            as_of=now,
         )
+        if not holds:
+            return
 
-        for hold in holds[:licensepool.licenses_reserved]:
-            if hold.position != 0:
-                # This hold just got a reserved license.
-                self._update_hold_end_date(hold)
+        collection = self.collection(_db)
+        default_reservation_period = collection.default_reservation_period
+        loan_periods = dict()
+        def default_loan_period(hold):
+            key = hold.library or hold.integration_client
+            if key not in loan_periods:
+                loan_periods[key] = collection.default_loan_period(key)
+            return loan_periods[key]
+
+        # The first holds in the queue have reserved licenses.
+        licenses_reserved = max(0, min(remaining_licenses, len(holds)))
+        reservations = holds[:licenses_reserved]
+
+        starts = [hold.start for hold in holds]
+        for hold in holds:
+            original_position = hold.position
+
+            # The position depends on how many holds started before
+            # this one.
+            holds_before = bisect.bisect_left(starts, hold.start)
+            if remaining_licenses > holds_before:
+                # The hold is ready to check out.
+                hold.position = 0
+            else:
+                # Add 1 since position 0 indicates the hold is ready.
+                hold.position = holds_before + 1
+
+            if hold.position == 0:
+                # If the hold just became available, the patron's
+                # reservation period starts now.
+                if original_position != 0 or not hold.end:
+                    hold.end = now + datetime.timedelta(
+                        days=default_reservation_period
+                    )
+                continue
+
+            if licensepool.licenses_owned < 1:
+                # There's no way to estimate when a license will
+                # become available.
+                continue
+
+            # See _update_hold_end_date for an explanation of this
+            # worst-case estimate.
+            loan_period = default_loan_period(hold)
+            cycles = (
+                hold.position - licenses_reserved - 1
+            ) // licensepool.licenses_owned
+            copy_index = (
+                hold.position - licenses_reserved - 1
+            ) % licensepool.licenses_owned
+            if len(loan_ends) > copy_index:
+                next_cycle_start = loan_ends[copy_index]
+            else:
+                reservation = reservations[copy_index - len(loan_ends)]
+                next_cycle_start = reservation.end and (
+                    reservation.end + datetime.timedelta(days=loan_period)
+                )
+            if not next_cycle_start:
+                # The loan or reservation never ends, so neither does
+                # the wait.
+                continue
+            cycle_period = loan_period + default_reservation_period
+            hold.end = next_cycle_start + datetime.timedelta(
+                days=(cycle_period * cycles)
+            )
 
     def place_hold(self, patron, pin, licensepool, notification_email_address):
         """Create a new hold."""
@@ -977,8 +1090,7 @@ class ODLHoldReaper(CollectionMonitor):
             self._db.delete(hold)
             total_deleted_holds += 1
 
-        for pool in changed_pools:
-            self.api.update_hold_queue(pool)
+        self.api.update_hold_queues(changed_pools)
 
         message = "Holds deleted: %d. License pools updated: %d" % (
             total_deleted_holds,
@@ -1,4 +1,5 @@
 import datetime
+import json
 import urllib
 import copy
 import logging
@@ -27,7 +28,6 @@ from core.util.opds_writer import (
 )
 from core.model import (
     CirculationEvent,
-    ConfigurationSetting,
     Credential,
     CustomList,
     DataSource,
@@ -60,6 +60,7 @@ from config import (
     CannotLoadConfiguration,
     Configuration,
 )
+from library_settings import LibrarySettings
 from novelist import NoveListAPI
 from core.analytics import Analytics
 
@@ -536,13 +537,15 @@ class LibraryAnnotator(CirculationManagerAnnotator):
         if not library:
             # This shouldn't happen, but we shouldn't crash if it does.
             return []
-        setting = library.setting(Configuration.HIDDEN_CONTENT_TYPES)
-        if not setting or not setting.value:
+        value = LibrarySettings.value_for(
+            Configuration.HIDDEN_CONTENT_TYPES, library
+        )
+        if not value:
             return []
         try:
-            hidden_types = setting.json_value
+            hidden_types = json.loads(value)
         except ValueError:
-            hidden_types = setting.value
+            hidden_types = value
         hidden_types = hidden_types or []
         if isinstance(hidden_types, basestring):
             hidden_types = [hidden_types]
@@ -941,16 +944,16 @@ class LibraryAnnotator(CirculationManagerAnnotator):
                 feed.append(link)
 
         for rel in self.CONFIGURATION_LINKS:
-            setting = ConfigurationSetting.for_library(rel, self.library)
-            if setting.value:
-                d = dict(href=setting.value, type="text/html", rel=rel)
+            value = LibrarySettings.value_for(rel, self.library)
+            if value:
+                d = dict(href=value, type="text/html", rel=rel)
                 _add_link(d)
 
-        navigation_urls = ConfigurationSetting.for_library(
-            Configuration.WEB_HEADER_LINKS, self.library).json_value
+        navigation_urls = LibrarySettings.json_value_for(
+            Configuration.WEB_HEADER_LINKS, self.library)
         if navigation_urls:
-            navigation_labels = ConfigurationSetting.for_library(
-                Configuration.WEB_HEADER_LABELS, self.library).json_value
+            navigation_labels = LibrarySettings.json_value_for(
+                Configuration.WEB_HEADER_LABELS, self.library)
             for (url, label) in zip(navigation_urls, navigation_labels):
                 d = dict(href=url, title=label, type="text/html", rel="related", role="navigation")
                 _add_link(d)
@@ -1181,7 +1184,7 @@ class LibraryAnnotator(CirculationManagerAnnotator):
             cached = []
             authdata = None
             try:
-                authdata = AuthdataUtility.from_config(self.library)
+                authdata = AuthdataUtility.for_library(self.library)
             except CannotLoadConfiguration as e:
                 logging.error("Cannot load Short Client Token configuration; outgoing OPDS entries will not have DRM autodiscovery support", exc_info=e)
                 return []
@@ -2,12 +2,17 @@ from nose.tools import set_trace
 import datetime
 import dateutil
 import json
+import logging
 import pytz
 import re
 import requests
+import threading
+import time
 import flask
 import urlparse
+from multiprocessing.pool import ThreadPool
 from flask_babel import lazy_gettext as _
+from expiringdict import ExpiringDict
 
 from sqlalchemy.orm import contains_eager
 
@@ -58,6 +63,165 @@ from core.scripts import Script
 from circulation_exceptions import *
 from core.analytics import Analytics
 
+class OverdrivePatronToken(object):
+    """An OAuth bearer token that lets us act on behalf of a patron.
+
+    This has the same `credential` and `expires` attributes as the
+    Credential it came from, but it's not tied to a database session,
+    so it can be shared between threads.
+    """
+
+    def __init__(self, credential=None, expires=None):
+        self.credential = credential
+        self.expires = expires
+
+    @classmethod
+    def from_credential(cls, credential):
+        return cls(credential.credential, credential.expires)
+
+
+class OverdrivePatronTokenCache(object):
+    """Keep patron OAuth bearer tokens in memory.
+
+    Without this cache, every request made on behalf of a patron
+    means looking up their Credential in the database, and a single
+    bookshelf sync makes several such requests.
+
+    Tokens are refreshed in a background thread shortly before they
+    expire, and only one thread at a time will ask Overdrive for a
+    given patron's token.
+    """
+
+    log = logging.getLogger("Overdrive patron token cache")
+
+    # Keep tokens for up to this many patrons.
+    MAX_LENGTH = 10000
+
+    # Overdrive's patron tokens are good for an hour, so there's
+    # no reason to keep one around for longer than that.
+    MAX_AGE = 60 * 60
+
+    # Start refreshing a token in the background once it's this
+    # close to expiring.
+    REFRESH_MARGIN = datetime.timedelta(minutes=5)
+
+    # Wait this many seconds for another thread to obtain a token
+    # before trying to obtain it ourselves.
+    WAIT_TIMEOUT = 30
+
+    def __init__(self, max_length=MAX_LENGTH,
+                 clock=datetime.datetime.utcnow):
+        self.tokens = ExpiringDict(
+            max_len=max_length, max_age_seconds=self.MAX_AGE
+        )
+        self.clock = clock
+        self.lock = threading.Lock()
+
+        # Maps a key to an Event that will be set when the thread
+        # currently obtaining the token for that key is done.
+        self.in_flight = {}
+
+        # Counters, so we can tell whether the cache is doing any good.
+        self.hits = 0
+        self.misses = 0
+        self.background_refreshes = 0
+
+    @classmethod
+    def key(cls, collection, patron):
+        return (collection.id, patron.id)
+
+    def get(self, key):
+        """Find a token that hasn't expired yet."""
+        token = self.tokens.get(key)
+        if token and token.expires and token.expires > self.clock():
+            return token
+        return None
+
+    def set(self, key, token):
+        if token and token.credential and token.expires:
+            self.tokens[key] = token
+
+    def invalidate(self, key):
+        self.tokens.pop(key, None)
+
+    def needs_refresh(self, token):
+        return token.expires - self.clock() < self.REFRESH_MARGIN
+
+    def single_flight(self, key, load):
+        """Obtain a token by calling `load`, unless another thread is
+        already obtaining the same token, in which case wait for that
+        thread to finish and use its token.
+
+        :param load: A callable that returns an OverdrivePatronToken.
+        """
+        with self.lock:
+            token = self.get(key)
+            if token:
+                return token
+            event = self.in_flight.get(key)
+            leader = event is None
+            if leader:
+                event = threading.Event()
+                self.in_flight[key] = event
+
+        if not leader:
+            event.wait(self.WAIT_TIMEOUT)
+            token = self.get(key)
+            if token:
+                return token
+            # The other thread didn't get a token. Try again
+            # ourselves, so the caller sees the real problem.
+            return load()
+
+        try:
+            token = load()
+            self.set(key, token)
+            return token
+        finally:
+            with self.lock:
+                self.in_flight.pop(key, None)
+            event.set()
+
+    def refresh_in_background(self, key, fetch):
+        """Replace a token that's about to expire, without making
+        the current request wait.
+
+        :param fetch: A callable that returns an OverdrivePatronToken,
+            or None if a token couldn't be obtained. It will be called
+            in a different thread, so it must not use the database.
+
+        :return: True if a refresh was started, False if one was
+            already in progress.
+        """
+        with self.lock:
+            if key in self.in_flight:
+                return False
+            event = threading.Event()
+            self.in_flight[key] = event
+
+        def refresh():
+            try:
+                token = fetch()
+                if token:
+                    self.set(key, token)
+                    self.background_refreshes += 1
+            except Exception, e:
+                self.log.warn(
+                    "Could not refresh Overdrive patron token: %r", e
+                )
+            finally:
+                with self.lock:
+                    self.in_flight.pop(key, None)
+                event.set()
+
+        thread = threading.Thread(
+            target=refresh, name="Overdrive patron token refresh"
+        )
+        thread.daemon = True
+        thread.start()
+        return True
+
+
 class OverdriveAPI(BaseOverdriveAPI, BaseCirculationAPI, HasSelfTests):
 
     NAME = ExternalIntegration.OVERDRIVE
@@ -160,6 +324,9 @@ class OverdriveAPI(BaseOverdriveAPI, BaseCirculationAPI, HasSelfTests):
         "PatronHasExceededCheckoutLimit_ForCPC": PatronLoanLimitReached,
     }
 
+    # Patron OAuth tokens are shared by every OverdriveAPI in a process.
+    patron_token_cache = OverdrivePatronTokenCache()
+
     def __init__(self, _db, collection):
         super(OverdriveAPI, self).__init__(_db, collection)
         self.overdrive_bibliographic_coverage_provider = (
@@ -240,8 +407,7 @@ class OverdriveAPI(BaseOverdriveAPI, BaseCirculationAPI, HasSelfTests):
                 )
             else:
                 # Refresh the token and try again.
-                self.refresh_patron_access_token(
-                    patron_credential, patron, pin)
+                self.get_patron_credential(patron, pin, force_refresh=True)
                 return self.patron_request(
                     patron, pin, url, extra_headers, data, True)
         else:
@@ -251,15 +417,72 @@ class OverdriveAPI(BaseOverdriveAPI, BaseCirculationAPI, HasSelfTests):
             # self.log.debug("%s: %s", url, response.status_code)
             return response
 
-    def get_patron_credential(self, patron, pin):
-        """Create an OAuth token for the given patron."""
+    def get_patron_credential(self, patron, pin, force_refresh=False):
+        """Find or create an OAuth token for the given patron.
+
+        Tokens are kept in memory, so the database is only consulted
+        when this process doesn't have a current token for the patron.
+
+        :param force_refresh: Get a new token from Overdrive even if
+            the one we have hasn't expired.
+        :return: An OverdrivePatronToken.
+        """
+        cache = self.patron_token_cache
+        key = cache.key(self.collection, patron)
+        if force_refresh:
+            cache.invalidate(key)
+        else:
+            token = cache.get(key)
+            if token:
+                cache.hits += 1
+                if cache.needs_refresh(token):
+                    payload = self.patron_token_payload(patron, pin)
+                    cache.refresh_in_background(
+                        key, lambda: self.fetch_patron_token(payload)
+                    )
+                return token
+        cache.misses += 1
+        return cache.single_flight(
+            key, lambda: self._lookup_patron_credential(
+                patron, pin, force_refresh
+            )
+        )
+
+    def _lookup_patron_credential(self, patron, pin, force_refresh=False):
+        """Find the patron's OAuth token in the database, asking
+        Overdrive for a new one if necessary.
+        """
+        refreshed = []
         def refresh(credential):
+            refreshed.append(credential)
             return self.refresh_patron_access_token(
                 credential, patron, pin)
-        return Credential.lookup(
+        credential = Credential.lookup(
             self._db, DataSource.OVERDRIVE, "OAuth Token", patron, refresh,
             collection=self.collection
         )
+        if force_refresh and not refreshed:
+            # Credential.lookup didn't already get a new token (say,
+            # because this is a new credential), so get one now.
+            refresh(credential)
+        return OverdrivePatronToken.from_credential(credential)
+
+    def fetch_patron_token(self, payload):
+        """Ask Overdrive for a new patron OAuth token.
+
+        This doesn't touch the database, so it can be called from a
+        background thread.
+
+        :param payload: Created by patron_token_payload().
+        :return: An OverdrivePatronToken, or None if Overdrive wouldn't
+            issue a token.
+        """
+        response = self.token_post(self.PATRON_TOKEN_ENDPOINT, payload)
+        if response.status_code != 200:
+            return None
+        token = OverdrivePatronToken()
+        self._update_credential(token, response.json())
+        return token
 
     def scope_string(self, library):
         """Create the Overdrive scope string for the given library.
@@ -272,12 +495,8 @@ class OverdriveAPI(BaseOverdriveAPI, BaseCirculationAPI, HasSelfTests):
             self.website_id, self.ils_name(library)
         )
 
-    def refresh_patron_access_token(self, credential, patron, pin):
-        """Request an OAuth bearer token that allows us to act on
-        behalf of a specific patron.
-
-        Documentation: https://developer.overdrive.com/apis/patron-auth
-        """
+    def patron_token_payload(self, patron, pin):
+        """Create the request body used to obtain a patron OAuth token."""
         payload = dict(
             grant_type="password",
             username=patron.authorization_identifier,
@@ -292,6 +511,15 @@ class OverdriveAPI(BaseOverdriveAPI, BaseCirculationAPI, HasSelfTests):
             # refuse to issue a token.
             payload['password_required'] = 'false'
             payload['password'] = '[ignore]'
+        return payload
+
+    def refresh_patron_access_token(self, credential, patron, pin):
+        """Request an OAuth bearer token that allows us to act on
+        behalf of a specific patron.
+
+        Documentation: https://developer.overdrive.com/apis/patron-auth
+        """
+        payload = self.patron_token_payload(patron, pin)
         response = self.token_post(self.PATRON_TOKEN_ENDPOINT, payload)
         if response.status_code == 200:
             self._update_credential(credential, response.json())
@@ -981,7 +1209,7 @@ class OverdriveAPI(BaseOverdriveAPI, BaseCirculationAPI, HasSelfTests):
             return True
         raise CannotReleaseHold(response.content)
 
-    def circulation_lookup(self, book):
+    def circulation_lookup(self, book, exception_on_401=False):
         if isinstance(book, basestring):
             book_id = book
             circulation_link = self.endpoint(
@@ -995,6 +1223,8 @@ class OverdriveAPI(BaseOverdriveAPI, BaseCirculationAPI, HasSelfTests):
             # Make sure we use v2 of the availability API,
             # even if Overdrive gave us a link to v1.
             circulation_link = self.make_link_safe(circulation_link)
+        if exception_on_401:
+            return book, self.get(circulation_link, {}, exception_on_401=True)
         return book, self.get(circulation_link, {})
 
     def update_formats(self, licensepool):
@@ -1028,16 +1258,43 @@ class OverdriveAPI(BaseOverdriveAPI, BaseCirculationAPI, HasSelfTests):
         created for the LicensePool and set as presentation-ready.
         """
         # Retrieve current circulation information about this book
+        book, response = self.fetch_availability(book_id)
+        return self.update_licensepool_from_availability(
+            book_id, book, response
+        )
+
+    def fetch_availability(self, book_id, exception_on_401=False):
+        """Ask Overdrive for current circulation information about a book.
+
+        This makes an HTTP request but doesn't touch the database, so
+        it's safe to call from a worker thread -- as long as
+        `exception_on_401` is set. Refreshing an expired bearer token
+        means looking up a Credential, which must be done in the
+        thread that owns the database session.
+
+        :return: A 2-tuple (book, response). `response` is a 3-tuple
+            (status_code, headers, content), or None if the request
+            raised an exception.
+        """
         try:
-            book, (status_code, headers, content) = self.circulation_lookup(
-                book_id
+            return self.circulation_lookup(
+                book_id, exception_on_401=exception_on_401
             )
         except Exception, e:
-            status_code = None
             self.log.error(
                 "HTTP exception communicating with Overdrive",
                 exc_info=e
             )
+            return book_id, None
+
+    def update_licensepool_from_availability(self, book_id, book, response):
+        """Update a book's LicensePool using a response obtained from
+        fetch_availability().
+        """
+        if response:
+            status_code, headers, content = response
+        else:
+            status_code = None
 
         # TODO: If you ask for a book that you know about, and
         # Overdrive says the book doesn't exist in the collection,
@@ -1236,6 +1493,12 @@ class MockOverdriveAPI(BaseMockOverdriveAPI, OverdriveAPI):
 
     collection_token = 'fake token'
 
+    def __init__(self, _db, collection, *args, **kwargs):
+        super(MockOverdriveAPI, self).__init__(_db, collection, *args, **kwargs)
+
+        # Don't share patron tokens with other tests.
+        self.patron_token_cache = OverdrivePatronTokenCache()
+
     def patron_request(self, patron, pin, *args, **kwargs):
         response = self._make_request(*args, **kwargs)
 
@@ -1257,11 +1520,29 @@ class OverdriveCirculationMonitor(CollectionMonitor, TimelineMonitor):
     PROTOCOL = ExternalIntegration.OVERDRIVE
     OVERLAP = datetime.timedelta(minutes=1)
 
-    def __init__(self, _db, collection, api_class=OverdriveAPI, analytics_class=Analytics):
-        """Constructor."""
+    # By default, ask Overdrive about one book at a time, and commit
+    # after each one.
+    DEFAULT_CONCURRENCY = 1
+
+    # When more than one book is being looked up at once, look up this
+    # many books before updating their LicensePools in a single
+    # transaction.
+    DEFAULT_BATCH_SIZE = 100
+
+    def __init__(self, _db, collection, api_class=OverdriveAPI,
+                 analytics_class=Analytics, concurrency=None, batch_size=None):
+        """Constructor.
+
+        :param concurrency: Look up availability information for up to
+            this many books at once.
+        :param batch_size: When looking up books concurrently, update
+            this many LicensePools per transaction.
+        """
         super(OverdriveCirculationMonitor, self).__init__(_db, collection)
         self.api = api_class(_db, collection)
         self.analytics = analytics_class(_db)
+        self.concurrency = concurrency or self.DEFAULT_CONCURRENCY
+        self.batch_size = batch_size or self.DEFAULT_BATCH_SIZE
 
     def recently_changed_ids(self, start, cutoff):
         return self.api.recently_changed_ids(start, cutoff)
@@ -1272,32 +1553,116 @@ class OverdriveCirculationMonitor(CollectionMonitor, TimelineMonitor):
         :progress: A TimestampData representing the time previously
             covered by this Monitor.
         """
-        overdrive_data_source = DataSource.lookup(
-            self._db, DataSource.OVERDRIVE
-        )
-
         # Ask for changes between the last time covered by the Monitor
         # and the current time.
+        started_at = time.time()
+        books = self.recently_changed_ids(start, cutoff)
+        if self.concurrency > 1:
+            total_books = self.process_books_concurrently(start, books)
+        else:
+            total_books = self.process_books(start, books)
+
+        elapsed = max(time.time() - started_at, 0.001)
+        progress.achievements = "Books processed: %d. Books per second: %.1f." % (
+            total_books, total_books / elapsed
+        )
+
+    def process_books(self, start, books):
+        """Update LicensePools one book at a time.
+
+        :return: The number of books processed.
+        """
         total_books = 0
-        for book in self.recently_changed_ids(start, cutoff):
+        for book in books:
             total_books += 1
             if not total_books % 100:
                 self.log.info("%s books processed", total_books)
             if not book:
                 continue
             license_pool, is_new, is_changed = self.api.update_licensepool(book)
-            # Log a circulation event for this work.
-            if is_new:
-                for library in self.collection.libraries:
-                    self.analytics.collect_event(
-                        library, license_pool, CirculationEvent.DISTRIBUTOR_TITLE_ADD, license_pool.last_checked
-                    )
-
+            self.book_processed(license_pool, is_new)
             self._db.commit()
             if self.should_stop(start, book, is_changed):
                 break
+        return total_books
 
-        progress.achievements = "Books processed: %d." % total_books
+    def process_books_concurrently(self, start, books):
+        """Look up availability information for a batch of books in
+        worker threads, then update the LicensePools for that batch in
+        the main thread, in order, and commit once.
+
+        Books are handled in the same order as in process_books, and
+        should_stop() is called after each one, so the only cost of
+        stopping partway through a batch is a few unnecessary HTTP
+        requests.
+
+        :return: The number of books processed.
+        """
+        # Worker threads can't touch the database, so make sure the
+        # API has everything it needs to build availability URLs
+        # before the workers start.
+        self.api.collection_token
+
+        pool = ThreadPool(self.concurrency)
+        total_books = 0
+        try:
+            for batch in self.batches(books):
+                responses = iter(
+                    pool.map(self.fetch_availability, [x for x in batch if x])
+                )
+                stop = False
+                for book in batch:
+                    total_books += 1
+                    if not total_books % 100:
+                        self.log.info("%s books processed", total_books)
+                    if not book:
+                        continue
+                    fetched, response = next(responses)
+                    if response:
+                        license_pool, is_new, is_changed = self.api.update_licensepool_from_availability(
+                            book, fetched, response
+                        )
+                    else:
+                        # The request failed, possibly because the
+                        # bearer token expired. Try again in this
+                        # thread, where the token can be refreshed.
+                        license_pool, is_new, is_changed = self.api.update_licensepool(book)
+                    self.book_processed(license_pool, is_new)
+                    if self.should_stop(start, book, is_changed):
+                        stop = True
+                        break
+                self._db.commit()
+                if stop:
+                    break
+        finally:
+            pool.close()
+            pool.join()
+        return total_books
+
+    def fetch_availability(self, book):
+        """Called in a worker thread to look up a single book."""
+        return self.api.fetch_availability(book, exception_on_401=True)
+
+    def batches(self, books):
+        """Split an iterator over books into lists of `batch_size` books."""
+        batch = []
+        for book in books:
+            batch.append(book)
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def book_processed(self, license_pool, is_new):
+        """Log a circulation event for a book that's new to the
+        collection.
+        """
+        if is_new:
+            for library in self.collection.libraries:
+                self.analytics.collect_event(
+                    library, license_pool, CirculationEvent.DISTRIBUTOR_TITLE_ADD, license_pool.last_checked
+                )
 
 
 class NewTitlesOverdriveCollectionMonitor(OverdriveCirculationMonitor):
@@ -1309,6 +1674,7 @@ class NewTitlesOverdriveCollectionMonitor(OverdriveCirculationMonitor):
     SERVICE_NAME = "Overdrive New Title Monitor"
     OVERLAP = datetime.timedelta(days=7)
     DEFAULT_START_TIME = OverdriveCirculationMonitor.NEVER
+    DEFAULT_CONCURRENCY = 10
 
     def recently_changed_ids(self, start, cutoff):
         """Ignore the dates and return all IDs."""
@@ -1371,6 +1737,8 @@ class RecentOverdriveCollectionMonitor(OverdriveCirculationMonitor):
     # that haven't changed, you're probably done.
     MAXIMUM_CONSECUTIVE_UNCHANGED_BOOKS=100
 
+    DEFAULT_CONCURRENCY = 10
+
     def __init__(self, *args, **kwargs):
         super(RecentOverdriveCollectionMonitor, self).__init__(*args, **kwargs)
         self.consecutive_unchanged_books = 0
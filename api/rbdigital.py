@@ -2,10 +2,10 @@ import base64
 from collections import defaultdict
 import datetime
 from dateutil.relativedelta import relativedelta
-from flask import Response
 from flask_babel import lazy_gettext as _
 import json
 import logging
+from multiprocessing.pool import ThreadPool
 from nose.tools import set_trace
 import os
 import random
@@ -98,6 +98,8 @@ from selftest import (
     HasSelfTests,
     SelfTestResult,
 )
+from streaming_proxy import StreamingProxy
+from util.response import ResponseUtility
 
 class RBDigitalAPI(BaseCirculationAPI, HasSelfTests):
 
@@ -173,6 +175,20 @@ class RBDigitalAPI(BaseCirculationAPI, HasSelfTests):
     # Bearer Token lifetime and is currently set to 30 minutes.
     PROXY_BEARER_GRACE_PERIOD = 30 * 60
 
+    # The full catalog is read from the network this many bytes at a
+    # time, and imported this many titles at a time. Progress is
+    # recorded after each batch of titles is committed, so that an
+    # interrupted import can pick up where it left off.
+    CATALOG_CHUNK_SIZE = 64 * 1024
+    IMPORT_BATCH_SIZE = 100
+    IMPORT_CHECKPOINT_KEY = u"rbdigital_import_checkpoint"
+
+    # When bringing in a catalog delta, look up the metadata for this
+    # many added titles at a time, making up to this many requests
+    # at once.
+    DELTA_BATCH_SIZE = 50
+    DELTA_CONCURRENCY = 5
+
     log = logging.getLogger("RBDigital Patron API")
 
     def __init__(self, _db, collection):
@@ -294,9 +310,18 @@ class RBDigitalAPI(BaseCirculationAPI, HasSelfTests):
             params=params, **kwargs
         )
 
+    def _make_streaming_request(self, url, headers):
+        """Make a GET request through the shared StreamingProxy session,
+        leaving the body of the response on the network.
+        """
+        return StreamingProxy().get(url, headers=headers)
+
     def request(self, url, method='get', extra_headers={}, data=None,
-                params=None, verbosity='complete'):
+                params=None, verbosity='complete', stream=False):
         """Make an HTTP request.
+
+        :param stream: If this is True, the body of the response is
+            left on the network to be read as it's needed.
         """
         if verbosity not in self.RESPONSE_VERBOSITY.values():
             verbosity = self.RESPONSE_VERBOSITY[2]
@@ -315,13 +340,20 @@ class RBDigitalAPI(BaseCirculationAPI, HasSelfTests):
         # some that will warrant repeating the request.
         disallowed_response_codes = []
 
+        kwargs = {}
+        if stream:
+            kwargs['stream'] = True
         response = self._make_request(
             url=url, method=method, headers=headers,
             data=data, params=params,
             allowed_response_codes=allowed_response_codes,
-            disallowed_response_codes=disallowed_response_codes
+            disallowed_response_codes=disallowed_response_codes,
+            **kwargs
         )
-        if (response.content
+        # A streamed response can't be checked without reading the
+        # whole thing; a permission-denied message will turn up as a
+        # parse error instead.
+        if (not stream and response.content
             and 'Invalid Basic Token or permission denied' in response.content):
             raise BadResponseException(
                 url, "Permission denied. This may be a temporary rate-limiting issue, or the credentials for this collection may be wrong.",
@@ -458,7 +490,8 @@ class RBDigitalAPI(BaseCirculationAPI, HasSelfTests):
 
         return resp_obj
 
-    def patron_fulfillment_request(self, patron, url, reauthorize=True):
+    def patron_fulfillment_request(self, patron, url, reauthorize=True,
+                                   extra_headers=None, stream=False):
         """Make a fulfillment request on behalf of a patron, using the
         a bearer token either previously cached or newly retrieved on
         behalf of the patron.
@@ -472,16 +505,27 @@ class RBDigitalAPI(BaseCirculationAPI, HasSelfTests):
         :param url: URL for a resource.
         :param reauthorize: (Optional) Boolean indicating whether to
             reauthorize the patron bearer token if we receive status code 401.
+        :param extra_headers: (Optional) Additional headers to send,
+            such as a Range header.
+        :param stream: (Optional) If True, the body of the response is
+            left on the network, so that it can be passed along to a
+            client as it arrives.
         :return: The request response.
         """
         content_type = 'application/json;charset=UTF-8'
 
         def perform_request(reauthorize=False):
             bearer_token = self.patron_bearer_token(patron)
-            headers = {"Authorization": 'Bearer {}'.format(bearer_token),
-                       "Content-Type": content_type}
-            response = self._make_request(url, 'GET', headers)
+            headers = dict(extra_headers or {})
+            headers.update({"Authorization": 'Bearer {}'.format(bearer_token),
+                            "Content-Type": content_type})
+            if stream:
+                response = self._make_streaming_request(url, headers)
+            else:
+                response = self._make_request(url, 'GET', headers)
             if response.status_code == 401 and reauthorize:
+                if stream:
+                    response.close()
                 self.reauthorize_patron_bearer_token(patron)
                 response = perform_request(reauthorize=False)
             return response
@@ -1489,6 +1533,86 @@ class RBDigitalAPI(BaseCirculationAPI, HasSelfTests):
 
         return response.json()
 
+    def stream_all_catalog(self):
+        """Get the entire RBDigital catalog for a particular library,
+        parsing it as it comes in over the network.
+
+        The catalog can be very large, so unlike get_all_catalog(),
+        this never holds the whole thing in memory.
+
+        :yield: A sequence of dictionaries, one per title, in the
+            order RBDigital sent them.
+        """
+        url = "%s/libraries/%s/media/all" % (self.base_url, str(self.library_id))
+
+        response = self.request(url, stream=True)
+        with ResponseUtility.body(response) as body:
+            try:
+                for item in self.json_list_items(body):
+                    yield item
+            except ValueError, e:
+                raise BadResponseException(
+                    url, "RBDigital all catalog response not parseable.",
+                    debug_message=str(e)
+                )
+
+    @classmethod
+    def json_list_items(cls, body, chunk_size=None):
+        """Parse a JSON list one item at a time.
+
+        :param body: A file-like object containing a JSON list.
+        :param chunk_size: Read this many bytes from `body` at a time.
+        :yield: The items in the list, as soon as each one has been
+            read in its entirety.
+        :raise ValueError: If `body` doesn't contain a JSON list.
+        """
+        chunk_size = chunk_size or cls.CATALOG_CHUNK_SIZE
+        decoder = json.JSONDecoder()
+        buffer = ''
+        position = 0
+        in_list = False
+        finished = False
+        while True:
+            # Skip whitespace, and the commas between items.
+            separators = ' \t\r\n'
+            if in_list:
+                separators += ','
+            while position < len(buffer) and buffer[position] in separators:
+                position += 1
+
+            if position < len(buffer):
+                if not in_list:
+                    if buffer[position] != '[':
+                        raise ValueError(
+                            "Expected a JSON list, got %r" % buffer[:100]
+                        )
+                    in_list = True
+                    position += 1
+                    continue
+                if buffer[position] == ']':
+                    return
+                try:
+                    item, end = decoder.raw_decode(buffer, position)
+                except ValueError, e:
+                    # Most likely we only have part of this item so far.
+                    if finished:
+                        raise
+                else:
+                    # A number at the very end of the buffer might be
+                    # continued in the next chunk.
+                    if end < len(buffer) or finished:
+                        yield item
+                        position = end
+                        continue
+            elif finished:
+                raise ValueError("JSON list was not terminated.")
+
+            chunk = body.read(chunk_size)
+            if not chunk:
+                finished = True
+            buffer = buffer[position:] + chunk
+            position = 0
+
     def get_delta(self, from_date=None, to_date=None, verbosity=None):
         """
         Gets the changes to the library's catalog.
@@ -1704,12 +1828,42 @@ class RBDigitalAPI(BaseCirculationAPI, HasSelfTests):
 
         return respdict
 
+    @property
+    def import_checkpoint(self):
+        """How many titles from the full catalog have already been
+        imported by an initial import that didn't finish.
+        """
+        setting = self.collection.external_integration.setting(
+            self.IMPORT_CHECKPOINT_KEY
+        )
+        return setting.int_value or 0
+
+    @import_checkpoint.setter
+    def import_checkpoint(self, value):
+        setting = self.collection.external_integration.setting(
+            self.IMPORT_CHECKPOINT_KEY
+        )
+        if value:
+            setting.value = unicode(value)
+        else:
+            setting.value = None
+
     def populate_all_catalog(self):
-        """ Call get_all_catalog to get all of library's book info from RBDigital.
+        """ Call stream_all_catalog to get all of library's book info from RBDigital.
         Create Work, Edition, LicensePool objects in our database.
+
+        Titles are committed in batches. If an earlier call was
+        interrupted, the titles it already committed are skipped.
+        This relies on RBDigital sending the catalog in the same
+        order every time; anything that slips through the cracks
+        will be picked up by the delta monitor.
         """
-        catalog_list = self.get_all_catalog()
-        items_transmitted = len(catalog_list)
+        already_imported = self.import_checkpoint
+        if already_imported:
+            self.log.info(
+                "Resuming catalog import after %d titles.", already_imported
+            )
+        items_transmitted = 0
         items_created = 0
 
         # the default policy doesn't update delivery mechanisms, which we do want to do
@@ -1721,7 +1875,10 @@ class RBDigitalAPI(BaseCirculationAPI, HasSelfTests):
             replacement_policy=metadata_replacement_policy
         )
 
-        for catalog_item in catalog_list:
+        for catalog_item in self.stream_all_catalog():
+            items_transmitted += 1
+            if items_transmitted <= already_imported:
+                continue
             result = coverage_provider.update_metadata(
                 catalog_item=catalog_item
             )
@@ -1745,12 +1902,15 @@ class RBDigitalAPI(BaseCirculationAPI, HasSelfTests):
                             # If it's not, we'll hear differently the
                             # next time we use the collection delta API.
                             lp.licenses_available = 1
-            if not items_created % 100:
-                # Periodically commit the work done so that if there's
-                # a failure, the subsequent run through this code will
-                # take less time.
+            if not items_transmitted % self.IMPORT_BATCH_SIZE:
+                # Commit the batch along with a note of how far we've
+                # gotten, so that if there's a failure, the
+                # subsequent run through this code won't redo it.
+                self.import_checkpoint = items_transmitted
                 self._db.commit()
+
         # stay data, stay!
+        self.import_checkpoint = None
         self._db.commit()
 
         return items_transmitted, items_created
@@ -1774,21 +1934,22 @@ class RBDigitalAPI(BaseCirculationAPI, HasSelfTests):
         coverage_provider = RBDigitalBibliographicCoverageProvider(
             collection=self.collection, api_class=self
         )
-        for item in items_added:
-            isbn = item["isbn"]
-            catalog_item = self.get_metadata_by_isbn(isbn)
-            result = coverage_provider.update_metadata(catalog_item)
-            if not isinstance(result, CoverageFailure):
-                items_updated += 1
-
-                # NOTE: To be consistent with populate_all_catalog, we
-                # should start off assuming that this title is owned
-                # and lendable. In practice, this isn't a big deal,
-                # because process_availability() will give us the
-                # right answer soon enough.
-                if isinstance(result, Identifier):
-                    # calls work.set_presentation_ready() for us
-                    coverage_provider.handle_success(result)
+        isbns = [item["isbn"] for item in items_added]
+        for catalog_items in self.metadata_for_isbns(isbns):
+            for catalog_item in catalog_items:
+                result = coverage_provider.update_metadata(catalog_item)
+                if not isinstance(result, CoverageFailure):
+                    items_updated += 1
+
+                    # NOTE: To be consistent with populate_all_catalog, we
+                    # should start off assuming that this title is owned
+                    # and lendable. In practice, this isn't a big deal,
+                    # because process_availability() will give us the
+                    # right answer soon enough.
+                    if isinstance(result, Identifier):
+                        # calls work.set_presentation_ready() for us
+                        coverage_provider.handle_success(result)
+            self._db.commit()
 
         for catalog_item in items_removed:
             metadata = RBDigitalRepresentationExtractor.isbn_info_to_metadata(catalog_item)
@@ -1830,6 +1991,31 @@ class RBDigitalAPI(BaseCirculationAPI, HasSelfTests):
 
         return items_transmitted, items_updated
 
+    def metadata_for_isbns(self, isbns):
+        """Look up RBDigital's metadata for a number of ISBNs.
+
+        Only DELTA_BATCH_SIZE ISBNs are looked up at a time, using up
+        to DELTA_CONCURRENCY simultaneous requests. The requests don't
+        touch the database, so the caller is free to use the database
+        while working through each batch.
+
+        :yield: A sequence of lists, each containing the responses to
+            get_metadata_by_isbn for one batch of ISBNs, in order.
+        """
+        pool = None
+        try:
+            for i in range(0, len(isbns), self.DELTA_BATCH_SIZE):
+                batch = isbns[i:i+self.DELTA_BATCH_SIZE]
+                if self.DELTA_CONCURRENCY > 1 and len(batch) > 1:
+                    if not pool:
+                        pool = ThreadPool(self.DELTA_CONCURRENCY)
+                    yield pool.map(self.get_metadata_by_isbn, batch)
+                else:
+                    yield [self.get_metadata_by_isbn(x) for x in batch]
+        finally:
+            if pool:
+                pool.close()
+
     def search(self, mediatype='ebook', genres=[], audience=None, availability=None, author=None, title=None,
         page_size=100, page_index=None, verbosity=None):
         """
@@ -2002,6 +2188,10 @@ class RBFulfillmentInfo(APIAwareFulfillmentInfo):
 
 class MockRBDigitalAPI(RBDigitalAPI):
 
+    # Queued responses are handed out in order, so the requests that
+    # get them have to be made in order.
+    DELTA_CONCURRENCY = 1
+
     @classmethod
     def mock_collection(self, _db):
         library = DatabaseTest.make_default_library(_db)
@@ -2057,6 +2247,10 @@ class MockRBDigitalAPI(RBDigitalAPI):
             kwargs.get('disallowed_response_codes')
         )
 
+    def _make_streaming_request(self, url, headers):
+        self.requests.append([url, [], dict(headers=headers, stream=True)])
+        return self.responses.pop()
+
     def get_data(self, filename):
         # returns contents of sample file as string and as dict
         path = os.path.join(self.resource_path, filename)
@@ -2482,30 +2676,77 @@ class RBDigitalCirculationMonitor(CollectionMonitor):
         )
         self.analytics = Analytics(self._db)
 
+    def current_availability(self):
+        """Find out what we currently believe about the availability of
+        every RBdigital title in this collection.
+
+        :return: A dictionary mapping each title's ISBN to a
+            (licenses_owned, licenses_available) 2-tuple.
+        """
+        qu = self._db.query(
+            Identifier.identifier, LicensePool.licenses_owned,
+            LicensePool.licenses_available
+        ).select_from(LicensePool).join(LicensePool.identifier).filter(
+            LicensePool.collection_id==self.collection.id
+        ).filter(
+            Identifier.type==Identifier.RB_DIGITAL_ID
+        )
+        return dict(
+            (isbn, (owned, available)) for isbn, owned, available in qu
+        )
+
     def process_availability(self, media_type='eBook'):
+        """Bring the collection's LicensePools in line with RBdigital's
+        availability information.
+
+        What we know about every title is loaded in one query and
+        compared with what RBdigital sent, so only new titles and
+        titles whose availability changed need any further work.
+
+        :return: The number of titles RBdigital sent.
+        """
         # get list of all titles, with availability info
         policy = self.api.default_circulation_replacement_policy
         availability_list = self.api.get_ebook_availability_info(media_type=media_type)
+        current = self.current_availability()
         item_count = 0
+        changed_count = 0
         for availability in availability_list:
+            item_count += 1
             isbn = availability['isbn']
             # boolean True/False value, not number of licenses
             available = availability['availability']
 
+            # Because the book showed up in availability, we know we
+            # own at least one license to it, and we know whether or
+            # not at least one license is available.
+            if available:
+                expect = (1, 1)
+            else:
+                expect = (1, 0)
+            if current.get(isbn) == expect:
+                # Nothing has changed.
+                continue
+
             medium = availability.get('mediaType')
             license_pool, is_new, is_changed = self.api.update_licensepool_for_identifier(
                 isbn, available, medium, policy
             )
+            current[isbn] = expect
             # Log a circulation event for this work.
             if is_new:
                 for library in self.collection.libraries:
                     self.analytics.collect_event(
                         library, license_pool, CirculationEvent.DISTRIBUTOR_TITLE_ADD, license_pool.last_checked)
 
-            item_count += 1
-            if item_count % self.batch_size == 0:
+            changed_count += 1
+            if changed_count % self.batch_size == 0:
                 self._db.commit()
 
+        self.log.info(
+            "%d of %d %s titles changed.", changed_count, item_count,
+            media_type
+        )
         return item_count
 
     def run_once(self, progress):
@@ -2682,7 +2923,7 @@ class RBDigitalFulfillmentProxy(object):
         return self.part is None
 
     @classmethod
-    def proxy(cls, _db, bearer, url, api_class=None):
+    def proxy(cls, _db, bearer, url, api_class=None, headers=None):
         # This method supports retrieval of resources that (a) require
         # a patron bearer token for fulfillment and (b) cannot be
         # fulfilled in a request authenticated by the usual patron
@@ -2693,6 +2934,8 @@ class RBDigitalFulfillmentProxy(object):
         #   exist or is expired, then return 403 Forbidden.
         # - We use the credential's `Collection` to create an instance of
         #   `RBDigitalAPI`, which we use to fulfill the request.
+        # - The response is streamed to the client as it arrives.
+        #   `headers` (e.g. Range) are passed along to RBdigital.
 
         api_class = api_class or RBDigitalAPI
 
@@ -2710,12 +2953,11 @@ class RBDigitalFulfillmentProxy(object):
         # We don't want someone who sniffed this bearer token to be able
         # to generate another one, which could cause DOS to patron.
         endpoint = cls._add_api_base_url(api, url)
-        response = api.patron_fulfillment_request(credential.patron, endpoint, reauthorize=False)
-        return Response(
-            response=response.content,
-            status=response.status_code,
-            headers=response.headers.items()
+        response = api.patron_fulfillment_request(
+            credential.patron, endpoint, reauthorize=False,
+            extra_headers=headers, stream=True
         )
+        return StreamingProxy().response(response)
 
     # The `_remove_api_base_url` and `_add_api_base_url` methods are used
     # in the construction and fulfillment of proxy URLs, respectively. They
@@ -29,6 +29,7 @@ from core.app_server import (
 from core.model import ConfigurationSetting
 from core.util.problem_detail import ProblemDetail
 from controller import CirculationManager
+from library_settings import LibrarySettings
 from problem_details import REMOTE_INTEGRATION_FAILED
 from flask_babel import lazy_gettext as _
 
@@ -79,6 +80,10 @@ def shutdown_session(exception):
         else:
             app.manager._db.commit()
 
+@app.teardown_request
+def report_library_settings(exception):
+    LibrarySettings.report()
+
 def requires_auth(f):
     @wraps(f)
     def decorated(*args, **kwargs):
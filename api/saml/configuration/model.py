@@ -1,4 +1,5 @@
 import json
+from collections import OrderedDict
 from threading import Lock
 
 from contextlib2 import contextmanager
@@ -148,7 +149,7 @@ class SAMLConfiguration(ConfigurationGrouping):
 
     IDP_DISPLAY_NAME_DEFAULT_TEMPLATE = "Identity Provider #{0}"
 
-    def __init__(self, configuration_storage, db, metadata_parser):
+    def __init__(self, configuration_storage, db, metadata_parser, metadata_cache=None):
         """Initializes a new instance of SAMLConfiguration class
 
         :param configuration_storage: SAML configuration storage
@@ -156,10 +157,14 @@ class SAMLConfiguration(ConfigurationGrouping):
 
         :param metadata_parser: SAML metadata parser
         :type metadata_parser: SAMLMetadataParser
+
+        :param metadata_cache: Optional cache of parsed IdP metadata
+        :type metadata_cache: Optional[api.saml.metadata.cache.SAMLIdentityProviderMetadataCache]
         """
         super(SAMLConfiguration, self).__init__(configuration_storage, db)
 
         self._metadata_parser = metadata_parser
+        self._metadata_cache = metadata_cache
 
         self._identity_providers = None
         self._service_provider = None
@@ -187,9 +192,103 @@ class SAMLConfiguration(ConfigurationGrouping):
                     federated_identity_provider_entity_ids
                 )
             )
+            .order_by(SAMLFederatedIdentityProvider.id)
             .all()
         )
 
+    def _parse_identity_providers(self, xml_metadata):
+        """Parses an XML string containing IdP metadata, using the cache if there is one
+
+        :param xml_metadata: XML string containing SAML metadata
+        :type xml_metadata: string
+
+        :return: List of IdentityProviderMetadata objects
+        :rtype: List[IdentityProviderMetadata]
+
+        :raise: SAMLParsingError
+        """
+        if self._metadata_cache is not None:
+            return self._metadata_cache.parse(self._metadata_parser, xml_metadata)
+
+        parsing_results = self._metadata_parser.parse(xml_metadata)
+
+        return [parsing_result.provider for parsing_result in parsing_results]
+
+    def _load_cached_federated_identity_providers(self, db):
+        """Loads federated IdPs selected by the admin, parsing only the ones missing from the cache.
+
+        Federated IdPs are cached by their ID and the time their federation was last updated,
+        so only those IDs have to be loaded to find out whether the cache is still valid.
+
+        :param db: Database session
+        :type db: sqlalchemy.orm.session.Session
+
+        :return: List of IdentityProviderMetadata objects
+        :rtype: List[IdentityProviderMetadata]
+
+        :raise: SAMLParsingError
+        """
+        federated_identity_provider_entity_ids = json.loads(
+            self.federated_identity_provider_entity_ids
+        )
+
+        keys = OrderedDict(
+            (
+                identity_provider_id,
+                self._metadata_cache.federated_identity_provider_key(
+                    identity_provider_id, last_updated_at
+                ),
+            )
+            for identity_provider_id, last_updated_at in db.query(
+                SAMLFederatedIdentityProvider.id, SAMLFederation.last_updated_at
+            )
+            .outerjoin(SAMLFederatedIdentityProvider.federation)
+            .filter(
+                SAMLFederatedIdentityProvider.entity_id.in_(
+                    federated_identity_provider_entity_ids
+                )
+            )
+            .order_by(SAMLFederatedIdentityProvider.id)
+        )
+
+        parsed_identity_providers = {}
+        for identity_provider_id, key in keys.items():
+            cached_identity_providers = self._metadata_cache.get(key)
+
+            if cached_identity_providers is not None:
+                parsed_identity_providers[
+                    identity_provider_id
+                ] = cached_identity_providers
+
+        missing_ids = [
+            identity_provider_id
+            for identity_provider_id in keys
+            if identity_provider_id not in parsed_identity_providers
+        ]
+
+        if missing_ids:
+            for identity_provider_metadata in db.query(
+                SAMLFederatedIdentityProvider
+            ).filter(SAMLFederatedIdentityProvider.id.in_(missing_ids)):
+                identity_provider_id = identity_provider_metadata.id
+                parsing_results = self._metadata_parser.parse(
+                    identity_provider_metadata.xml_metadata
+                )
+                parsed_identity_providers[identity_provider_id] = [
+                    parsing_result.provider for parsing_result in parsing_results
+                ]
+
+                self._metadata_cache.set(
+                    keys[identity_provider_id],
+                    parsed_identity_providers[identity_provider_id],
+                )
+
+        identity_providers = []
+        for identity_provider_id in keys:
+            identity_providers.extend(parsed_identity_providers[identity_provider_id])
+
+        return identity_providers
+
     def _load_identity_providers(self, db):
         """Loads IdP settings from the library's configuration settings
 
@@ -204,14 +303,18 @@ class SAMLConfiguration(ConfigurationGrouping):
         identity_providers = []
 
         if self.non_federated_identity_provider_xml_metadata:
-            parsing_results = self._metadata_parser.parse(
+            identity_providers = self._parse_identity_providers(
                 self.non_federated_identity_provider_xml_metadata
             )
-            identity_providers = [
-                parsing_result.provider for parsing_result in parsing_results
-            ]
 
-        if self.federated_identity_provider_entity_ids:
+        if (
+            self.federated_identity_provider_entity_ids
+            and self._metadata_cache is not None
+        ):
+            identity_providers.extend(
+                self._load_cached_federated_identity_providers(db)
+            )
+        elif self.federated_identity_provider_entity_ids:
             for identity_provider_metadata in self._get_federated_identity_providers(
                 db
             ):
@@ -359,11 +462,14 @@ class SAMLSettings(dict):
 class SAMLConfigurationFactory(ConfigurationFactory):
     """Factory creating new instances of SAMLConfiguration class."""
 
-    def __init__(self, parser):
+    def __init__(self, parser, metadata_cache=None):
         """Initialize a new instance of SAMLConfigurationFactory class.
 
         :param parser: SAMLMetadataParser object
         :type parser: api.saml.metadata.parser.SAMLMetadataParser
+
+        :param metadata_cache: Optional cache of parsed IdP metadata shared by all created configurations
+        :type metadata_cache: Optional[api.saml.metadata.cache.SAMLIdentityProviderMetadataCache]
         """
         if not isinstance(parser, SAMLMetadataParser):
             raise ValueError(
@@ -373,6 +479,7 @@ class SAMLConfigurationFactory(ConfigurationFactory):
             )
 
         self._parser = parser
+        self._metadata_cache = metadata_cache
 
     @contextmanager
     def create(self, configuration_storage, db, configuration_grouping_class):
@@ -398,7 +505,7 @@ class SAMLConfigurationFactory(ConfigurationFactory):
             )
 
         with configuration_grouping_class(
-            configuration_storage, db, self._parser
+            configuration_storage, db, self._parser, self._metadata_cache
         ) as configuration_bucket:
             yield configuration_bucket
 
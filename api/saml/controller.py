@@ -15,6 +15,7 @@ from six.moves.urllib.parse import (
 from api.problem_details import *
 from api.saml.auth import SAMLAuthenticationManager
 from api.saml.configuration.model import SAMLConfigurationFactory
+from api.saml.metadata.cache import identity_provider_metadata_cache
 from api.saml.metadata.parser import SAMLMetadataParser
 from core.util.problem_detail import ProblemDetail
 from core.util.problem_detail import json as pd_json
@@ -59,7 +60,9 @@ class SAMLController(object):
         self._authenticator = authenticator
 
         self._logger = logging.getLogger(__name__)
-        self._configuration_factory = SAMLConfigurationFactory(SAMLMetadataParser())
+        self._configuration_factory = SAMLConfigurationFactory(
+            SAMLMetadataParser(), identity_provider_metadata_cache
+        )
 
     @staticmethod
     def _get_authentication_manager(db, authentication_provider):
@@ -0,0 +1,135 @@
+import hashlib
+import logging
+
+import six
+from expiringdict import ExpiringDict
+
+
+class SAMLIdentityProviderMetadataCache(object):
+    """Keeps parsed IdP metadata so that it doesn't have to be parsed again
+    every time a SAML configuration is loaded.
+
+    Entries are keyed either by a hash of the XML metadata or by the ID of a
+    federated IdP together with the time its federation was last updated.
+    Neither kind of key can point to outdated metadata, so each process can
+    keep its own cache without coordinating with the others.
+    """
+
+    MAX_LENGTH = 10000
+    MAX_AGE = 24 * 60 * 60
+
+    def __init__(self, max_length=MAX_LENGTH, max_age=MAX_AGE):
+        """Initialize a new instance of SAMLIdentityProviderMetadataCache class.
+
+        :param max_length: Maximum number of entries kept in the cache
+        :type max_length: int
+
+        :param max_age: Number of seconds an entry is kept in the cache
+        :type max_age: int
+        """
+        self._cache = ExpiringDict(max_len=max_length, max_age_seconds=max_age)
+        self._logger = logging.getLogger(__name__)
+
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def xml_metadata_key(xml_metadata):
+        """Return a cache key for an XML string containing SAML metadata.
+
+        :param xml_metadata: XML string containing SAML metadata
+        :type xml_metadata: string
+
+        :return: Cache key
+        :rtype: Tuple
+        """
+        if isinstance(xml_metadata, six.text_type):
+            xml_metadata = xml_metadata.encode("utf-8")
+
+        return "xml", hashlib.sha256(xml_metadata).hexdigest()
+
+    @staticmethod
+    def federated_identity_provider_key(identity_provider_id, last_updated_at):
+        """Return a cache key for a federated IdP.
+
+        :param identity_provider_id: SAMLFederatedIdentityProvider's ID
+        :type identity_provider_id: int
+
+        :param last_updated_at: Time when the IdP's federation was last updated
+        :type last_updated_at: datetime.datetime
+
+        :return: Cache key
+        :rtype: Tuple
+        """
+        return "federated", identity_provider_id, last_updated_at
+
+    def get(self, key):
+        """Return the IdPs cached under the specified key.
+
+        :param key: Cache key
+        :type key: Tuple
+
+        :return: List of IdentityProviderMetadata objects or None if there is nothing in the cache
+        :rtype: Optional[List[IdentityProviderMetadata]]
+        """
+        identity_providers = self._cache.get(key)
+
+        if identity_providers is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+
+        return list(identity_providers)
+
+    def set(self, key, identity_providers):
+        """Cache IdPs under the specified key.
+
+        :param key: Cache key
+        :type key: Tuple
+
+        :param identity_providers: List of IdentityProviderMetadata objects
+        :type identity_providers: List[IdentityProviderMetadata]
+        """
+        self._cache[key] = tuple(identity_providers)
+
+    def parse(self, metadata_parser, xml_metadata):
+        """Parse an XML string containing SAML metadata unless it has been already parsed.
+
+        :param metadata_parser: SAML metadata parser
+        :type metadata_parser: api.saml.metadata.parser.SAMLMetadataParser
+
+        :param xml_metadata: XML string containing SAML metadata
+        :type xml_metadata: string
+
+        :return: List of IdentityProviderMetadata objects
+        :rtype: List[IdentityProviderMetadata]
+
+        :raise: SAMLMetadataParsingError
+        """
+        key = self.xml_metadata_key(xml_metadata)
+        identity_providers = self.get(key)
+
+        if identity_providers is None:
+            parsing_results = metadata_parser.parse(xml_metadata)
+            identity_providers = [
+                parsing_result.provider for parsing_result in parsing_results
+            ]
+
+            self.set(key, identity_providers)
+
+        return identity_providers
+
+    def clear(self):
+        """Remove all the entries from the cache."""
+        self._logger.info(
+            "Clearing SAML metadata cache ({0} hits, {1} misses)".format(
+                self.hits, self.misses
+            )
+        )
+
+        self._cache.clear()
+
+
+# Cache shared by all SAML authentication providers in this process.
+identity_provider_metadata_cache = SAMLIdentityProviderMetadataCache()
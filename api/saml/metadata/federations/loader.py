@@ -1,6 +1,9 @@
 import logging
+from io import BytesIO
 
 from defusedxml.lxml import tostring
+from lxml.etree import XMLSyntaxError, iterparse
+from onelogin.saml2.constants import OneLogin_Saml2_Constants
 from onelogin.saml2.idp_metadata_parser import OneLogin_Saml2_IdPMetadataParser
 
 from api.saml.metadata.federations.model import (
@@ -8,7 +11,7 @@ from api.saml.metadata.federations.model import (
     SAMLFederation,
 )
 from api.saml.metadata.federations.validator import SAMLFederatedMetadataValidator
-from api.saml.metadata.parser import SAMLMetadataParser
+from api.saml.metadata.parser import SAMLMetadataParser, SAMLMetadataParsingError
 from core.exceptions import BaseError
 from core.util import first_or_default
 
@@ -53,6 +56,10 @@ class SAMLFederatedIdentityProviderLoader(object):
 
     ENGLISH_LANGUAGE_CODES = ("en", "eng")
 
+    ENTITY_DESCRIPTOR_TAG = "{{{0}}}EntityDescriptor".format(
+        OneLogin_Saml2_Constants.NS_MD
+    )
+
     def __init__(self, loader, validator, parser):
         """Initialize a new instance of SAMLFederatedIdentityProviderLoader class.
 
@@ -108,13 +115,68 @@ class SAMLFederatedIdentityProviderLoader(object):
 
         return first_or_default(localized_values).value
 
-    def load(self, federation):
-        """Loads metadata of federated IdPs from the specified metadata service.
+    def _get_display_name(self, idp):
+        """Choose a display name for an IdP.
+
+        :param idp: IdP's metadata
+        :type idp: api.saml.metadata.model.SAMLProviderMetadata
+
+        :return: Display name
+        :rtype: str
+        """
+        if idp.ui_info.display_names:
+            return self._try_to_get_an_english_value(idp.ui_info.display_names)
+        elif idp.organization.organization_display_names:
+            return self._try_to_get_an_english_value(
+                idp.organization.organization_display_names
+            )
+        elif idp.organization.organization_names:
+            return self._try_to_get_an_english_value(
+                idp.organization.organization_names
+            )
+
+        return idp.entity_id
+
+    def _iterate_entity_descriptors(self, metadata):
+        """Yield EntityDescriptor elements of the aggregated metadata one at a time.
+
+        The metadata is parsed incrementally and every element is removed from the tree
+        once it has been processed, so the whole document is never kept in memory.
+
+        :param metadata: SAML federation's aggregated metadata
+        :type metadata: str
+
+        :return: Iterable collection of XML strings containing individual EntityDescriptor elements
+        :rtype: Iterable[str]
+
+        :raise: SAMLMetadataParsingError
+        """
+        try:
+            for _, element in iterparse(
+                BytesIO(bytes(metadata)),
+                events=("end",),
+                tag=self.ENTITY_DESCRIPTOR_TAG,
+                resolve_entities=False,
+                load_dtd=False,
+                no_network=True,
+            ):
+                # The element's tail may not have been read yet,
+                # so leave it out to keep the XML identical between runs.
+                yield tostring(element, with_tail=False)
+
+                element.clear()
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+        except XMLSyntaxError as exception:
+            raise SAMLMetadataParsingError(inner_exception=exception)
+
+    def stream(self, federation):
+        """Load metadata of federated IdPs from the specified metadata service one IdP at a time.
 
         :param federation: SAML federation where loaded IdPs belong to
         :type federation: api.saml.metadata.federations.model.SAMLFederation
 
-        :return: List of SAMLFederatedIdP objects
+        :return: Iterable collection of SAMLFederatedIdP objects
         :rtype: Iterable[api.saml.configuration.SAMLFederatedIdentityProvider]
         """
         if not isinstance(federation, SAMLFederation):
@@ -126,42 +188,37 @@ class SAMLFederatedIdentityProviderLoader(object):
 
         self._logger.info("Started loading federated IdP's for {0}".format(federation))
 
-        federated_idps = []
         metadata = self._loader.load_idp_metadata(federation.idp_metadata_service_url)
 
+        # Signatures cover the whole document, so it has to be validated at once.
         self._validator.validate(federation, metadata)
 
-        parsing_results = self._parser.parse(bytes(metadata))
+        count = 0
+        for xml_metadata in self._iterate_entity_descriptors(metadata):
+            for parsing_result in self._parser.parse(xml_metadata):
+                idp = parsing_result.provider
+                display_name = self._get_display_name(idp)
 
-        for parsing_result in parsing_results:
-            idp = parsing_result.provider
+                count += 1
 
-            if idp.ui_info.display_names:
-                display_name = self._try_to_get_an_english_value(
-                    idp.ui_info.display_names
-                )
-            elif idp.organization.organization_display_names:
-                display_name = self._try_to_get_an_english_value(
-                    idp.organization.organization_display_names
+                yield SAMLFederatedIdentityProvider(
+                    federation,
+                    idp.entity_id.strip(),
+                    display_name.strip(),
+                    xml_metadata,
                 )
-            elif idp.organization.organization_names:
-                display_name = self._try_to_get_an_english_value(
-                    idp.organization.organization_names
-                )
-            else:
-                display_name = idp.entity_id
-
-            xml_metadata = tostring(parsing_result.xml_node)
-            federated_idp = SAMLFederatedIdentityProvider(
-                federation, idp.entity_id.strip(), display_name.strip(), xml_metadata
-            )
-
-            federated_idps.append(federated_idp)
 
         self._logger.info(
-            "Finished loading {0} federated IdP's for {1}".format(
-                len(federated_idps), federation
-            )
+            "Finished loading {0} federated IdP's for {1}".format(count, federation)
         )
 
-        return federated_idps
+    def load(self, federation):
+        """Loads metadata of federated IdPs from the specified metadata service.
+
+        :param federation: SAML federation where loaded IdPs belong to
+        :type federation: api.saml.metadata.federations.model.SAMLFederation
+
+        :return: List of SAMLFederatedIdP objects
+        :rtype: List[api.saml.configuration.SAMLFederatedIdentityProvider]
+        """
+        return list(self.stream(federation))
@@ -1,7 +1,15 @@
 import datetime
+import hashlib
 import logging
 
-from api.saml.metadata.federations.model import SAMLFederation
+import six
+from sqlalchemy.sql import func
+
+from api.saml.metadata.cache import identity_provider_metadata_cache
+from api.saml.metadata.federations.model import (
+    SAMLFederatedIdentityProvider,
+    SAMLFederation,
+)
 from core.monitor import Monitor
 
 
@@ -10,36 +18,152 @@ class SAMLMetadataMonitor(Monitor):
 
     MAX_AGE = datetime.timedelta(days=1)
 
-    def __init__(self, db, loader):
+    # Number of IdPs added or removed in a single database round trip.
+    BATCH_SIZE = 500
+
+    def __init__(self, db, loader, metadata_cache=identity_provider_metadata_cache):
         """Initialize a new instance of SAMLMetadataMonitor class.
 
         :param loader: IdP loader
         :type loader: api.saml.loader.SAMLFederatedIdPLoader
+
+        :param metadata_cache: Cache of parsed IdP metadata
+        :type metadata_cache: api.saml.metadata.cache.SAMLIdentityProviderMetadataCache
         """
         super(SAMLMetadataMonitor, self).__init__(db)
 
         self._loader = loader
+        self._metadata_cache = metadata_cache
         self._logger = logging.getLogger(__name__)
 
+    @staticmethod
+    def _hash_xml_metadata(xml_metadata):
+        """Return the same hash of IdP's XML metadata as PostgreSQL's md5 function.
+
+        :param xml_metadata: IdP's XML metadata
+        :type xml_metadata: str
+
+        :return: Hex digest of the XML metadata
+        :rtype: str
+        """
+        if isinstance(xml_metadata, six.text_type):
+            xml_metadata = xml_metadata.encode("utf-8")
+
+        return hashlib.md5(xml_metadata).hexdigest()
+
+    def _load_existing_identity_providers(self, saml_federation):
+        """Load entity IDs, display names and XML hashes of the IdPs stored for the federation.
+
+        :param saml_federation: SAML federation
+        :type saml_federation: api.saml.metadata.federations.model.SAMLFederation
+
+        :return: 2-tuple containing a dictionary mapping entity IDs to (ID, display name, XML hash)
+            tuples and a list of IDs of duplicate IdPs
+        :rtype: Tuple[Dict[str, Tuple[int, str, str]], List[int]]
+        """
+        existing_identity_providers = {}
+        duplicate_ids = []
+
+        query = (
+            self._db.query(
+                SAMLFederatedIdentityProvider.id,
+                SAMLFederatedIdentityProvider.entity_id,
+                SAMLFederatedIdentityProvider.display_name,
+                func.md5(SAMLFederatedIdentityProvider.xml_metadata),
+            )
+            .filter(SAMLFederatedIdentityProvider.federation_id == saml_federation.id)
+            .order_by(SAMLFederatedIdentityProvider.id)
+        )
+
+        for identity_provider_id, entity_id, display_name, xml_metadata_hash in query:
+            if entity_id in existing_identity_providers:
+                duplicate_ids.append(identity_provider_id)
+            else:
+                existing_identity_providers[entity_id] = (
+                    identity_provider_id,
+                    display_name,
+                    xml_metadata_hash,
+                )
+
+        return existing_identity_providers, duplicate_ids
+
     def _update_saml_federation_idps_metadata(self, saml_federation):
         """Update IdPs' metadata belonging to the specified SAML federation.
 
+        IdPs are compared with the stored ones by their entity IDs and XML hashes
+        so that only new, changed and removed IdPs are written to the database.
+
         :param saml_federation: SAML federation
         :type saml_federation: api.saml.metadata.federations.model.SAMLFederation
         """
         self._logger.info("Started processing {0}".format(saml_federation))
 
-        for existing_identity_provider in saml_federation.identity_providers:
-            self._db.delete(existing_identity_provider)
+        (
+            existing_identity_providers,
+            removed_ids,
+        ) = self._load_existing_identity_providers(saml_federation)
+        loaded_entity_ids = set()
+        inserted = 0
+        updated = 0
+
+        for new_identity_provider in self._loader.stream(saml_federation):
+            entity_id = new_identity_provider.entity_id
+
+            if entity_id in loaded_entity_ids:
+                # The same entity can describe both an IdP and an SP.
+                continue
+
+            loaded_entity_ids.add(entity_id)
+            existing_identity_provider = existing_identity_providers.get(entity_id)
 
-        new_identity_providers = self._loader.load(saml_federation)
+            if existing_identity_provider is None:
+                self._db.add(new_identity_provider)
+                inserted += 1
 
-        for new_identity_provider in new_identity_providers:
-            self._db.add(new_identity_provider)
+                if inserted % self.BATCH_SIZE == 0:
+                    self._db.flush()
+
+                continue
+
+            identity_provider_id, display_name, xml_metadata_hash = (
+                existing_identity_provider
+            )
+
+            if display_name != new_identity_provider.display_name or (
+                xml_metadata_hash
+                != self._hash_xml_metadata(new_identity_provider.xml_metadata)
+            ):
+                self._db.query(SAMLFederatedIdentityProvider).filter(
+                    SAMLFederatedIdentityProvider.id == identity_provider_id
+                ).update(
+                    {
+                        SAMLFederatedIdentityProvider.display_name: new_identity_provider.display_name,
+                        SAMLFederatedIdentityProvider.xml_metadata: new_identity_provider.xml_metadata,
+                    },
+                    synchronize_session=False,
+                )
+                updated += 1
+
+        removed_ids.extend(
+            identity_provider_id
+            for entity_id, (identity_provider_id, _, _) in existing_identity_providers.items()
+            if entity_id not in loaded_entity_ids
+        )
+
+        for index in range(0, len(removed_ids), self.BATCH_SIZE):
+            self._db.query(SAMLFederatedIdentityProvider).filter(
+                SAMLFederatedIdentityProvider.id.in_(
+                    removed_ids[index : index + self.BATCH_SIZE]
+                )
+            ).delete(synchronize_session=False)
 
         saml_federation.last_updated_at = datetime.datetime.utcnow()
 
-        self._logger.info("Finished processing {0}".format(saml_federation))
+        self._logger.info(
+            "Finished processing {0}: {1} IdPs added, {2} updated, {3} removed".format(
+                saml_federation, inserted, updated, len(removed_ids)
+            )
+        )
 
     def run_once(self, progress):
         self._logger.info("Started running the SAML metadata monitor")
@@ -54,4 +178,9 @@ class SAMLMetadataMonitor(Monitor):
             for outdated_saml_federation in saml_federations:
                 self._update_saml_federation_idps_metadata(outdated_saml_federation)
 
+        # Cached federated IdPs are keyed by their federation's last_updated_at,
+        # so other processes stop using the old metadata as soon as they see
+        # the new timestamp. Entries in this process can be dropped right away.
+        self._metadata_cache.clear()
+
         self._logger.info("Finished running the SAML metadata monitor")
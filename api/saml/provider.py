@@ -12,6 +12,7 @@ from api.problem_details import *
 from api.saml.auth import SAMLAuthenticationManager, SAMLAuthenticationManagerFactory
 from api.saml.configuration.model import SAMLConfiguration, SAMLConfigurationFactory
 from api.saml.configuration.validator import SAMLSettingsValidator
+from api.saml.metadata.cache import identity_provider_metadata_cache
 from api.saml.metadata.filter import SAMLSubjectFilter
 from api.saml.metadata.model import (
     SAMLLocalizedMetadataItem,
@@ -71,7 +72,9 @@ class SAMLWebSSOAuthenticationProvider(
 
         self._logger = logging.getLogger(__name__)
         self._configuration_storage = ConfigurationStorage(self)
-        self._configuration_factory = SAMLConfigurationFactory(SAMLMetadataParser())
+        self._configuration_factory = SAMLConfigurationFactory(
+            SAMLMetadataParser(), identity_provider_metadata_cache
+        )
         self._authentication_manager_factory = SAMLAuthenticationManagerFactory()
 
     def _authentication_flow_document(self, db):
@@ -6,6 +6,7 @@ from api.authenticator import (
     PatronData,
 )
 from api.sip.client import SIPClient
+from api.sip.pool import SIPConnectionPool
 from core.util.http import RemoteIntegrationException
 from core.util import MoneyUtility
 from core.model import ExternalIntegration
@@ -27,6 +28,8 @@ class SIP2AuthenticationProvider(BasicAuthenticationProvider):
     SSL_KEY = "ssl_key"
     ILS = "ils"
     PATRON_STATUS_BLOCK = "patron status block"
+    CONNECTION_POOL_SIZE = "connection pool size"
+    CONNECTION_IDLE_TIMEOUT = "connection idle timeout"
 
     SETTINGS = [
         { "key": ExternalIntegration.URL, "label": _("Server"), "required": True },
@@ -77,6 +80,18 @@ class SIP2AuthenticationProvider(BasicAuthenticationProvider):
           ],
           "default": "true",
         },
+        { "key": CONNECTION_POOL_SIZE,
+          "label": _("SIP2 connection pool size"),
+          "description": _("The number of idle, logged-in SIP2 sessions to keep open for reuse. Reusing a session avoids connecting and logging in to the SIP2 server for every patron authentication. Some SIP2 servers limit the number of simultaneous connections; set this to 0 to open a new session for every request."),
+          "type": "number",
+          "default": 0,
+        },
+        { "key": CONNECTION_IDLE_TIMEOUT,
+          "label": _("SIP2 connection idle timeout (seconds)"),
+          "description": _("A pooled SIP2 session that has been idle for longer than this will be closed rather than reused."),
+          "type": "number",
+          "default": SIPConnectionPool.DEFAULT_IDLE_TIMEOUT,
+        },
     ] + BasicAuthenticationProvider.SETTINGS
 
     # Map the reasons why SIP2 might report a patron is blocked to the
@@ -143,28 +158,68 @@ class SIP2AuthenticationProvider(BasicAuthenticationProvider):
         self.ssl_key = integration.setting(self.SSL_KEY).value
         self.dialect = Sip2Dialect.load_dialect(integration.setting(self.ILS).value)
         self.client = client
+        self.integration_id = integration.id
+        self.connection_pool_size = (
+            integration.setting(self.CONNECTION_POOL_SIZE).int_value or 0
+        )
+        self.connection_idle_timeout = integration.setting(
+            self.CONNECTION_IDLE_TIMEOUT
+        ).int_value
         patron_status_block = integration.setting(self.PATRON_STATUS_BLOCK).json_value
         if patron_status_block is None or patron_status_block:
             self.fields_that_deny_borrowing = SIPClient.PATRON_STATUS_FIELDS_THAT_DENY_BORROWING_PRIVILEGES
         else:
             self.fields_that_deny_borrowing = []
 
+    def _make_client(self):
+        """Create a new SIPClient based on this provider's configuration."""
+        return SIPClient(
+            target_server=self.server, target_port=self.port,
+            login_user_id=self.login_user_id, login_password=self.login_password,
+            location_code=self.location_code, institution_id=self.institution_id, separator=self.field_separator,
+            use_ssl=self.use_ssl, ssl_cert=self.ssl_cert, ssl_key=self.ssl_key,
+            dialect=self.dialect
+        )
+
+    @property
+    def connection_pool(self):
+        """The SIPConnectionPool shared by every provider for this
+        integration, or None if sessions should not be pooled.
+        """
+        if self.client or self.connection_pool_size <= 0:
+            return None
+        # If any of these change, sessions created under the old
+        # configuration must not be reused.
+        signature = (
+            self.server, self.port, self.login_user_id, self.login_password,
+            self.location_code, self.institution_id, self.field_separator,
+            self.use_ssl, self.ssl_cert, self.ssl_key, self.dialect,
+            self.connection_pool_size, self.connection_idle_timeout
+        )
+        return SIPConnectionPool.for_integration(
+            self.integration_id, self._make_client, signature,
+            size=self.connection_pool_size,
+            idle_timeout=self.connection_idle_timeout
+        )
+
     def patron_information(self, username, password):
+        def request(sip):
+            info = sip.patron_information(username, password)
+            sip.end_session(username, password)
+            return info
+
         try:
+            pool = self.connection_pool
+            if pool:
+                return pool.run(request)
+
             if self.client:
                 sip = self.client
             else:
-                sip = SIPClient(
-                    target_server=self.server, target_port=self.port,
-                    login_user_id=self.login_user_id, login_password=self.login_password,
-                    location_code=self.location_code, institution_id=self.institution_id, separator=self.field_separator,
-                    use_ssl=self.use_ssl, ssl_cert=self.ssl_cert, ssl_key=self.ssl_key,
-                    dialect=self.dialect
-                )
+                sip = self._make_client()
             sip.connect()
             sip.login()
-            info = sip.patron_information(username, password)
-            sip.end_session(username, password)
+            info = request(sip)
             sip.disconnect()
             return info
 
@@ -201,14 +256,8 @@ class SIP2AuthenticationProvider(BasicAuthenticationProvider):
         if self.client:
             sip = self.client
         else:
-            sip = SIPClient(
-                target_server=self.server, target_port=self.port,
-                login_user_id=self.login_user_id, login_password=self.login_password,
-                location_code=self.location_code, institution_id=self.institution_id, separator=self.field_separator,
-                use_ssl=self.use_ssl, ssl_cert=self.ssl_cert, ssl_key=self.ssl_key,
-                dialect=self.dialect
-            )
-        
+            sip = self._make_client()
+
         connection = self.run_test(
             ("Test Connection"),
             makeConnection,
@@ -29,6 +29,7 @@ import datetime
 import logging
 import os
 import re
+import select
 import socket
 import ssl
 import tempfile
@@ -273,6 +274,7 @@ class SIPClient(Constants):
         self.separator_re = re.compile(escaped + "([A-Z][A-Z])")
 
         self.sequence_number = 0
+        self.sequence_number_wrapped = False
         self.connection = None
         self.login_user_id = login_user_id
         if login_user_id:
@@ -383,12 +385,31 @@ class SIPClient(Constants):
         Specifically, the sequence number.
         """
         self.sequence_number = 0
+        self.sequence_number_wrapped = False
 
     def disconnect(self):
         """Close the connection to the SIP server."""
         self.connection.close()
         self.connection = None
 
+    def connection_is_stale(self):
+        """Check whether an idle connection can no longer be used.
+
+        When no request is outstanding, the server has no reason to
+        send us anything. If the socket is readable anyway, the server
+        has either closed the connection or sent data we don't know
+        what to do with. Either way the connection shouldn't be reused.
+        """
+        if not self.connection:
+            return True
+        try:
+            readable, writable, errored = select.select(
+                [self.connection], [], [self.connection], 0
+            )
+        except (select.error, socket.error, ValueError), e:
+            return True
+        return bool(readable or errored)
+
     def make_request(self, message_creator, parser, *args, **kwargs):
         """Send a request to a SIP server and parse the response.
 
@@ -814,6 +835,7 @@ class SIPClient(Constants):
             self.sequence_number += 1
             if self.sequence_number > 9:
                 self.sequence_number = 0
+                self.sequence_number_wrapped = True
 
         # Finally, add the checksum.
         text += "AZ"
@@ -872,5 +894,9 @@ class MockSIPClient(SIPClient):
         self.responses = self.responses[1:]
         return response
 
+    def connection_is_stale(self):
+        # There is no socket to go stale.
+        return False
+
     def disconnect(self):
         pass
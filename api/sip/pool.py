@@ -0,0 +1,217 @@
+"""A thread-safe pool of logged-in SIP2 sessions.
+
+Opening a SIP2 session means a TCP (and often TLS) handshake followed
+by a login message. For a busy library that's more work than the
+patron information request we actually care about, so instead of
+tearing a session down after every request, we keep a small number of
+idle, logged-in sessions around for each SIP2 integration and hand
+them out as needed.
+"""
+import logging
+import threading
+import time
+from collections import deque
+
+from nose.tools import set_trace
+
+
+class SIPConnectionPool(object):
+    """Maintains idle, logged-in SIPClient objects for a single SIP2
+    server configuration.
+    """
+
+    log = logging.getLogger("SIP2 connection pool")
+
+    # By default, keep up to this many idle sessions around.
+    DEFAULT_SIZE = 5
+
+    # By default, don't reuse a session that's been idle for longer
+    # than this many seconds. Many SIP2 servers silently drop idle
+    # connections after a minute or two.
+    DEFAULT_IDLE_TIMEOUT = 60
+
+    # Pools are shared across threads, one per integration.
+    _pools = {}
+    _pools_lock = threading.Lock()
+
+    @classmethod
+    def for_integration(cls, integration_id, client_factory, signature,
+                        size=None, idle_timeout=None):
+        """Find or create the pool for the given integration.
+
+        :param integration_id: The ID of the ExternalIntegration that
+            configures the SIP2 server.
+        :param client_factory: A callable that creates a new,
+            unconnected SIPClient.
+        :param signature: A hashable object summarizing the
+            configuration used to create SIPClients. If the
+            configuration changes, the old pool is closed and a new one
+            created.
+        """
+        with cls._pools_lock:
+            pool = cls._pools.get(integration_id)
+            if pool and pool.signature != signature:
+                pool.close()
+                pool = None
+            if not pool:
+                pool = cls(client_factory, size, idle_timeout, signature)
+                cls._pools[integration_id] = pool
+            return pool
+
+    @classmethod
+    def reset(cls):
+        """Close and forget about every pool. Mainly for use in tests."""
+        with cls._pools_lock:
+            for pool in cls._pools.values():
+                pool.close()
+            cls._pools = {}
+
+    def __init__(self, client_factory, size=None, idle_timeout=None,
+                 signature=None, clock=time.time):
+        """Constructor.
+
+        :param client_factory: A callable that creates a new,
+            unconnected SIPClient.
+        :param size: The maximum number of idle sessions to keep.
+        :param idle_timeout: Don't reuse a session that has been idle
+            for more than this number of seconds.
+        :param clock: A callable returning the current time, in seconds.
+            Only intended for use in tests.
+        """
+        self.client_factory = client_factory
+        if size is None:
+            size = self.DEFAULT_SIZE
+        if idle_timeout is None:
+            idle_timeout = self.DEFAULT_IDLE_TIMEOUT
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.signature = signature
+        self.clock = clock
+        self.lock = threading.Lock()
+
+        # Each idle session is stored as a (SIPClient, last_used) 2-tuple.
+        # The most recently used session is on the right.
+        self.idle = deque()
+
+        # Counters, so we can tell whether the pool is doing any good.
+        self.created = 0
+        self.reused = 0
+        self.discarded = 0
+
+    def checkout(self):
+        """Obtain a logged-in SIPClient for exclusive use by the caller.
+
+        :return: A 2-tuple (client, reused). `reused` is True if the
+            client came from the pool rather than being newly created.
+        """
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                client, last_used = self.idle.pop()
+            if self.is_healthy(client, last_used):
+                with self.lock:
+                    self.reused += 1
+                return client, True
+            self.discard(client)
+
+        # There are no usable idle sessions. Make a new one.
+        return self._new_client(), False
+
+    def _new_client(self):
+        """Create a new SIPClient, connect it and log it in."""
+        client = self.client_factory()
+        client.connect()
+        try:
+            client.login()
+        except Exception, e:
+            self.discard(client)
+            raise
+        with self.lock:
+            self.created += 1
+        return client
+
+    def checkin(self, client):
+        """Return a client to the pool once the caller is done with it.
+
+        The client is disconnected instead if its session shouldn't be
+        reused or the pool is already full.
+        """
+        if client.sequence_number_wrapped:
+            # The sequence number has been through all ten of its
+            # values on this session. Rather than risk confusing the
+            # server with a repeated sequence number, start over with
+            # a fresh session.
+            self.discard(client)
+            return
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append((client, self.clock()))
+                return
+        self.discard(client)
+
+    def discard(self, client):
+        """Disconnect a client without returning it to the pool."""
+        with self.lock:
+            self.discarded += 1
+        try:
+            if client.connection:
+                client.disconnect()
+        except Exception, e:
+            self.log.warn("Error disconnecting from SIP2 server: %r", e)
+
+    def is_healthy(self, client, last_used):
+        """Is it safe to reuse the given idle client?"""
+        if self.clock() - last_used > self.idle_timeout:
+            return False
+        return not client.connection_is_stale()
+
+    def run(self, f):
+        """Call `f` with a logged-in SIPClient, then return the client to
+        the pool.
+
+        If `f` raises an IOError while using a session taken from the
+        pool, the session was probably dropped by the server while it
+        was idle. In that case `f` is tried once more with a brand-new
+        session. The other idle sessions were probably dropped too, so
+        the retry doesn't use any of them.
+        """
+        client, reused = self.checkout()
+        try:
+            result = f(client)
+        except IOError, e:
+            self.discard(client)
+            if not reused:
+                raise
+            self.log.info(
+                "Pooled SIP2 session failed (%r), retrying with a new session.",
+                e
+            )
+            client = self._new_client()
+            try:
+                result = f(client)
+            except Exception, e:
+                self.discard(client)
+                raise
+        except Exception, e:
+            self.discard(client)
+            raise
+        self.checkin(client)
+        return result
+
+    def close(self):
+        """Disconnect every idle session."""
+        with self.lock:
+            idle = list(self.idle)
+            self.idle.clear()
+        for client, last_used in idle:
+            self.discard(client)
+
+    @property
+    def stats(self):
+        """Summarize the pool's activity."""
+        with self.lock:
+            return dict(
+                idle=len(self.idle), created=self.created,
+                reused=self.reused, discarded=self.discarded
+            )
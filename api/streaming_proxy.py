@@ -0,0 +1,197 @@
+"""Pass content from a remote server through to a client as it arrives.
+
+Some fulfillment links can't be given to the client directly, so the
+circulation manager has to fetch the content and send it along. Books
+and audiobook files can be hundreds of megabytes, so rather than
+loading the whole thing into memory, the remote response is streamed
+to the client a chunk at a time.
+
+The WSGI server only asks for the next chunk once it has sent the
+previous one, so a slow client slows down the remote download instead
+of making the content pile up in memory.
+"""
+import logging
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from flask import Response
+
+from nose.tools import set_trace
+
+from core.util.http import (
+    BadResponseException,
+    RemoteIntegrationException,
+)
+from util.response import ResponseUtility
+
+
+class StreamingProxy(object):
+
+    log = logging.getLogger("Streaming proxy")
+
+    # Read the remote response this many bytes at a time.
+    CHUNK_SIZE = 64 * 1024
+
+    # Keep up to this many connections open to each remote host.
+    POOL_SIZE = 20
+
+    # Seconds to wait for a connection, and between bytes received.
+    CONNECT_TIMEOUT = 20
+    READ_TIMEOUT = 60
+
+    # Headers from the client that tell the remote server which part
+    # of the content to send, or whether to send it at all.
+    CLIENT_HEADERS = [
+        'Range', 'If-Range', 'If-Match', 'If-None-Match',
+        'If-Modified-Since', 'If-Unmodified-Since',
+    ]
+
+    # Headers that describe a single connection and must not be
+    # passed along to the client.
+    HOP_BY_HOP_HEADERS = set([
+        'connection', 'keep-alive', 'proxy-authenticate',
+        'proxy-authorization', 'te', 'trailer', 'trailers',
+        'transfer-encoding', 'upgrade',
+    ])
+
+    # A requests Session can't be shared with a forked process, so
+    # there's one per process.
+    _session = None
+    _session_pid = None
+    _session_lock = threading.Lock()
+
+    @classmethod
+    def shared_session(cls):
+        """Find or create the HTTP session shared by every proxy in
+        this process, so that connections to remote servers are reused.
+        """
+        pid = os.getpid()
+        with cls._session_lock:
+            if not cls._session or cls._session_pid != pid:
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=cls.POOL_SIZE,
+                    pool_maxsize=cls.POOL_SIZE
+                )
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                cls._session = session
+                cls._session_pid = pid
+            return cls._session
+
+    @classmethod
+    def client_headers(cls, request_headers):
+        """Pick out the headers from an incoming request that should be
+        sent along to the remote server.
+
+        :param request_headers: The headers of the incoming request,
+            e.g. `flask.request.headers`.
+        :return: A dictionary.
+        """
+        headers = dict()
+        for name in cls.CLIENT_HEADERS:
+            value = request_headers.get(name)
+            if value:
+                headers[name] = value
+        return headers
+
+    def __init__(self, session=None, chunk_size=None):
+        """Constructor.
+
+        :param session: A requests Session to use instead of the
+            shared one.
+        :param chunk_size: Read the remote response this many bytes
+            at a time.
+        """
+        self.session = session or self.shared_session()
+        self.chunk_size = chunk_size or self.CHUNK_SIZE
+
+    def get(self, url, headers=None):
+        """Start retrieving content from a remote server.
+
+        Only the headers are read; the body is left on the network.
+
+        :return: A requests Response.
+        :raise RemoteIntegrationException: If the remote server can't
+            be reached or has a problem of its own.
+        """
+        try:
+            response = self.session.get(
+                url, headers=headers or {}, stream=True,
+                timeout=(self.CONNECT_TIMEOUT, self.READ_TIMEOUT)
+            )
+        except requests.exceptions.RequestException, e:
+            raise RemoteIntegrationException(url, e.message)
+        if response.status_code // 100 == 5:
+            response.close()
+            raise BadResponseException(
+                url, "Got status code %s from external server." % (
+                    response.status_code
+                ),
+                status_code=502
+            )
+        return response
+
+    def response(self, remote_response, content_type=None):
+        """Turn a remote response into a Flask Response that sends the
+        body along as it arrives.
+
+        :param remote_response: A requests Response, ideally one that
+            was made with stream=True.
+        :param content_type: Use this Content-Type instead of the one
+            sent by the remote server.
+        """
+        streaming = self.is_streaming(remote_response)
+        headers = []
+        for name, value in remote_response.headers.items():
+            lower = name.lower()
+            if lower in self.HOP_BY_HOP_HEADERS:
+                continue
+            if lower == 'content-type' and content_type:
+                continue
+            if not streaming and lower in ('content-length', 'content-encoding'):
+                # The body has already been decoded, so these
+                # headers no longer describe it.
+                continue
+            headers.append((name, value))
+        if content_type:
+            headers.append(('Content-Type', content_type))
+
+        return Response(
+            response=self.chunks(remote_response),
+            status=remote_response.status_code,
+            headers=headers
+        )
+
+    def proxy(self, url, headers=None, content_type=None):
+        """Retrieve content from a remote server and stream it to the
+        client.
+
+        :return: A Flask Response.
+        """
+        return self.response(self.get(url, headers), content_type)
+
+    def is_streaming(self, remote_response):
+        raw = getattr(remote_response, 'raw', None)
+        return raw is not None and hasattr(raw, 'stream')
+
+    def chunks(self, remote_response):
+        """Yield the body of a remote response a chunk at a time.
+
+        The body is passed along exactly as it was sent, without
+        undoing any gzip or deflate encoding, so that it matches the
+        Content-Length and Content-Encoding headers.
+        """
+        try:
+            if self.is_streaming(remote_response):
+                for chunk in remote_response.raw.stream(
+                    self.chunk_size, decode_content=False
+                ):
+                    yield chunk
+            else:
+                # This response was already read into memory.
+                yield remote_response.content
+        finally:
+            ResponseUtility.close(remote_response)
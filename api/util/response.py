@@ -0,0 +1,35 @@
+import contextlib
+from io import BytesIO
+
+
+class ResponseUtility(object):
+    """Helper methods for reading and releasing HTTP responses from
+    the requests library.
+    """
+
+    @classmethod
+    @contextlib.contextmanager
+    def body(cls, response):
+        """Find a file-like object containing the body of an HTTP response,
+        and close the response once the caller is done with it.
+
+        If the response was streamed, reading from the object reads
+        from the network, and any gzip or deflate encoding is undone
+        along the way.
+        """
+        try:
+            raw = getattr(response, 'raw', None)
+            if raw is not None and hasattr(raw, 'read'):
+                raw.decode_content = True
+                yield raw
+            else:
+                yield BytesIO(response.content)
+        finally:
+            cls.close(response)
+
+    @staticmethod
+    def close(response):
+        """Release the connection behind an HTTP response, if it has one."""
+        close = getattr(response, 'close', None)
+        if close:
+            close()
@@ -0,0 +1,93 @@
+# encoding: utf-8
+"""Measure how quickly an AuthdataUtility can create and check tokens.
+
+This creates an AuthdataUtility that knows about a number of other
+libraries, as the one belonging to a busy Adobe Vendor ID delegation
+authority would, and times how many Short Client Tokens and authdata
+JWTs it can encode and decode per second.
+
+Decoding Short Client Tokens is timed twice: once with the signing
+keys prepared in advance, and once preparing the key for each token,
+as AuthdataUtility used to.
+
+This doesn't need a database:
+
+  python integration_tests/benchmark_authdata_utility.py [other libraries] [tokens]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from api.adobe_vendor_id import AuthdataUtility
+
+library_count = 100
+if len(sys.argv) > 1:
+    library_count = int(sys.argv[1])
+
+token_count = 10000
+if len(sys.argv) > 2:
+    token_count = int(sys.argv[2])
+
+other_libraries = dict(
+    ("http://library%d.org/" % i, ("LIB%d" % i, "secret %d" % i))
+    for i in range(library_count)
+)
+utility = AuthdataUtility(
+    vendor_id="The Vendor ID",
+    library_uri="http://my-library.org/",
+    library_short_name="MyLibrary",
+    secret="My library secret",
+    other_libraries=other_libraries,
+)
+
+# Tokens are decoded by the delegation authority, but most of them
+# were encoded by other libraries.
+other_utilities = [
+    AuthdataUtility("The Vendor ID", uri, short_name, secret)
+    for uri, (short_name, secret) in sorted(other_libraries.items())[:10]
+]
+
+
+def measure(name, function, inputs):
+    start = time.time()
+    for x in inputs:
+        function(x)
+    elapsed = time.time() - start
+    print "%s: %d in %.2f sec (%.0f/sec)" % (
+        name, len(inputs), elapsed, len(inputs) / elapsed
+    )
+
+
+print "%d other libraries, %d tokens" % (library_count, token_count)
+patrons = ["patron %d" % i for i in range(token_count)]
+
+measure(
+    "Encode Short Client Token",
+    lambda x: utility.encode_short_client_token(x), patrons
+)
+short_client_tokens = [
+    other_utilities[i % len(other_utilities)].encode_short_client_token(x)[1]
+    for i, x in enumerate(patrons)
+]
+measure(
+    "Decode Short Client Token",
+    utility.decode_short_client_token, short_client_tokens
+)
+prepared_keys = utility.short_token_signing_keys_by_library_uri
+utility.short_token_signing_keys_by_library_uri = {}
+measure(
+    "Decode Short Client Token, preparing each key",
+    utility.decode_short_client_token, short_client_tokens
+)
+utility.short_token_signing_keys_by_library_uri = prepared_keys
+
+measure("Encode authdata", lambda x: utility.encode(x), patrons)
+authdatas = [
+    other_utilities[i % len(other_utilities)].encode(x)[1]
+    for i, x in enumerate(patrons)
+]
+
+# Decoding logs every authdata it sees, which would swamp the timing.
+utility.log.disabled = True
+measure("Decode authdata", utility.decode, authdatas)
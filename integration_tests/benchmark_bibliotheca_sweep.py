@@ -0,0 +1,140 @@
+# encoding: utf-8
+"""Measure how long a BibliothecaCirculationSweep takes to go through a
+collection.
+
+This creates a collection of Bibliotheca titles, then sweeps it with a
+mock API that answers every /items request after a simulated network
+delay. It compares the old behavior -- 25 titles per batch, one
+request at a time -- with larger batches whose requests are made
+concurrently.
+
+A warm-up sweep runs first, so that every sweep being measured sees
+the same (unchanged) availability information.
+
+This uses the unit test database, so run it the same way as the unit
+tests:
+
+  TESTING=true python integration_tests/benchmark_bibliotheca_sweep.py [titles] [delay in ms]
+"""
+import os
+import re
+import sys
+import time
+
+from sqlalchemy import event
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from tests import (
+    DatabaseTest,
+    sample_data,
+)
+from api.bibliotheca import (
+    BibliothecaCirculationSweep,
+    MockBibliothecaAPI,
+)
+from core.model import (
+    DataSource,
+    Identifier,
+)
+
+title_count = 2000
+if len(sys.argv) > 1:
+    title_count = int(sys.argv[1])
+
+# Simulated time for Bibliotheca to answer a request, in seconds.
+delay = 0.3
+if len(sys.argv) > 2:
+    delay = float(sys.argv[2]) / 1000
+
+ITEM_TEMPLATE = re.search(
+    "<Item>.*</Item>",
+    sample_data("item_metadata_single.xml", "bibliotheca"),
+    re.DOTALL
+).group(0)
+
+
+class SlowMockBibliothecaAPI(MockBibliothecaAPI):
+
+    requests_made = 0
+
+    def bibliographic_lookup_request(self, identifiers):
+        self.requests_made += 1
+        time.sleep(delay)
+        items = [
+            re.sub("<ItemId>[^<]*</ItemId>", "<ItemId>%s</ItemId>" % x,
+                   ITEM_TEMPLATE)
+            for x in identifiers
+        ]
+        return "<ArrayOfItem>%s</ArrayOfItem>" % "".join(items)
+
+
+class QueryCounter(object):
+
+    def __init__(self, engine):
+        self.count = 0
+        self.engine = engine
+        event.listen(engine, "before_cursor_execute", self.before_execute)
+
+    def before_execute(self, *args, **kwargs):
+        self.count += 1
+
+    def stop(self):
+        event.remove(self.engine, "before_cursor_execute", self.before_execute)
+
+
+class BibliothecaSweepBenchmark(DatabaseTest):
+
+    def sweep(self, batch_size, concurrency):
+        api = SlowMockBibliothecaAPI(self._db, self.collection)
+        monitor = BibliothecaCirculationSweep(
+            self._db, self.collection, api_class=api,
+            batch_size=batch_size, concurrency=concurrency
+        )
+        for i in range(0, len(self.identifiers), batch_size):
+            monitor.process_items(self.identifiers[i:i+batch_size])
+            self._db.commit()
+        return api
+
+    def measure(self, name, batch_size, concurrency):
+        counter = QueryCounter(self._db.get_bind())
+        start = time.time()
+        api = self.sweep(batch_size, concurrency)
+        elapsed = time.time() - start
+        counter.stop()
+        print ""
+        print name
+        print "-" * len(name)
+        print "Requests: %d" % api.requests_made
+        print "Queries: %d" % counter.count
+        print "Time: %.2f sec (%.1f titles/sec)" % (
+            elapsed, len(self.identifiers) / elapsed
+        )
+
+    def run(self):
+        self.collection = MockBibliothecaAPI.mock_collection(self._db)
+        for i in range(title_count):
+            self._edition(
+                data_source_name=DataSource.BIBLIOTHECA,
+                identifier_type=Identifier.BIBLIOTHECA_ID,
+                with_license_pool=True, collection=self.collection
+            )
+        self._db.commit()
+        self.identifiers = self._db.query(Identifier).filter(
+            Identifier.type==Identifier.BIBLIOTHECA_ID
+        ).order_by(Identifier.id).all()
+        print "%d titles, %d ms per request" % (
+            len(self.identifiers), delay * 1000
+        )
+
+        self.sweep(200, 8)
+        self.measure("25 titles per batch, one request at a time", 25, 1)
+        self.measure("100 titles per batch, four requests at once", 100, 4)
+        self.measure("200 titles per batch, eight requests at once", 200, 8)
+
+
+benchmark = BibliothecaSweepBenchmark()
+benchmark.setup()
+try:
+    benchmark.run()
+finally:
+    benchmark.teardown()
@@ -0,0 +1,204 @@
+# encoding: utf-8
+"""Measure the cost of generating the MARC files for a large lane.
+
+This simulates a lane with a large number of titles, half of which
+changed since the last time the MARC files were generated. It compares
+the old approach -- one pass over the lane for the full file and
+another for the file of changes, looking up the library's settings for
+every record -- with LibraryMARCExporter.records_with_changes, which
+builds both files in one pass with settings looked up ahead of time.
+
+Works come from memory rather than the search index, and uploads are
+thrown away, so this measures the work done by the circulation
+manager itself.
+
+This uses the unit test database, so run it the same way as the unit
+tests:
+
+  TESTING=true python integration_tests/benchmark_marc_export.py [titles]
+"""
+import datetime
+import os
+import resource
+import sys
+import time
+
+from pymarc import (
+    Field,
+    Record,
+)
+from sqlalchemy import event
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from tests import DatabaseTest
+from api.marc import (
+    LibraryAnnotator,
+    LibraryMARCExporter,
+)
+from core.model import ExternalIntegration
+
+title_count = 500000
+if len(sys.argv) > 1:
+    title_count = int(sys.argv[1])
+
+batch_size = 500
+
+
+class FakeIdentifier(object):
+    type = "ISBN"
+
+    def __init__(self, i):
+        self.identifier = "%013d" % i
+
+
+class FakeWork(object):
+
+    def __init__(self, i, last_update_time):
+        self.identifier = FakeIdentifier(i)
+        self.title = "Title %d" % i
+        self.last_update_time = last_update_time
+
+
+class DiscardingUpload(object):
+
+    def __init__(self, mirror):
+        self.mirror = mirror
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+    def upload_part(self, content):
+        self.mirror.parts += 1
+        self.mirror.bytes += len(content)
+
+
+class DiscardingMirror(object):
+
+    def __init__(self):
+        self.parts = 0
+        self.bytes = 0
+
+    def marc_file_url(self, library, lane, end_time, start_time=None):
+        return "http://marc/%s/%s" % (end_time, start_time)
+
+    def multipart_upload(self, representation, url):
+        return DiscardingUpload(self)
+
+
+class BenchmarkExporter(LibraryMARCExporter):
+
+    def __init__(self, *args, **kwargs):
+        super(BenchmarkExporter, self).__init__(*args, **kwargs)
+        self.records_created = 0
+        now = datetime.datetime.utcnow()
+        self.old = now - datetime.timedelta(days=30)
+        self.new = now
+
+    def work_batches(self, lane, search_engine=None, batch_size=batch_size):
+        for start in range(0, title_count, batch_size):
+            yield [
+                FakeWork(i, self.new if i % 2 else self.old)
+                for i in range(start, min(start + batch_size, title_count))
+            ]
+
+    def create_record(self, work, annotator, force_refresh=False,
+                      integration=None):
+        self.records_created += 1
+        record = Record(force_utf8=True)
+        record.add_field(Field(tag="245", indicators=["0", "0"],
+                               subfields=["a", work.title]))
+        annotator.add_web_client_urls(
+            record, annotator.library, work.identifier, integration
+        )
+        return record
+
+
+class QueryCounter(object):
+
+    def __init__(self, engine):
+        self.count = 0
+        self.engine = engine
+        event.listen(engine, "before_cursor_execute", self.before_execute)
+
+    def before_execute(self, *args, **kwargs):
+        self.count += 1
+
+    def stop(self):
+        event.remove(self.engine, "before_cursor_execute", self.before_execute)
+
+
+class MARCExportBenchmark(DatabaseTest):
+
+    def measure(self, name, f):
+        exporter = BenchmarkExporter(
+            self._db, self._default_library, self.integration
+        )
+        mirror = DiscardingMirror()
+        counter = QueryCounter(self._db.get_bind())
+        start = time.time()
+        f(exporter, mirror)
+        elapsed = time.time() - start
+        counter.stop()
+        print ""
+        print name
+        print "-" * len(name)
+        print "Records created: %d" % exporter.records_created
+        print "Queries: %d" % counter.count
+        print "Parts uploaded: %d (%d bytes)" % (mirror.parts, mirror.bytes)
+        print "Time: %.2f sec" % elapsed
+        print "Peak memory so far: %d KB" % (
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        )
+
+    def run(self):
+        self.integration = self._external_integration(
+            ExternalIntegration.MARC_EXPORT, ExternalIntegration.CATALOG_GOAL,
+            libraries=[self._default_library]
+        )
+        lane = self._lane()
+        start_time = datetime.datetime.utcnow() - datetime.timedelta(days=7)
+        print "%d titles, half of them changed recently" % title_count
+
+        def two_passes(exporter, mirror):
+            annotator = LibraryAnnotator(self._default_library)
+            exporter.records_with_changes(
+                lane, annotator, None, mirror=mirror
+            )
+            # The second pass only sees the works that changed, the
+            # way a search restricted to recent changes would.
+            exporter.work_batches = self.changed_batches(exporter)
+            exporter.records_with_changes(
+                lane, annotator, None, mirror=mirror
+            )
+        self.measure(
+            "Two passes, settings looked up for each record", two_passes
+        )
+
+        def one_pass(exporter, mirror):
+            annotator = LibraryAnnotator(self._default_library)
+            annotator.cache_settings(self.integration)
+            exporter.records_with_changes(
+                lane, annotator, None, start_time=start_time, mirror=mirror
+            )
+        self.measure("One pass, settings cached", one_pass)
+
+    def changed_batches(self, exporter):
+        all_batches = exporter.work_batches
+        def work_batches(*args, **kwargs):
+            for works in all_batches(*args, **kwargs):
+                yield [
+                    work for work in works
+                    if work.last_update_time == exporter.new
+                ]
+        return work_batches
+
+
+benchmark = MARCExportBenchmark()
+benchmark.setup()
+try:
+    benchmark.run()
+finally:
+    benchmark.teardown()
@@ -0,0 +1,121 @@
+# encoding: utf-8
+"""Measure the cost of recalculating ODL holds queues.
+
+This creates ODL license pools with long holds queues, then compares
+updating every hold one at a time with ODLAPI._update_hold_end_date
+against updating the whole queue at once with
+ODLAPI.update_hold_queues.
+
+This uses the unit test database, so run it the same way as the unit
+tests:
+
+  TESTING=true python integration_tests/benchmark_odl_hold_queue.py
+"""
+import datetime
+import os
+import sys
+import time
+
+from sqlalchemy import event
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from tests import DatabaseTest
+from api.odl import MockODLAPI
+from core.model import (
+    Collection,
+    DataSource,
+    Hold,
+)
+
+# Each pool has this many holds.
+hold_count = 1000
+
+# Each pool has this many copies, all of which are on loan.
+license_count = 10
+
+pool_count = 3
+
+
+class QueryCounter(object):
+
+    def __init__(self, engine):
+        self.count = 0
+        self.engine = engine
+        event.listen(engine, "before_cursor_execute", self.before_execute)
+
+    def before_execute(self, *args, **kwargs):
+        self.count += 1
+
+    def stop(self):
+        event.remove(self.engine, "before_cursor_execute", self.before_execute)
+
+
+class HoldQueueBenchmark(DatabaseTest):
+
+    def create_pools(self):
+        collection = MockODLAPI.mock_collection(self._db)
+        collection.external_integration.set_setting(
+            Collection.DATA_SOURCE_NAME_SETTING, DataSource.FEEDBOOKS
+        )
+        api = MockODLAPI(self._db, collection)
+        now = datetime.datetime.utcnow()
+        pools = []
+        for i in range(pool_count):
+            pool = self._licensepool(None, collection=collection)
+            pool.licenses_owned = license_count
+            pool.licenses_available = 0
+            pool.licenses_reserved = 0
+            for j in range(license_count):
+                pool.loan_to(
+                    self._patron(), end=now + datetime.timedelta(days=j+1)
+                )
+            for j in range(hold_count):
+                pool.on_hold_to(
+                    self._patron(), start=now - datetime.timedelta(minutes=j)
+                )
+            pools.append(pool)
+        self._db.commit()
+        return api, pools
+
+    def measure(self, name, f):
+        # Start each measurement with a queue that hasn't been
+        # calculated yet.
+        self._db.query(Hold).update(
+            {Hold.position: None, Hold.end: None}, synchronize_session=False
+        )
+        self._db.commit()
+        self._db.expire_all()
+        counter = QueryCounter(self._db.get_bind())
+        start = time.time()
+        f()
+        self._db.flush()
+        elapsed = time.time() - start
+        counter.stop()
+        print "%-30s %6d queries, %.3f sec" % (name, counter.count, elapsed)
+
+    def run(self):
+        api, pools = self.create_pools()
+        print "%d pools, %d holds each" % (pool_count, hold_count)
+
+        def one_at_a_time():
+            for pool in pools:
+                for hold in pool.holds:
+                    api._update_hold_end_date(hold)
+        self.measure("One hold at a time", one_at_a_time)
+
+        def one_pool_at_a_time():
+            for pool in pools:
+                api.update_hold_queue(pool)
+        self.measure("One pool at a time", one_pool_at_a_time)
+
+        self.measure(
+            "All pools at once", lambda: api.update_hold_queues(pools)
+        )
+
+
+benchmark = HoldQueueBenchmark()
+benchmark.setup()
+try:
+    benchmark.run()
+finally:
+    benchmark.teardown()
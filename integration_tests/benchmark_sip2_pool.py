@@ -0,0 +1,150 @@
+# encoding: utf-8
+"""Compare SIP2 patron authentication with and without connection pooling.
+
+This starts a fake SIP2 server on localhost that answers login,
+patron information and end session messages after a simulated network
+delay, then authenticates patrons against it from several threads,
+first opening a new session for every request and then using a
+SIPConnectionPool.
+
+Usage: python integration_tests/benchmark_sip2_pool.py [delay in ms]
+"""
+import os
+import sys
+import threading
+import time
+from SocketServer import (
+    StreamRequestHandler,
+    ThreadingTCPServer,
+)
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from api.sip.client import SIPClient
+from api.sip.pool import SIPConnectionPool
+
+# Simulated one-way network delay, in seconds.
+delay = 0.005
+if len(sys.argv) > 1:
+    delay = float(sys.argv[1]) / 1000
+
+thread_count = 10
+requests_per_thread = 50
+
+LOGIN_RESPONSE = "941"
+PATRON_INFORMATION_RESPONSE = "64              000201610210000142637000000000000000000000000AOnypl |AA12345|AESHELDON, ALICE|BZ0030|CA0050|CB0050|BLY|CQY|BV0|CC15.00|BEfoo@example.com"
+END_SESSION_RESPONSE = "36Y201610210000142637AOnypl |AA12345|AF|AG"
+
+
+class FakeSIP2Handler(StreamRequestHandler):
+
+    RESPONSES = {
+        "93": LOGIN_RESPONSE,
+        "63": PATRON_INFORMATION_RESPONSE,
+        "35": END_SESSION_RESPONSE,
+    }
+
+    def handle(self):
+        # Simulate the TCP handshake.
+        time.sleep(delay)
+        while True:
+            message = self.read_message()
+            if not message:
+                return
+            response = self.RESPONSES.get(message[:2])
+            time.sleep(delay * 2)
+            self.wfile.write(response + "|AY0AZ0000\r")
+            self.wfile.flush()
+
+    def read_message(self):
+        data = ""
+        while not data.endswith("\r"):
+            c = self.rfile.read(1)
+            if not c:
+                return None
+            data += c
+        return data
+
+
+class FakeSIP2Server(ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def make_client(port):
+    return SIPClient(
+        target_server="127.0.0.1", target_port=port,
+        login_user_id="user", login_password="pass",
+        institution_id="nypl"
+    )
+
+
+def unpooled(port):
+    def authenticate():
+        sip = make_client(port)
+        sip.connect()
+        sip.login()
+        sip.patron_information("12345", "pin")
+        sip.end_session("12345", "pin")
+        sip.disconnect()
+    return authenticate
+
+
+def pooled(port):
+    pool = SIPConnectionPool(lambda: make_client(port), size=thread_count)
+    def request(sip):
+        sip.patron_information("12345", "pin")
+        sip.end_session("12345", "pin")
+    def authenticate():
+        pool.run(request)
+    authenticate.pool = pool
+    return authenticate
+
+
+class TimingThread(threading.Thread):
+
+    def __init__(self, authenticate):
+        threading.Thread.__init__(self)
+        self.authenticate = authenticate
+        self.elapsed = []
+
+    def run(self):
+        for i in range(requests_per_thread):
+            a = time.time()
+            self.authenticate()
+            self.elapsed.append(time.time()-a)
+
+
+def benchmark(name, authenticate):
+    threads = [TimingThread(authenticate) for i in range(thread_count)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    total = time.time() - start
+    elapsed = sum([t.elapsed for t in threads], [])
+    print ""
+    print "Timing results: %s" % name
+    print "------------------"
+    print "Requests: %d" % len(elapsed)
+    print "Throughput: %.1f requests/sec" % (len(elapsed) / total)
+    print "Mean latency: %.2f ms" % (numpy.mean(elapsed) * 1000)
+    print "Median latency: %.2f ms" % (numpy.median(elapsed) * 1000)
+    print "95th percentile latency: %.2f ms" % (
+        numpy.percentile(elapsed, 95) * 1000
+    )
+    pool = getattr(authenticate, 'pool', None)
+    if pool:
+        print "Pool activity: %r" % pool.stats
+
+server = FakeSIP2Server(("127.0.0.1", 0), FakeSIP2Handler)
+port = server.server_address[1]
+server_thread = threading.Thread(target=server.serve_forever)
+server_thread.daemon = True
+server_thread.start()
+
+benchmark("New session per request", unpooled(port))
+benchmark("Pooled sessions", pooled(port))
+server.shutdown()
@@ -0,0 +1,111 @@
+# encoding: utf-8
+"""Measure the database cost of CirculationAPI.sync_bookshelf.
+
+For bookshelves of several sizes, this creates a patron whose remote
+loans and holds are all known locally except for a handful of new
+ones, then counts the SQL statements issued by a sync and how long it
+takes.
+
+This uses the unit test database, so run it the same way as the unit
+tests:
+
+  TESTING=true python integration_tests/benchmark_sync_bookshelf.py
+"""
+import os
+import sys
+import time
+
+from sqlalchemy import event
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from tests import DatabaseTest
+from api.testing import MockCirculationAPI
+from api.bibliotheca import MockBibliothecaAPI
+from core.model import (
+    DataSource,
+    ExternalIntegration,
+    Identifier,
+)
+
+sizes = [10, 100, 500]
+
+# This fraction of each bookshelf consists of loans and holds the
+# circulation manager doesn't know about yet.
+new_fraction = 0.1
+
+
+class BenchmarkCirculationAPI(MockCirculationAPI):
+    """Takes remote loans and holds from MockCirculationAPI, but looks
+    up local loans and holds the way the real CirculationAPI does.
+    """
+
+    def local_loans(self, patron):
+        return super(MockCirculationAPI, self).local_loans(patron)
+
+    def local_holds(self, patron):
+        return super(MockCirculationAPI, self).local_holds(patron)
+
+
+class QueryCounter(object):
+
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, "before_cursor_execute", self.before_execute)
+
+    def before_execute(self, *args, **kwargs):
+        self.count += 1
+
+
+class SyncBookshelfBenchmark(DatabaseTest):
+
+    def run_once(self, size):
+        collection = MockBibliothecaAPI.mock_collection(self._db)
+        patron = self._patron()
+        circulation = BenchmarkCirculationAPI(
+            self._db, self._default_library, api_map={
+                ExternalIntegration.BIBLIOTHECA : MockBibliothecaAPI
+            }
+        )
+        new_count = int(size * new_fraction)
+        for i in range(size):
+            edition, pool = self._edition(
+                data_source_name=DataSource.BIBLIOTHECA,
+                identifier_type=Identifier.BIBLIOTHECA_ID,
+                with_license_pool=True, collection=collection
+            )
+            is_loan = i % 2 == 0
+            if i >= new_count:
+                # This one is already on the local bookshelf.
+                if is_loan:
+                    pool.loan_to(patron)
+                else:
+                    pool.on_hold_to(patron)
+            args = (
+                collection, DataSource.BIBLIOTHECA, pool.identifier.type,
+                pool.identifier.identifier, None, None
+            )
+            if is_loan:
+                circulation.add_remote_loan(*args)
+            else:
+                circulation.add_remote_hold(*(args + (i,)))
+        self._db.commit()
+        self._db.expire_all()
+
+        counter = QueryCounter(self._db.get_bind())
+        start = time.time()
+        loans, holds = circulation.sync_bookshelf(patron, "1234", force=True)
+        elapsed = time.time() - start
+        event.remove(
+            self._db.get_bind(), "before_cursor_execute", counter.before_execute
+        )
+        assert len(loans) + len(holds) == size
+        print "%4d items: %5d queries, %.3f sec" % (size, counter.count, elapsed)
+
+
+for size in sizes:
+    benchmark = SyncBookshelfBenchmark()
+    benchmark.setup()
+    try:
+        benchmark.run_once(size)
+    finally:
+        benchmark.teardown()
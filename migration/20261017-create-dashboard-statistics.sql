@@ -0,0 +1,23 @@
+-- Precomputed counts for the admin dashboard, one row per library and
+-- one per collection. See api/admin/dashboard_stats.py.
+create table if not exists dashboardstatistics (
+    id serial primary key,
+    library_id integer references libraries(id),
+    collection_id integer references collections(id),
+    patrons integer,
+    patrons_with_active_loans integer,
+    patrons_with_active_loans_or_holds integer,
+    loans integer,
+    holds integer,
+    licensed_titles integer,
+    open_access_titles integer,
+    licenses integer,
+    available_licenses integer,
+    updated_at timestamp without time zone,
+    stale boolean
+);
+
+create unique index if not exists ix_dashboardstatistics_library_id on dashboardstatistics (library_id);
+create unique index if not exists ix_dashboardstatistics_collection_id on dashboardstatistics (collection_id);
+create index if not exists ix_dashboardstatistics_updated_at on dashboardstatistics (updated_at);
+create index if not exists ix_dashboardstatistics_stale on dashboardstatistics (stale);
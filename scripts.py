@@ -2,6 +2,7 @@
 import argparse
 import csv
 import logging
+import multiprocessing
 import os
 import sys
 import time
@@ -29,7 +30,11 @@ from api.config import (
 from api.controller import CirculationManager
 from api.lanes import create_default_lanes
 from api.local_analytics_exporter import LocalAnalyticsExporter
-from api.marc import LibraryAnnotator as MARCLibraryAnnotator
+from api.marc import (
+    LibraryAnnotator as MARCLibraryAnnotator,
+    LibraryMARCExporter,
+)
+from api.monitor import BulkReaper
 from api.novelist import (
     NoveListAPI
 )
@@ -57,6 +62,7 @@ from core.lane import (
     Pagination,
     Facets,
     FeaturedFacets,
+    WorkList,
 )
 from core.marc import MARCExporter
 from core.metadata_layer import (
@@ -64,6 +70,7 @@ from core.metadata_layer import (
     FormatData,
     ReplacementPolicy,
     LinkData,
+    TimestampData,
 )
 from core.metadata_layer import MARCExtractor
 from core.mirror import MirrorUploader
@@ -82,6 +89,7 @@ from core.model import (
     Hold,
     Hyperlink,
     Identifier,
+    Library,
     LicensePool,
     Loan,
     Representation,
@@ -90,7 +98,9 @@ from core.model import (
     Subject,
     Timestamp,
     Work,
-    EditionConstants)
+    EditionConstants,
+    production_session,
+)
 from core.model.configuration import ExternalIntegrationLink
 from core.opds import (
     AcquisitionFeed,
@@ -296,6 +306,28 @@ class UpdateStaffPicksScript(Script):
         return StringIO(representation.content)
 
 
+# The CacheRepresentationPerLane used by a worker process.
+_worker_script = None
+
+def _cache_representation_worker_init(script_class, cmd_args, testing):
+    """Set up a worker process for CacheRepresentationPerLane.run_tasks.
+
+    The worker gets its own database session, CirculationManager and
+    request context rather than sharing the parent process's.
+    """
+    global _worker_script
+    _worker_script = script_class(
+        production_session(), cmd_args=cmd_args, testing=testing
+    )
+    ctx = _worker_script.app.test_request_context(
+        base_url=_worker_script.base_url
+    )
+    ctx.push()
+
+def _cache_representation_worker(task):
+    return _worker_script.process_task(*task)
+
+
 class CacheRepresentationPerLane(TimestampScript, LaneSweeperScript):
 
     name = "Cache one representation per lane"
@@ -320,6 +352,12 @@ class CacheRepresentationPerLane(TimestampScript, LaneSweeperScript):
             type=int,
             default=1
         )
+        parser.add_argument(
+            '--workers',
+            help='Generate feeds in this many worker processes at once.',
+            type=int,
+            default=1
+        )
         return parser
 
     def __init__(self, _db=None, cmd_args=None, testing=False, manager=None,
@@ -339,7 +377,17 @@ class CacheRepresentationPerLane(TimestampScript, LaneSweeperScript):
         """
 
         super(CacheRepresentationPerLane, self).__init__(_db, *args, **kwargs)
+        self.cmd_args = cmd_args
+        self.testing = testing
         self.parse_args(cmd_args)
+
+        # How long it took to generate each feed, and how big it was.
+        self.feed_metrics = []
+
+        # When feeds are being generated by worker processes, this
+        # holds the work that needs to be done.
+        self.pending_tasks = None
+
         if not manager:
             manager = CirculationManager(self._db, testing=testing)
         from api.app import app
@@ -360,6 +408,7 @@ class CacheRepresentationPerLane(TimestampScript, LaneSweeperScript):
                     self.log.warn("Ignored unrecognized language code %s", alpha)
         self.max_depth = parsed.max_depth
         self.min_depth = parsed.min_depth
+        self.workers = parsed.workers
 
         # Return the parsed arguments in case a subclass needs to
         # process more args.
@@ -404,12 +453,28 @@ class CacheRepresentationPerLane(TimestampScript, LaneSweeperScript):
 
     cache_url_method = None
 
+    def do_run(self, *args, **kwargs):
+        super(CacheRepresentationPerLane, self).do_run(*args, **kwargs)
+        return TimestampData(achievements=self.metrics_summary())
+
     def process_library(self, library):
         begin = time.time()
         client = self.app.test_client()
         ctx = self.app.test_request_context(base_url=self.base_url)
         ctx.push()
-        super(CacheRepresentationPerLane, self).process_library(library)
+        if self.workers > 1:
+            # Find out which feeds need to be generated, and have
+            # worker processes generate them.
+            self.pending_tasks = []
+            try:
+                super(CacheRepresentationPerLane, self).process_library(library)
+                tasks = self.pending_tasks
+            finally:
+                self.pending_tasks = None
+            for metrics in self.run_tasks(tasks):
+                self.feed_metrics.extend(metrics)
+        else:
+            super(CacheRepresentationPerLane, self).process_library(library)
         ctx.pop()
         end = time.time()
         self.log.info(
@@ -420,9 +485,21 @@ class CacheRepresentationPerLane(TimestampScript, LaneSweeperScript):
         """Generate a number of feeds for this lane.
         One feed will be generated for each combination of Facets and
         Pagination objects returned by facets() and pagination().
+
+        If feeds are being generated by worker processes, this just
+        makes a note of the work to be done.
+        """
+        if self.pending_tasks is not None:
+            self.pending_tasks.extend(self.tasks_for_lane(lane))
+            return []
+        return self.generate_feeds(lane, self.facets(lane))
+
+    def generate_feeds(self, lane, all_facets):
+        """Generate a feed for each combination of the given Facets
+        objects with the Pagination objects returned by pagination().
         """
         cached_feeds = []
-        for facets in self.facets(lane):
+        for facets in all_facets:
             for pagination in self.pagination(lane):
                 extra_description = ""
                 if facets:
@@ -438,13 +515,86 @@ class CacheRepresentationPerLane(TimestampScript, LaneSweeperScript):
                 b = time.time()
                 if feed:
                     cached_feeds.append(feed)
+                    self.feed_metrics.append((b-a, len(feed.data)))
                     self.log.info(
                         "Took %.2f sec to make %d bytes.", (b-a),
                         len(feed.data)
                     )
-        total_size = sum(len(x.data) for x in cached_feeds)
         return cached_feeds
 
+    def tasks_for_lane(self, lane):
+        """Divide the work of generating a lane's feeds into tasks that
+        can be handed to worker processes.
+
+        :return: A list of (library ID, lane ID, facets index) 3-tuples.
+            The lane ID is None for a library's top-level WorkList.
+            The facets index identifies one of the Facets objects
+            yielded by facets().
+        """
+        library = lane.get_library(self._db)
+        lane_id = lane.id if isinstance(lane, Lane) else None
+        return [
+            (library.id, lane_id, index)
+            for index, facets in enumerate(self.facets(lane))
+        ]
+
+    def process_task(self, library_id, lane_id, facets_index):
+        """Generate the feeds for one task created by tasks_for_lane.
+
+        :return: A list of (seconds, bytes) 2-tuples, one for each
+            feed generated.
+        """
+        if lane_id is None:
+            library = get_one(self._db, Library, id=library_id)
+            lane = WorkList.top_level_for_library(self._db, library)
+        else:
+            lane = get_one(self._db, Lane, id=lane_id)
+        facets = list(self.facets(lane))[facets_index]
+        all_metrics = self.feed_metrics
+        self.feed_metrics = []
+        try:
+            self.generate_feeds(lane, [facets])
+            self._db.commit()
+            return self.feed_metrics
+        finally:
+            self.feed_metrics = all_metrics
+
+    def run_tasks(self, tasks):
+        """Run tasks in a pool of worker processes.
+
+        Each worker has its own database session, CirculationManager
+        and request context.
+
+        :yield: The result of process_task for each task.
+        """
+        pool = multiprocessing.Pool(
+            processes=self.workers,
+            initializer=_cache_representation_worker_init,
+            initargs=(self.__class__, self.cmd_args, self.testing)
+        )
+        try:
+            for metrics in pool.imap_unordered(
+                _cache_representation_worker, tasks
+            ):
+                yield metrics
+            pool.close()
+        except Exception, e:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    def metrics_summary(self):
+        """Summarize the feeds generated, for use in a Timestamp."""
+        if not self.feed_metrics:
+            return "Feeds generated: 0."
+        times = [seconds for seconds, size in self.feed_metrics]
+        sizes = [size for seconds, size in self.feed_metrics]
+        return (
+            "Feeds generated: %d. Total size: %d bytes. "
+            "Total time: %.2f sec. Slowest feed: %.2f sec."
+        ) % (len(self.feed_metrics), sum(sizes), sum(times), max(times))
+
     def facets(self, lane):
         """Yield a Facets object for each set of facets this
         script is expected to handle.
@@ -747,8 +897,7 @@ class CacheMARCFiles(LaneSweeperScript):
         else:
             library = lane.get_library(self._db)
 
-        annotator = MARCLibraryAnnotator(library)
-        exporter = exporter or MARCExporter.from_config(library)
+        exporter = exporter or LibraryMARCExporter.from_config(library)
 
         update_frequency = ConfigurationSetting.for_library_and_externalintegration(
             self._db, MARCExporter.UPDATE_FREQUENCY, library, exporter.integration
@@ -786,20 +935,22 @@ class CacheMARCFiles(LaneSweeperScript):
             self.log.info("No storage External Integration was found.")
             return
 
-        # First update the file with ALL the records.
-        records = exporter.records(
-            lane, annotator, storage_integration
-        )
+        # The library's settings won't change while the files are
+        # being generated, so look them up once.
+        annotator = MARCLibraryAnnotator(library)
+        annotator.cache_settings(exporter.integration)
 
-        # Then create a new file with changes since the last update.
+        # Update the file with ALL the records and, if there was a
+        # previous update, create a new file with changes since then.
+        # Both files are generated in a single pass.
         start_time = None
         if last_update:
             # Allow one day of overlap to ensure we don't miss anything due to script timing.
             start_time = last_update - timedelta(days=1)
 
-            records = exporter.records(
-                lane, annotator, storage_integration, start_time=start_time
-            )
+        exporter.records_with_changes(
+            lane, annotator, storage_integration, start_time=start_time
+        )
 
 
 class AdobeAccountIDResetScript(PatronInputScript):
@@ -1027,11 +1178,12 @@ class LoanReaperScript(TimestampScript):
 
     def do_run(self):
         now = datetime.utcnow()
+        self.reaper = BulkReaper(self._db, log=self.log)
 
         # Reap loans and holds that we know have expired.
         for obj, what in ((Loan, 'loans'), (Hold, 'holds')):
             qu = self._db.query(obj).filter(obj.end < now)
-            self._reap(qu, "expired %s" % what)
+            self._reap(obj, qu, "expired %s" % what)
 
         for obj, what, max_age in (
                 (Loan, 'loans', timedelta(days=90)),
@@ -1049,24 +1201,19 @@ class LoanReaperScript(TimestampScript):
             explain = "%s older than %s" % (
                 what, older_than.strftime("%Y-%m-%d")
             )
-            self._reap(qu, explain)
+            self._reap(obj, qu, explain)
+        print self.reaper.achievements
 
-    def _reap(self, qu, what):
+    def _reap(self, obj, qu, what):
         """Delete every database object that matches the given query.
 
+        :param obj: The model class being deleted.
         :param qu: The query that yields objects to delete.
         :param what: A human-readable explanation of what's being
                      deleted.
         """
-        counter = 0
-        print "Reaping %d %s." % (qu.count(), what)
-        for o in qu:
-            self._db.delete(o)
-            counter += 1
-            if not counter % 100:
-                print counter
-                self._db.commit()
-        self._db.commit()
+        deleted = self.reaper.reap(obj, qu, what)
+        print "Reaped %d %s." % (deleted, what)
 
 
 class DisappearingBookReportScript(Script):
@@ -20,6 +20,7 @@ from api.admin.controller import (
     SettingsController,
     PatronController
 )
+from api.admin.dashboard_stats import DashboardStatistics
 from api.admin.exceptions import *
 from api.admin.google_oauth_admin_authentication_provider import GoogleOAuthAdminAuthenticationProvider
 from api.admin.password_admin_authentication_provider import PasswordAdminAuthenticationProvider
@@ -31,6 +32,7 @@ from api.adobe_vendor_id import (
 )
 from api.adobe_vendor_id import AuthdataUtility
 from api.authenticator import (
+    PatronAuthenticationCache,
     PatronData,
 )
 from api.axis import (Axis360API, MockAxis360API)
@@ -758,6 +760,12 @@ class TestPatronController(AdminControllerTest):
             authorization_identifier=patron.authorization_identifier
         )
 
+        # The patron recently authenticated, and the authentication
+        # was cached.
+        PatronAuthenticationCache.reset()
+        cache = PatronAuthenticationCache.for_integration(1, 60)
+        cache.store(self._default_library.id, "user", "pass", patron.id, None)
+
         # We reset their Adobe ID.
         authenticator = object()
         with self.request_context_with_library_and_admin("/"):
@@ -774,6 +782,10 @@ class TestPatronController(AdminControllerTest):
         # Both of the Patron's credentials are gone.
         eq_(patron.credentials, [])
 
+        # So is their cached authentication.
+        eq_(None, cache.lookup(self._default_library.id, "user", "pass"))
+        PatronAuthenticationCache.reset()
+
         # Here, the AuthenticationProvider finds a PatronData, but the
         # controller can't turn it into a Patron because it's too vague.
         controller.mock_patrondata = PatronData()
@@ -1212,6 +1224,54 @@ class TestCustomListsController(AdminControllerTest):
                           self.manager.admin_custom_lists_controller.custom_list,
                           list.id)
 
+    def test_custom_list_edit_many_entries(self):
+        data_source = DataSource.lookup(self._db, DataSource.LIBRARY_STAFF)
+        list, ignore = create(self._db, CustomList, name=self._str, data_source=data_source)
+        list.library = self._default_library
+
+        on_list = self._work(with_license_pool=True)
+        to_add = [self._work(with_license_pool=True) for i in range(3)]
+        added_and_deleted = self._work(with_license_pool=True)
+        entry, ignore = list.add_entry(on_list, featured=False)
+        eq_(1, list.size)
+
+        # This work isn't in any of the library's collections.
+        elsewhere = self._work(
+            with_license_pool=True, collection=self._collection()
+        )
+
+        def urn(work):
+            return dict(id=work.presentation_edition.primary_identifier.urn)
+
+        entries = [urn(w) for w in [on_list] + to_add + [added_and_deleted, elsewhere]]
+        entries.append(dict(id="urn:isbn:9780000000000"))
+        deleted_entries = [urn(added_and_deleted)]
+
+        with self.request_context_with_library_and_admin("/", method="POST"):
+            flask.request.form = MultiDict([
+                ("id", str(list.id)),
+                ("name", list.name),
+                ("entries", json.dumps(entries)),
+                ("deletedEntries", json.dumps(deleted_entries)),
+                ("collections", json.dumps([])),
+            ])
+            response = self.manager.admin_custom_lists_controller.custom_list(list.id)
+        eq_(200, response.status_code)
+
+        # The new works were added. The work that was added and
+        # deleted in the same request isn't on the list, and URNs
+        # that don't identify a work in the library's collections
+        # were ignored.
+        eq_(set([on_list] + to_add),
+            set([entry.work for entry in list.entries]))
+        eq_(4, list.size)
+
+        # The work that was already on the list kept its entry, which
+        # is now featured.
+        eq_([entry], [x for x in list.entries if x.work == on_list])
+        eq_(True, entry.featured)
+        eq_(True, all(x.featured for x in list.entries))
+
     def test_custom_list_delete_success(self):
         self.admin.add_role(AdminRole.LIBRARY_MANAGER, self._default_library)
 
@@ -1745,7 +1805,10 @@ class TestDashboardController(AdminControllerTest):
         # Try an end-to-end test, getting all circulation events for
         # the current day.
         with self.app.test_request_context("/"):
-            response, requested_date, date_end, library_short_name = self.manager.admin_dashboard_controller.bulk_circulation_events()
+            response, requested_date, date_end, library_short_name, compressed = self.manager.admin_dashboard_controller.bulk_circulation_events()
+            # The CSV file is generated a piece at a time.
+            response = "".join(response)
+        eq_(False, compressed)
         reader = csv.reader(
             [row for row in response.split("\r\n") if row],
             dialect=csv.excel
@@ -1762,17 +1825,18 @@ class TestDashboardController(AdminControllerTest):
         # Now verify that this works by passing incoming query
         # parameters into a LocalAnalyticsExporter object.
         class MockLocalAnalyticsExporter(object):
-            def export(self, _db, date_start, date_end, locations, library):
+            def stream(self, _db, date_start, date_end, locations, library,
+                       compress):
                 self.called_with = (
-                    _db, date_start, date_end, locations, library
+                    _db, date_start, date_end, locations, library, compress
                 )
                 return "A CSV file"
 
         exporter = MockLocalAnalyticsExporter()
-        with self.request_context_with_library("/?date=2018-01-01&dateEnd=2018-01-04&locations=loc1,loc2"):
-            response, requested_date, date_end, library_short_name = self.manager.admin_dashboard_controller.bulk_circulation_events(analytics_exporter=exporter)
+        with self.request_context_with_library("/?date=2018-01-01&dateEnd=2018-01-04&locations=loc1,loc2&gzip=true"):
+            response, requested_date, date_end, library_short_name, compressed = self.manager.admin_dashboard_controller.bulk_circulation_events(analytics_exporter=exporter)
 
-            # export() was called with the arguments we expect.
+            # stream() was called with the arguments we expect.
             #
             args = list(exporter.called_with)
             eq_(self._db, args.pop(0))
@@ -1783,10 +1847,13 @@ class TestDashboardController(AdminControllerTest):
             eq_(datetime(2018, 1, 5), args.pop(0))
             eq_("loc1,loc2", args.pop(0))
             eq_(self._default_library, args.pop(0))
+            # We asked for the file to be gzipped.
+            eq_(True, args.pop(0))
             eq_([], args)
 
-            # The data returned is whatever export() returned.
+            # The data returned is whatever stream() returned.
             eq_("A CSV file", response)
+            eq_(True, compressed)
 
             # The other data is necessary to build a filename for the
             # "CSV file".
@@ -2057,6 +2124,48 @@ class TestDashboardController(AdminControllerTest):
                 eq_(0, c3_data.get('licenses'))
                 eq_(0, c3_data.get('available_licenses'))
 
+    def test_stats_stored(self):
+        with self.request_context_with_admin("/"):
+            self.admin.add_role(AdminRole.SYSTEM_ADMIN)
+            library = self._default_library
+            collection = self._default_collection
+
+            # Store statistics that don't match what's in the database.
+            old = datetime(2020, 1, 1)
+            library_stats = DashboardStatistics.refresh_library(
+                self._db, library, old
+            )
+            library_stats.patrons = 100
+            collection_stats = DashboardStatistics.refresh_collection(
+                self._db, collection, old
+            )
+            collection_stats.licenses = 50
+
+            # The stored statistics are used, and we're told how old
+            # they are.
+            response = self.manager.admin_dashboard_controller.stats()
+            library_data = response.get(library.short_name)
+            total_data = response.get("total")
+            for data in [library_data, total_data]:
+                eq_(100, data.get('patrons').get('total'))
+                eq_(50, data.get('inventory').get('licenses'))
+                eq_(
+                    50,
+                    data.get('collections').get(collection.name).get('licenses')
+                )
+                eq_("2020-01-01T00:00:00Z", data.get('updated_at'))
+
+        # Asking for live statistics recalculates and stores them.
+        with self.request_context_with_admin("/?live=true"):
+            response = self.manager.admin_dashboard_controller.stats()
+            library_data = response.get(library.short_name)
+            eq_(1, library_data.get('patrons').get('total'))
+            eq_(0, library_data.get('inventory').get('licenses'))
+            assert library_data.get('updated_at') > "2020-01-01T00:00:00Z"
+            eq_(1, library_stats.patrons)
+            eq_(0, collection_stats.licenses)
+            assert library_stats.updated_at > old
+
 
 class SettingsControllerTest(AdminControllerTest):
     """Test some part of the settings controller."""
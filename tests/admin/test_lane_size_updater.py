@@ -0,0 +1,81 @@
+from nose.tools import (
+    set_trace,
+    eq_
+)
+
+from api.admin.lane_size_updater import LaneSizeUpdater
+from core.external_search import MockExternalSearchIndex
+
+from .. import DatabaseTest
+
+
+class MockLaneSizeUpdater(LaneSizeUpdater):
+    """Records lane size updates instead of making them in a new
+    database session.
+    """
+    _queue = None
+    _queue_pid = None
+    _pending = set()
+
+    updated = []
+
+    @classmethod
+    def update_lane(cls, bind, search_engine, lane_id):
+        cls.updated.append((search_engine, lane_id))
+
+
+class TestLaneSizeUpdater(DatabaseTest):
+
+    def setup(self):
+        super(TestLaneSizeUpdater, self).setup()
+        self.search = MockExternalSearchIndex()
+        self.search.docs = dict(id1="doc1", id2="doc2")
+        MockLaneSizeUpdater.updated = []
+
+    def test_update_synchronously(self):
+        lane = self._lane()
+        lane.size = 100
+        updater = LaneSizeUpdater(self._db, self.search, asynchronous=False)
+        updater.update([lane])
+
+        # The search engine was asked about the lane right away.
+        eq_(2, lane.size)
+
+    def test_update_asynchronously(self):
+        lane1 = self._lane()
+        lane2 = self._lane()
+        updater = MockLaneSizeUpdater(self._db, self.search)
+        queue = updater.worker_queue()
+
+        # Nothing is queued until the database session commits, since
+        # until then the worker thread would see the lanes as they
+        # were before the change.
+        updater.update([lane1, lane2])
+        eq_(set(), MockLaneSizeUpdater._pending)
+        eq_([], MockLaneSizeUpdater.updated)
+
+        # If the transaction is rolled back, the lanes are forgotten.
+        MockLaneSizeUpdater.session_rolled_back(self._db)
+        self._db.commit()
+        queue.join()
+        eq_([], MockLaneSizeUpdater.updated)
+
+        # A lane that's already waiting to be updated isn't queued
+        # again.
+        MockLaneSizeUpdater._pending.add(lane2.id)
+        updater.update([lane1, lane2])
+        self._db.commit()
+        queue.join()
+        eq_([(self.search, lane1.id)], MockLaneSizeUpdater.updated)
+
+        # Once a lane has been updated, it can be queued again.
+        eq_(set([lane2.id]), MockLaneSizeUpdater._pending)
+        updater.update([lane1])
+        self._db.commit()
+        queue.join()
+        eq_([(self.search, lane1.id)] * 2, MockLaneSizeUpdater.updated)
+
+        # Committing again doesn't queue anything new.
+        self._db.commit()
+        queue.join()
+        eq_([(self.search, lane1.id)] * 2, MockLaneSizeUpdater.updated)
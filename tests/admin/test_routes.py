@@ -74,7 +74,7 @@ class MockAdminController(MockController):
             return INVALID_CSRF_TOKEN
     
     def bulk_circulation_events(self):
-        return "data", "date", "date_end", "library"
+        return iter(["da", "ta"]), "date", "date_end", "library", False
 
 class AdminRouteTest(RouteTest):
     def setup(self, _db=None):
@@ -162,6 +162,11 @@ class AdminRouteTest(RouteTest):
         response = self.request(url, http_method)
 
         eq_(response.headers['Content-type'], 'text/csv')
+        eq_(
+            "attachment; filename=circulation_events_library-date-to-date_end.csv",
+            response.headers['Content-Disposition']
+        )
+        eq_("data", response.get_data())
     
     def assert_redirect_call(self, url, *args, **kwargs):
 
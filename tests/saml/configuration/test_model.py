@@ -1,3 +1,4 @@
+import datetime
 import json
 
 import sqlalchemy
@@ -12,6 +13,7 @@ from api.saml.configuration.model import (
     SAMLConfigurationFactory,
     SAMLOneLoginConfiguration,
 )
+from api.saml.metadata.cache import SAMLIdentityProviderMetadataCache
 from api.saml.metadata.federations import incommon
 from api.saml.metadata.federations.model import (
     SAMLFederatedIdentityProvider,
@@ -306,6 +308,92 @@ class TestSAMLConfiguration(DatabaseTest):
                 ]
             )
 
+    def test_get_identity_providers_uses_metadata_cache(self):
+        # Arrange
+        non_federated_identity_providers_metadata = (
+            fixtures.CORRECT_XML_WITH_MULTIPLE_IDPS
+        )
+        federated_identity_provider_entity_ids = json.dumps(
+            [fixtures.IDP_1_ENTITY_ID, fixtures.IDP_2_ENTITY_ID]
+        )
+
+        metadata_parser = SAMLMetadataParser()
+        metadata_parser.parse = MagicMock(side_effect=metadata_parser.parse)
+        metadata_cache = SAMLIdentityProviderMetadataCache()
+
+        configuration_storage = ConfigurationStorage(self._saml_integration_association)
+
+        saml_configuration_factory = SAMLConfigurationFactory(
+            metadata_parser, metadata_cache
+        )
+
+        federation = SAMLFederation("Test federation", "http://localhost")
+        federated_idp_1 = SAMLFederatedIdentityProvider(
+            federation,
+            fixtures.IDP_1_ENTITY_ID,
+            fixtures.IDP_1_UI_INFO_EN_DISPLAY_NAME,
+            fixtures.CORRECT_XML_WITH_IDP_1,
+        )
+        federated_idp_2 = SAMLFederatedIdentityProvider(
+            federation,
+            fixtures.IDP_2_ENTITY_ID,
+            fixtures.IDP_2_UI_INFO_EN_DISPLAY_NAME,
+            fixtures.CORRECT_XML_WITH_IDP_2,
+        )
+
+        self._db.add_all([federation, federated_idp_1, federated_idp_2])
+        self._db.flush()
+
+        def get_identity_providers():
+            with saml_configuration_factory.create(
+                configuration_storage, self._db, SAMLConfiguration
+            ) as configuration:
+                configuration.non_federated_identity_provider_xml_metadata = (
+                    non_federated_identity_providers_metadata
+                )
+                configuration.federated_identity_provider_entity_ids = (
+                    federated_identity_provider_entity_ids
+                )
+
+                return configuration.get_identity_providers(self._db)
+
+        # Act
+        identity_providers_1 = get_identity_providers()
+        identity_providers_2 = get_identity_providers()
+
+        # Assert
+        eq_(4, len(identity_providers_1))
+        eq_(
+            [
+                fixtures.IDP_1_ENTITY_ID,
+                fixtures.IDP_2_ENTITY_ID,
+                fixtures.IDP_1_ENTITY_ID,
+                fixtures.IDP_2_ENTITY_ID,
+            ],
+            [identity_provider.entity_id for identity_provider in identity_providers_1],
+        )
+        eq_(identity_providers_1, identity_providers_2)
+
+        # Each piece of metadata was parsed only once.
+        metadata_parser.parse.assert_has_calls(
+            [
+                call(non_federated_identity_providers_metadata),
+                call(federated_idp_1.xml_metadata),
+                call(federated_idp_2.xml_metadata),
+            ]
+        )
+        eq_(3, metadata_parser.parse.call_count)
+
+        # Once the federation is updated, its IdPs are parsed again
+        # but the non-federated IdPs are still taken from the cache.
+        federation.last_updated_at = datetime.datetime.utcnow()
+        self._db.flush()
+
+        identity_providers_3 = get_identity_providers()
+
+        eq_(4, len(identity_providers_3))
+        eq_(5, metadata_parser.parse.call_count)
+
 
 class TestSAMLSettings(DatabaseTest):
     def test(self):
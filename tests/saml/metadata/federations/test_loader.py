@@ -1,4 +1,4 @@
-from mock import MagicMock, create_autospec, patch
+from mock import MagicMock, call, create_autospec, patch
 from nose.tools import eq_, raises
 
 from api.saml.metadata.federations import incommon
@@ -9,7 +9,7 @@ from api.saml.metadata.federations.loader import (
 )
 from api.saml.metadata.federations.model import SAMLFederation
 from api.saml.metadata.federations.validator import SAMLFederatedMetadataValidator
-from api.saml.metadata.parser import SAMLMetadataParser
+from api.saml.metadata.parser import SAMLMetadataParser, SAMLMetadataParsingError
 from tests.saml import fixtures
 
 
@@ -100,4 +100,63 @@ class TestSAMLFederatedIdentityProviderLoader(object):
         metadata_loader.load_idp_metadata.assert_called_once_with(
             federation_idp_metadata_service_url
         )
-        metadata_parser.parse.assert_called_once_with(xml_metadata)
+
+        # Each EntityDescriptor is parsed on its own.
+        eq_(2, metadata_parser.parse.call_count)
+        metadata_parser.parse.assert_has_calls(
+            [call(idps[0].xml_metadata), call(idps[1].xml_metadata)]
+        )
+        assert fixtures.IDP_1_ENTITY_ID in idps[0].xml_metadata
+        assert fixtures.IDP_2_ENTITY_ID not in idps[0].xml_metadata
+        assert fixtures.IDP_2_ENTITY_ID in idps[1].xml_metadata
+
+    def test_stream_yields_identity_providers_one_at_a_time(self):
+        # Arrange
+        xml_metadata = fixtures.CORRECT_XML_WITH_MULTIPLE_IDPS
+
+        metadata_loader = create_autospec(spec=SAMLMetadataLoader)
+        metadata_validator = create_autospec(spec=SAMLFederatedMetadataValidator)
+        metadata_parser = SAMLMetadataParser()
+        idp_loader = SAMLFederatedIdentityProviderLoader(
+            metadata_loader, metadata_validator, metadata_parser
+        )
+        saml_federation = SAMLFederation(
+            incommon.FEDERATION_TYPE, incommon.IDP_METADATA_SERVICE_URL
+        )
+
+        metadata_loader.load_idp_metadata = MagicMock(return_value=xml_metadata)
+        metadata_parser.parse = MagicMock(side_effect=metadata_parser.parse)
+
+        # Act
+        idps = idp_loader.stream(saml_federation)
+        first_idp = next(idps)
+
+        # Assert
+        eq_(fixtures.IDP_1_ENTITY_ID, first_idp.entity_id)
+        metadata_validator.validate.assert_called_once_with(
+            saml_federation, xml_metadata
+        )
+        eq_(1, metadata_parser.parse.call_count)
+
+        eq_([fixtures.IDP_2_ENTITY_ID], [idp.entity_id for idp in idps])
+        eq_(2, metadata_parser.parse.call_count)
+
+    @raises(SAMLMetadataParsingError)
+    def test_stream_raises_error_when_xml_is_incorrect(self):
+        # Arrange
+        metadata_loader = create_autospec(spec=SAMLMetadataLoader)
+        metadata_validator = create_autospec(spec=SAMLFederatedMetadataValidator)
+        metadata_parser = SAMLMetadataParser()
+        idp_loader = SAMLFederatedIdentityProviderLoader(
+            metadata_loader, metadata_validator, metadata_parser
+        )
+        saml_federation = SAMLFederation(
+            incommon.FEDERATION_TYPE, incommon.IDP_METADATA_SERVICE_URL
+        )
+
+        metadata_loader.load_idp_metadata = MagicMock(
+            return_value=fixtures.INCORRECT_XML
+        )
+
+        # Act
+        list(idp_loader.stream(saml_federation))
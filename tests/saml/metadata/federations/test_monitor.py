@@ -1,6 +1,7 @@
 from mock import MagicMock, create_autospec
 from nose.tools import eq_
 
+from api.saml.metadata.cache import SAMLIdentityProviderMetadataCache
 from api.saml.metadata.federations.loader import SAMLFederatedIdentityProviderLoader
 from api.saml.metadata.federations.model import (
     SAMLFederatedIdentityProvider,
@@ -33,12 +34,15 @@ class TestSAMLMetadataMonitor(DatabaseTest):
         ]
 
         self._db.add_all([expected_federation])
-        self._db.add_all(expected_federated_identity_providers)
 
         loader = create_autospec(spec=SAMLFederatedIdentityProviderLoader)
-        loader.load = MagicMock(return_value=expected_federated_identity_providers)
+        loader.stream = MagicMock(
+            return_value=iter(expected_federated_identity_providers)
+        )
+
+        metadata_cache = create_autospec(spec=SAMLIdentityProviderMetadataCache)
 
-        monitor = SAMLMetadataMonitor(self._db, loader)
+        monitor = SAMLMetadataMonitor(self._db, loader, metadata_cache)
 
         # Act
         monitor.run_once(None)
@@ -46,3 +50,94 @@ class TestSAMLMetadataMonitor(DatabaseTest):
         # Assert
         identity_providers = self._db.query(SAMLFederatedIdentityProvider).all()
         eq_(expected_federated_identity_providers, identity_providers)
+
+        # The federation's last update time changed, and the parsed
+        # metadata cached in this process was dropped.
+        assert expected_federation.last_updated_at is not None
+        metadata_cache.clear.assert_called_once_with()
+
+    def test_only_changed_identity_providers_are_written(self):
+        # Arrange
+        federation = SAMLFederation("Test federation", "http://incommon.org/metadata")
+        unchanged_identity_provider = SAMLFederatedIdentityProvider(
+            federation,
+            fixtures.IDP_1_ENTITY_ID,
+            fixtures.IDP_1_UI_INFO_EN_DISPLAY_NAME,
+            fixtures.CORRECT_XML_WITH_IDP_1,
+        )
+        changed_identity_provider = SAMLFederatedIdentityProvider(
+            federation,
+            fixtures.IDP_2_ENTITY_ID,
+            "Old display name",
+            fixtures.CORRECT_XML_WITH_IDP_1,
+        )
+        removed_identity_provider = SAMLFederatedIdentityProvider(
+            federation,
+            "http://removed.idp.org",
+            "Removed IdP",
+            fixtures.CORRECT_XML_WITH_IDP_1,
+        )
+
+        self._db.add_all(
+            [
+                federation,
+                unchanged_identity_provider,
+                changed_identity_provider,
+                removed_identity_provider,
+            ]
+        )
+        self._db.commit()
+
+        unchanged_identity_provider_id = unchanged_identity_provider.id
+        changed_identity_provider_id = changed_identity_provider.id
+
+        loaded_identity_providers = [
+            SAMLFederatedIdentityProvider(
+                federation,
+                fixtures.IDP_1_ENTITY_ID,
+                fixtures.IDP_1_UI_INFO_EN_DISPLAY_NAME,
+                fixtures.CORRECT_XML_WITH_IDP_1,
+            ),
+            SAMLFederatedIdentityProvider(
+                federation,
+                fixtures.IDP_2_ENTITY_ID,
+                fixtures.IDP_2_UI_INFO_EN_DISPLAY_NAME,
+                fixtures.CORRECT_XML_WITH_IDP_2,
+            ),
+            SAMLFederatedIdentityProvider(
+                federation,
+                "http://new.idp.org",
+                "New IdP",
+                fixtures.CORRECT_XML_WITH_IDP_2,
+            ),
+        ]
+
+        loader = create_autospec(spec=SAMLFederatedIdentityProviderLoader)
+        loader.stream = MagicMock(return_value=iter(loaded_identity_providers))
+
+        monitor = SAMLMetadataMonitor(
+            self._db, loader, create_autospec(spec=SAMLIdentityProviderMetadataCache)
+        )
+
+        # Act
+        monitor.run_once(None)
+        self._db.expire_all()
+
+        # Assert
+        identity_providers = (
+            self._db.query(SAMLFederatedIdentityProvider)
+            .order_by(SAMLFederatedIdentityProvider.id)
+            .all()
+        )
+        eq_(
+            [fixtures.IDP_1_ENTITY_ID, fixtures.IDP_2_ENTITY_ID, "http://new.idp.org"],
+            [identity_provider.entity_id for identity_provider in identity_providers],
+        )
+
+        # The unchanged and the changed IdPs kept their rows.
+        eq_(unchanged_identity_provider_id, identity_providers[0].id)
+        eq_(changed_identity_provider_id, identity_providers[1].id)
+
+        # The changed IdP was updated.
+        eq_(fixtures.IDP_2_UI_INFO_EN_DISPLAY_NAME, identity_providers[1].display_name)
+        eq_(fixtures.CORRECT_XML_WITH_IDP_2, identity_providers[1].xml_metadata)
@@ -0,0 +1,103 @@
+import datetime
+
+from mock import MagicMock
+from nose.tools import eq_
+
+from api.saml.metadata.cache import SAMLIdentityProviderMetadataCache
+from api.saml.metadata.parser import SAMLMetadataParser
+from tests.saml import fixtures
+
+
+class TestSAMLIdentityProviderMetadataCache(object):
+    def test_parse_parses_xml_metadata_only_once(self):
+        # Arrange
+        metadata_parser = SAMLMetadataParser()
+        metadata_parser.parse = MagicMock(side_effect=metadata_parser.parse)
+        cache = SAMLIdentityProviderMetadataCache()
+
+        # Act
+        identity_providers_1 = cache.parse(
+            metadata_parser, fixtures.CORRECT_XML_WITH_MULTIPLE_IDPS
+        )
+        identity_providers_2 = cache.parse(
+            metadata_parser, fixtures.CORRECT_XML_WITH_MULTIPLE_IDPS
+        )
+
+        # Assert
+        eq_(2, len(identity_providers_1))
+        eq_(fixtures.IDP_1_ENTITY_ID, identity_providers_1[0].entity_id)
+        eq_(fixtures.IDP_2_ENTITY_ID, identity_providers_1[1].entity_id)
+        eq_(identity_providers_1, identity_providers_2)
+
+        metadata_parser.parse.assert_called_once_with(
+            fixtures.CORRECT_XML_WITH_MULTIPLE_IDPS
+        )
+        eq_(1, cache.hits)
+        eq_(1, cache.misses)
+
+        # Changing the list returned by the cache doesn't change the cache.
+        identity_providers_2.pop()
+        eq_(
+            2,
+            len(cache.parse(metadata_parser, fixtures.CORRECT_XML_WITH_MULTIPLE_IDPS)),
+        )
+
+    def test_parse_parses_different_xml_metadata_separately(self):
+        # Arrange
+        metadata_parser = SAMLMetadataParser()
+        metadata_parser.parse = MagicMock(side_effect=metadata_parser.parse)
+        cache = SAMLIdentityProviderMetadataCache()
+
+        # Act
+        identity_providers_1 = cache.parse(
+            metadata_parser, fixtures.CORRECT_XML_WITH_IDP_1
+        )
+        identity_providers_2 = cache.parse(
+            metadata_parser, fixtures.CORRECT_XML_WITH_IDP_2
+        )
+
+        # Assert
+        eq_(fixtures.IDP_1_ENTITY_ID, identity_providers_1[0].entity_id)
+        eq_(fixtures.IDP_2_ENTITY_ID, identity_providers_2[0].entity_id)
+        eq_(2, metadata_parser.parse.call_count)
+
+    def test_federated_identity_provider_key_depends_on_last_updated_at(self):
+        # Arrange
+        cache = SAMLIdentityProviderMetadataCache()
+        last_updated_at = datetime.datetime(2020, 1, 1)
+        identity_providers = [MagicMock()]
+
+        # Act
+        cache.set(
+            cache.federated_identity_provider_key(1, last_updated_at),
+            identity_providers,
+        )
+
+        # Assert
+        eq_(
+            identity_providers,
+            cache.get(cache.federated_identity_provider_key(1, last_updated_at)),
+        )
+        eq_(
+            None,
+            cache.get(
+                cache.federated_identity_provider_key(
+                    1, last_updated_at + datetime.timedelta(days=1)
+                )
+            ),
+        )
+        eq_(None, cache.get(cache.federated_identity_provider_key(2, last_updated_at)))
+
+    def test_clear(self):
+        # Arrange
+        metadata_parser = SAMLMetadataParser()
+        metadata_parser.parse = MagicMock(side_effect=metadata_parser.parse)
+        cache = SAMLIdentityProviderMetadataCache()
+        cache.parse(metadata_parser, fixtures.CORRECT_XML_WITH_IDP_1)
+
+        # Act
+        cache.clear()
+        cache.parse(metadata_parser, fixtures.CORRECT_XML_WITH_IDP_1)
+
+        # Assert
+        eq_(2, metadata_parser.parse.call_count)
@@ -6,6 +6,7 @@ from nose.tools import (
 )
 from api.sip.client import MockSIPClient
 from api.sip import SIP2AuthenticationProvider
+from api.sip.pool import SIPConnectionPool
 from core.util.http import RemoteIntegrationException
 from api.authenticator import PatronData
 import json
@@ -259,6 +260,48 @@ class TestSIP2AuthenticationProvider(DatabaseTest):
             "username", "password",
         )
 
+    def test_pooled_sessions(self):
+        # If a connection pool size is configured, SIP2 sessions are
+        # reused from one request to the next.
+        p = SIP2AuthenticationProvider
+        SIPConnectionPool.reset()
+        integration = self._external_integration(self._str)
+        integration.setting(p.CONNECTION_POOL_SIZE).value = "2"
+        integration.setting(p.CONNECTION_IDLE_TIMEOUT).value = "30"
+
+        clients = []
+        test = self
+        class Mock(p):
+            def _make_client(self):
+                client = MockSIPClient()
+                for i in range(2):
+                    client.queue_response(test.sierra_valid_login)
+                    client.queue_response(test.end_session_response)
+                clients.append(client)
+                return client
+
+        auth = Mock(self._default_library, integration)
+        pool = auth.connection_pool
+        eq_(2, pool.size)
+        eq_(30, pool.idle_timeout)
+
+        # Another provider for the same integration shares the pool.
+        eq_(pool, Mock(self._default_library, integration).connection_pool)
+
+        for i in range(2):
+            patrondata = auth.remote_authenticate("user", "pass")
+            eq_("12345", patrondata.authorization_identifier)
+
+        # Only one client was ever created, and it only connected once.
+        eq_(1, len(clients))
+        eq_(["Creating new socket connection."], clients[0].status)
+        eq_(dict(idle=1, created=1, reused=1, discarded=0), pool.stats)
+
+        # If a client is passed in, pooling is disabled.
+        auth = p(self._default_library, integration, client=MockSIPClient())
+        eq_(None, auth.connection_pool)
+        SIPConnectionPool.reset()
+
     def test_parse_date(self):
         parse = SIP2AuthenticationProvider.parse_date
         eq_(datetime(2011, 1, 2), parse("20110102"))
@@ -0,0 +1,169 @@
+from nose.tools import (
+    assert_raises_regexp,
+    set_trace,
+    eq_,
+)
+from api.sip.client import MockSIPClient
+from api.sip.pool import SIPConnectionPool
+
+
+class MockClock(object):
+    def __init__(self):
+        self.now = 1000
+
+    def __call__(self):
+        return self.now
+
+
+class StaleableSIPClient(MockSIPClient):
+    """A MockSIPClient that can pretend its socket went stale."""
+    stale = False
+    login_count = 0
+
+    def connection_is_stale(self):
+        return self.stale
+
+    def login(self):
+        self.login_count += 1
+
+
+class TestSIPConnectionPool(object):
+
+    def setup(self):
+        self.clients = []
+        self.clock = MockClock()
+        self.pool = SIPConnectionPool(
+            self.factory, size=2, idle_timeout=60, clock=self.clock
+        )
+
+    def factory(self):
+        client = StaleableSIPClient()
+        self.clients.append(client)
+        return client
+
+    def test_checkout_creates_logged_in_client(self):
+        client, reused = self.pool.checkout()
+        eq_(False, reused)
+        eq_([client], self.clients)
+        eq_(["Creating new socket connection."], client.status)
+        eq_(1, client.login_count)
+
+    def test_checkin_and_reuse(self):
+        client, reused = self.pool.checkout()
+        self.pool.checkin(client)
+
+        # The same client comes back out, without a new connection or login.
+        client2, reused = self.pool.checkout()
+        eq_(client, client2)
+        eq_(True, reused)
+        eq_(1, client.login_count)
+        eq_(dict(idle=0, created=1, reused=1, discarded=0), self.pool.stats)
+
+    def test_pool_size_bounds_idle_sessions(self):
+        clients = [self.pool.checkout()[0] for i in range(3)]
+        for client in clients:
+            self.pool.checkin(client)
+
+        # Only two sessions were kept; the third was discarded.
+        eq_(2, self.pool.stats['idle'])
+        eq_(1, self.pool.stats['discarded'])
+
+    def test_idle_timeout(self):
+        client, reused = self.pool.checkout()
+        self.pool.checkin(client)
+        self.clock.now += 61
+
+        # The idle session is too old, so a new one is created.
+        client2, reused = self.pool.checkout()
+        eq_(False, reused)
+        assert client2 != client
+        eq_(1, self.pool.stats['discarded'])
+
+    def test_stale_connection_is_not_reused(self):
+        client, reused = self.pool.checkout()
+        self.pool.checkin(client)
+        client.stale = True
+        client2, reused = self.pool.checkout()
+        eq_(False, reused)
+        assert client2 != client
+
+    def test_sequence_number_wrap_retires_session(self):
+        client, reused = self.pool.checkout()
+        for i in range(10):
+            client.append_checksum("message")
+        eq_(True, client.sequence_number_wrapped)
+        self.pool.checkin(client)
+        eq_(0, self.pool.stats['idle'])
+        eq_(1, self.pool.stats['discarded'])
+
+        # Reconnecting resets the flag.
+        client.connect()
+        eq_(False, client.sequence_number_wrapped)
+
+    def test_run_retries_once_with_fresh_session(self):
+        client, reused = self.pool.checkout()
+        self.pool.checkin(client)
+
+        calls = []
+        def f(sip):
+            calls.append(sip)
+            if len(calls) == 1:
+                raise IOError("connection reset")
+            return "result"
+
+        # The pooled session failed, so the request was retried
+        # on a new session, which then went back into the pool.
+        eq_("result", self.pool.run(f))
+        eq_(2, len(calls))
+        eq_(client, calls[0])
+        assert calls[1] != client
+        eq_(1, self.pool.stats['idle'])
+
+    def test_run_retries_with_new_session_when_pooled_sessions_are_stale(self):
+        # Two sessions go into the pool. Then the server restarts,
+        # and both of them stop working, though that can't be
+        # detected without using them.
+        pooled = [self.pool.checkout()[0] for i in range(2)]
+        for client in pooled:
+            self.pool.checkin(client)
+        eq_(2, self.pool.stats['idle'])
+
+        calls = []
+        def f(sip):
+            calls.append(sip)
+            if sip in pooled:
+                raise IOError("connection reset")
+            return "result"
+
+        # The request failed on the most recently used pooled session,
+        # and was retried on a brand-new session rather than on the
+        # other pooled session.
+        eq_("result", self.pool.run(f))
+        eq_(2, len(calls))
+        eq_(pooled[1], calls[0])
+        assert calls[1] not in pooled
+        eq_(3, self.pool.stats['created'])
+        eq_(3, len(self.clients))
+
+    def test_run_does_not_retry_fresh_session(self):
+        def f(sip):
+            raise IOError("Doom!")
+        assert_raises_regexp(IOError, "Doom!", self.pool.run, f)
+        eq_(1, len(self.clients))
+        eq_(0, self.pool.stats['idle'])
+
+    def test_for_integration(self):
+        SIPConnectionPool.reset()
+        pool = SIPConnectionPool.for_integration(1, self.factory, "sig")
+        eq_(pool, SIPConnectionPool.for_integration(1, self.factory, "sig"))
+
+        # A different integration gets a different pool.
+        assert pool != SIPConnectionPool.for_integration(2, self.factory, "sig")
+
+        # If the configuration changes, the old pool is replaced.
+        client, reused = pool.checkout()
+        pool.checkin(client)
+        new_pool = SIPConnectionPool.for_integration(1, self.factory, "new sig")
+        assert new_pool != pool
+        eq_(0, pool.stats['idle'])
+        SIPConnectionPool.reset()
@@ -703,6 +703,42 @@ class TestAuthdataUtility(VendorIDTest):
         self._db.delete(registry)
         eq_(None, AuthdataUtility.from_config(library))
 
+    def test_for_library(self):
+        library = self._default_library
+        library2 = self._library()
+        unconfigured = self._library()
+        self.initialize_adobe(library, [library2])
+        setting = library.setting(Configuration.WEBSITE_URL)
+        self._db.flush()
+        AuthdataUtility.reset_cache()
+
+        # The first time, the AuthdataUtility is created from the
+        # configuration. After that, the same one is reused.
+        utility = AuthdataUtility.for_library(library)
+        eq_(self.TEST_VENDOR_ID, utility.vendor_id)
+        eq_(utility, AuthdataUtility.for_library(library, self._db))
+
+        # A library without a Short Client Token configuration
+        # gets None, and that's also remembered.
+        eq_(None, AuthdataUtility.for_library(unconfigured))
+        eq_((None,), AuthdataUtility._cache[unconfigured.id])
+
+        # While a configuration change is pending, the cache isn't
+        # used, even though looking at the cache wouldn't write the
+        # change to the database.
+        setting.value = "http://new/"
+        eq_("http://new/", AuthdataUtility.for_library(library).library_uri)
+
+        # Writing the change to the database cleared the cache.
+        eq_(0, len(AuthdataUtility._cache))
+        new_utility = AuthdataUtility.for_library(library)
+        assert new_utility != utility
+        eq_("http://new/", new_utility.library_uri)
+
+        # The cache can also be cleared explicitly.
+        AuthdataUtility.reset_cache()
+        eq_(0, len(AuthdataUtility._cache))
+
     def test_short_client_token_for_patron(self):
         class MockAuthdataUtility(AuthdataUtility):
             def __init__(self):
@@ -884,6 +920,13 @@ class TestAuthdataUtility(VendorIDTest):
         )
         eq_(expect_signature, signature)
 
+    def test_short_token_signing_keys_are_prepared_in_advance(self):
+        signer = self.authdata.short_token_signer
+        eq_({
+            "http://my-library.org/": signer.prepare_key("My library secret"),
+            "http://your-library.org/": signer.prepare_key("Your library secret"),
+        }, self.authdata.short_token_signing_keys_by_library_uri)
+
     def test_decode_short_client_token_from_another_library(self):
         # Here's the AuthdataUtility used by another library.
         foreign_authdata = AuthdataUtility(
@@ -9,6 +9,7 @@ from pyld import jsonld
 from . import DatabaseTest
 from test_controller import ControllerTest
 
+from core.lane import Pagination
 from core.model import (
     Annotation,
     create,
@@ -272,6 +273,82 @@ class TestAnnotationWriter(AnnotationTest, ControllerTest):
             page = AnnotationWriter.annotation_page_for(patron, identifier)
             eq_(0, len(page['items']))
 
+    def test_annotation_page_for_pagination(self):
+        patron = self._patron()
+        now = datetime.datetime.now()
+        annotations = []
+        for i in range(5):
+            annotation, ignore = create(
+                self._db, Annotation,
+                patron=patron,
+                identifier=self._identifier(),
+                motivation=Annotation.IDLING,
+                timestamp=now - datetime.timedelta(minutes=i),
+            )
+            annotations.append(annotation)
+
+        with self.app.test_request_context("/"):
+            # By default, every annotation fits on the first page.
+            page = AnnotationWriter.annotation_page_for(patron)
+            eq_(5, len(page['items']))
+            eq_(0, page['startIndex'])
+            eq_(None, page.get('next'))
+
+            # With a smaller page size, the annotations are split
+            # across pages, most recent first.
+            pagination = Pagination(size=2)
+            page = AnnotationWriter.annotation_page_for(
+                patron, pagination=pagination
+            )
+            eq_([annotations[0].id, annotations[1].id],
+                [int(x['id'].split('/')[-1]) for x in page['items']])
+            assert 'after' not in page['id']
+            assert 'after=2' in page['next']
+            assert 'size=2' in page['next']
+
+            page = AnnotationWriter.annotation_page_for(
+                patron, pagination=pagination.next_page.next_page
+            )
+            eq_(4, page['startIndex'])
+            assert 'after=4' in page['id']
+            eq_([annotations[4].id],
+                [int(x['id'].split('/')[-1]) for x in page['items']])
+
+            # That's the last page.
+            eq_(None, page.get('next'))
+
+            # The container's total counts every annotation, but its
+            # first page only has the first few.
+            container, timestamp = AnnotationWriter.annotation_container_for(
+                patron, pagination=pagination
+            )
+            eq_(5, container['total'])
+            eq_(2, len(container['first']['items']))
+            assert 'after=2' in container['first']['next']
+            eq_(now, timestamp)
+
+    def test_compact(self):
+        expanded = {
+            "http://www.w3.org/ns/oa#hasSource": [{"@id": "urn:isbn:9781449328030"}]
+        }
+        data = json.dumps(expanded)
+        compacted = AnnotationWriter.compact(data)
+        eq_({"source": "urn:isbn:9781449328030"}, compacted)
+
+        # The compacted document was cached, so the next time it's
+        # needed, jsonld.compact isn't called.
+        old_compact = jsonld.compact
+        def compact(*args, **kwargs):
+            raise Exception("jsonld.compact was called")
+        jsonld.compact = compact
+        try:
+            eq_(compacted, AnnotationWriter.compact(data))
+
+            # Every caller gets its own copy.
+            assert compacted is not AnnotationWriter.compact(data)
+        finally:
+            jsonld.compact = old_compact
+
     def test_detail_target(self):
         patron = self._patron()
         identifier = self._identifier()
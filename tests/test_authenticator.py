@@ -56,6 +56,7 @@ from api.authenticator import (
     BasicAuthenticationProvider,
     OAuthController,
     OAuthAuthenticationProvider,
+    PatronAuthenticationCache,
     PatronData,
 )
 from api.problem_details import PATRON_OF_ANOTHER_LIBRARY
@@ -2541,12 +2542,141 @@ class TestBasicAuthenticationProviderAuthenticate(AuthenticatorTest):
         # new identifiers.
         eq_(new_username, patron.username)
 
+    def test_authentication_cache(self):
+        PatronAuthenticationCache.reset()
+        patron = self._patron()
+        patrondata = PatronData(
+            permanent_id=patron.external_identifier, neighborhood="Park"
+        )
+        integration = self._external_integration(
+            self._str, ExternalIntegration.PATRON_AUTH_GOAL
+        )
+        integration.setting(MockBasic.AUTHENTICATION_CACHE_TTL).value = 60
+
+        class CountingMockBasic(MockBasic):
+            remote_calls = 0
+            def remote_authenticate(self, username, password):
+                self.remote_calls += 1
+                return self.patrondata
+        provider = CountingMockBasic(
+            self._default_library, integration, patrondata=patrondata
+        )
+        cache = provider.authentication_cache
+        eq_(60, cache.ttl)
+        eq_(PatronAuthenticationCache.DEFAULT_SIZE, cache.size)
+
+        # The first time, the credentials are checked with the ILS.
+        eq_(patron, provider.authenticate(self._db, self.credentials))
+        eq_(1, provider.remote_calls)
+
+        # The second time, the cached authentication is used.
+        patron.neighborhood = None
+        eq_(patron, provider.authenticate(self._db, self.credentials))
+        eq_(1, provider.remote_calls)
+        eq_("Park", patron.neighborhood)
+        eq_(dict(size=1, hits=1, misses=1), cache.stats)
+
+        # A different password isn't in the cache, and when the ILS
+        # rejects it, every cached authentication for that username is
+        # removed.
+        provider.patrondata = None
+        eq_(None, provider.authenticate(
+            self._db, dict(username="user", password="wrong"))
+        )
+        eq_(2, provider.remote_calls)
+        eq_(0, cache.stats['size'])
+        eq_(None, provider.authenticate(self._db, self.credentials))
+        eq_(3, provider.remote_calls)
+
+        # An admin action can invalidate a patron's cached authentications.
+        provider.patrondata = patrondata
+        provider.authenticate(self._db, self.credentials)
+        eq_(1, cache.stats['size'])
+        eq_(1, PatronAuthenticationCache.invalidate_patron(patron.id))
+        eq_(0, cache.stats['size'])
+
+        # If no TTL is configured, there is no cache.
+        eq_(None, self.mock_basic().authentication_cache)
+        PatronAuthenticationCache.reset()
+
     # Notice what's missing: If a patron has no permanent identifier,
     # _and_ their username and authorization identifier both change,
     # then we have no way of locating them in our database. They will
     # appear no different to us than a patron who has never used the
     # circulation manager before.
 
+class TestPatronAuthenticationCache(object):
+
+    def setup(self):
+        self.now = 1000
+        self.cache = PatronAuthenticationCache(
+            ttl=10, size=2, clock=lambda: self.now
+        )
+
+    def test_store_and_lookup(self):
+        patrondata = PatronData(permanent_id="1234")
+        self.cache.store(1, "user", "pass", 5, patrondata)
+
+        entry = self.cache.lookup(1, "user", "pass")
+        eq_(5, entry.patron_id)
+        eq_(patrondata, entry.patrondata)
+
+        # The PatronData was copied.
+        assert entry.patrondata is not patrondata
+
+        # The credentials themselves aren't stored anywhere.
+        assert "user" not in repr(self.cache.entries)
+        assert "pass" not in repr(self.cache.entries)
+
+        # A different library, username or password is a different key.
+        eq_(None, self.cache.lookup(2, "user", "pass"))
+        eq_(None, self.cache.lookup(1, "user2", "pass"))
+        eq_(None, self.cache.lookup(1, "user", "pass2"))
+        eq_(dict(size=1, hits=1, misses=3), self.cache.stats)
+
+    def test_expiration(self):
+        self.cache.store(1, "user", "pass", 5, None)
+        self.now += 9
+        assert self.cache.lookup(1, "user", "pass")
+        self.now += 2
+        eq_(None, self.cache.lookup(1, "user", "pass"))
+
+        # The expired entry was removed.
+        eq_(0, self.cache.stats['size'])
+
+    def test_size_bound(self):
+        self.cache.store(1, "user1", "pass", 1, None)
+        self.cache.store(1, "user2", "pass", 2, None)
+
+        # Looking up user1 makes user2 the least recently used entry.
+        assert self.cache.lookup(1, "user1", "pass")
+        self.cache.store(1, "user3", "pass", 3, None)
+        eq_(2, self.cache.stats['size'])
+        eq_(None, self.cache.lookup(1, "user2", "pass"))
+        assert self.cache.lookup(1, "user1", "pass")
+        assert self.cache.lookup(1, "user3", "pass")
+
+    def test_remove(self):
+        self.cache.store(1, "user", "pass", 5, None)
+        self.cache.store(1, "user", "oldpass", 5, None)
+        eq_(0, self.cache.remove_username(2, "user"))
+        eq_(2, self.cache.remove_username(1, "user"))
+
+        self.cache.store(1, "user", "pass", 5, None)
+        eq_(0, self.cache.remove_patron(6))
+        eq_(1, self.cache.remove_patron(5))
+
+    def test_for_integration(self):
+        PatronAuthenticationCache.reset()
+        cache = PatronAuthenticationCache.for_integration(1, 10)
+        eq_(cache, PatronAuthenticationCache.for_integration(1, 10))
+        assert cache != PatronAuthenticationCache.for_integration(2, 10)
+
+        # Changing the configuration replaces the cache.
+        assert cache != PatronAuthenticationCache.for_integration(1, 20)
+        PatronAuthenticationCache.reset()
+
+
 class TestOAuthAuthenticationProvider(AuthenticatorTest):
 
     def test_from_config(self):
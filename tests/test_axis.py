@@ -266,6 +266,30 @@ class TestAxis360API(Axis360Test):
         kwargs = request[-1]
         eq_(None, kwargs['timeout'])
 
+    def test_availability_stream(self):
+        # The availability API can be asked to stream its response.
+        self.api.queue_response(200)
+        self.api.availability(stream=True)
+        request = self.api.requests.pop()
+        kwargs = request[-1]
+        eq_(True, kwargs['stream'])
+        eq_(None, kwargs['timeout'])
+
+    def test_recent_activity(self):
+        # recent_activity parses the availability document as it
+        # comes in.
+        data = self.sample_data("tiny_collection.xml")
+        self.api.queue_response(200, content=data)
+        since = datetime.datetime(2020, 1, 1)
+        titles = [bib.title for bib, circulation in self.api.recent_activity(since)]
+        eq_([u'Faith of My Fathers : A Family Memoir', u'Slightly Irregular'],
+            titles)
+
+        [request] = self.api.requests
+        kwargs = request[-1]
+        eq_(True, kwargs['stream'])
+        eq_(since.strftime(self.api.DATE_FORMAT), kwargs['params']['updatedDate'])
+
     def test_availability_exception(self):
 
         self.api.queue_response(500)
@@ -279,13 +303,19 @@ class TestAxis360API(Axis360Test):
         request again.
         """
         self.api.queue_response(401)
+        closed = []
+        self.api.responses[0].close = lambda: closed.append(True)
         self.api.queue_response(
             200, content=json.dumps(dict(access_token="foo"))
         )
         self.api.queue_response(200, content="The data")
-        response = self.api.request("http://url/")
+        response = self.api.request("http://url/", stream=True)
         eq_("The data", response.content)
 
+        # The response to the first request was closed before the
+        # request was retried, so its connection wasn't left open.
+        eq_([True], closed)
+
     def test_refresh_bearer_token_error(self):
         """Raise an exception if we don't get a 200 status code when
         refreshing the bearer token.
@@ -867,6 +897,21 @@ class TestReaper(Axis360Test):
 
 class TestParsers(Axis360Test):
 
+    def test_bibliographic_parser_process_stream(self):
+        # process_stream reads a document incrementally, but finds
+        # the same information as process_all.
+        data = self.sample_data("tiny_collection.xml")
+        parser = BibliographicParser(True, True)
+        expect = list(parser.process_all(data))
+        streamed = list(parser.process_stream(StringIO(data)))
+
+        eq_(2, len(streamed))
+        for (bib1, av1), (bib2, av2) in zip(expect, streamed):
+            eq_(bib1.title, bib2.title)
+            eq_(bib1.primary_identifier, bib2.primary_identifier)
+            eq_(av1.licenses_owned, av2.licenses_owned)
+            eq_(av1.licenses_available, av2.licenses_available)
+
     def test_bibliographic_parser(self):
         """Make sure the bibliographic information gets properly
         collated in preparation for creating Edition objects.
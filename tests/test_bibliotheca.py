@@ -29,6 +29,7 @@ from core.model import (
     DataSource,
     DeliveryMechanism,
     Edition,
+    Equivalency,
     ExternalIntegration,
     Hold,
     Hyperlink,
@@ -662,6 +663,54 @@ class TestBibliothecaCirculationSweep(BibliothecaAPITest):
         ]),
             sorted(types))
 
+    def test_lookup_makes_concurrent_requests(self):
+        # If there are too many identifiers for one request, lookup()
+        # splits them up and makes the requests in worker threads.
+        class MockAPI(MockBibliothecaAPI):
+            def bibliographic_lookup(self, identifiers):
+                self.requests.append(list(identifiers))
+                return ["metadata for %s" % x for x in identifiers]
+
+        api = MockAPI(self._db, self.collection)
+        monitor = BibliothecaCirculationSweep(
+            self._db, self.collection, api_class=api, concurrency=3
+        )
+        monitor.LOOKUP_SIZE = 2
+        results = list(monitor.lookup(["e", "d", "c", "b", "a"]))
+
+        # The results come back in a predictable order.
+        eq_(["metadata for %s" % x for x in "abcde"], results)
+        eq_([["a", "b"], ["c", "d"], ["e"]],
+            sorted(api.requests))
+
+    def test_license_pools_and_editions_for(self):
+        # The LicensePools and Editions for a batch of identifiers are
+        # found ahead of time.
+        edition, pool = self._edition(
+            data_source_name=DataSource.BIBLIOTHECA,
+            identifier_type=Identifier.BIBLIOTHECA_ID,
+            with_license_pool=True, collection=self.collection
+        )
+        identifier = pool.identifier
+
+        # This LicensePool is in a different collection, so it's ignored.
+        other_edition, other_pool = self._edition(
+            data_source_name=DataSource.BIBLIOTHECA,
+            identifier_type=Identifier.BIBLIOTHECA_ID,
+            with_license_pool=True, collection=self._collection()
+        )
+
+        no_pool = self._identifier(identifier_type=Identifier.BIBLIOTHECA_ID)
+        identifiers = [identifier, other_pool.identifier, no_pool]
+
+        monitor = BibliothecaCirculationSweep(
+            self._db, self.collection, api_class=self.api
+        )
+        eq_({identifier.id: pool}, monitor.license_pools_for(identifiers))
+        eq_({identifier.id: edition,
+             other_pool.identifier.id: other_edition},
+            monitor.editions_for(identifiers))
+
 
 # Tests of the various parser classes.
 #
@@ -1119,6 +1168,77 @@ class TestBibliothecaEventMonitor(BibliothecaAPITest):
         # affect the counts.
         eq_(4, analytics.count)
 
+    def test_handle_events(self):
+        # handle_events() looks up everything mentioned by a batch of
+        # events ahead of time, then has the same effect as calling
+        # handle_event() on each event.
+        api = MockBibliothecaAPI(self._db, self.collection)
+        api.queue_response(
+            200, content=self.sample_data("item_metadata_single.xml")
+        )
+        analytics = MockAnalyticsProvider()
+        monitor = BibliothecaEventMonitor(
+            self._db, self.collection, api_class=api,
+            analytics=analytics
+        )
+
+        # We already know about one of the books.
+        edition, existing_pool = self._edition(
+            data_source_name=DataSource.BIBLIOTHECA,
+            identifier_type=Identifier.BIBLIOTHECA_ID,
+            with_license_pool=True, collection=self.collection
+        )
+        existing_pool.licenses_owned = 2
+        existing_pool.licenses_available = 2
+        existing_pool.last_checked = None
+        existing_id = existing_pool.identifier.identifier
+
+        now = datetime.utcnow()
+        events = [
+            ("ddf4gr9", "9781250015280", None, now, None,
+             CirculationEvent.DISTRIBUTOR_LICENSE_ADD),
+            (existing_id, "9781101190623", None, now, None,
+             CirculationEvent.DISTRIBUTOR_CHECKOUT),
+            (existing_id, "9781101190623", None, now + timedelta(seconds=1),
+             None, CirculationEvent.DISTRIBUTOR_CHECKOUT),
+        ]
+        eq_(3, monitor.handle_events(events))
+
+        # Only the new book had to be looked up.
+        eq_(1, len(api.requests))
+        new_pool = [x for x in self.collection.licensepools
+                    if x.identifier.identifier == "ddf4gr9"][0]
+        eq_("The Incense Game", new_pool.work.title)
+        eq_(1, new_pool.licenses_owned)
+        eq_(1, new_pool.licenses_available)
+
+        # Both checkouts were applied to the book we already knew about.
+        eq_(2, existing_pool.licenses_owned)
+        eq_(0, existing_pool.licenses_available)
+
+        # Each Bibliotheca identifier is now equivalent to its ISBN.
+        def equivalencies(pool):
+            return self._db.query(Equivalency).filter(
+                Equivalency.input_id==pool.identifier.id
+            ).all()
+        [equivalency] = equivalencies(existing_pool)
+        eq_("9781101190623", equivalency.output.identifier)
+        eq_(1, equivalency.strength)
+        eq_(1, len(equivalencies(new_pool)))
+
+        # Handling the same events again doesn't create more
+        # equivalencies.
+        monitor.handle_events(events)
+        eq_(1, len(equivalencies(existing_pool)))
+        eq_(1, len(equivalencies(new_pool)))
+
+    def test_event_batches(self):
+        monitor = BibliothecaEventMonitor(
+            self._db, self.collection, api_class=self.api
+        )
+        monitor.EVENT_BATCH_SIZE = 2
+        eq_([[1, 2], [3, 4], [5]], list(monitor.event_batches(iter([1, 2, 3, 4, 5]))))
+
 
 class TestItemListParser(BibliothecaAPITest):
 
@@ -8,6 +8,7 @@ from nose.tools import (
 
 import flask
 from flask import Flask
+from threading import Event
 
 from api.config import (
     Configuration,
@@ -19,6 +20,7 @@ from datetime import (
     timedelta,
 )
 
+from api.admin.dashboard_stats import DashboardStatistics
 from api.authenticator import (
     LibraryAuthenticator,
     PatronData,
@@ -31,8 +33,11 @@ from api.circulation import (
     CirculationInfo,
     DeliveryMechanismInfo,
     FulfillmentInfo,
+    LatencyHistogram,
     LoanInfo,
     HoldInfo,
+    PatronActivityExecutor,
+    PatronActivityTask,
 )
 
 from core.config import CannotLoadConfiguration
@@ -1056,6 +1061,37 @@ class TestCirculationAPI(DatabaseTest):
         api.analytics = None
         api._collect_event(p1, None, 'event')
 
+    def test__collect_event_marks_dashboard_statistics_stale(self):
+        library_stats = DashboardStatistics.refresh_library(
+            self._db, self.patron.library
+        )
+        collection_stats = DashboardStatistics.refresh_collection(
+            self._db, self.pool.collection
+        )
+        other_stats = DashboardStatistics.refresh_library(
+            self._db, self._library()
+        )
+
+        # Even without analytics, a circulation event means the
+        # dashboard statistics for the patron's library and the
+        # book's collection need to be recalculated.
+        self.circulation.analytics = None
+        self.circulation._collect_event(self.patron, self.pool, 'event')
+        eq_(True, library_stats.stale)
+        eq_(True, collection_stats.stale)
+        eq_(False, other_stats.stale)
+
+        # If there's no patron, and the current request isn't
+        # associated with a library, the CirculationAPI's library
+        # is used.
+        library_stats.stale = False
+        eq_(self.patron.library, self.circulation.library)
+        app = Flask(__name__)
+        with app.test_request_context():
+            self.circulation._collect_event(None, None, 'event')
+        eq_(True, library_stats.stale)
+        eq_(False, other_stats.stale)
+
     def test_sync_bookshelf_ignores_local_loan_with_no_identifier(self):
         loan, ignore = self.pool.loan_to(self.patron)
         loan.start = self.YESTERDAY
@@ -1210,6 +1246,109 @@ class TestCirculationAPI(DatabaseTest):
         eq_(self.IN_TWO_WEEKS, hold.end)
         eq_(0, hold.position)
 
+    def test_sync_bookshelf_creates_new_loans_and_holds(self):
+        # The remote knows about two loans and a hold that we've
+        # never heard of. One of the loans is for a LicensePool that
+        # doesn't exist yet.
+        edition, pool2 = self._edition(
+            data_source_name=DataSource.BIBLIOTHECA,
+            identifier_type=Identifier.BIBLIOTHECA_ID,
+            with_license_pool=True, collection=self.collection
+        )
+        self.circulation.add_remote_loan(
+            self.pool.collection, self.pool.data_source, self.identifier.type,
+            self.identifier.identifier, self.TODAY, self.IN_TWO_WEEKS
+        )
+        self.circulation.add_remote_loan(
+            self.collection, DataSource.BIBLIOTHECA, Identifier.BIBLIOTHECA_ID,
+            "new-title", None, self.IN_TWO_WEEKS
+        )
+        self.circulation.add_remote_hold(
+            pool2.collection, pool2.data_source, pool2.identifier.type,
+            pool2.identifier.identifier, self.TODAY, self.IN_TWO_WEEKS, 3
+        )
+        loans, holds = self.circulation.sync_bookshelf(self.patron, "1234")
+
+        eq_(2, len(loans))
+        eq_(self.pool, loans[0].license_pool)
+        eq_(self.TODAY, loans[0].start)
+        eq_("new-title", loans[1].license_pool.identifier.identifier)
+
+        # A loan without a start date is assumed to start now.
+        assert loans[1].start > self.YESTERDAY
+
+        [hold] = holds
+        eq_(pool2, hold.license_pool)
+        eq_(3, hold.position)
+        eq_(set(loans), set(self._db.query(Loan).all()))
+        eq_([hold], self._db.query(Hold).all())
+
+        # Syncing again finds the same loans and holds rather than
+        # creating new ones.
+        loans2, holds2 = self.circulation.sync_bookshelf(
+            self.patron, "1234", force=True
+        )
+        eq_(loans, loans2)
+        eq_(holds, holds2)
+        eq_(2, self._db.query(Loan).count())
+
+    def test_sync_bookshelf_with_loan_and_hold_created_during_sync(self):
+        # The patron borrowed one book and put another on hold after
+        # we looked up their local loans and holds, but before the
+        # remote loans and holds were created locally.
+        edition, pool2 = self._edition(
+            data_source_name=DataSource.BIBLIOTHECA,
+            identifier_type=Identifier.BIBLIOTHECA_ID,
+            with_license_pool=True, collection=self.collection
+        )
+        loan, ignore = self.pool.loan_to(self.patron)
+        hold, ignore = pool2.on_hold_to(self.patron)
+        self.circulation.local_loans = lambda patron: []
+        self.circulation.local_holds = lambda patron: []
+
+        self.circulation.add_remote_loan(
+            self.pool.collection, self.pool.data_source, self.identifier.type,
+            self.identifier.identifier, self.TODAY, self.IN_TWO_WEEKS
+        )
+        self.circulation.add_remote_hold(
+            pool2.collection, pool2.data_source, pool2.identifier.type,
+            pool2.identifier.identifier, self.TODAY, self.IN_TWO_WEEKS, 3
+        )
+        loans, holds = self.circulation.sync_bookshelf(self.patron, "1234")
+
+        # Instead of raising an IntegrityError, the sync found the
+        # loan and hold that had been created in the meantime.
+        eq_([loan], loans)
+        eq_([hold], holds)
+        eq_(3, hold.position)
+        eq_([loan], self._db.query(Loan).all())
+        eq_([hold], self._db.query(Hold).all())
+
+    def test_license_pools_for(self):
+        edition, pool2 = self._edition(
+            data_source_name=DataSource.BIBLIOTHECA,
+            identifier_type=Identifier.BIBLIOTHECA_ID,
+            with_license_pool=True, collection=self.collection
+        )
+        existing = LoanInfo(
+            self.collection, DataSource.BIBLIOTHECA, self.identifier.type,
+            self.identifier.identifier, None, None
+        )
+        existing2 = HoldInfo(
+            self.collection, self.pool.data_source, pool2.identifier.type,
+            pool2.identifier.identifier, None, None, None
+        )
+        new = LoanInfo(
+            self.collection, DataSource.BIBLIOTHECA, Identifier.BIBLIOTHECA_ID,
+            "new-title", None, None
+        )
+        pools = self.circulation.license_pools_for([existing, existing2, new])
+        eq_(self.pool, pools[existing])
+        eq_(pool2, pools[existing2])
+        eq_("new-title", pools[new].identifier.identifier)
+        eq_(self.collection, pools[new].collection)
+        eq_({}, self.circulation.license_pools_for([]))
+
     def test_sync_bookshelf_applies_locked_delivery_mechanism_to_loan(self):
 
         # By the time we hear about the patron's loan, they've already
@@ -1307,6 +1446,104 @@ class TestCirculationAPI(DatabaseTest):
         eq_(0, len(holds))
         eq_(False, complete)
 
+        # How long the API took was recorded.
+        histogram = CirculationAPI.patron_activity_latency['MockBibliothecaAPI']
+        assert histogram.count >= 2
+
+    def test_patron_activity_timeout(self):
+        # An API that takes too long to respond doesn't hold up the
+        # results from the other APIs.
+        loan = LoanInfo(
+            self.collection, DataSource.GUTENBERG, Identifier.GUTENBERG_ID,
+            "1", None, None
+        )
+        released = Event()
+        class Fast(BaseCirculationAPI):
+            PATRON_ACTIVITY_TIMEOUT = None
+            def patron_activity(self, patron, pin):
+                return [loan]
+        class Slow(BaseCirculationAPI):
+            PATRON_ACTIVITY_TIMEOUT = 0.1
+            def patron_activity(self, patron, pin):
+                released.wait(5)
+                return []
+
+        circulation = CirculationAPI(self._db, self._default_library)
+        circulation.api_for_collection = {1: Fast(), 2: Slow()}
+        executor = PatronActivityExecutor(workers=2)
+        loans, holds, complete = circulation.patron_activity(
+            self.patron, "1234", executor=executor
+        )
+        released.set()
+
+        # We got the loan from the fast API, but since the slow API
+        # timed out, we don't have the complete picture.
+        eq_([loan], loans)
+        eq_([], holds)
+        eq_(False, complete)
+
+        # The overall deadline also applies to APIs with no timeout
+        # of their own.
+        released.clear()
+        Slow.PATRON_ACTIVITY_TIMEOUT = None
+        circulation.PATRON_ACTIVITY_DEADLINE = 0.1
+        loans, holds, complete = circulation.patron_activity(
+            self.patron, "1234", executor=executor
+        )
+        released.set()
+        eq_([loan], loans)
+        eq_(False, complete)
+
+    def test_patron_activity_session(self):
+        # Each API is asked about the patron's activity in a database
+        # session of its own, rather than the caller's session.
+        class Mock(BaseCirculationAPI):
+            def patron_activity(self, patron, pin):
+                self.calls.append((self._db, patron))
+                return []
+        api = Mock()
+        api._db = self._db
+        api.calls = []
+
+        circulation = CirculationAPI(self._db, self._default_library)
+        circulation.api_for_collection = {1: api}
+        executor = PatronActivityExecutor(workers=1)
+        loans, holds, complete = circulation.patron_activity(
+            self.patron, "1234", executor=executor
+        )
+        eq_(True, complete)
+        [(_db, patron)] = api.calls
+        assert _db != self._db
+        assert patron != self.patron
+        eq_(self.patron.id, patron.id)
+
+        # If the worker thread can't see the patron, because the
+        # patron hasn't been committed yet, the caller runs the task
+        # in its own session.
+        api.calls = []
+        task = PatronActivityTask(api, self.patron, "1234")
+        task.patron_id = -1
+        task.run()
+        eq_(True, task.patron_not_found)
+        eq_([], api.calls)
+
+        task.run_in(self._db, self.patron)
+        eq_([(self._db, self.patron)], api.calls)
+
+    def test_patron_activity_task_cancel(self):
+        # A task that's cancelled before it starts never asks the API
+        # about the patron.
+        class Mock(BaseCirculationAPI):
+            def patron_activity(self, patron, pin):
+                raise Exception("I should not have been called.")
+
+        task = PatronActivityTask(Mock(), self.patron, "1234")
+        task.cancel()
+        task.run()
+        eq_(True, task.done.is_set())
+        eq_(None, task.exception)
+        eq_(None, task.activity)
+
     def test_can_fulfill_without_loan(self):
         """Can a title can be fulfilled without an active loan?  It depends on
         the BaseCirculationAPI implementation for that title's colelction.
@@ -1335,6 +1572,42 @@ class TestCirculationAPI(DatabaseTest):
         pool.open_access = True
         eq_(True, circulation.can_fulfill_without_loan(None, pool, object()))
 
+class TestLatencyHistogram(object):
+
+    def test_record(self):
+        histogram = LatencyHistogram()
+        eq_(None, histogram.mean)
+        for seconds in (0.05, 0.1, 0.3, 100):
+            histogram.record(seconds)
+        eq_(4, histogram.count)
+        data = histogram.as_dict()
+        eq_(4, data['count'])
+        eq_(2, data['buckets']['0.1'])
+        eq_(1, data['buckets']['0.5'])
+        eq_(1, data['buckets']['+Inf'])
+        eq_(0, data['buckets']['30'])
+
+
+class TestPatronActivityExecutor(object):
+
+    def test_bounded_workers(self):
+        executor = PatronActivityExecutor(workers=2)
+
+        class Task(object):
+            name = "task"
+            def __init__(self):
+                self.done = Event()
+            def run(self):
+                self.done.set()
+
+        tasks = [executor.submit(Task()) for i in range(5)]
+        for task in tasks:
+            eq_(True, task.done.wait(5))
+
+        # Five tasks were run, but only two threads were started.
+        eq_(2, len(executor.threads))
+
+
 class TestBaseCirculationAPI(DatabaseTest):
 
     def test_default_notification_email_address(self):
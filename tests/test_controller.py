@@ -186,6 +186,23 @@ from core.analytics import Analytics
 from core.lane import BaseFacets
 from core.util.authentication_for_opds import AuthenticationForOPDSDocument
 from api.registry import Registration
+from api.streaming_proxy import StreamingProxy
+from .test_streaming_proxy import (
+    MockSession,
+    remote_response,
+)
+
+
+@contextmanager
+def mock_streaming_proxy_session(session):
+    """Make every StreamingProxy use the given requests Session."""
+    old = (StreamingProxy._session, StreamingProxy._session_pid)
+    StreamingProxy._session = session
+    StreamingProxy._session_pid = os.getpid()
+    try:
+        yield session
+    finally:
+        StreamingProxy._session, StreamingProxy._session_pid = old
 
 class ControllerTest(VendorIDTest):
     """A test that requires a functional app server."""
@@ -468,6 +485,11 @@ class TestCirculationManager(CirculationControllerTest):
         # Now the new library has a top-level lane.
         assert library.id in manager.top_level_lanes
 
+        # And its settings were loaded into a snapshot.
+        eq_("http://registration", manager.library_settings[library.id].value(
+            Registration.LIBRARY_REGISTRATION_WEB_CLIENT, registry
+        ))
+
         # And a circulation API.
         assert library.id in manager.circulation_apis
 
@@ -1324,6 +1346,12 @@ class TestBaseController(CirculationControllerTest):
             eq_(self._default_library, value)
             eq_(self._default_library, flask.request.library)
 
+            # The snapshot of the library's settings was attached to
+            # the request.
+            eq_(self._default_library.id,
+                flask.request.library_settings.library_id)
+            eq_(0, flask.request.library_settings.lookups_saved)
+
         # If you don't specify a library, the default library is used.
         with self.app.test_request_context("/"):
             value = self.controller.library_for_request(None)
@@ -2188,6 +2216,60 @@ class TestLoanController(CirculationControllerTest):
             # returned directly.
             eq_("Here's your response", result)
 
+    def test_fulfill_streams_remote_content(self):
+        # When the content has to be fetched from a remote server, it's
+        # streamed to the client as it arrives.
+        class MockCirculationAPI(object):
+            def fulfill(slf, *args, **kwargs):
+                return FulfillmentInfo(
+                    self.pool.collection, DataSource.ENKI,
+                    self.pool.identifier.type,
+                    self.pool.identifier.identifier,
+                    "http://content/", "application/epub+zip", None, None
+                )
+
+        controller = self.manager.loans
+        controller.manager.circulation_apis[self._default_library.id] = (
+            MockCirculationAPI()
+        )
+        self.pool.open_access = False
+        mechanism = self.pool.set_delivery_mechanism(
+            Representation.EPUB_MEDIA_TYPE, DeliveryMechanism.NO_DRM,
+            RightsStatus.IN_COPYRIGHT, None
+        )
+
+        session = MockSession()
+        session.responses.append(
+            remote_response(
+                206, {"Content-Type": "text/plain", "Content-Range": "bytes 0-3/10"},
+                "book"
+            )
+        )
+        headers = dict(Authorization=self.valid_auth, Range="bytes=0-3")
+        with mock_streaming_proxy_session(session):
+            with self.request_context_with_library("/", headers=headers):
+                authenticated = controller.authenticated_patron_from_request()
+                self.pool.loan_to(authenticated)
+                response = controller.fulfill(
+                    self.pool.id, mechanism.delivery_mechanism.id
+                )
+
+        # The Range header from the client was passed along, along
+        # with the Accept-Encoding header Enki needs for unencrypted
+        # books.
+        [(url, kwargs)] = session.requests
+        eq_("http://content/", url)
+        eq_({"Range": "bytes=0-3", "Accept-Encoding": "deflate"},
+            kwargs['headers'])
+        eq_(True, kwargs['stream'])
+
+        # The response wasn't read into memory before being returned.
+        eq_(True, response.is_streamed)
+        eq_(206, response.status_code)
+        eq_("bytes 0-3/10", response.headers['Content-Range'])
+        eq_("application/epub+zip", response.headers['Content-Type'])
+        eq_("book", "".join(response.response))
+
     def test_fulfill_without_active_loan(self):
 
         controller = self.manager.loans
@@ -2597,6 +2679,50 @@ class TestAnnotationController(CirculationControllerTest):
             expected_time = format_date_time(mktime(annotation.timestamp.timetuple()))
             eq_(expected_time, response.headers['Last-Modified'])
 
+    def test_get_container_pages(self):
+        now = datetime.datetime.now()
+        annotations = []
+        for i in range(3):
+            annotation, ignore = create(
+                self._db, Annotation,
+                patron=self.default_patron,
+                identifier=self._identifier(),
+                motivation=Annotation.IDLING,
+                active=True,
+                timestamp=now - datetime.timedelta(minutes=i),
+            )
+            annotations.append(annotation)
+
+        with self.request_context_with_library(
+                "/?size=2", headers=dict(Authorization=self.valid_auth)):
+            self.manager.annotations.authenticated_patron_from_request()
+            response = self.manager.annotations.container()
+            eq_(200, response.status_code)
+
+            # The container has all three annotations, but only the
+            # first two are on its first page.
+            container = json.loads(response.data)
+            eq_(3, container['total'])
+            eq_(2, len(container['first']['items']))
+            next_url = container['first']['next']
+            assert 'after=2' in next_url
+
+        with self.request_context_with_library(
+                "/?after=2&size=2", headers=dict(Authorization=self.valid_auth)):
+            self.manager.annotations.authenticated_patron_from_request()
+            response = self.manager.annotations.container()
+            eq_(200, response.status_code)
+
+            # Following the 'next' link gets the second page on its own.
+            page = json.loads(response.data)
+            eq_("AnnotationPage", page['type'])
+            eq_(AnnotationWriter.JSONLD_CONTEXT, page['@context'])
+            eq_(2, page['startIndex'])
+            eq_(1, len(page['items']))
+            eq_(annotations[2].motivation, page['items'][0]['motivation'])
+            eq_(None, page.get('next'))
+            eq_(AnnotationWriter.CONTENT_TYPE, response.headers['Content-Type'])
+
     def test_get_container_for_work(self):
         self.pool.loan_to(self.default_patron)
 
@@ -5254,6 +5380,26 @@ class TestSharedCollectionController(ControllerTest):
             eq_("Content", response.data)
             eq_("text/html", response.headers.get("Content-Type"))
 
+            # Without do_get, the content is streamed from the remote
+            # server, and the client's Range header is passed along.
+            api.queue_fulfill(fulfillment_info)
+            session = MockSession()
+            session.responses.append(
+                remote_response(206, {"Content-Type": "text/plain"}, "Cont")
+            )
+            with mock_streaming_proxy_session(session):
+                with self.request_context_with_client(
+                    "/", headers={"Range": "bytes=0-3"}
+                ):
+                    response = self.manager.shared_collection_controller.fulfill(self.collection.name, loan.id, self.delivery_mechanism.delivery_mechanism.id)
+            [(url, kwargs)] = session.requests
+            eq_("http://content", url)
+            eq_({"Range": "bytes=0-3"}, kwargs['headers'])
+            eq_(True, response.is_streamed)
+            eq_(206, response.status_code)
+            eq_("text/html", response.headers.get("Content-Type"))
+            eq_("Cont", "".join(response.response))
+
             fulfillment_info.content_link = None
             fulfillment_info.content = "Content"
             api.queue_fulfill(fulfillment_info)
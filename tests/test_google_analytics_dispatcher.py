@@ -0,0 +1,155 @@
+import os
+import shutil
+import tempfile
+
+from nose.tools import (
+    eq_,
+    set_trace,
+)
+
+from api.google_analytics_dispatcher import GoogleAnalyticsDispatcher
+
+
+class MockGoogleAnalyticsDispatcher(GoogleAnalyticsDispatcher):
+    """Sends hits only when told to, and records them instead of
+    sending them to Google.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.now = 1000.0
+        self.sleeps = []
+        kwargs.setdefault('clock', lambda: self.now)
+        kwargs.setdefault('sleep', self.sleeps.append)
+        super(MockGoogleAnalyticsDispatcher, self).__init__(*args, **kwargs)
+        self.posts = []
+        self.failures = 0
+
+    def ensure_worker(self):
+        pass
+
+    def post(self, url, payload):
+        if self.failures:
+            self.failures -= 1
+            raise IOError("Google is down.")
+        self.posts.append((url, payload))
+
+
+class TestGoogleAnalyticsDispatcher(object):
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.spill_path = os.path.join(self.directory, "hits.spill")
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def dispatcher(self, url="http://www.google-analytics.com/collect", **kwargs):
+        return MockGoogleAnalyticsDispatcher(
+            url, spill_path=self.spill_path, **kwargs
+        )
+
+    def test_batch_url_for(self):
+        m = GoogleAnalyticsDispatcher.batch_url_for
+        eq_("http://www.google-analytics.com/batch",
+            m("http://www.google-analytics.com/collect"))
+        eq_("https://example.com/ga/batch", m("https://example.com/ga/collect/"))
+        eq_(None, m("https://example.com/hits"))
+
+    def test_dispatch_sends_hits_in_batches(self):
+        dispatcher = self.dispatcher()
+        for i in range(25):
+            dispatcher.enqueue("hit=%d" % i)
+        eq_(25, dispatcher.queue_depth)
+
+        # Time passes before the hits are sent.
+        dispatcher.now += 2
+
+        eq_(20, dispatcher.dispatch())
+        eq_(5, dispatcher.dispatch())
+        eq_(0, dispatcher.dispatch())
+
+        [(url1, payload1), (url2, payload2)] = dispatcher.posts
+        eq_("http://www.google-analytics.com/batch", url1)
+        eq_("http://www.google-analytics.com/batch", url2)
+
+        # Each hit goes on its own line, with its queue time in
+        # milliseconds.
+        lines = payload1.split("\n")
+        eq_(20, len(lines))
+        eq_("hit=0&qt=2000", lines[0])
+        eq_(["hit=20&qt=2000", "hit=21&qt=2000", "hit=22&qt=2000",
+             "hit=23&qt=2000", "hit=24&qt=2000"], payload2.split("\n"))
+
+        eq_(dict(queue_depth=0, sent=25, spilled=0, dropped=0,
+                 failed_requests=0), dispatcher.metrics())
+
+    def test_hits_are_sent_one_at_a_time_without_batch_endpoint(self):
+        dispatcher = self.dispatcher(url="http://example.com/hits")
+        dispatcher.enqueue("hit=1")
+        dispatcher.enqueue("hit=2")
+        dispatcher.dispatch()
+        eq_([("http://example.com/hits", "hit=1&qt=0"),
+             ("http://example.com/hits", "hit=2&qt=0")],
+            dispatcher.posts)
+
+    def test_retry_with_backoff(self):
+        dispatcher = self.dispatcher()
+        dispatcher.enqueue("hit=1")
+        dispatcher.failures = 2
+        dispatcher.dispatch()
+
+        # The third attempt succeeded, after waiting longer before
+        # each retry.
+        eq_([1, 2], dispatcher.sleeps)
+        eq_(1, len(dispatcher.posts))
+        eq_(1, dispatcher.sent)
+        eq_(2, dispatcher.failed_requests)
+
+    def test_hits_that_cant_be_sent_are_spilled_and_resent_later(self):
+        dispatcher = self.dispatcher()
+        dispatcher.enqueue("hit=1")
+        dispatcher.failures = dispatcher.MAX_ATTEMPTS
+        dispatcher.dispatch()
+        eq_([], dispatcher.posts)
+        eq_(1, dispatcher.spilled)
+        assert os.path.exists(self.spill_path)
+
+        dispatcher.now += 10
+        dispatcher.resend_spilled()
+        eq_([("http://www.google-analytics.com/batch", "hit=1&qt=10000")],
+            dispatcher.posts)
+        assert not os.path.exists(self.spill_path)
+
+        # There's nothing more to resend.
+        dispatcher.resend_spilled()
+        eq_(1, len(dispatcher.posts))
+
+    def test_queue_overflow_spills_to_disk(self):
+        dispatcher = self.dispatcher(queue_size=2)
+        for i in range(3):
+            dispatcher.enqueue("hit=%d" % i)
+        eq_(2, dispatcher.queue_depth)
+        eq_(1, dispatcher.spilled)
+        eq_([("hit=2", 1000.0)], dispatcher.take_spilled())
+
+    def test_old_hits_are_dropped(self):
+        dispatcher = self.dispatcher()
+        dispatcher.enqueue("hit=1")
+        dispatcher.now += dispatcher.MAX_HIT_AGE + 1
+        dispatcher.enqueue("hit=2")
+        dispatcher.dispatch()
+        eq_([("http://www.google-analytics.com/batch", "hit=2&qt=0")],
+            dispatcher.posts)
+        eq_(1, dispatcher.dropped)
+
+    def test_shutdown_spills_unsent_hits(self):
+        dispatcher = self.dispatcher()
+        dispatcher.enqueue("hit=1")
+        dispatcher.shutdown(timeout=0)
+        eq_(0, dispatcher.queue_depth)
+        eq_(1, dispatcher.spilled)
+
+        # Hits that show up after shutdown go straight to disk.
+        dispatcher.enqueue("hit=2")
+        eq_(["hit=1", "hit=2"],
+            [params for params, queued_at in dispatcher.take_spilled()])
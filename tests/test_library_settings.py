@@ -0,0 +1,113 @@
+from nose.tools import (
+    eq_,
+    set_trace,
+)
+import flask
+import json
+
+from api.app import app
+from api.library_settings import LibrarySettings
+from core.model import (
+    ConfigurationSetting,
+    ExternalIntegration,
+)
+from . import DatabaseTest
+
+
+class TestLibrarySettings(DatabaseTest):
+
+    def test_load(self):
+        library = self._default_library
+        other_library = self._library()
+        integration = self._external_integration(
+            ExternalIntegration.MARC_EXPORT, ExternalIntegration.CATALOG_GOAL,
+            libraries=[library]
+        )
+        library.setting("key").value = "library value"
+        ConfigurationSetting.for_library_and_externalintegration(
+            self._db, "key", library, integration
+        ).value = "integration value"
+        other_library.setting("key").value = "other value"
+
+        # A sitewide setting isn't associated with any library.
+        ConfigurationSetting.sitewide(self._db, "key").value = "sitewide value"
+
+        settings = LibrarySettings.load(self._db)
+        eq_(set([library.id, other_library.id]), set(settings.keys()))
+
+        snapshot = settings[library.id]
+        eq_("library value", snapshot.value("key"))
+        eq_("integration value", snapshot.value("key", integration))
+        eq_(None, snapshot.value("no such key"))
+        eq_("other value", settings[other_library.id].value("key"))
+
+        # Every lookup was counted.
+        eq_(3, snapshot.lookups_saved)
+
+        # A snapshot created for a request shares the values but
+        # keeps its own count.
+        for_request = snapshot.for_request()
+        eq_("library value", for_request.value("key"))
+        eq_(1, for_request.lookups_saved)
+        eq_(3, snapshot.lookups_saved)
+
+    def test_defaults(self):
+        library = self._default_library
+        integration = self._external_integration(
+            ExternalIntegration.MARC_EXPORT, ExternalIntegration.CATALOG_GOAL,
+            libraries=[library]
+        )
+        library.setting("library key").value = "library value"
+        ConfigurationSetting.sitewide(self._db, "key").value = "sitewide value"
+        integration.setting("key").value = "integration value"
+        ConfigurationSetting.for_library_and_externalintegration(
+            self._db, "blank key", library, integration
+        ).value = ""
+        integration.setting("blank key").value = "integration default"
+
+        snapshot = LibrarySettings.load(self._db)[library.id]
+
+        # A setting the library doesn't have falls back to the
+        # sitewide setting, and a library's setting for an integration
+        # falls back to the integration's own setting -- the same
+        # values ConfigurationSetting.value would find.
+        eq_("sitewide value", snapshot.value("key"))
+        eq_("integration value", snapshot.value("key", integration))
+        eq_("integration default", snapshot.value("blank key", integration))
+        eq_("library value", snapshot.value("library key"))
+        eq_(None, snapshot.value("no such key"))
+
+        # A snapshot created for a request falls back to the same
+        # settings.
+        eq_("sitewide value", snapshot.for_request().value("key"))
+
+    def test_value_for(self):
+        library = self._default_library
+        library.setting("key").value = json.dumps(["a", "b"])
+        snapshot = LibrarySettings.load(self._db)[library.id].for_request()
+
+        # Change the setting after the snapshot was taken.
+        library.setting("key").value = json.dumps(["c"])
+
+        # Outside of a request, the setting is looked up in the database.
+        eq_(["c"], LibrarySettings.json_value_for("key", library))
+
+        with app.test_request_context("/"):
+            # If no snapshot was attached to the request, the setting is
+            # looked up in the database.
+            eq_(None, LibrarySettings.current(library))
+            eq_(json.dumps(["c"]), LibrarySettings.value_for("key", library))
+
+            # Once a snapshot is attached, the setting comes from the
+            # snapshot.
+            flask.request.library_settings = snapshot
+            eq_(snapshot, LibrarySettings.current(library))
+            eq_(["a", "b"], LibrarySettings.json_value_for("key", library))
+            eq_(1, snapshot.lookups_saved)
+
+            # The snapshot is only used for the library it belongs to.
+            other_library = self._library()
+            other_library.setting("key").value = "other value"
+            eq_(None, LibrarySettings.current(other_library))
+            eq_("other value", LibrarySettings.value_for("key", other_library))
+            eq_(1, snapshot.lookups_saved)
@@ -5,6 +5,8 @@ from nose.tools import (
     assert_raises,
 )
 import csv
+import gzip
+from StringIO import StringIO
 
 from . import DatabaseTest
 from core.model import (
@@ -238,3 +240,36 @@ class TestLocalAnalyticsExporter(DatabaseTest):
         for row in rows:
             eq_(14, len(row))
             eq_(constant, row[2:])
+
+    def test_stream(self):
+        exporter = LocalAnalyticsExporter()
+        work = self._work(with_open_access_download=True)
+        [pool] = work.license_pools
+        time = datetime.now() - timedelta(minutes=5)
+        for i in range(3):
+            get_one_or_create(
+                self._db, CirculationEvent, license_pool=pool,
+                type=CirculationEvent.DISTRIBUTOR_CHECKOUT, start=time,
+                end=time
+            )
+            time += timedelta(minutes=1)
+        today = date.today() - timedelta(days=1)
+
+        # With a fetch size of 2, the header and the first two events
+        # come out in the first chunk and the last event in the second.
+        chunks = list(exporter.stream(self._db, today, time, fetch_size=2))
+        eq_(2, len(chunks))
+        eq_(3, chunks[0].count("\r\n"))
+        eq_(1, chunks[1].count("\r\n"))
+        eq_(exporter.export(self._db, today, time), "".join(chunks))
+
+        # The document can also be gzipped on the fly.
+        compressed = "".join(
+            exporter.stream(self._db, today, time, compress=True)
+        )
+        eq_("".join(chunks), gzip.GzipFile(fileobj=StringIO(compressed)).read())
+
+    def test_gzip_chunks(self):
+        chunks = ["first chunk\n", "", "second chunk\n"]
+        compressed = "".join(LocalAnalyticsExporter.gzip_chunks(iter(chunks)))
+        eq_("".join(chunks), gzip.GzipFile(fileobj=StringIO(compressed)).read())
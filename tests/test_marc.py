@@ -3,6 +3,7 @@ from nose.tools import (
     set_trace,
 )
 from pymarc import Record
+import datetime
 import urllib
 
 from . import DatabaseTest
@@ -12,7 +13,11 @@ from core.model import (
     ExternalIntegration,
 )
 
-from api.marc import LibraryAnnotator
+from api.marc import (
+    LibraryAnnotator,
+    LibraryMARCExporter,
+    MARCFileUpload,
+)
 from core.marc import MARCExporter
 from api.registry import Registration
 
@@ -185,3 +190,168 @@ class TestLibraryAnnotator(DatabaseTest):
 
         eq_(["4", "0"], field2.indicators)
         eq_(expected_client_url_1, field2.get_subfields("u")[0])
+
+    def test_cache_settings(self):
+        integration = self._external_integration(
+            ExternalIntegration.MARC_EXPORT, ExternalIntegration.CATALOG_GOAL,
+            libraries=[self._default_library])
+        registry = self._external_integration(
+            ExternalIntegration.OPDS_REGISTRATION, ExternalIntegration.DISCOVERY_GOAL,
+            libraries=[self._default_library])
+        ConfigurationSetting.for_library_and_externalintegration(
+            self._db, MARCExporter.MARC_ORGANIZATION_CODE,
+            self._default_library, integration).value = "marc org"
+        ConfigurationSetting.for_library_and_externalintegration(
+            self._db, Registration.LIBRARY_REGISTRATION_WEB_CLIENT,
+            self._default_library, registry).value = "http://web_catalog"
+
+        annotator = LibraryAnnotator(self._default_library)
+        annotator.cache_settings(integration)
+
+        # Once the settings are cached, changes to the database are
+        # ignored.
+        ConfigurationSetting.for_library_and_externalintegration(
+            self._db, MARCExporter.MARC_ORGANIZATION_CODE,
+            self._default_library, integration).value = "new org"
+        ConfigurationSetting.for_library_and_externalintegration(
+            self._db, Registration.LIBRARY_REGISTRATION_WEB_CLIENT,
+            self._default_library, registry).value = "http://new_catalog"
+
+        eq_("marc org", annotator.value(
+            MARCExporter.MARC_ORGANIZATION_CODE, integration
+        ))
+        eq_(["http://web_catalog"],
+            annotator.registry_web_client_urls(self._default_library))
+
+        # A different library's settings aren't cached.
+        other_library = self._library()
+        eq_([], annotator.registry_web_client_urls(other_library))
+
+        # An annotator that hasn't cached its settings looks them up.
+        annotator = LibraryAnnotator(self._default_library)
+        eq_("new org", annotator.value(
+            MARCExporter.MARC_ORGANIZATION_CODE, integration
+        ))
+        eq_(["http://new_catalog"],
+            annotator.registry_web_client_urls(self._default_library))
+
+
+class MockMultipartUpload(object):
+
+    def __init__(self, mirror, url):
+        self.mirror = mirror
+        self.url = url
+        self.parts = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.mirror.uploaded[self.url] = self.parts
+
+    def upload_part(self, content):
+        self.parts.append(content)
+
+
+class MockMirror(object):
+
+    def __init__(self):
+        self.uploaded = {}
+
+    def marc_file_url(self, library, lane, end_time, start_time=None):
+        if start_time:
+            return "http://marc/changes.mrc"
+        return "http://marc/all.mrc"
+
+    def multipart_upload(self, representation, url):
+        return MockMultipartUpload(self, url)
+
+
+class TestLibraryMARCExporter(DatabaseTest):
+
+    def test_records_with_changes(self):
+        integration = self._external_integration(
+            ExternalIntegration.MARC_EXPORT, ExternalIntegration.CATALOG_GOAL,
+            libraries=[self._default_library])
+        now = datetime.datetime.utcnow()
+        last_week = now - datetime.timedelta(days=7)
+        yesterday = now - datetime.timedelta(days=1)
+
+        old_work = self._work(title="Unchanged Title", with_license_pool=True)
+        old_work.last_update_time = last_week
+        new_work = self._work(title="Recently Updated Title", with_license_pool=True)
+        new_work.last_update_time = now
+
+        class MockExporter(LibraryMARCExporter):
+            created = []
+
+            def work_batches(self, lane, search_engine=None, batch_size=500):
+                # Skip the search index and return the works in
+                # batches of one.
+                yield [old_work]
+                yield [new_work]
+
+            def create_record(self, work, annotator, force_refresh=False,
+                              integration=None):
+                self.created.append(work)
+                return super(MockExporter, self).create_record(
+                    work, annotator, force_refresh, integration
+                )
+
+        exporter = MockExporter(self._db, self._default_library, integration)
+        annotator = LibraryAnnotator(self._default_library)
+        mirror = MockMirror()
+        lane = self._lane()
+
+        # Without a start time, only one file is created.
+        [cached] = exporter.records_with_changes(
+            lane, annotator, None, mirror=mirror, upload_batch_size=1
+        )
+        eq_(["http://marc/all.mrc"], mirror.uploaded.keys())
+        eq_(lane, cached.lane)
+        eq_(None, cached.start_time)
+        eq_("http://marc/all.mrc", cached.representation.url)
+
+        # Even though the upload batch size is one work, both records
+        # were uploaded in a single part, since a part smaller than
+        # MINIMUM_PART_SIZE would be rejected by S3.
+        [data] = mirror.uploaded["http://marc/all.mrc"]
+        assert "Unchanged Title" in data
+        assert "Recently Updated Title" in data
+
+        # Once a part is big enough, a new part is started after every
+        # `upload_batch_size` works.
+        mirror.uploaded = {}
+        old_minimum = MARCFileUpload.MINIMUM_PART_SIZE
+        MARCFileUpload.MINIMUM_PART_SIZE = 1
+        try:
+            exporter.records_with_changes(
+                lane, annotator, None, mirror=mirror, upload_batch_size=1
+            )
+        finally:
+            MARCFileUpload.MINIMUM_PART_SIZE = old_minimum
+        [old_record, new_record] = mirror.uploaded["http://marc/all.mrc"]
+        assert "Unchanged Title" in old_record
+        assert "Recently Updated Title" in new_record
+
+        # With a start time, both files are created with one pass
+        # over the works.
+        mirror.uploaded = {}
+        exporter.created = []
+        all_records, changes = exporter.records_with_changes(
+            lane, annotator, None, start_time=yesterday, mirror=mirror
+        )
+        eq_([old_work, new_work], exporter.created)
+        eq_(None, all_records.start_time)
+        eq_(yesterday, changes.start_time)
+
+        # The file of all records contains both works, in a single
+        # part this time.
+        [data] = mirror.uploaded["http://marc/all.mrc"]
+        assert "Unchanged Title" in data
+        assert "Recently Updated Title" in data
+
+        # The file of changes only has the work that changed recently.
+        [data] = mirror.uploaded["http://marc/changes.mrc"]
+        assert "Unchanged Title" not in data
+        assert "Recently Updated Title" in data
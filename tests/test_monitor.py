@@ -17,9 +17,13 @@ from core.model import (
     DataSource,
     ExternalIntegration,
     Identifier,
+    Loan,
 )
 
+from api.admin.dashboard_stats import DashboardStatistics
 from api.monitor import (
+    BulkReaper,
+    DashboardStatisticsMonitor,
     HoldReaper,
     IdlingAnnotationReaper,
     LoanlikeReaperMonitor,
@@ -33,6 +37,51 @@ from api.odl import (
 from api.testing import MonitorTest
 
 
+class TestBulkReaper(DatabaseTest):
+
+    def test_reap(self):
+        now = datetime.datetime.utcnow()
+        long_ago = now - datetime.timedelta(days=1000)
+        patron = self._patron()
+        old_loans = []
+        new_loans = []
+        for i in range(5):
+            pool = self._licensepool(None)
+            loan, ignore = pool.loan_to(patron, start=long_ago, end=long_ago)
+            old_loans.append(loan)
+        for i in range(2):
+            pool = self._licensepool(None)
+            loan, ignore = pool.loan_to(patron, start=now)
+            new_loans.append(loan)
+        new_loan_ids = set(x.id for x in new_loans)
+
+        library_stats = DashboardStatistics.refresh_library(
+            self._db, self._default_library, now
+        )
+        collection_stats = DashboardStatistics.refresh_collection(
+            self._db, self._default_collection, now
+        )
+        eq_(False, library_stats.stale)
+        eq_(False, collection_stats.stale)
+
+        # The old loans are deleted two at a time.
+        reaper = BulkReaper(self._db, batch_size=2)
+        qu = self._db.query(Loan).filter(Loan.end < now)
+        eq_(5, reaper.reap(Loan, qu, "expired loans"))
+        eq_(new_loan_ids, set(x.id for x in self._db.query(Loan)))
+        eq_(5, reaper.rows_deleted)
+        assert reaper.achievements.startswith("Items deleted: 5 (")
+
+        # The loans counted in the dashboard statistics have changed,
+        # so the statistics for the library and collection are stale.
+        eq_(True, library_stats.stale)
+        eq_(True, collection_stats.stale)
+
+        # There's nothing more to delete.
+        eq_(0, reaper.reap(Loan, qu, "expired loans"))
+        eq_(5, reaper.rows_deleted)
+
+
 class TestLoanlikeReaperMonitor(DatabaseTest):
     """Tests the loan and hold reapers."""
 
@@ -250,3 +299,52 @@ class TestIdlingAnnotationReaper(DatabaseTest):
         reaper = IdlingAnnotationReaper(self._db)
         qu = self._db.query(Annotation).filter(reaper.where_clause)
         eq_([reapable], qu.all())
+
+
+class TestDashboardStatisticsMonitor(DatabaseTest):
+
+    def test_run_once(self):
+        library = self._default_library
+        collection = self._default_collection
+        patron = self._patron()
+        monitor = DashboardStatisticsMonitor(self._db)
+
+        # The first time the monitor runs, statistics are calculated
+        # for every library and collection.
+        progress = monitor.run_once(monitor.timestamp().to_data())
+        eq_("Libraries refreshed: 1. Collections refreshed: 1.",
+            progress.achievements)
+        [library_stats] = self._db.query(DashboardStatistics).filter(
+            DashboardStatistics.library_id==library.id
+        ).all()
+        eq_(1, library_stats.patrons)
+        eq_(False, library_stats.stale)
+
+        # Nothing has changed, so there's nothing to do.
+        progress = monitor.run_once(monitor.timestamp().to_data())
+        eq_("Libraries refreshed: 0. Collections refreshed: 0.",
+            progress.achievements)
+
+        # Once the library's statistics are marked stale, they're
+        # recalculated, but the collection is left alone.
+        self._patron()
+        DashboardStatistics.mark_stale(self._db, library=library)
+        eq_(True, library_stats.stale)
+        progress = monitor.run_once(monitor.timestamp().to_data())
+        eq_("Libraries refreshed: 1. Collections refreshed: 0.",
+            progress.achievements)
+        eq_(2, library_stats.patrons)
+        eq_(False, library_stats.stale)
+
+        # Statistics that are too old are recalculated even if
+        # they're not stale.
+        [collection_stats] = self._db.query(DashboardStatistics).filter(
+            DashboardStatistics.collection_id==collection.id
+        ).all()
+        collection_stats.updated_at = (
+            datetime.datetime.utcnow() - monitor.MAX_AGE
+            - datetime.timedelta(minutes=1)
+        )
+        progress = monitor.run_once(monitor.timestamp().to_data())
+        eq_("Libraries refreshed: 0. Collections refreshed: 1.",
+            progress.achievements)
@@ -895,6 +895,62 @@ class TestODLAPI(DatabaseTest, BaseODLTest):
             eq_(0, hold.position)
             assert hold.end - datetime.datetime.utcnow() - datetime.timedelta(days=3) < datetime.timedelta(hours=1)
 
+    def test_update_hold_queues(self):
+        # update_hold_queues updates several pools at once, including
+        # holds that are still waiting in the queue.
+        self.collection.external_integration.set_setting(
+            Collection.DEFAULT_RESERVATION_PERIOD_KEY, 3
+        )
+        self.collection.external_integration.set_setting(
+            Collection.EBOOK_LOAN_DURATION_KEY, 6
+        )
+        now = datetime.datetime.utcnow()
+        tomorrow = now + datetime.timedelta(days=1)
+
+        other_pool = self._licensepool(None, collection=self.collection)
+        for pool in self.pool, other_pool:
+            pool.licenses_owned = 1
+            pool.licenses_available = 0
+            pool.licenses_reserved = 0
+
+        # One pool has one copy, which is on loan until tomorrow, and
+        # two holds.
+        self.license.loan_to(self._patron(), end=tomorrow)
+        first_hold, ignore = self.pool.on_hold_to(
+            self._patron(), start=now - datetime.timedelta(days=2)
+        )
+        second_hold, ignore = self.pool.on_hold_to(
+            self._patron(), start=now - datetime.timedelta(days=1)
+        )
+
+        # The other pool's copy is available for its one hold.
+        other_hold, ignore = other_pool.on_hold_to(
+            self._patron(), start=now, position=1
+        )
+
+        self.api.update_hold_queues([self.pool, other_pool])
+
+        eq_(0, self.pool.licenses_available)
+        eq_(0, self.pool.licenses_reserved)
+        eq_(2, self.pool.patrons_in_hold_queue)
+
+        # The first hold will be available when the loan expires.
+        eq_(1, first_hold.position)
+        eq_(tomorrow, first_hold.end)
+
+        # The second will be available after one more loan and
+        # reservation cycle.
+        eq_(2, second_hold.position)
+        eq_(tomorrow + datetime.timedelta(days=9), second_hold.end)
+
+        # The other pool's hold got the reserved copy.
+        eq_(1, other_pool.licenses_reserved)
+        eq_(0, other_hold.position)
+        assert other_hold.end > now
+
+        # Calling update_hold_queues with no pools does nothing.
+        self.api.update_hold_queues([])
+
     def test_place_hold_success(self):
         tomorrow = datetime.datetime.utcnow() + datetime.timedelta(days=1)
         self.pool.licenses_owned = 1
@@ -11,6 +11,8 @@ from datetime import (
     timedelta,
 )
 import random
+import threading
+import time
 from api.overdrive import (
     MockOverdriveAPI,
     NewTitlesOverdriveCollectionMonitor,
@@ -19,6 +21,8 @@ from api.overdrive import (
     OverdriveCollectionReaper,
     OverdriveFormatSweep,
     OverdriveManifestFulfillmentInfo,
+    OverdrivePatronToken,
+    OverdrivePatronTokenCache,
     RecentOverdriveCollectionMonitor
 )
 
@@ -1546,6 +1550,121 @@ class TestOverdriveAPICredentials(OverdriveAPITest):
             eq_(expected_credentials[name], credential.credential)
 
 
+    def test_get_patron_credential_uses_cache(self):
+        patron = self._patron()
+        patron.authorization_identifier = "barcode"
+        api = self.api
+        api.access_token_response = api.mock_access_token_response("token 1")
+
+        # The first time we need a token, we get it from Overdrive.
+        token = api.get_patron_credential(patron, "pin")
+        eq_("token 1", token.credential)
+        eq_(1, len(api.access_token_requests))
+        eq_(1, api.patron_token_cache.misses)
+
+        # The second time, it comes from the cache, without a trip to
+        # Overdrive.
+        api.access_token_response = api.mock_access_token_response("token 2")
+        eq_(token, api.get_patron_credential(patron, "pin"))
+        eq_(1, len(api.access_token_requests))
+        eq_(1, api.patron_token_cache.hits)
+
+        # A different patron gets a different token.
+        other_patron = self._patron()
+        eq_("token 2", api.get_patron_credential(other_patron, "pin").credential)
+
+        # If Overdrive rejects our token, we can force it to be
+        # refreshed.
+        api.access_token_response = api.mock_access_token_response("token 3")
+        requests = len(api.access_token_requests)
+        token = api.get_patron_credential(patron, "pin", force_refresh=True)
+        eq_("token 3", token.credential)
+        eq_(token, api.get_patron_credential(patron, "pin"))
+        eq_(requests + 1, len(api.access_token_requests))
+
+        # Forcing a refresh for a patron who has no token yet only
+        # asks Overdrive for one token.
+        new_patron = self._patron()
+        token = api.get_patron_credential(new_patron, "pin", force_refresh=True)
+        eq_("token 3", token.credential)
+        eq_(requests + 2, len(api.access_token_requests))
+
+    def test_get_patron_credential_refreshes_in_background(self):
+        patron = self._patron()
+        patron.authorization_identifier = "barcode"
+        api = self.api
+        api.access_token_response = api.mock_access_token_response("old token")
+        cache = api.patron_token_cache
+        old_token = api.get_patron_credential(patron, "pin")
+
+        # Time passes, and the token is about to expire.
+        now = old_token.expires - (cache.REFRESH_MARGIN / 2)
+        cache.clock = lambda: now
+
+        # The token we have is still returned, but a new one is
+        # requested in the background.
+        api.access_token_response = api.mock_access_token_response("new token")
+        eq_(old_token, api.get_patron_credential(patron, "pin"))
+        for i in range(100):
+            if cache.background_refreshes:
+                break
+            time.sleep(0.05)
+
+        eq_("new token", api.get_patron_credential(patron, "pin").credential)
+        eq_(1, cache.background_refreshes)
+        eq_(2, len(api.access_token_requests))
+
+
+class TestOverdrivePatronTokenCache(object):
+
+    def test_single_flight(self):
+        # When several threads need the same token at once, only one
+        # of them obtains it.
+        cache = OverdrivePatronTokenCache()
+        expires = datetime.utcnow() + timedelta(hours=1)
+        loading = threading.Event()
+        release = threading.Event()
+        loads = []
+
+        def load():
+            loads.append(1)
+            loading.set()
+            release.wait(5)
+            return OverdrivePatronToken("token", expires)
+
+        results = []
+        def get_token():
+            results.append(cache.single_flight("key", load))
+
+        leader = threading.Thread(target=get_token)
+        leader.start()
+        loading.wait(5)
+        followers = [threading.Thread(target=get_token) for i in range(3)]
+        for thread in followers:
+            thread.start()
+        release.set()
+        for thread in [leader] + followers:
+            thread.join(5)
+
+        eq_(1, len(loads))
+        eq_(["token"] * 4, [token.credential for token in results])
+        eq_({}, cache.in_flight)
+
+    def test_expired_tokens_are_ignored(self):
+        cache = OverdrivePatronTokenCache()
+        now = datetime.utcnow()
+        cache.set("key", OverdrivePatronToken("token", now - timedelta(seconds=1)))
+        eq_(None, cache.get("key"))
+
+        token = OverdrivePatronToken("token", now + timedelta(hours=1))
+        cache.set("key", token)
+        eq_(token, cache.get("key"))
+        eq_(False, cache.needs_refresh(token))
+
+        cache.invalidate("key")
+        eq_(None, cache.get("key"))
+
+
 class TestExtractData(OverdriveAPITest):
 
     def test_get_download_link(self):
@@ -2092,7 +2211,61 @@ class TestOverdriveCirculationMonitor(OverdriveAPITest):
         #
         # We processed four books: 1, 2, None (which was ignored)
         # and 3.
-        eq_("Books processed: 4.", progress.achievements)
+        assert progress.achievements.startswith("Books processed: 4. ")
+        assert "Books per second: " in progress.achievements
+
+    def test_catch_up_from_concurrently(self):
+        # When the monitor looks up more than one book at a time,
+        # availability information is fetched in worker threads, but
+        # LicensePools are updated in order, in this thread, and
+        # should_stop() still decides when to stop.
+        class MockAPI(object):
+            collection_token = "token"
+
+            def __init__(self, *ignore, **kwignore):
+                self.licensepools = {}
+                self.updated = []
+                self.retried = []
+
+            def fetch_availability(self, book_id, exception_on_401=False):
+                assert exception_on_401 == True
+                if book_id == 2:
+                    # Simulate an expired bearer token.
+                    return book_id, None
+                return dict(id=book_id), (200, {}, "{}")
+
+            def update_licensepool_from_availability(self, book_id, book,
+                                                     response):
+                self.updated.append(book_id)
+                return self.licensepools[book_id]
+
+            def update_licensepool(self, book_id):
+                self.retried.append(book_id)
+                return self.licensepools[book_id]
+
+        class MockMonitor(OverdriveCirculationMonitor):
+            def recently_changed_ids(self, start, cutoff):
+                return [1, 2, None, 3, 4, 5, 6]
+
+            def should_stop(self, start, book, is_changed):
+                return book == 4
+
+        monitor = MockMonitor(self._db, self.collection, api_class=MockAPI,
+                              concurrency=3, batch_size=2)
+        api = monitor.api
+        for book_id in range(1, 7):
+            api.licensepools[book_id] = (self._licensepool(None), False, True)
+
+        progress = TimestampData()
+        monitor.catch_up_from(object(), object(), progress)
+
+        # Book 2 was retried outside of the worker threads.
+        eq_([1, 3, 4], api.updated)
+        eq_([2], api.retried)
+
+        # Books 5 and 6 were never processed, because should_stop
+        # returned True for book 4.
+        assert progress.achievements.startswith("Books processed: 5. ")
 
 
 class TestNewTitlesOverdriveCollectionMonitor(OverdriveAPITest):
@@ -59,6 +59,7 @@ from core.metadata_layer import (
 
 from core.model import (
     get_one_or_create,
+    CirculationEvent,
     Classification,
     ConfigurationSetting,
     Contributor,
@@ -952,6 +953,51 @@ class TestRBDigitalAPI(RBDigitalAPITest):
             m, identifier
         )
 
+    def test_stream_all_catalog(self):
+        datastr, datadict = self.api.get_data("response_catalog_all_sample.json")
+        self.api.queue_response(status_code=200, content=datastr)
+
+        catalog = self.api.stream_all_catalog()
+        eq_(
+            [u'Tricks', u'Emperor Mage: The Immortals', u'In-Flight Russian'],
+            [x['title'] for x in catalog]
+        )
+
+        # The request asked for the response to be streamed.
+        [[url, args, kwargs]] = self.api.requests
+        assert url.endswith("/media/all")
+        eq_(True, kwargs['stream'])
+
+        # A response that isn't a list can't be parsed.
+        self.api.queue_response(
+            status_code=200,
+            content='{"message": "Invalid Basic Token or permission denied"}'
+        )
+        assert_raises_regexp(
+            BadResponseException,
+            "RBDigital all catalog response not parseable",
+            list, self.api.stream_all_catalog()
+        )
+
+    def test_json_list_items(self):
+        def parse(document, chunk_size=3):
+            return list(RBDigitalAPI.json_list_items(
+                StringIO(document), chunk_size=chunk_size
+            ))
+
+        # Items come out one at a time, even when they're split
+        # across chunks.
+        eq_([{u"a": [1, 2]}, 12345, u"x, ]", None, []],
+            parse(' [{"a": [1, 2]}, 12345,\n "x, ]", null, []] '))
+        eq_([], parse("[]"))
+        eq_([u"caf\xe9"], parse('["caf\xc3\xa9"]', chunk_size=1))
+
+        assert_raises_regexp(ValueError, "Expected a JSON list", parse, '{}')
+        assert_raises_regexp(
+            ValueError, "JSON list was not terminated", parse, '[1, 2'
+        )
+        assert_raises(ValueError, parse, '[{"a": ')
+
     def test_get_ebook_availability_info(self):
         datastr, datadict = self.api.get_data("response_availability_ebook_1.json")
         self.api.queue_response(status_code=200, content=datastr)
@@ -1015,6 +1061,38 @@ class TestRBDigitalAPI(RBDigitalAPITest):
             # monitor.
             eq_(1, pool.licenses_available)
 
+        # The import finished, so there's nothing to resume.
+        eq_(0, self.api.import_checkpoint)
+
+    def test_populate_all_catalog_resumes_interrupted_import(self):
+        datastr, datadict = self.get_data("response_catalog_all_sample.json")
+
+        # The connection is lost after two titles have come in.
+        class InterruptedAPI(MockRBDigitalAPI):
+            IMPORT_BATCH_SIZE = 1
+
+            def stream_all_catalog(self):
+                for item in datadict[:2]:
+                    yield item
+                raise IOError("Connection reset")
+
+        api = InterruptedAPI(
+            self._db, self.collection, base_path=self.base_path
+        )
+        assert_raises(IOError, api.populate_all_catalog)
+
+        # The titles that came in were imported and committed, and
+        # we made a note of how far we got.
+        eq_(2, api.import_checkpoint)
+        eq_(2, self._db.query(Work).count())
+
+        # The next time, the first two titles are skipped.
+        self.api.queue_response(status_code=200, content=datastr)
+        eq_((3, 1), self.api.populate_all_catalog())
+        eq_(["Emperor Mage: The Immortals", "In-Flight Russian", "Tricks"],
+            sorted(x.title for x in self._db.query(Work)))
+        eq_(0, self.api.import_checkpoint)
+
     def test_populate_delta(self):
 
         # A title we don't know about -- "Emperor Mage: The Immortals"
@@ -1133,6 +1211,38 @@ class TestRBDigitalAPI(RBDigitalAPITest):
         eq_(2, items_transmitted)
         eq_(1, items_updated)
 
+    def test_populate_delta_looks_up_added_titles_concurrently(self):
+        item_media_str, item_media = self.get_data("response_catalog_media_isbn.json")
+        isbns = ["9781934180723", "9781400024018", "9781615730186"]
+
+        class ConcurrentAPI(MockRBDigitalAPI):
+            DELTA_BATCH_SIZE = 2
+            DELTA_CONCURRENCY = 2
+
+            def get_delta(self, *args, **kwargs):
+                return dict(
+                    addedBooks=[dict(isbn=isbn) for isbn in isbns],
+                    removedBooks=[],
+                )
+
+            def get_metadata_by_isbn(self, identifier):
+                item = dict(item_media)
+                item['isbn'] = identifier
+                return item
+
+        api = ConcurrentAPI(self._db, self.collection, base_path=self.base_path)
+        batches = list(api.metadata_for_isbns(isbns))
+        eq_([isbns[:2], isbns[2:]],
+            [[x['isbn'] for x in batch] for batch in batches])
+
+        eq_((3, 3), api.populate_delta())
+        for isbn in isbns:
+            pool = LicensePool.for_foreign_id(
+                self._db, DataSource.RB_DIGITAL, Identifier.RB_DIGITAL_ID,
+                isbn, collection=self.collection, autocreate=False
+            )[0]
+            eq_(True, pool.work.presentation_ready)
+
     def test_circulate_item(self):
         edition, pool = self._edition(
             identifier_type=Identifier.RB_DIGITAL_ID,
@@ -1790,6 +1900,72 @@ class TestCirculationMonitor(RBDigitalAPITest):
         eq_(1, item_count)
         pool_ebook.licenses_available = 0
 
+    def test_process_availability_only_updates_changed_titles(self):
+        class Mock(MockRBDigitalAPI):
+            def update_licensepool_for_identifier(self, isbn, *args, **kwargs):
+                self.updated.append(isbn)
+                return super(Mock, self).update_licensepool_for_identifier(
+                    isbn, *args, **kwargs
+                )
+
+        monitor = RBDigitalCirculationMonitor(
+            self._db, self.collection, api_class=Mock,
+            api_class_kwargs=dict(base_path=self.base_path)
+        )
+        monitor.api.updated = []
+        events = []
+        monitor.analytics.collect_event = (
+            lambda library, pool, event, time: events.append((pool, event))
+        )
+
+        def make_pool(available):
+            edition, pool = self._edition(
+                identifier_type=Identifier.RB_DIGITAL_ID,
+                data_source_name=DataSource.RB_DIGITAL,
+                with_license_pool=True, collection=self.collection
+            )
+            pool.licenses_owned = 1
+            pool.licenses_available = available
+            return pool
+        unchanged = make_pool(1)
+        changed = make_pool(1)
+
+        # This pool is in another collection, so it doesn't count.
+        elsewhere = make_pool(0)
+        elsewhere.collection = self._collection()
+
+        eq_({unchanged.identifier.identifier: (1, 1),
+             changed.identifier.identifier: (1, 1)},
+            monitor.current_availability())
+
+        availability = [
+            dict(isbn=unchanged.identifier.identifier, availability=True,
+                 mediaType="eBook"),
+            dict(isbn=changed.identifier.identifier, availability=False,
+                 mediaType="eBook"),
+            dict(isbn=elsewhere.identifier.identifier, availability=True,
+                 mediaType="eBook"),
+        ]
+        monitor.api.queue_response(
+            status_code=200, content=json.dumps(availability)
+        )
+        eq_(3, monitor.process_availability())
+
+        # The title whose availability didn't change was left alone.
+        eq_([changed.identifier.identifier, elsewhere.identifier.identifier],
+            monitor.api.updated)
+        eq_(0, changed.licenses_available)
+
+        # The title that's new to this collection got a new
+        # LicensePool, and an analytics event for each library.
+        [new_pool] = [
+            x for x in elsewhere.identifier.licensed_through
+            if x.collection == self.collection
+        ]
+        eq_(1, new_pool.licenses_available)
+        eq_([(new_pool, CirculationEvent.DISTRIBUTOR_TITLE_ADD)]
+            * len(self.collection.libraries), events)
+
 class TestRBFulfillmentInfo(RBDigitalAPITest):
 
     def test_fulfill_part(self):
@@ -2304,13 +2480,17 @@ class TestRBDProxyController(ControllerTest):
                 credential.expires = datetime.datetime.utcnow()+datetime.timedelta(minutes=30)
                 return credential
 
-            def patron_fulfillment_request(self, patron, url, reauthorize=None):
+            def patron_fulfillment_request(self, patron, url, reauthorize=None,
+                                           extra_headers=None, stream=False):
                 class Response:
                     def __init__(self, **kwargs):
                         self.__dict__.update(kwargs)
 
                 response = Response(**dict(
-                    content=json.dumps({"request_url": url, "reauthorize": reauthorize}),
+                    content=json.dumps({
+                        "request_url": url, "reauthorize": reauthorize,
+                        "extra_headers": extra_headers, "stream": stream,
+                    }),
                     status_code=200, headers={'Content-Type': 'application/json'},
                 ))
                 return response
@@ -2327,7 +2507,10 @@ class TestRBDProxyController(ControllerTest):
         eq_(403, response.status_code)
 
         # Valid URL and valid token. We need our mock api for this one.
-        with self.app.test_request_context('/?url={}'.format(downloadUrl)):
+        with self.app.test_request_context(
+            '/?url={}'.format(downloadUrl),
+            headers={"Range": "bytes=0-99", "Cookie": "yum"}
+        ):
             response = self.app.manager.rbdproxy.proxy(valid_bearer_token, api_class=MockAPI)
 
         expected_url = '{}{}'.format(MockAPI.PRODUCTION_BASE_URL, downloadUrl)
@@ -2338,3 +2521,7 @@ class TestRBDProxyController(ControllerTest):
         eq_(expected_url, response.json.get('request_url'))
         # We should not allow token reauthorization when proxying.
         eq_(False, response.json.get('reauthorize'))
+        # The response is streamed, and the client's Range header
+        # (but not its other headers) was passed along.
+        eq_(True, response.json.get('stream'))
+        eq_({"Range": "bytes=0-99"}, response.json.get('extra_headers'))
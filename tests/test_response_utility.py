@@ -0,0 +1,36 @@
+import zlib
+
+from nose.tools import (
+    eq_,
+    set_trace,
+)
+
+from api.util.response import ResponseUtility
+from core.testing import MockRequestsResponse
+from .test_streaming_proxy import remote_response
+
+
+class TestResponseUtility(object):
+
+    def test_body(self):
+        # A streamed response is read from the network, with its
+        # encoding undone, and closed afterwards.
+        remote = remote_response(
+            200, {"Content-Encoding": "deflate"}, zlib.compress("I am a book")
+        )
+        with ResponseUtility.body(remote) as body:
+            eq_("I am a book", body.read())
+        eq_(True, remote.raw.closed)
+
+        # A response that was already read into memory works too.
+        remote = MockRequestsResponse(200, {}, "content")
+        with ResponseUtility.body(remote) as body:
+            eq_("content", body.read())
+
+    def test_close(self):
+        remote = remote_response(200, {}, "I am a book")
+        ResponseUtility.close(remote)
+        eq_(True, remote.raw.closed)
+
+        # A response with no connection behind it is left alone.
+        ResponseUtility.close(object())
@@ -84,7 +84,10 @@ from core.util.flask_util import (
     OPDSFeedResponse
 )
 
-from api.marc import LibraryAnnotator as  MARCLibraryAnnotator
+from api.marc import (
+    LibraryAnnotator as MARCLibraryAnnotator,
+    LibraryMARCExporter,
+)
 
 from . import (
     DatabaseTest,
@@ -255,6 +258,65 @@ class TestCacheRepresentationPerLane(TestLaneScript):
         eq_((lane, facets2, page1), c3)
         eq_((lane, facets2, page2), c4)
 
+        # The time taken and size of each feed was recorded.
+        eq_(4, len(script.feed_metrics))
+        for seconds, size in script.feed_metrics:
+            eq_(len("mock response"), size)
+        assert script.metrics_summary().startswith(
+            "Feeds generated: 4. Total size: 52 bytes."
+        )
+
+    def test_worker_processes(self):
+        # If there's more than one worker, process_library divides the
+        # work into tasks and passes them into run_tasks.
+
+        class MockFacets(object):
+
+            def __init__(self, query):
+                self.query = query
+
+            @property
+            def query_string(self):
+                return self.query
+
+        class Mock(CacheRepresentationPerLane):
+            generated = []
+
+            def facets(self, lane):
+                yield MockFacets("facets1")
+                yield MockFacets("facets2")
+
+            def do_generate(self, lane, facets, pagination):
+                self.generated.append((lane, facets.query_string))
+                return Response("feed for %s" % facets.query_string)
+
+            def run_tasks(self, tasks):
+                self.tasks = tasks
+                # Rather than starting worker processes, run each task
+                # in this process.
+                for task in tasks:
+                    yield self.process_task(*task)
+
+        parent = self._lane(display_name="parent")
+        child = self._lane(display_name="child", parent=parent)
+        script = Mock(self._db, manager=object(), cmd_args=["--workers=2"])
+        eq_(2, script.workers)
+        script.process_library(self._default_library)
+
+        # Only the child lane is deep enough to be processed, and it
+        # has two sets of facets, so there are two tasks.
+        library_id = self._default_library.id
+        eq_([(library_id, child.id, 0), (library_id, child.id, 1)],
+            script.tasks)
+
+        # Each task generated one feed.
+        eq_([(child, "facets1"), (child, "facets2")], script.generated)
+        eq_([len("feed for facets1")]*2,
+            [size for seconds, size in script.feed_metrics])
+        assert script.metrics_summary().startswith(
+            "Feeds generated: 2. Total size: 32 bytes."
+        )
+
     def test_default_facets(self):
         # By default, do_generate will only be called once, with facets=None.
         script = CacheRepresentationPerLane(
@@ -538,7 +600,11 @@ class TestCacheOPDSGroupFeedPerLane(TestLaneScript):
         search_engine.bulk_update([work])
         with mock_search_index(search_engine):
             script = CacheOPDSGroupFeedPerLane(self._db, cmd_args=[])
-            script.do_run(cmd_args=[])
+            progress = script.do_run(cmd_args=[])
+
+        # A summary of the work done is stored with the script's
+        # Timestamp.
+        assert progress.achievements.startswith("Feeds generated: ")
 
         # The Lane object was disconnected from its database session
         # when the app server was initialized. Reconnect it.
@@ -590,10 +656,10 @@ class TestCacheMARCFiles(TestLaneScript):
         integration = self._external_integration(
             ExternalIntegration.MARC_EXPORT, ExternalIntegration.CATALOG_GOAL)
 
-        class MockMARCExporter(MARCExporter):
+        class MockMARCExporter(LibraryMARCExporter):
             called_with = []
 
-            def records(self, lane, annotator, mirror_integration, start_time=None):
+            def records_with_changes(self, lane, annotator, mirror_integration, start_time=None):
                 self.called_with += [(lane, annotator, mirror_integration, start_time)]
 
         exporter = MockMARCExporter(None, None, integration)
@@ -615,7 +681,7 @@ class TestCacheMARCFiles(TestLaneScript):
         script = CacheMARCFiles(self._db, cmd_args=[])
         script.process_lane(lane, exporter)
 
-        # If the script has never been run before, it runs the exporter once
+        # If the script has never been run before, it runs the exporter
         # to create a file with all records.
         eq_(1, len(exporter.called_with))
 
@@ -624,9 +690,13 @@ class TestCacheMARCFiles(TestLaneScript):
         eq_(the_linked_integration, exporter.called_with[0][2])
         eq_(None, exporter.called_with[0][3])
 
-        # If we have a cached file already, and it's old enough, the script will
-        # run the exporter twice, first to update that file and second to create
-        # a file with changes since that first file was originally created.
+        # The annotator looked up the library's settings ahead of time.
+        assert exporter.called_with[0][1]._values is not None
+
+        # If we have a cached file already, and it's old enough, the
+        # script will run the exporter with a start time, to update
+        # that file and also create a file with changes since that
+        # first file was originally created.
         exporter.called_with = []
         now = datetime.datetime.utcnow()
         yesterday = now - datetime.timedelta(days=1)
@@ -641,17 +711,12 @@ class TestCacheMARCFiles(TestLaneScript):
 
         script.process_lane(lane, exporter)
 
-        eq_(2, len(exporter.called_with))
+        eq_(1, len(exporter.called_with))
 
         eq_(lane, exporter.called_with[0][0])
         assert isinstance(exporter.called_with[0][1], MARCLibraryAnnotator)
         eq_(the_linked_integration, exporter.called_with[0][2])
-        eq_(None, exporter.called_with[0][3])
-
-        eq_(lane, exporter.called_with[1][0])
-        assert isinstance(exporter.called_with[1][1], MARCLibraryAnnotator)
-        eq_(the_linked_integration, exporter.called_with[1][2])
-        assert exporter.called_with[1][3] < last_week
+        assert exporter.called_with[0][3] < last_week
 
         # If we already have a recent cached file, the script won't do anything.
         cached.end_time = yesterday
@@ -663,18 +728,13 @@ class TestCacheMARCFiles(TestLaneScript):
         script = CacheMARCFiles(self._db, cmd_args=["--force"])
         script.process_lane(lane, exporter)
 
-        eq_(2, len(exporter.called_with))
+        eq_(1, len(exporter.called_with))
 
         eq_(lane, exporter.called_with[0][0])
         assert isinstance(exporter.called_with[0][1], MARCLibraryAnnotator)
         eq_(the_linked_integration, exporter.called_with[0][2])
-        eq_(None, exporter.called_with[0][3])
-
-        eq_(lane, exporter.called_with[1][0])
-        assert isinstance(exporter.called_with[1][1], MARCLibraryAnnotator)
-        eq_(the_linked_integration, exporter.called_with[1][2])
-        assert exporter.called_with[1][3] < yesterday
-        assert exporter.called_with[1][3] > last_week
+        assert exporter.called_with[0][3] < yesterday
+        assert exporter.called_with[0][3] > last_week
 
         # The update frequency can also be 0, in which case it will always run.
         ConfigurationSetting.for_library_and_externalintegration(
@@ -684,18 +744,13 @@ class TestCacheMARCFiles(TestLaneScript):
         script = CacheMARCFiles(self._db, cmd_args=[])
         script.process_lane(lane, exporter)
 
-        eq_(2, len(exporter.called_with))
+        eq_(1, len(exporter.called_with))
 
         eq_(lane, exporter.called_with[0][0])
         assert isinstance(exporter.called_with[0][1], MARCLibraryAnnotator)
         eq_(the_linked_integration, exporter.called_with[0][2])
-        eq_(None, exporter.called_with[0][3])
-
-        eq_(lane, exporter.called_with[1][0])
-        assert isinstance(exporter.called_with[1][1], MARCLibraryAnnotator)
-        eq_(the_linked_integration, exporter.called_with[1][2])
-        assert exporter.called_with[1][3] < yesterday
-        assert exporter.called_with[1][3] > last_week
+        assert exporter.called_with[0][3] < yesterday
+        assert exporter.called_with[0][3] > last_week
 
 
 
@@ -0,0 +1,140 @@
+from io import BytesIO
+import zlib
+
+import requests
+from requests.structures import CaseInsensitiveDict
+from urllib3.response import HTTPResponse
+
+from nose.tools import (
+    assert_raises,
+    eq_,
+    set_trace,
+)
+
+from api.streaming_proxy import StreamingProxy
+
+from core.testing import MockRequestsResponse
+from core.util.http import (
+    BadResponseException,
+    RemoteIntegrationException,
+)
+
+
+def remote_response(status_code, headers, body):
+    """Create a requests Response whose body hasn't been read yet."""
+    response = requests.models.Response()
+    response.status_code = status_code
+    response.headers = CaseInsensitiveDict(headers)
+    response.raw = HTTPResponse(
+        body=BytesIO(body), headers=headers, status=status_code,
+        preload_content=False
+    )
+    return response
+
+
+class MockSession(object):
+
+    def __init__(self):
+        self.requests = []
+        self.responses = []
+
+    def get(self, url, **kwargs):
+        self.requests.append((url, kwargs))
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+class TestStreamingProxy(object):
+
+    def setup(self):
+        self.session = MockSession()
+        self.proxy = StreamingProxy(self.session, chunk_size=4)
+
+    def test_shared_session(self):
+        session = StreamingProxy.shared_session()
+        assert isinstance(session, requests.Session)
+        eq_(session, StreamingProxy.shared_session())
+        eq_(session, StreamingProxy().session)
+
+    def test_client_headers(self):
+        headers = {
+            "Range": "bytes=0-99", "If-None-Match": '"abc"',
+            "Authorization": "Basic secret", "Cookie": "yum",
+        }
+        eq_({"Range": "bytes=0-99", "If-None-Match": '"abc"'},
+            StreamingProxy.client_headers(headers))
+
+    def test_proxy(self):
+        body = "0123456789"
+        self.session.responses.append(remote_response(
+            206, {
+                "Content-Type": "application/epub+zip",
+                "Content-Length": "10",
+                "Content-Range": "bytes 0-9/100",
+                "ETag": '"abc"',
+                "Transfer-Encoding": "chunked",
+            }, body
+        ))
+        response = self.proxy.proxy(
+            "http://books/1", headers={"Range": "bytes=0-9"}
+        )
+
+        # The request was made without reading the body.
+        [(url, kwargs)] = self.session.requests
+        eq_("http://books/1", url)
+        eq_({"Range": "bytes=0-9"}, kwargs['headers'])
+        eq_(True, kwargs['stream'])
+
+        # The status and most of the headers are passed along.
+        eq_(206, response.status_code)
+        eq_("application/epub+zip", response.headers['Content-Type'])
+        eq_("10", response.headers['Content-Length'])
+        eq_("bytes 0-9/100", response.headers['Content-Range'])
+        eq_('"abc"', response.headers['ETag'])
+        eq_(None, response.headers.get('Transfer-Encoding'))
+
+        # The body comes through a chunk at a time.
+        eq_(["0123", "4567", "89"], list(response.response))
+
+    def test_encoded_content_is_passed_through(self):
+        body = zlib.compress("I am a book")
+        self.session.responses.append(remote_response(
+            200, {"Content-Encoding": "deflate",
+                  "Content-Length": str(len(body))}, body
+        ))
+        response = self.proxy.proxy(
+            "http://books/1", content_type="application/vnd.adobe.adept+xml"
+        )
+        eq_("deflate", response.headers['Content-Encoding'])
+        eq_("application/vnd.adobe.adept+xml", response.headers['Content-Type'])
+        eq_(body, "".join(response.response))
+
+    def test_response_already_in_memory(self):
+        remote = MockRequestsResponse(
+            200, {"Content-Type": "text/plain", "Content-Length": "999"},
+            "content"
+        )
+        response = self.proxy.response(remote)
+        eq_(["content"], list(response.response))
+        eq_("text/plain", response.headers['Content-Type'])
+
+        # The Content-Length didn't describe the content we actually
+        # have, so it was dropped.
+        eq_(None, response.headers.get("Content-Length"))
+
+    def test_errors(self):
+        self.session.responses.append(
+            requests.exceptions.ConnectionError("Connection refused")
+        )
+        assert_raises(RemoteIntegrationException,
+                      self.proxy.get, "http://books/1")
+
+        self.session.responses.append(remote_response(503, {}, "oops"))
+        assert_raises(BadResponseException,
+                      self.proxy.get, "http://books/1")
+
+        # Client errors are the client's problem, and are passed along.
+        self.session.responses.append(remote_response(404, {}, "not found"))
+        eq_(404, self.proxy.get("http://books/1").status_code)